@@ -0,0 +1,109 @@
+'''
+Loading the acquisition scripts as modules
+    The scripts are plain files with SETTINGS constants at the top and a
+    per-script acquisition function; the benchmark and the multi-camera
+    controller import them from here, override settings, and count the
+    frames they wrote.
+'''
+import ast
+import importlib.util
+import os
+import re
+import types
+
+from astropy.io import fits
+
+from frame_spool import SpoolReader
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# frame files: per-frame FITS (plain or compressed) and burst cubes
+FRAME_FILE = re.compile(r'.+_(i\d+\.fits(\.fz)?|cube\.fits)$')
+
+# name: (script file, acquisition function)
+SCRIPTS = {
+    'totality': ('py_eclipse_spectrum.totality.py', 'acquire_hdr_images'),
+    'lucid_sequence': ('lucid_sequence_acquire.py', 'acquire_singlexp_images'),
+    'image_acquire': ('image_acquire_sequence.py', 'acquire_singlexp_images'),
+}
+
+
+def load_script(name, prefix='bench'):
+    '''
+    Import an acquisition script as a module. The simulated arena_api must be
+        installed first (or the camera SDK present). Script file names are
+        not valid module names, so the loader is given one explicitly.
+    '''
+    filename, _ = SCRIPTS[name]
+    spec = importlib.util.spec_from_file_location(f'{prefix}_{name}',
+                                                  os.path.join(SCRIPT_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def script_for_path(path):
+    '''
+    SCRIPTS key of an acquisition script file
+    '''
+    filename = os.path.basename(path)
+    for name, (script, _) in SCRIPTS.items():
+        if script == filename:
+            return name
+    raise ValueError(f'{filename} is not one of the acquisition scripts')
+
+
+def setting_name(module, name):
+    '''
+    Attribute holding a SETTINGS constant; scripts spell them lower or upper
+        case, and a lower case spelling can also be an imported module
+        (HDR_MERGE vs hdr_merge)
+    '''
+    for attr in (name, name.upper(), name.lower()):
+        if hasattr(module, attr) and not isinstance(getattr(module, attr), types.ModuleType):
+            return attr
+    return None
+
+
+def set_setting(module, name, value):
+    '''
+    Override a SETTINGS constant
+    '''
+    attr = setting_name(module, name)
+    if attr is not None:
+        setattr(module, attr, value)
+
+
+def get_setting(module, name):
+    attr = setting_name(module, name)
+    if attr is None:
+        raise AttributeError(name)
+    return getattr(module, attr)
+
+
+def parse_setting(text):
+    '''
+    NAME=VALUE from the command line; VALUE is a Python literal or a string
+    '''
+    name, _, value = text.partition('=')
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return name, value
+
+
+def count_frames(out_dir):
+    '''
+    Frames on disk: one per plain or compressed per-frame FITS file
+        (_i<n>.fits, _i<n>.fits.fz), NAXIS3 per burst cube (_cube.fits), valid
+        records per spool segment; HDR maps, stacks, spectra and the other
+        products are not frames
+    '''
+    frames = 0
+    for name in os.listdir(out_dir):
+        path = os.path.join(out_dir, name)
+        if name.endswith('.spool'):
+            frames += len(SpoolReader(path).records())
+        elif FRAME_FILE.match(name):
+            frames += fits.getheader(path).get('NAXIS3', 1) if name.endswith('_cube.fits') else 1
+    return frames
@@ -0,0 +1,237 @@
+'''
+Adaptive exposure control
+    The exposure ladder is a guess made before the run, and the sky
+    brightness changes by orders of magnitude within seconds around the
+    contacts. ExposureControl watches the frames of one rung of the ladder
+    (the shortest by default: the one that has to keep the highlights) and
+    scales the whole ladder between sequences so that rung's peak signal
+    stays in a target band:
+
+    - every frame of the reference rung is histogrammed from every stride-th
+      pixel of every stride-th row (stride 16: 20 k pixels of a 5 MP frame,
+      a few hundred microseconds). This runs as a frame pipeline sink on the
+      writer threads, so the trigger loop never waits for it
+    - peak signal = the PEAK_PERCENTILE of those pixels, saturation fraction =
+      their share at or above the saturation level
+    - before every sequence, ladder() looks at the last complete burst of the
+      reference rung: more than max_saturated of its pixels saturated halves
+      the exposures; a peak outside [low, high] of the full scale scales them
+      towards the middle of the band, by at most max_step; inside the band
+      nothing changes. The ratios between the rungs are kept. The writers
+      run a sequence or two behind the trigger loop, so the step is taken
+      from the scale the measured burst was taken at, not the current one.
+    - exposures stay within [min_us, max_us]; ExposureTime.max follows the
+      frame rate, so with software triggering the caller sets the frame rate
+      for the new longest exposure (couple_frame_rate()) and limits the
+      ladder to what that allows
+
+    Every adjustment is logged, kept in adjustments (write_log() saves them
+    as CSV), and header_state() is put in the metadata of the frames it
+    applies to (AESCALE, AESTEP, AEPEAK, AESATFR header cards).
+'''
+import csv
+import logging
+import threading
+import time
+
+import numpy as np
+
+from frame_statistics import MONO12_MAX, FrameStatistics
+
+logger = logging.getLogger(__name__)
+
+STRIDE = 16
+PEAK_PERCENTILE = 99.9
+LOG_FIELDS = ('seq', 'measured_seq', 'reason', 'peak', 'saturated_fraction', 'step', 'scale',
+              'exposures_us')
+
+
+def couple_frame_rate(nodes, longest_us):
+    '''
+    Set AcquisitionFrameRate for a ladder whose longest exposure is
+        longest_us, as acquire_hdr_images does at the start: 1 / longest
+        exposure, within the camera's range. A longer exposure than the
+        current one would not let the faster rate through, so ExposureTime is
+        brought down first. Returns the frame rate and the longest exposure
+        the camera allows at it.
+    '''
+    exposure = nodes['ExposureTime']
+    rate = nodes['AcquisitionFrameRate']
+    if exposure.value > longest_us:
+        exposure.value = longest_us
+    rate.value = min(max(1e6 / longest_us, rate.min), rate.max)
+    return rate.value, exposure.max
+
+
+class ExposureControl:
+    '''
+    Ladder scaling from the peak signal of a reference rung (see module
+        docstring). low and high are fractions of the full scale (saturation
+        minus dark); reference is the rung index watched, None for the
+        shortest exposure. log gets every adjustment (default: this module's
+        logger).
+    '''
+    stage = 'exposure_control'
+
+    def __init__(self, low=0.5, high=0.85, max_saturated=1e-3, max_step=4., min_us=None,
+                 max_us=None, reference=None, stride=STRIDE, percentile=PEAK_PERCENTILE,
+                 saturation=MONO12_MAX, dark=0., log=None):
+        if not 0 < low < high <= 1:
+            raise ValueError('Adaptive exposure band needs 0 < low < high <= 1')
+        self.low = low
+        self.high = high
+        self.max_saturated = max_saturated
+        self.max_step = max_step
+        self.min_us = min_us
+        self.max_us = max_us
+        self.reference = reference
+        self.percentile = percentile
+        self.saturation = saturation
+        self.dark = dark
+        self.log = log or logger.info
+        self.statistics = FrameStatistics(stride, saturation)
+        self.scale = 1.
+        self.adjustments = []
+        self._state = {'scale': 1., 'step': 1., 'peak': None, 'saturated': None}
+        self._references = {}
+        self._bursts = {}
+        self._latest = None
+        self._decided = None
+        self._lock = threading.Lock()
+        self.frames_observed = 0
+        self.observe_s = 0.
+
+    def _limit(self, exposure_us):
+        if self.min_us is not None:
+            exposure_us = max(exposure_us, self.min_us)
+        if self.max_us is not None:
+            exposure_us = min(exposure_us, self.max_us)
+        return exposure_us
+
+    def scaled(self, planned):
+        '''
+        planned exposures (microseconds) at the current scale
+        '''
+        return [self._limit(exposure * self.scale) for exposure in planned]
+
+    def ladder(self, seq, planned):
+        '''
+        Exposures for sequence seq: planned scaled after the latest complete
+            reference burst. Called by the trigger loop before the sequence.
+        '''
+        reference = self.reference
+        if reference is None:
+            reference = int(np.argmin(planned))
+        with self._lock:
+            latest = self._latest
+        if latest is not None and latest is not self._decided:
+            self._decided = latest
+            self._adjust(seq, planned, reference, *latest)
+        with self._lock:
+            self._references[seq] = (reference, self.scale)
+        return self.scaled(planned)
+
+    def _adjust(self, seq, planned, reference, measured_seq, measured_scale, peak, saturated):
+        full = self.saturation - self.dark
+        if saturated > self.max_saturated:
+            step, reason = 0.5, 'saturated'
+        elif peak < self.dark + self.low * full or peak > self.dark + self.high * full:
+            target = 0.5 * (self.low + self.high) * full
+            step = min(max(target / max(peak - self.dark, 1.), 1. / self.max_step), self.max_step)
+            reason = 'low' if step > 1 else 'high'
+        else:
+            step, reason = 1., None
+        # the scale the limits let through, on the reference rung
+        scale = self._limit(planned[reference] * measured_scale * step) / planned[reference]
+        step = scale / self.scale
+        if reason is None or abs(step - 1.) < 1e-3:
+            self._state = {'scale': self.scale, 'step': 1., 'peak': peak, 'saturated': saturated}
+            return
+        self.scale = scale
+        self._state = {'scale': scale, 'step': step, 'peak': peak, 'saturated': saturated}
+        exposures = self.scaled(planned)
+        self.adjustments.append({'seq': seq, 'measured_seq': measured_seq, 'reason': reason,
+                                 'peak': peak, 'saturated_fraction': saturated, 'step': step,
+                                 'scale': scale, 'exposures_us': exposures})
+        self.log(f"Adaptive exposure seq{seq}: peak {peak:.0f} DN, {100. * saturated:.3f}% "
+                 f"saturated in seq{measured_seq} ({reason}), x{step:.3f} -> "
+                 f"{', '.join(f'{exposure / 1000.:.3f}' for exposure in exposures)} ms")
+
+    def header_state(self):
+        '''
+        Scale, last step and the measurement behind it, for the frame
+            metadata (frame_pipeline.frame_header_cards)
+        '''
+        return dict(self._state)
+
+    def measure(self, frame):
+        '''
+        (peak, saturated fraction) from the decimated histogram of a frame
+        '''
+        counts = self.statistics.histogram(frame)[:self.saturation + 1]
+        cumulative = np.cumsum(counts)
+        pixels = self.statistics.pixels(frame).size
+        peak = float(np.searchsorted(cumulative, pixels * self.percentile / 100.))
+        saturated = (pixels - cumulative[self.saturation - 1]) / pixels
+        return peak, float(saturated)
+
+    def write(self, frame, meta):
+        with self._lock:
+            reference, scale = self._references.get(meta['seq'], (None, None))
+        if reference is None or meta.get('exp_index') != reference:
+            return
+        t = time.perf_counter()
+        peak, saturated = self.measure(frame)
+        elapsed = time.perf_counter() - t
+        with self._lock:
+            self.frames_observed += 1
+            self.observe_s += elapsed
+            self._add(meta, reference, scale, (peak, saturated))
+
+    def dropped(self, meta):
+        '''
+        A reference frame the backpressure policy dropped: the burst is
+            measured on the frames that were written
+        '''
+        with self._lock:
+            reference, scale = self._references.get(meta['seq'], (None, None))
+            if reference is not None and meta.get('exp_index') == reference:
+                self._add(meta, reference, scale, None)
+
+    def _add(self, meta, reference, scale, measurement):
+        # called with the lock held
+        key = (meta['seq'], reference)
+        burst = self._bursts.setdefault(key, [])
+        burst.append(measurement)
+        if len(burst) < meta['burst_size']:
+            return
+        del self._bursts[key]
+        measured = [m for m in burst if m is not None]
+        if measured:
+            peaks, fractions = zip(*measured)
+            self._latest = (meta['seq'], scale, float(np.median(peaks)),
+                            float(np.mean(fractions)))
+
+    def close(self):
+        pass
+
+    def write_log(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(LOG_FIELDS)
+            for a in self.adjustments:
+                writer.writerow([a['seq'], a['measured_seq'], a['reason'], f"{a['peak']:.1f}",
+                                 f"{a['saturated_fraction']:.6f}", f"{a['step']:.4f}",
+                                 f"{a['scale']:.4f}",
+                                 ' '.join(f'{exposure:.1f}' for exposure in a['exposures_us'])])
+
+    def summary(self):
+        return {'adjustments': len(self.adjustments), 'scale': self.scale,
+                'frames_observed': self.frames_observed,
+                'observe_us_mean': 1e6 * self.observe_s / max(self.frames_observed, 1)}
+
+    def report(self):
+        s = self.summary()
+        return (f"Adaptive exposure: {s['adjustments']} adjustments, ladder x{s['scale']:.3f} of "
+                f"the plan; {s['frames_observed']} frames measured, "
+                f"{s['observe_us_mean']:.0f} us each")
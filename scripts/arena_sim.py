@@ -0,0 +1,661 @@
+'''
+Simulated Lucid camera backend
+    Drop-in stand-in for the parts of ``arena_api`` the acquisition scripts use
+    (``arena_api.system.system``, devices, nodemaps, nodes and buffers), so the
+    frame loops can be exercised and timed without a camera plugged in.
+
+    The model is deliberately simple but keeps the timing behaviour that matters
+    for frame rate:
+    - Mono12 frames (12-bit values in 16-bit containers) of configurable size,
+      or Mono12p / Mono12Packed (two pixels in three bytes, less link time)
+    - exposure-dependent delivery: a frame arrives after its exposure, the
+      sensor readout and the transfer over the link
+    - ``TriggerArmed`` only goes true once the sensor can accept a new trigger
+      (exposure finished and the ``AcquisitionFrameRate`` period elapsed)
+    - a new ``ExposureTime`` only takes effect on the frame after the next one,
+      which is why the scripts throw away one frame after every change
+    - ``ExposureTime.max`` follows ``AcquisitionFrameRate`` like on the Tritons
+    - with ``TriggerMode`` Off the sensor free-runs: a producer thread starts a
+      frame every max(exposure, 1 / AcquisitionFrameRate); frames that find no
+      free stream buffer are dropped according to ``StreamBufferHandlingMode``
+      and a fraction of buffers can be delivered incomplete
+    - a sequencer (SequencerMode/SequencerConfigurationMode/SequencerSet*) whose
+      sets hold an ExposureTime and the next set; with SequencerMode On each
+      frame takes the exposure of the active set with no frame of delay
+    - frame IDs count from 1 after every start_stream, like GigE Vision block IDs
+    - StreamLostFrameCount / StreamIncompleteFrameCount in the stream nodemap
+      count the dropped and incomplete frames
+    - a camera clock (ns since the device was opened, optionally running
+      clock_drift_ppm fast) readable with TimestampLatch/TimestampLatchValue,
+      and chunk data (ChunkModeActive, ChunkSelector, ChunkEnable) carrying
+      the exposure-start Timestamp, ExposureTime, FrameID and
+      SequencerSetActive of every buffer
+
+Usage:
+    import arena_sim
+    arena_sim.install(width=2448, height=2048)
+    from arena_api.system import system     # now the simulated system
+'''
+import ctypes
+import sys
+import threading
+import time
+import types
+
+import numpy as np
+
+from mono12_packed import is_packed, pack_mono12
+
+MONO12_MAX = 4095
+SEQUENCER_SETS = 8
+CHUNKS = ('Timestamp', 'ExposureTime', 'FrameID', 'SequencerSetActive')
+BITS_PER_PIXEL = {'Mono8': 8, 'Mono12': 16, 'Mono12p': 12, 'Mono12Packed': 12, 'Mono16': 16}
+
+
+class CameraModel:
+    '''
+    Sensor, timing and scene parameters of a simulated camera. Times are in
+        microseconds like the GenICam nodes, bandwidth in bytes per second.
+    '''
+
+    def __init__(self, width=2448, height=2048, max_frame_rate=24.0,
+                readout_us=20000.0, exposure_overhead_us=30.0,
+                link_bytes_per_s=115e6, scene='corona', dark_level=100.0,
+                full_well_exposure_us=250000.0, serial='SIM0000',
+                model_name='TRI050S-M (simulated)', incomplete_fraction=0.0,
+                clock_drift_ppm=0.0):
+        self.width = width
+        self.height = height
+        self.max_frame_rate = max_frame_rate
+        self.readout_us = readout_us
+        self.exposure_overhead_us = exposure_overhead_us
+        self.link_bytes_per_s = link_bytes_per_s
+        self.scene = scene
+        self.dark_level = dark_level
+        self.full_well_exposure_us = full_well_exposure_us
+        self.serial = serial
+        self.model_name = model_name
+        self.clock_drift_ppm = clock_drift_ppm
+        self.incomplete_fraction = incomplete_fraction
+
+
+def scene_pattern(scene, height, width):
+    '''
+    Noise-free signal pattern in [0, 1] (fraction of full well reached at
+        ``full_well_exposure_us``)
+    '''
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    if scene == 'corona':
+        # occulted disk with a radially falling corona and a few streamers
+        r = np.hypot(x - width / 2., y - height / 2.) / (0.2 * min(width, height))
+        theta = np.arctan2(y - height / 2., x - width / 2.)
+        pattern = np.where(r < 1., 0.02, np.maximum(r, 1e-3) ** -2.5 * (1. + 0.3 * np.cos(4 * theta) ** 8))
+    elif scene == 'spectrum':
+        # slit spectrum: a bright band along x with broad absorption lines
+        profile = np.exp(-0.5 * ((y - height / 2.) / (0.15 * height)) ** 2)
+        lines = np.ones(width, dtype=np.float32)
+        for center in np.linspace(0.1, 0.9, 7) * width:
+            lines -= 0.4 * np.exp(-0.5 * ((np.arange(width) - center) / (0.01 * width)) ** 2)
+        pattern = 0.9 * profile * lines[np.newaxis, :]
+    else:
+        pattern = np.full((height, width), 0.5, dtype=np.float32)
+    return np.clip(pattern, 0., 1.).astype(np.float32)
+
+
+class SimNode:
+    '''
+    Minimal GenICam node: value/min/max/is_writable/is_readable and execute()
+        for command nodes. ``min``/``max`` may be callables so ranges can depend
+        on other nodes, ``on_write`` lets the device react to writes. Every
+        access from outside (value, min, max, is_writable, execute) counts as
+        one camera transaction in reads/writes.
+    '''
+
+    def __init__(self, name, value=None, min=None, max=None, writable=True,
+                readable=True, entries=None, getter=None, on_write=None,
+                command=None):
+        self.name = name
+        self._value = value
+        self._min = min
+        self._max = max
+        self._writable = writable
+        self._readable = readable
+        self.enumentry_names = entries
+        self._getter = getter
+        self._on_write = on_write
+        self._command = command
+        self.reads = 0
+        self.writes = 0
+
+    @property
+    def value(self):
+        self.reads += 1
+        if self._getter is not None:
+            return self._getter()
+        return self._value
+
+    @value.setter
+    def value(self, new_value):
+        self.writes += 1
+        if not self._get(self._writable):
+            raise ValueError(f'Node {self.name} is not writable')
+        if self.enumentry_names is not None and new_value not in self.enumentry_names:
+            raise ValueError(f'{new_value!r} is not a valid entry for {self.name}')
+        low, high = self._get(self._min), self._get(self._max)
+        if low is not None and new_value < low:
+            raise ValueError(f'{self.name}={new_value} is below the minimum {low}')
+        if high is not None and new_value > high:
+            raise ValueError(f'{self.name}={new_value} is above the maximum {high}')
+        self._value = new_value
+        if self._on_write is not None:
+            self._on_write(new_value)
+
+    @staticmethod
+    def _get(attribute):
+        return attribute() if callable(attribute) else attribute
+
+    @property
+    def min(self):
+        self.reads += 1
+        return self._get(self._min)
+
+    @property
+    def max(self):
+        self.reads += 1
+        return self._get(self._max)
+
+    @property
+    def is_writable(self):
+        self.reads += 1
+        return self._get(self._writable)
+
+    @property
+    def is_readable(self):
+        return self._readable
+
+    def execute(self):
+        self.writes += 1
+        if self._command is None:
+            raise ValueError(f'Node {self.name} is not a command node')
+        self._command()
+
+
+class SimNodeMap:
+    '''
+    Dictionary of SimNodes with the arena_api nodemap access style
+    '''
+
+    def __init__(self, nodes=()):
+        self._nodes = {node.name: node for node in nodes}
+
+    def add(self, node):
+        self._nodes[node.name] = node
+        return node
+
+    def get_node(self, names):
+        if isinstance(names, str):
+            return self._nodes.get(names)
+        return {name: self._nodes.get(name) for name in names}
+
+    def __getitem__(self, name):
+        return self._nodes[name]
+
+    def __contains__(self, name):
+        return name in self._nodes
+
+    @property
+    def transactions(self):
+        return sum(node.reads + node.writes for node in self._nodes.values())
+
+
+class SimBuffer:
+    '''
+    Image buffer handed out by SimDevice.get_buffer(). ``pdata`` points at
+        the frame bytes like arena_api's buffer does.
+    '''
+
+    def __init__(self, data, width, height, pixel_format, frame_id=0,
+                timestamp_ns=0, exposure_us=0.0):
+        self._data = data
+        self.width = width
+        self.height = height
+        self.pixel_format = pixel_format
+        self.bits_per_pixel = BITS_PER_PIXEL[pixel_format]
+        self.frame_id = frame_id
+        self.timestamp_ns = timestamp_ns
+        self.exposure_us = exposure_us
+        self.is_incomplete = False
+        self.size_filled = data.nbytes
+        self.pdata = data.ctypes.data_as(ctypes.POINTER(ctypes.c_ubyte))
+        self.chunks = {}
+
+    @property
+    def has_chunkdata(self):
+        return bool(self.chunks)
+
+    def get_chunk(self, names):
+        '''
+        Chunk nodes (ChunkTimestamp, ChunkExposureTime, ChunkFrameID, ...) of the
+            buffer by name, None for chunks that were not enabled
+        '''
+        return {name: SimNode(name, self.chunks[name], writable=False)
+                if name in self.chunks else None for name in names}
+
+
+class BufferFactory:
+    '''
+    Stand-in for arena_api.buffer.BufferFactory
+    '''
+
+    @staticmethod
+    def copy(buffer):
+        copy = SimBuffer(buffer._data.copy(), buffer.width, buffer.height,
+                        buffer.pixel_format, buffer.frame_id,
+                        buffer.timestamp_ns, buffer.exposure_us)
+        copy.chunks = dict(buffer.chunks)
+        return copy
+
+    @staticmethod
+    def destroy(buffer):
+        buffer._data = None
+        buffer.pdata = None
+
+
+class SimDevice:
+    '''
+    Simulated camera. Frames are produced by software triggers, or by a
+        free-running producer thread when TriggerMode is Off; their delivery
+        time is computed from the exposure, readout and link transfer, and
+        get_buffer() sleeps until then.
+    '''
+
+    def __init__(self, model):
+        self.model = model
+        self._clock_origin = time.perf_counter()
+        self._lock = threading.Condition()
+        self._streaming = False
+        self._free_buffers = 0
+        self._pending = []
+        self._outstanding = {}
+        self._armed_at = 0.
+        self._link_free_at = 0.
+        self._frame_id = 0
+        self._active_exposure = 10000.
+        self._templates = {}
+        self._producer = None
+        self._rng = np.random.default_rng(0)
+        self.frame_log = {}
+        self.dropped_frames = 0
+        self.incomplete_buffers = 0
+        self.ignored_triggers = 0
+        self._sequencer_sets = {}
+        self._sequencer_active = 0
+        self._chunk_enable = {name: False for name in CHUNKS}
+        self._timestamp_latch = 0
+        self.nodemap = self._build_nodemap()
+        # start at the fastest rate the default format allows
+        self.nodemap['AcquisitionFrameRate']._value = self._max_frame_rate()
+        self.tl_stream_nodemap = SimNodeMap([
+            SimNode('StreamAutoNegotiatePacketSize', True),
+            SimNode('StreamPacketResendEnable', True),
+            SimNode('StreamBufferHandlingMode', 'OldestFirst',
+                    entries=['OldestFirst', 'OldestFirstOverwrite', 'NewestOnly']),
+            SimNode('StreamLostFrameCount', getter=lambda: self.dropped_frames, writable=False),
+            SimNode('StreamIncompleteFrameCount', getter=lambda: self.incomplete_buffers,
+                    writable=False),
+        ])
+        self.tl_device_nodemap = SimNodeMap()
+
+    def _build_nodemap(self):
+        m = self.model
+        nodemap = SimNodeMap()
+        add = nodemap.add
+        add(SimNode('DeviceSerialNumber', m.serial, writable=False))
+        add(SimNode('DeviceModelName', m.model_name, writable=False))
+        add(SimNode('TriggerSelector', 'FrameStart', entries=['FrameStart']))
+        add(SimNode('TriggerMode', 'Off', entries=['Off', 'On']))
+        add(SimNode('TriggerSource', 'Software',
+                    entries=['Software', 'Line0', 'Line2', 'Line3']))
+        add(SimNode('TriggerSoftware', command=self._software_trigger))
+        add(SimNode('TriggerArmed', getter=self._is_armed, writable=False))
+        add(SimNode('ExposureAuto', 'Continuous', entries=['Off', 'Once', 'Continuous']))
+        add(SimNode('ExposureTime', 10000., min=m.exposure_overhead_us,
+                    max=self._max_exposure,
+                    writable=lambda: nodemap['ExposureAuto']._value == 'Off'))
+        add(SimNode('PixelFormat', 'Mono8',
+                    entries=['Mono8', 'Mono12', 'Mono12p', 'Mono12Packed', 'Mono16'],
+                    writable=lambda: not self._streaming))
+        add(SimNode('Width', m.width, min=16, max=m.width,
+                    writable=lambda: not self._streaming))
+        add(SimNode('Height', m.height, min=16, max=m.height,
+                    writable=lambda: not self._streaming))
+        add(SimNode('AcquisitionMode', 'Continuous',
+                    entries=['Continuous', 'SingleFrame', 'MultiFrame']))
+        add(SimNode('AcquisitionFrameRateEnable', False))
+        add(SimNode('AcquisitionFrameRate', m.max_frame_rate, min=0.1,
+                    max=self._max_frame_rate,
+                    writable=lambda: bool(nodemap['AcquisitionFrameRateEnable']._value)))
+        configuring = lambda: nodemap['SequencerConfigurationMode']._value == 'On'
+        add(SimNode('SequencerMode', 'Off', entries=['Off', 'On'],
+                    writable=lambda: not configuring(), on_write=self._sequencer_mode))
+        add(SimNode('SequencerConfigurationMode', 'Off', entries=['Off', 'On'],
+                    writable=lambda: nodemap['SequencerMode']._value == 'Off'))
+        add(SimNode('SequencerSetSelector', 0, min=0, max=SEQUENCER_SETS - 1,
+                    writable=configuring))
+        add(SimNode('SequencerSetSave', command=self._sequencer_save))
+        add(SimNode('SequencerPathSelector', 0, min=0, max=1, writable=configuring))
+        add(SimNode('SequencerSetNext', 0, min=0, max=SEQUENCER_SETS - 1, writable=configuring))
+        add(SimNode('SequencerTriggerSource', 'FrameEnd', entries=['Off', 'FrameEnd'],
+                    writable=configuring))
+        add(SimNode('SequencerSetStart', 0, min=0, max=SEQUENCER_SETS - 1,
+                    writable=lambda: nodemap['SequencerMode']._value == 'Off'))
+        add(SimNode('SequencerSetActive', getter=lambda: self._sequencer_active,
+                    writable=False))
+        add(SimNode('TimestampLatch', command=self._latch_timestamp))
+        add(SimNode('TimestampLatchValue', getter=lambda: self._timestamp_latch,
+                    writable=False))
+        add(SimNode('ChunkModeActive', False, writable=lambda: not self._streaming))
+        add(SimNode('ChunkSelector', CHUNKS[0], entries=list(CHUNKS)))
+        add(SimNode('ChunkEnable', False,
+                    getter=lambda: self._chunk_enable[self._node('ChunkSelector')],
+                    writable=lambda: not self._streaming,
+                    on_write=lambda value: self._chunk_enable.__setitem__(
+                        self._node('ChunkSelector'), bool(value))))
+        return nodemap
+
+    def camera_time_ns(self, t=None):
+        '''
+        Camera clock at perf_counter time t (default now)
+        '''
+        elapsed = (self._now() if t is None else t) - self._clock_origin
+        return int(elapsed * 1e9 * (1. + self.model.clock_drift_ppm * 1e-6))
+
+    def _latch_timestamp(self):
+        self._timestamp_latch = self.camera_time_ns()
+
+    def _sequencer_save(self):
+        if self._node('SequencerConfigurationMode') != 'On':
+            raise ValueError('SequencerSetSave needs SequencerConfigurationMode On')
+        self._sequencer_sets[self._node('SequencerSetSelector')] = {
+            'exposure_us': self._node('ExposureTime'),
+            'next': self._node('SequencerSetNext'),
+            'advance': self._node('SequencerTriggerSource') == 'FrameEnd'}
+
+    def _sequencer_mode(self, mode):
+        if mode == 'On':
+            if self._node('SequencerSetStart') not in self._sequencer_sets:
+                raise ValueError('SequencerSetStart refers to a set that was never saved')
+            self._sequencer_active = self._node('SequencerSetStart')
+
+    def _now(self):
+        return time.perf_counter()
+
+    def _node(self, name):
+        return self.nodemap[name]._value
+
+    def _max_exposure(self):
+        if self._node('AcquisitionFrameRateEnable'):
+            return 1e6 / self._node('AcquisitionFrameRate') - self.model.exposure_overhead_us
+        return 10e6
+
+    def _max_frame_rate(self):
+        '''
+        Limited by the sensor, the exposure and, like DeviceLinkThroughputLimit
+            on the real cameras, by the link bandwidth
+        '''
+        period_us = self._node('ExposureTime') + self.model.exposure_overhead_us
+        link_rate = self.model.link_bytes_per_s / self._frame_bytes()
+        return min(self.model.max_frame_rate, 1e6 / period_us, link_rate)
+
+    def _frame_period(self):
+        if self._node('AcquisitionFrameRateEnable'):
+            return 1. / self._node('AcquisitionFrameRate')
+        return 1. / min(self.model.max_frame_rate,
+                        self.model.link_bytes_per_s / self._frame_bytes())
+
+    def _is_armed(self):
+        return (self._streaming and self._node('TriggerMode') == 'On'
+                and self._now() >= self._armed_at)
+
+    def _frame_bytes(self):
+        bits = BITS_PER_PIXEL[self._node('PixelFormat')]
+        return self._node('Width') * self._node('Height') * bits // 8
+
+    def _template(self, exposure_us):
+        '''
+        Cached frame for an exposure time, so producing a frame costs nothing
+        '''
+        width = self._node('Width')
+        height = self._node('Height')
+        key = (exposure_us, width, height)
+        if key not in self._templates:
+            if len(self._templates) > 8:
+                self._templates.clear()
+            pattern = scene_pattern(self.model.scene, height, width)
+            signal = pattern * (MONO12_MAX * exposure_us / self.model.full_well_exposure_us)
+            rng = np.random.default_rng(int(exposure_us))
+            signal += self.model.dark_level + rng.normal(0., 4., signal.shape)
+            signal += rng.normal(0., 1., signal.shape) * np.sqrt(np.maximum(signal, 0.))
+            self._templates[key] = np.clip(np.rint(signal), 0, MONO12_MAX).astype(np.uint16)
+        return self._templates[key]
+
+    def _buffer_data(self, exposure_us):
+        '''
+        Bytes sent for a frame: the template, packed for the packed formats
+        '''
+        pixel_format = self._node('PixelFormat')
+        if not is_packed(pixel_format):
+            return self._template(exposure_us)
+        key = (exposure_us, self._node('Width'), self._node('Height'), pixel_format)
+        if key not in self._templates:
+            self._templates[key] = pack_mono12(self._template(exposure_us), pixel_format)
+        return self._templates[key]
+
+    def _software_trigger(self):
+        now = self._now()
+        if not self._is_armed():
+            self.ignored_triggers += 1
+            return
+        self._expose(now)
+
+    def _buffer_handling_mode(self):
+        return self.tl_stream_nodemap['StreamBufferHandlingMode']._value
+
+    def _free_run(self):
+        '''
+        Producer thread: while TriggerMode is Off a new exposure starts as soon
+            as the sensor is ready for it
+        '''
+        next_start = self._now()
+        while self._streaming:
+            if self._node('TriggerMode') != 'Off':
+                time.sleep(0.001)
+                next_start = self._now()
+                continue
+            now = self._now()
+            if now < next_start:
+                time.sleep(min(next_start - now, 0.01))
+                continue
+            self._expose(next_start)
+            next_start = self._armed_at
+
+    def _expose(self, start):
+        '''
+        Schedule one frame exposed from ``start``
+        '''
+        active_set = self._sequencer_active
+        if self._node('SequencerMode') == 'On':
+            # the sequencer switches sets between frames, no frame of delay
+            sequencer_set = self._sequencer_sets[active_set]
+            exposure_us = sequencer_set['exposure_us']
+            if sequencer_set['advance']:
+                self._sequencer_active = sequencer_set['next']
+        else:
+            exposure_us = self._active_exposure
+            # a new exposure setting is picked up after the frame in flight
+            self._active_exposure = self._node('ExposureTime')
+        self._armed_at = start + max((exposure_us + self.model.exposure_overhead_us) * 1e-6,
+                                    self._frame_period())
+        readout_done = start + (exposure_us + self.model.readout_us) * 1e-6
+        self._link_free_at = (max(self._link_free_at, readout_done)
+                            + self._frame_bytes() / self.model.link_bytes_per_s)
+        self._frame_id += 1
+        with self._lock:
+            if self._free_buffers > 0:
+                self._free_buffers -= 1
+            elif self._buffer_handling_mode() == 'OldestFirstOverwrite' and self._pending:
+                # the oldest undelivered frame's buffer is reused for this one
+                self._pending.pop(0)
+                self.dropped_frames += 1
+            else:
+                self.dropped_frames += 1
+                return
+            buffer = SimBuffer(self._buffer_data(exposure_us), self._node('Width'),
+                            self._node('Height'), self._node('PixelFormat'),
+                            frame_id=self._frame_id,
+                            timestamp_ns=self.camera_time_ns(start),
+                            exposure_us=exposure_us)
+            if self._node('ChunkModeActive'):
+                values = {'Timestamp': buffer.timestamp_ns, 'ExposureTime': exposure_us,
+                          'FrameID': self._frame_id, 'SequencerSetActive': active_set}
+                buffer.chunks = {f'Chunk{name}': values[name] for name in CHUNKS
+                                 if self._chunk_enable[name]}
+            if self._rng.random() < self.model.incomplete_fraction:
+                buffer.is_incomplete = True
+                self.incomplete_buffers += 1
+            self.frame_log[self._frame_id] = {'trigger': start,
+                                            'delivered': self._link_free_at,
+                                            'exposure_us': exposure_us}
+            self._pending.append((self._link_free_at, buffer))
+            self._lock.notify_all()
+
+    def start_stream(self, number_of_buffers=10):
+        if self._streaming:
+            raise RuntimeError('Stream already started')
+        self._streaming = True
+        self._free_buffers = number_of_buffers
+        self._pending = []
+        self._outstanding = {}
+        self._frame_id = 0
+        self.frame_log = {}
+        self._active_exposure = self._node('ExposureTime')
+        self._armed_at = self._now()
+        if self._node('SequencerMode') == 'On':
+            self._sequencer_active = self._node('SequencerSetStart')
+        self._producer = threading.Thread(target=self._free_run, name='sim-free-run',
+                                          daemon=True)
+        self._producer.start()
+
+    def stop_stream(self):
+        self._streaming = False
+        if self._producer is not None:
+            self._producer.join()
+            self._producer = None
+        with self._lock:
+            self._pending = []
+            self._lock.notify_all()
+
+    def get_buffer(self, number_of_buffers=1, timeout=None):
+        '''
+        Wait for the next delivered frame. ``timeout`` is in milliseconds.
+        '''
+        deadline = None if timeout is None else self._now() + timeout / 1000.
+        with self._lock:
+            while not self._pending:
+                if not self._streaming:
+                    raise RuntimeError('Stream is not started')
+                remaining = None if deadline is None else deadline - self._now()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError('No buffer delivered within the timeout')
+                self._lock.wait(remaining if remaining is not None else 0.1)
+            if self._buffer_handling_mode() == 'NewestOnly':
+                # hand out the newest delivered frame, older ones are dropped
+                now = self._now()
+                while len(self._pending) > 1 and self._pending[1][0] <= now:
+                    self._pending.pop(0)
+                    self._free_buffers += 1
+                    self.dropped_frames += 1
+            delivered, buffer = self._pending.pop(0)
+        wait = delivered - self._now()
+        if wait > 0:
+            time.sleep(wait)
+        self.frame_log[buffer.frame_id]['fetched'] = self._now()
+        self._outstanding[buffer.frame_id] = buffer
+        if number_of_buffers != 1:
+            return [buffer] + [self.get_buffer(1, timeout) for _ in range(number_of_buffers - 1)]
+        return buffer
+
+    def requeue_buffer(self, buffer):
+        buffers = buffer if isinstance(buffer, list) else [buffer]
+        now = self._now()
+        with self._lock:
+            for buf in buffers:
+                if self._outstanding.pop(buf.frame_id, None) is None:
+                    raise ValueError('Buffer was not handed out by this device')
+                self.frame_log[buf.frame_id]['requeued'] = now
+                self._free_buffers += 1
+
+
+class SimSystem:
+    '''
+    Stand-in for arena_api.system.system
+    '''
+
+    def __init__(self):
+        self.models = [CameraModel()]
+        self._devices = []
+
+    def configure(self, num_devices=1, **model_kwargs):
+        '''
+        Set how many cameras are "connected" and their CameraModel parameters
+        '''
+        self.models = []
+        for n in range(num_devices):
+            kwargs = dict(model_kwargs)
+            kwargs.setdefault('serial', f'SIM{n:04d}')
+            self.models.append(CameraModel(**kwargs))
+
+    @property
+    def device_infos(self):
+        return [{'model': m.model_name, 'serial': m.serial, 'vendor': 'Lucid Vision Labs (simulated)'}
+                for m in self.models]
+
+    def create_device(self, device_infos=None):
+        serials = None
+        if device_infos is not None:
+            serials = {info['serial'] for info in device_infos}
+        devices = [SimDevice(m) for m in self.models
+                if serials is None or m.serial in serials]
+        self._devices.extend(devices)
+        return devices
+
+    def destroy_device(self, device=None):
+        devices = self._devices if device is None else [device]
+        for dev in list(devices):
+            if dev._streaming:
+                dev.stop_stream()
+            if dev in self._devices:
+                self._devices.remove(dev)
+
+
+system = SimSystem()
+
+
+def install(num_devices=1, **model_kwargs):
+    '''
+    Register the simulated backend as ``arena_api`` in sys.modules so that
+        ``from arena_api.system import system`` picks it up. Returns the system.
+    '''
+    system.configure(num_devices, **model_kwargs)
+    package = types.ModuleType('arena_api')
+    package.__path__ = []
+    system_module = types.ModuleType('arena_api.system')
+    system_module.system = system
+    buffer_module = types.ModuleType('arena_api.buffer')
+    buffer_module.BufferFactory = BufferFactory
+    package.system = system_module
+    package.buffer = buffer_module
+    sys.modules['arena_api'] = package
+    sys.modules['arena_api.system'] = system_module
+    sys.modules['arena_api.buffer'] = buffer_module
+    return system
@@ -0,0 +1,370 @@
+'''
+Backpressure and dropped-frame accounting
+    When the disk falls behind the camera, the writer threads fall behind, the
+    frame pool fills up and something has to give. FrameWritePipeline asks a
+    Backpressure policy before a frame is copied into a pool slot:
+
+    block     wait for a free slot (the original behaviour): no frame is lost,
+              but the trigger loop stalls and the cadence slips. Every wait
+              is recorded as a delayed frame.
+    drop      never wait: a frame that finds every slot taken is dropped and
+              its camera buffer requeued at once
+    decimate  keep the cadence and shed load evenly: at the start of every
+              burst a decimation level (1, 2, 4, ... up to max_decimate) is
+              picked and only every level-th frame of the burst is kept. The
+              level doubles when the pool fill reaches high or the frames
+              arrive faster than the writers write them, and halves once the
+              fill is down to low and the writers would keep up at the lower
+              level. Kept frames keep their frame_index (file names, spool
+              index and manifest stay seq/exp/frame_index) and carry
+              decimation for the DECIMATE header card; the frames left out are
+              marked decimated and counted toward their burst like dropped
+              ones, so the burst sinks complete with them missing. A frame
+              that still finds every slot taken is dropped.
+
+    The write rate is measured on the writer threads (seconds per frame
+    through the statistics and every sink, with the writers working in
+    parallel), the arrival rate from the intervals between offered frames.
+
+    Every dropped, decimated or delayed frame is kept in events, write_log()
+    saves them as CSV and report() sums them up.
+
+    DiskPreflight is the pre-flight check of the output disk: it writes and
+    fsyncs a test file to measure the sustained write rate and estimates how
+    many sequences fit in the free space, and whether the disk keeps up with
+    the sequence cadence.
+
+Usage:
+    python backpressure.py D:/Annular2023/spectra --frames-per-seq 30 --seq-seconds 3.5
+    python backpressure.py /data --width 2448 --height 2048 --output rice --mb 256
+'''
+import argparse
+import csv
+import logging
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from frame_pipeline import FITS_BLOCK
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ('block', 'drop', 'decimate')
+RATE_WEIGHT = 0.2           # weight of the newest sample in the rate averages
+PREFLIGHT_FILE = '.disk_preflight.tmp'
+PREFLIGHT_CHUNK = 8 * 1024 * 1024
+LOG_FIELDS = ('time_s', 'seq', 'exp_index', 'frame_index', 'action', 'level', 'fill', 'wait_ms')
+
+
+def average(previous, sample):
+    return sample if previous is None else previous + RATE_WEIGHT * (sample - previous)
+
+
+class Backpressure:
+    '''
+    What the frame pipeline does with a frame when the writers fall behind
+        (see module docstring). high and low are fractions of the frame pool
+        in use; writers is the number of writer threads sharing the
+        measured write time. log gets every change of the decimation level
+        (default: this module's logger).
+    '''
+
+    def __init__(self, policy='block', high=0.75, low=0.25, max_decimate=8, writers=1,
+                 log=None):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown backpressure policy {policy!r}, expected one of {POLICIES}')
+        if not 0 <= low < high <= 1:
+            raise ValueError('Backpressure needs 0 <= low < high <= 1')
+        self.policy = policy
+        self.high = high
+        self.low = low
+        self.max_decimate = max(int(max_decimate), 1)
+        self.writers = max(writers, 1)
+        self.log = log or logger.info
+        self.level = 1
+        self.events = []
+        self.offered = 0
+        self.dropped = 0
+        self.decimated = 0
+        self.delayed = 0
+        self.delay_s = 0.
+        self.max_delay_s = 0.
+        self._levels = {}
+        self._interval_s = None
+        self._last_offer = None
+        self._write_s = None
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def arrival_rate(self):
+        '''
+        Frames per second offered by the trigger loop, None before two frames
+        '''
+        return 1. / self._interval_s if self._interval_s else None
+
+    def write_rate(self):
+        '''
+        Frames per second the writers get through, None before the first one
+        '''
+        return self.writers / self._write_s if self._write_s else None
+
+    def _record(self, action, meta, fill, wait_s=0.):
+        self.events.append((time.perf_counter() - self._start, meta.get('seq'),
+                            meta.get('exp_index'), meta.get('frame_index'), action, self.level,
+                            fill, wait_s))
+
+    def admit(self, meta, fill):
+        '''
+        Whether a frame offered by the trigger loop goes on to the writers;
+            fill is the fraction of the frame pool in use. With 'decimate'
+            every frame of a decimated burst gets decimation in meta, and
+            the frames left out decimated = True.
+        '''
+        t = time.perf_counter()
+        if self._last_offer is not None:
+            self._interval_s = average(self._interval_s, t - self._last_offer)
+        self._last_offer = t
+        self.offered += 1
+        if self.policy != 'decimate':
+            return True
+        key = (meta['seq'], meta.get('exp_index'))
+        level = self._levels.get(key)
+        if level is None:
+            level = self._levels[key] = self._choose(fill)
+        index = meta['frame_index']
+        if index >= meta['burst_size'] - 1:
+            del self._levels[key]
+        if level > 1:
+            meta['decimation'] = level
+        if index % level:
+            meta['decimated'] = True
+            self.decimated += 1
+            self._record('decimated', meta, fill)
+            return False
+        return True
+
+    def _choose(self, fill):
+        # level for a new burst
+        level = self.level
+        arrival, capacity = self.arrival_rate(), self.write_rate()
+        need = arrival / capacity if arrival and capacity else 1.
+        if fill >= self.high:
+            level = min(level * 2, self.max_decimate)
+        while level < min(need, self.max_decimate):
+            level *= 2
+        if level > 1 and fill <= self.low and need <= level / 2:
+            level //= 2
+        level = min(level, self.max_decimate)
+        if level != self.level:
+            self.log(f"Backpressure: keeping 1 in {level} frames of the next bursts (pool "
+                     f"{100. * fill:.0f}% full, {arrival or 0.:.1f} frames/s offered, "
+                     f"{capacity or 0.:.1f} frames/s written)")
+            self.level = level
+        return level
+
+    def drop(self, meta, fill=1.):
+        '''
+        Note a frame dropped because every pool slot was taken
+        '''
+        self.dropped += 1
+        self._record('dropped', meta, fill)
+
+    def delay(self, meta, wait_s, fill=1.):
+        '''
+        Note a frame the trigger loop waited wait_s seconds for a slot for
+        '''
+        self.delayed += 1
+        self.delay_s += wait_s
+        self.max_delay_s = max(self.max_delay_s, wait_s)
+        self._record('delayed', meta, fill, wait_s)
+
+    def written(self, seconds):
+        '''
+        Called by a writer thread with the time it spent on one frame
+        '''
+        with self._lock:
+            self._write_s = average(self._write_s, seconds)
+
+    def write_log(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(LOG_FIELDS)
+            for t, seq, exp_index, frame_index, action, level, fill, wait_s in self.events:
+                writer.writerow([f'{t:.6f}', seq, exp_index, frame_index, action, level,
+                                 f'{fill:.3f}', f'{1000. * wait_s:.3f}'])
+
+    def summary(self):
+        return {'policy': self.policy, 'offered': self.offered,
+                'kept': self.offered - self.dropped - self.decimated,
+                'dropped': self.dropped, 'decimated': self.decimated, 'delayed': self.delayed,
+                'delay_s': self.delay_s, 'max_delay_ms': 1000. * self.max_delay_s,
+                'level': self.level, 'write_fps': self.write_rate(),
+                'arrival_fps': self.arrival_rate()}
+
+    def report(self):
+        s = self.summary()
+        rates = ''
+        if s['write_fps'] and s['arrival_fps']:
+            rates = (f"; {s['arrival_fps']:.1f} frames/s offered, writers good for "
+                     f"{s['write_fps']:.1f} frames/s")
+        return (f"Backpressure ({s['policy']}): {s['kept']} of {s['offered']} frames queued, "
+                f"{s['dropped']} dropped, {s['decimated']} decimated, {s['delayed']} delayed "
+                f"({s['delay_s']:.3f} s in total, at most {s['max_delay_ms']:.1f} ms)" + rates)
+
+
+def frame_file_bytes(height, width, output='frames'):
+    '''
+    Bytes one uint16 frame takes on disk in an output mode: a FITS header
+        block plus the padded data for a file per frame, the padded data in
+        a cube, the raw frame in the spool. RICE files are counted
+        uncompressed, an upper bound.
+    '''
+    data = height * width * 2
+    padded = -(-data // FITS_BLOCK) * FITS_BLOCK
+    if output == 'spool':
+        return data
+    if output == 'cube':
+        return padded
+    if output == 'none':
+        return 0
+    return FITS_BLOCK + padded
+
+
+def measure_write_rate(directory, megabytes=64):
+    '''
+    Sustained write rate of the disk holding directory in bytes per second:
+        megabytes of random data written in chunks and fsynced, so neither
+        the page cache nor a compressing file system flatters it
+    '''
+    chunk = np.random.default_rng().integers(0, 256, PREFLIGHT_CHUNK, dtype=np.uint8).tobytes()
+    total = max(int(megabytes * 1024 * 1024) // PREFLIGHT_CHUNK, 1) * PREFLIGHT_CHUNK
+    path = os.path.join(directory, PREFLIGHT_FILE)
+    try:
+        t = time.perf_counter()
+        with open(path, 'wb', buffering=0) as f:
+            for _ in range(total // PREFLIGHT_CHUNK):
+                f.write(chunk)
+            os.fsync(f.fileno())
+        elapsed = time.perf_counter() - t
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    return total / elapsed
+
+
+class DiskPreflight:
+    '''
+    Pre-flight check of the output disk for sequences of frames_per_seq
+        frames of frame_bytes each, taken every seq_seconds. run_frames, when
+        given, is the number of frames the whole run plans to write.
+    '''
+
+    def __init__(self, directory, frame_bytes, frames_per_seq, seq_seconds, run_frames=None,
+                 megabytes=64):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.frame_bytes = frame_bytes
+        self.frames_per_seq = frames_per_seq
+        self.seq_seconds = seq_seconds
+        self.run_frames = run_frames
+        self.write_rate = measure_write_rate(directory, megabytes)
+        self.free_bytes = shutil.disk_usage(directory).free
+
+    @property
+    def seq_bytes(self):
+        return self.frame_bytes * self.frames_per_seq
+
+    @property
+    def required_rate(self):
+        return self.seq_bytes / self.seq_seconds
+
+    def sequences_fit(self):
+        return self.free_bytes // self.seq_bytes if self.seq_bytes else None
+
+    def keeps_up(self):
+        return self.write_rate >= self.required_rate
+
+    def run_fits(self):
+        if self.run_frames is None:
+            return None
+        return self.run_frames * self.frame_bytes <= self.free_bytes
+
+    def report(self):
+        mb = 1024. * 1024.
+        if not self.seq_bytes:
+            return (f"Disk pre-flight: {self.write_rate / mb:.0f} MB/s sustained, "
+                    f"{self.free_bytes / mb / 1024.:.1f} GB free; no per-frame output")
+        fit = self.sequences_fit()
+        line = (f"Disk pre-flight: {self.write_rate / mb:.0f} MB/s sustained, "
+                f"{self.free_bytes / mb / 1024.:.1f} GB free: {fit} sequences of "
+                f"{self.seq_bytes / mb:.0f} MB fit ({fit * self.seq_seconds / 60.:.0f} min at "
+                f"one per {self.seq_seconds:.2f} s); the cadence needs "
+                f"{self.required_rate / mb:.0f} MB/s")
+        if not self.keeps_up():
+            line += (f", {self.required_rate / self.write_rate:.1f}x what the disk writes: "
+                     f"expect backpressure")
+        if self.run_fits() is False:
+            line += f"; the planned {self.run_frames} frames do NOT fit"
+        return line
+
+
+def sequence_seconds(exposures, burst_size, max_frame_rate=None, cadence_s=0.):
+    '''
+    Shortest time a sequence can take: every frame at least its exposure and
+        one frame period at max_frame_rate, and at least cadence_s
+    '''
+    period = 1. / max_frame_rate if max_frame_rate else 0.
+    return max(burst_size * sum(max(1e-6 * exposure, period) for exposure in exposures),
+               cadence_s)
+
+
+def preflight_run(directory, nodes, output, ladders, run_frames=None, keep_every=1,
+                  megabytes=64):
+    '''
+    DiskPreflight for a run of the camera behind nodes (frame size from
+        Width/Height, fastest frame rate from AcquisitionFrameRate.max).
+        ladders are the (exposures, burst_size, cadence_s) of the kinds of
+        sequence of the run; the one needing the highest write rate is
+        checked. keep_every > 1 writes only every keep_every-th frame.
+    '''
+    frame_bytes = frame_file_bytes(int(nodes['Height'].value), int(nodes['Width'].value), output)
+    max_frame_rate = nodes['AcquisitionFrameRate'].max
+
+    def sequence(ladder):
+        exposures, burst_size, cadence_s = ladder
+        frames = len(exposures) * -(-burst_size // keep_every)
+        return frames, sequence_seconds(exposures, burst_size, max_frame_rate, cadence_s)
+
+    frames, seconds = max((sequence(ladder) for ladder in ladders),
+                          key=lambda sequence: sequence[0] / sequence[1])
+    if run_frames is not None:
+        run_frames = -(-run_frames // keep_every)
+    return DiskPreflight(directory, frame_bytes, frames, seconds, run_frames, megabytes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', help='output directory to test')
+    parser.add_argument('--width', type=int, default=2448)
+    parser.add_argument('--height', type=int, default=2048)
+    parser.add_argument('--output', default='frames',
+                        choices=('frames', 'cube', 'spool', 'rice'))
+    parser.add_argument('--frames-per-seq', type=int, default=30,
+                        help='frames of one sequence (bursts x exposures)')
+    parser.add_argument('--seq-seconds', type=float, default=3.,
+                        help='time between sequence starts')
+    parser.add_argument('--mb', type=float, default=256, help='size of the test write')
+    args = parser.parse_args()
+
+    preflight = DiskPreflight(args.directory,
+                              frame_file_bytes(args.height, args.width, args.output),
+                              args.frames_per_seq, args.seq_seconds, megabytes=args.mb)
+    print(preflight.report())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+'''
+Acquisition throughput benchmark
+    Runs the frame loops of the acquisition scripts against the simulated
+    camera in arena_sim.py and reports, per script:
+    - frames/s (frames written to disk and frames delivered by the camera)
+    - per-frame latency percentiles: trigger -> requeue_buffer, and the host
+      time spent between get_buffer returning and the requeue
+    - CPU use of the process (100% = one core busy)
+    - node transactions (reads and writes that reach the camera) of the run
+      and per frame, counted by the simulated nodemap, with the TriggerArmed
+      polls apart; compare with --set NODE_CACHE=False
+
+    The goal tracked here is the README TODO of a reliable ~10 fps.
+
+Usage:
+    python bench_acquisition.py
+    python bench_acquisition.py --scripts totality --num-images 25 --json bench.json
+    python bench_acquisition.py --width 1224 --height 1024 --exposures 25000 8000 2500
+    python bench_acquisition.py --set WRITER_THREADS=0     # override script SETTINGS
+    python bench_acquisition.py --set NODE_CACHE=False --set ARMING_STRATEGY="'predictive'"
+    python bench_acquisition.py --set ACQUISITION_MODE="'streaming'" --incomplete-fraction 0.01
+'''
+import argparse
+import contextlib
+import io
+import json
+import logging
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import arena_sim
+from acquisition_scripts import (SCRIPTS, count_frames, get_setting, load_script,
+                                 parse_setting, set_setting)
+
+PERCENTILES = (50, 90, 99, 100)
+
+
+def percentiles_ms(values):
+    if len(values) == 0:
+        return {f'p{p}': float('nan') for p in PERCENTILES}
+    values = np.asarray(values) * 1000.
+    return {f'p{p}': float(np.percentile(values, p)) for p in PERCENTILES}
+
+
+def frame_metrics(frame_log):
+    '''
+    Per-frame latency lists from the simulated device's frame log
+    '''
+    done = [rec for rec in frame_log.values() if 'requeued' in rec]
+    latency = [rec['requeued'] - rec['trigger'] for rec in done]
+    host = [rec['requeued'] - rec['fetched'] for rec in done]
+    return done, latency, host
+
+
+def run_script(name, out_dir, num_seq, num_images, exposures=None, settings=None):
+    '''
+    Run one acquisition script's frame loop against the simulated camera and
+        return its metrics
+    '''
+    filename, function_name = SCRIPTS[name]
+    module = load_script(name)
+    set_setting(module, 'BASE_DIR', out_dir)
+    set_setting(module, 'SUB_DIR', '')
+    set_setting(module, 'num_seq', num_seq)
+    set_setting(module, 'num_images', num_images)
+    # the disk pre-flight write is not part of the frame loop being timed
+    set_setting(module, 'DISK_PREFLIGHT_MB', None)
+    for key, value in (settings or {}).items():
+        set_setting(module, key, value)
+    if exposures is None:
+        exposures = [get_setting(module, f'exp{n}') for n in (1, 2, 3)]
+    acquire = getattr(module, function_name)
+
+    device = module.system.create_device()[0]
+    nodes, initial_vals = module.store_initial(device.nodemap)
+    logging.disable(logging.CRITICAL)
+    try:
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            acquire(device, nodes, initial_vals, *exposures)
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+    finally:
+        logging.disable(logging.NOTSET)
+        module.system.destroy_device(device)
+
+    done, latency, host = frame_metrics(device.frame_log)
+    frames_written = count_frames(out_dir)
+    polls = device.nodemap['TriggerArmed'].reads
+    transactions = device.nodemap.transactions - polls
+    return {
+        'script': filename,
+        'frames_written': frames_written,
+        'frames_delivered': len(done),
+        'dropped_frames': device.dropped_frames,
+        'incomplete_buffers': device.incomplete_buffers,
+        'wall_s': wall,
+        'fps_written': frames_written / wall,
+        'fps_delivered': len(done) / wall,
+        'cpu_percent': 100. * cpu / wall,
+        'node_transactions': transactions,
+        'node_transactions_per_frame': transactions / max(frames_written, 1),
+        'trigger_armed_polls': polls,
+        'latency_ms': percentiles_ms(latency),
+        'host_ms': percentiles_ms(host),
+    }
+
+
+def print_report(results):
+    print(f"{'script':<34}{'fps':>7}{'deliv':>7}{'cpu%':>7}"
+          f"{'lat p50':>9}{'p90':>8}{'p99':>8}{'host p50':>10}{'p99':>8}{'node tx':>9}{'/frame':>8}{'polls':>7}")
+    for res in results:
+        lat = res['latency_ms']
+        host = res['host_ms']
+        print(f"{res['script']:<34}{res['fps_written']:>7.2f}{res['fps_delivered']:>7.2f}"
+              f"{res['cpu_percent']:>7.1f}{lat['p50']:>9.1f}{lat['p90']:>8.1f}{lat['p99']:>8.1f}"
+              f"{host['p50']:>10.1f}{host['p99']:>8.1f}{res['node_transactions']:>9}"
+              f"{res['node_transactions_per_frame']:>8.1f}{res['trigger_armed_polls']:>7}")
+    print('latencies in ms; lat = trigger -> requeue, host = get_buffer -> requeue; '
+          'node tx = camera node reads and writes of the run without the TriggerArmed polls')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scripts', nargs='+', choices=sorted(SCRIPTS), default=list(SCRIPTS))
+    parser.add_argument('--width', type=int, default=2448)
+    parser.add_argument('--height', type=int, default=2048)
+    parser.add_argument('--num-seq', type=int, default=1)
+    parser.add_argument('--num-images', type=int, default=10)
+    parser.add_argument('--exposures', type=float, nargs=3, default=None,
+                        help='exp1 exp2 exp3 in microseconds (default: script settings)')
+    parser.add_argument('--link-mbps', type=float, default=115.,
+                        help='simulated link bandwidth in MB/s')
+    parser.add_argument('--readout-ms', type=float, default=20.)
+    parser.add_argument('--incomplete-fraction', type=float, default=0.,
+                        help='fraction of buffers the simulated camera delivers incomplete')
+    parser.add_argument('--set', dest='settings', action='append', default=[],
+                        type=parse_setting, metavar='NAME=VALUE',
+                        help='override a SETTINGS constant of the scripts (repeatable)')
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    arena_sim.install(width=args.width, height=args.height,
+                      link_bytes_per_s=args.link_mbps * 1e6,
+                      readout_us=args.readout_ms * 1000.,
+                      incomplete_fraction=args.incomplete_fraction)
+    results = []
+    for name in args.scripts:
+        out_dir = tempfile.mkdtemp(prefix=f'bench_{name}_')
+        try:
+            results.append(run_script(name, out_dir, args.num_seq, args.num_images,
+                                      args.exposures, dict(args.settings)))
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'width': args.width, 'height': args.height,
+                       'num_seq': args.num_seq, 'num_images': args.num_images,
+                       'settings': dict(args.settings),
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
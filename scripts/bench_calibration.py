@@ -0,0 +1,144 @@
+'''
+Calibration throughput benchmark
+    Writes a synthetic night of per-frame FITS files (darks at two exposure
+    times, flats, and science frames of the simulated corona seen through a
+    vignetting flat, with dark current and noise), then for 1, 2, 4, ... up
+    to --max-workers worker processes:
+    1. builds the masters (median combination, cache cleared first)
+    2. reduces every science frame
+    and reports frames/s, the speed-up over one worker and the parallel
+    efficiency, and how close the reduced frames come to the true signal.
+
+Usage:
+    python bench_calibration.py
+    python bench_calibration.py --width 2448 --height 2048 --science 128 --max-workers 8
+'''
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+import arena_sim
+from calibration import CACHE_DIR, Calibration, MasterCache, reduce_frames
+from frame_pipeline import FitsFrameEncoder, frame_filename, frame_header_cards
+
+DARK_LEVEL = 100.
+DARK_CURRENT = 200.         # DN per second
+
+
+def write_frames(out_dir, prefix, frames, exposure_us, encoder):
+    meta = {'seq': 0, 'exp_index': 0, 'burst_size': len(frames), 'exposure_us': exposure_us,
+            'timestamp': datetime.now()}
+    for n, frame in enumerate(frames):
+        meta['frame_index'] = n
+        encoder.write(os.path.join(out_dir, frame_filename(prefix, meta)), frame,
+                      frame_header_cards(meta))
+
+
+def synthetic_night(root, height, width, darks, flats, science, seed=0):
+    '''
+    Frame directories and the true science signal (DN) of a synthetic night,
+    the latter scaled by the median of the flat the master is normalised to
+    '''
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    r2 = ((y - height / 2) / height) ** 2 + ((x - width / 2) / width) ** 2
+    flat = (1. - 0.8 * r2) * (1. + 0.02 * rng.standard_normal((height, width)))
+    signal = arena_sim.scene_pattern('corona', height, width) * 2000.
+    encoder = FitsFrameEncoder(height, width)
+
+    def frame(level):
+        noisy = level + rng.normal(0., 4., level.shape)
+        return np.clip(np.rint(noisy), 0, 4095).astype(np.uint16)
+
+    dirs = {kind: os.path.join(root, kind) for kind in ('darks', 'flats', 'science')}
+    for path in dirs.values():
+        os.makedirs(path)
+    for exposure_us in (10000., 100000.):
+        dark = DARK_LEVEL + DARK_CURRENT * exposure_us * 1e-6
+        write_frames(dirs['darks'], f'dark{int(exposure_us)}',
+                     [frame(np.full((height, width), dark)) for _ in range(darks)],
+                     exposure_us, encoder)
+    flat_exposure = 10000.
+    flat_dark = DARK_LEVEL + DARK_CURRENT * flat_exposure * 1e-6
+    write_frames(dirs['flats'], 'flat',
+                 [frame(flat_dark + 2500. * (1. + 0.05 * n) * flat) for n in range(flats)],
+                 flat_exposure, encoder)
+    science_dark = DARK_LEVEL + DARK_CURRENT * 0.1
+    write_frames(dirs['science'], 'corona',
+                 [frame(science_dark + signal * flat) for _ in range(science)], 100000., encoder)
+    return dirs, signal * np.median(flat)
+
+
+def run(dirs, out_dir, workers, memory_mb):
+    shutil.rmtree(out_dir, ignore_errors=True)
+    cache = MasterCache(os.path.join(out_dir, CACHE_DIR))
+    darks = sorted(glob.glob(os.path.join(dirs['darks'], '*.fits')))
+    flats = sorted(glob.glob(os.path.join(dirs['flats'], '*.fits')))
+    science = sorted(glob.glob(os.path.join(dirs['science'], '*.fits')))
+    with ProcessPoolExecutor(workers) as executor:
+        # start the workers before the clock
+        list(executor.map(int, range(workers)))
+        t = time.perf_counter()
+        calibration = Calibration.build(cache, executor, workers, darks=darks, flats=flats,
+                                        memory_mb=memory_mb)
+        masters_s = time.perf_counter() - t
+        t = time.perf_counter()
+        frames, _ = reduce_frames(science, calibration, out_dir, executor)
+        reduce_s = time.perf_counter() - t
+    return masters_s, frames, reduce_s
+
+
+def residual(out_dir, signal):
+    from astropy.io import fits
+    path = sorted(glob.glob(os.path.join(out_dir, '*_cal.fits')))[0]
+    reduced = fits.getdata(path)
+    bright = signal > 200.
+    return float(np.nanmedian(np.abs(reduced[bright] - signal[bright]) / signal[bright]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--width', type=int, default=1224)
+    parser.add_argument('--height', type=int, default=1024)
+    parser.add_argument('--darks', type=int, default=8, help='dark frames per exposure time')
+    parser.add_argument('--flats', type=int, default=8)
+    parser.add_argument('--science', type=int, default=48)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count())
+    parser.add_argument('--memory-mb', type=float, default=64)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='bench_calibration_')
+    try:
+        dirs, signal = synthetic_night(root, args.height, args.width, args.darks, args.flats,
+                                       args.science)
+        print(f'{args.science} science frames of {args.width}x{args.height}, {args.darks} darks '
+              f'at 2 exposure times, {args.flats} flats; {os.cpu_count()} cores')
+        print(f"  {'workers':<9}{'masters s':>10}{'frames/s':>10}{'speed-up':>10}{'efficiency':>12}")
+        counts = [1]
+        while counts[-1] * 2 <= args.max_workers:
+            counts.append(counts[-1] * 2)
+        if counts[-1] != args.max_workers:
+            counts.append(args.max_workers)
+        base = None
+        out_dir = os.path.join(root, 'reduced')
+        for workers in counts:
+            masters_s, frames, reduce_s = run(dirs, out_dir, workers, args.memory_mb)
+            fps = frames / reduce_s
+            base = base or fps
+            print(f'  {workers:<9}{masters_s:>10.2f}{fps:>10.1f}{fps / base:>10.2f}'
+                  f'{fps / base / workers:>12.0%}')
+        print(f'median relative error of the reduced corona: {residual(out_dir, signal):.2%}')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+'''
+Tile-compressed FITS benchmark
+    Writes the same simulated frames (the corona and slit spectrum scenes of
+    arena_sim.py, at the three exposures of the totality script) as plain
+    per-frame FITS files and as tile-compressed files through
+    CompressedFitsSink with different numbers of worker processes, and
+    reports per scene and compression:
+    - compression ratio (uncompressed 16-bit frame bytes / file bytes)
+    - frames/s and MB/s of frame data written
+    - CPU per frame in the worker processes and in the writing process
+    Every compressed file is read back and compared with the PrimaryHDU
+    output of the same frame: pixels and DATE-OBS/EXPTIME must be identical.
+
+Usage:
+    python bench_compression.py
+    python bench_compression.py --dir D:/eclipse/benchmark --frames 60 --processes 1 2 4
+    python bench_compression.py --compression RICE_1 GZIP_2 HCOMPRESS_1
+'''
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+from astropy.io import fits
+
+import arena_sim
+from fits_compressed import COMPRESSION_TYPES, CompressedFitsSink, compressed_filename, image_hdu
+from frame_pipeline import FitsFrameSink, frame_filename
+
+EXPOSURES = (250000., 80000., 25000.)
+
+
+def scene_frames(scene, height, width, exposures=EXPOSURES):
+    device = arena_sim.SimDevice(arena_sim.CameraModel(width=width, height=height, scene=scene))
+    return [(device._template(exposure), exposure) for exposure in exposures]
+
+
+def frame_metas(frames, count):
+    t0 = datetime(2024, 4, 8, 18, 18, 0)
+    return [(frames[n % len(frames)][0],
+             {'seq': n // len(frames), 'exp_index': n % len(frames), 'frame_index': 0,
+              'burst_size': 1, 'exposure_us': frames[n % len(frames)][1],
+              'timestamp': t0 + timedelta(milliseconds=100 * n)})
+            for n in range(count)]
+
+
+def write_all(sink, items):
+    cpu_start = time.process_time()
+    t_start = time.perf_counter()
+    for frame, meta in items:
+        sink.write(frame, meta)
+    sink.close()
+    return time.perf_counter() - t_start, time.process_time() - cpu_start
+
+
+def directory_bytes(path, suffix):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)
+               if name.endswith(suffix))
+
+
+def check_round_trip(plain_dir, packed_dir, prefix, items):
+    '''
+    Number of compressed frames whose pixels or cards differ from the
+        PrimaryHDU output
+    '''
+    mismatches = 0
+    for _, meta in items:
+        with fits.open(os.path.join(plain_dir, frame_filename(prefix, meta))) as plain, \
+                fits.open(os.path.join(packed_dir, compressed_filename(prefix, meta))) as packed:
+            hdu = image_hdu(packed)
+            same = (np.array_equal(plain[0].data, hdu.data) and hdu.data.dtype == plain[0].data.dtype
+                    and all(plain[0].header[key] == hdu.header[key] for key in ('DATE-OBS', 'EXPTIME')))
+            mismatches += not same
+    return mismatches
+
+
+def report(label, frames, frame_bytes, elapsed, file_bytes, cpu_worker, cpu_parent):
+    mb = frames * frame_bytes / 1e6
+    print(f'  {label:<26}{frame_bytes * frames / file_bytes:7.2f}{frames / elapsed:9.1f}'
+          f'{mb / elapsed:9.1f}{1e3 * cpu_worker / frames:11.1f}{1e3 * cpu_parent / frames:11.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default=None, help='where to write (default: a temp dir)')
+    parser.add_argument('--width', type=int, default=2448)
+    parser.add_argument('--height', type=int, default=2048)
+    parser.add_argument('--frames', type=int, default=30)
+    parser.add_argument('--scenes', nargs='+', default=['corona', 'spectrum'])
+    parser.add_argument('--compression', nargs='+', default=['RICE_1'], choices=COMPRESSION_TYPES)
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2])
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='bench_compression_', dir=args.dir)
+    prefix = 'bench'
+    try:
+        for scene in args.scenes:
+            items = frame_metas(scene_frames(scene, args.height, args.width), args.frames)
+            frame_bytes = items[0][0].nbytes
+            print(f'{scene}: {args.frames} frames of {args.width}x{args.height}')
+            print(f"  {'output':<26}{'ratio':>7}{'fps':>9}{'MB/s':>9}{'worker ms':>11}{'main ms':>11}")
+            plain_dir = os.path.join(root, f'{scene}_plain')
+            os.makedirs(plain_dir)
+            elapsed, cpu = write_all(FitsFrameSink(plain_dir, prefix), items)
+            report('PrimaryHDU (plain)', args.frames, frame_bytes, elapsed,
+                   directory_bytes(plain_dir, '.fits'), 0., cpu)
+            for compression in args.compression:
+                for processes in args.processes:
+                    out_dir = os.path.join(root, f'{scene}_{compression}_{processes}')
+                    os.makedirs(out_dir)
+                    with ProcessPoolExecutor(processes) as pool:
+                        # start the workers before timing
+                        list(pool.map(abs, range(processes)))
+                        sink = CompressedFitsSink(out_dir, prefix, pool, compression)
+                        elapsed, cpu = write_all(sink, items)
+                    report(f'{compression}, {processes} proc', args.frames, frame_bytes, elapsed,
+                           directory_bytes(out_dir, '.fits.fz'), sink.worker_cpu_s, cpu)
+                    mismatches = check_round_trip(plain_dir, out_dir, prefix, items)
+                    failed = sink.failed_frames + mismatches
+                    print(f'  {"":<26}round trip: ' + (f'{failed} frames FAILED' if failed
+                                                       else 'bit-exact'))
+                    shutil.rmtree(out_dir)
+            shutil.rmtree(plain_dir)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+'''
+K-corona Doppler fitting benchmark
+    Synthetic K-corona spectra with known velocities and electron
+    temperatures (a sloping continuum times the thermally broadened dip,
+    Poisson noise) are fitted with doppler_fit.py:
+    1. fits/s of the batched Levenberg-Marquardt fit for a few batch sizes,
+       batch 1 being the spectrum at a time loop it replaces
+    2. accuracy: bias and scatter of the fitted velocity and temperature
+       against the true ones, the mean reported uncertainty and the scatter
+       of the normalised residuals (about 1 when the uncertainties are right)
+    3. fits/s of fit_files on spectra tables, one burst per table, for 1, 2,
+       4, ... worker processes
+
+Usage:
+    python bench_doppler.py
+    python bench_doppler.py --columns 1200 --spectra 4096 --bursts 16 --bins 25 --max-workers 8
+'''
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+from doppler_fit import (C_KMS, CONTINUUM_ORDER, DISPERSION, LINE, SCATTER, WAVELENGTH0,
+                         DopplerModel, column_wavelengths, fit_files, width_of)
+from frame_pipeline import DATE_OBS_FORMAT
+from spectrum_extract import SlitGeometry, SpectrumTable, spectra_filename, write_spectra
+
+DEPTH = 0.3
+
+
+def synthetic_spectra(count, columns, level, rng):
+    '''
+    (spectra, true velocities km/s, true temperatures K)
+    '''
+    wavelength = column_wavelengths(columns)
+    velocity = rng.uniform(-300., 300., count)
+    temperature = rng.uniform(0.7e6, 2.0e6, count)
+    x = np.linspace(-1., 1., columns)
+    continuum = level * (1. + rng.uniform(-0.2, 0.2, (count, 1)) * x
+                         + rng.uniform(-0.05, 0.05, (count, 1)) * x * x)
+    centre = LINE + velocity * SCATTER * LINE / C_KMS
+    distance = (wavelength - centre[:, np.newaxis]) / width_of(temperature)[:, np.newaxis]
+    spectra = continuum * (1. - DEPTH * np.exp(-0.5 * distance * distance))
+    return rng.poisson(spectra).astype(np.float64), velocity, temperature
+
+
+def write_tables(out_dir, bursts, frames, bins, columns, level, rng):
+    geometry = SlitGeometry((0, bins, 0, columns), bins)
+    for seq in range(bursts):
+        meta = {'seq': seq, 'exp_index': 0, 'exposure_us': 100000., 'timestamp': datetime.now()}
+        table = SpectrumTable(frames, bins, columns)
+        for index in range(frames):
+            spectra, _, _ = synthetic_spectra(bins, columns, level, rng)
+            table.add(index, spectra, meta)
+        cards = [('DATE-OBS', meta['timestamp'].strftime(DATE_OBS_FORMAT)), ('SEQ', seq),
+                 ('EXPNUM', 1)]
+        write_spectra(os.path.join(out_dir, spectra_filename('bench', meta)), table,
+                      cards + geometry.cards())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--columns', type=int, default=2448)
+    parser.add_argument('--spectra', type=int, default=1024)
+    parser.add_argument('--level', type=float, default=20000., help='continuum in DN')
+    parser.add_argument('--batches', type=int, nargs='+', default=[1, 8, 32, 128])
+    parser.add_argument('--bursts', type=int, default=8)
+    parser.add_argument('--frames', type=int, default=10, help='frames per burst')
+    parser.add_argument('--bins', type=int, default=10, help='spatial bins per frame')
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+
+    spectra, velocity, temperature = synthetic_spectra(args.spectra, args.columns, args.level, rng)
+    model = DopplerModel(column_wavelengths(args.columns))
+    print(f'{args.spectra} spectra of {args.columns} columns, continuum {args.level:.0f} DN, '
+          f'dip depth {DEPTH}')
+    print(f"  {'batch':<8}{'fits/s':>10}{'speed-up':>10}")
+    base = None
+    for batch in args.batches:
+        t = time.perf_counter()
+        maps = model.fit(spectra, batch=batch)
+        rate = args.spectra / (time.perf_counter() - t)
+        base = base or rate
+        print(f'  {batch:<8}{rate:>10.1f}{rate / base:>10.2f}')
+
+    print(f"\n  {'':<14}{'bias':>10}{'rms':>10}{'mean err':>10}{'pull rms':>10}"
+          f"   ({np.mean(maps['CONVERGED']):.1%} converged)")
+    for name, truth, unit in (('VELOCITY', velocity, 'km/s'), ('TEMPERATURE', temperature, 'K')):
+        residual = maps[name] - truth
+        error = maps[name + '_ERR']
+        scale = 1e3 if unit == 'K' else 1.
+        print(f"  {name.lower() + ' ' + ('kK' if unit == 'K' else unit):<14}"
+              f'{np.nanmean(residual) / scale:>10.2f}{np.nanstd(residual) / scale:>10.2f}'
+              f'{np.nanmean(error) / scale:>10.2f}{np.nanstd(residual / error):>10.2f}')
+
+    root = tempfile.mkdtemp(prefix='bench_doppler_')
+    try:
+        tables = os.path.join(root, 'spectra')
+        os.makedirs(tables)
+        write_tables(tables, args.bursts, args.frames, args.bins, args.columns, args.level, rng)
+        paths = sorted(glob.glob(os.path.join(tables, '*_spectra.fits')))
+        calibration = {'wavelength0': WAVELENGTH0, 'dispersion': DISPERSION, 'line': LINE,
+                       'order': CONTINUUM_ORDER}
+        print(f'\n{args.bursts} bursts of {args.frames} frames x {args.bins} bins; '
+              f'{os.cpu_count()} cores')
+        print(f"  {'workers':<9}{'fits/s':>10}{'speed-up':>10}{'efficiency':>12}")
+        counts = [1]
+        while counts[-1] * 2 <= args.max_workers:
+            counts.append(counts[-1] * 2)
+        if counts[-1] != args.max_workers:
+            counts.append(args.max_workers)
+        base = None
+        for workers in counts:
+            t = time.perf_counter()
+            fitted, _ = fit_files(paths, os.path.join(root, 'doppler'), calibration,
+                                  workers=workers)
+            rate = fitted / (time.perf_counter() - t)
+            base = base or rate
+            print(f'  {workers:<9}{rate:>10.1f}{rate / base:>10.2f}{rate / base / workers:>12.0%}')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+'''
+HDR merge throughput benchmark
+    Folds synthetic exposure-bracketed frames (the simulated corona scene of
+    arena_sim.py) into an HdrAccumulator and reports megapixels merged per
+    second for a few band sizes, single threaded and with several threads
+    folding frames of the same sequence, against a whole-frame float64 merge
+    that keeps every frame of the sequence in memory.
+
+Usage:
+    python bench_hdr.py
+    python bench_hdr.py --width 2448 --height 2048 --frames 5 --threads 1 2 4
+'''
+import argparse
+import threading
+import time
+
+import numpy as np
+
+import arena_sim
+from hdr_merge import SATURATION, HdrAccumulator
+
+
+def synthetic_frames(height, width, exposures, frames, dark=100.):
+    model = arena_sim.CameraModel(width=width, height=height, dark_level=dark)
+    device = arena_sim.SimDevice(model)
+    return [(device._template(exposure), exposure) for exposure in exposures
+            for _ in range(frames)]
+
+
+def naive_merge(frames, dark):
+    '''
+    Reference: stack the whole sequence in float64 and merge in one go
+    '''
+    stack = np.stack([frame for frame, _ in frames]).astype(np.float64) - dark
+    t = np.array([exposure * 1e-6 for _, exposure in frames])[:, None, None]
+    good = (stack + dark < SATURATION) & (stack >= 20.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (stack * good).sum(axis=0) / (t * good).sum(axis=0)
+
+
+def time_accumulator(frames, height, width, dark, band_rows, threads):
+    accumulator = HdrAccumulator(height, width, dark=dark, band_rows=band_rows)
+    work = list(frames)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not work:
+                    return
+                frame, exposure = work.pop()
+            accumulator.add(frame, exposure)
+
+    t_start = time.perf_counter()
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    accumulator.radiance()
+    return time.perf_counter() - t_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--width', type=int, default=2448)
+    parser.add_argument('--height', type=int, default=2048)
+    parser.add_argument('--exposures', type=float, nargs='+', default=[250000., 80000., 25000.])
+    parser.add_argument('--frames', type=int, default=5, help='frames per exposure')
+    parser.add_argument('--band-rows', type=int, nargs='+', default=[16, 32, 128])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--dark', type=float, default=100.)
+    args = parser.parse_args()
+
+    frames = synthetic_frames(args.height, args.width, args.exposures, args.frames, args.dark)
+    megapixels = len(frames) * args.height * args.width / 1e6
+    print(f'{len(frames)} frames of {args.width}x{args.height} ({megapixels:.0f} MP)')
+    t_start = time.perf_counter()
+    naive_merge(frames, args.dark)
+    elapsed = time.perf_counter() - t_start
+    print(f"{'whole-sequence float64':<28}{megapixels / elapsed:8.1f} MP/s")
+    for band_rows in args.band_rows:
+        for threads in args.threads:
+            elapsed = time_accumulator(frames, args.height, args.width, args.dark,
+                                       band_rows, threads)
+            print(f"{f'bands of {band_rows} rows, {threads} thr':<28}"
+                  f"{megapixels / elapsed:8.1f} MP/s")
+
+
+if __name__ == '__main__':
+    main()
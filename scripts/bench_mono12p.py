@@ -0,0 +1,112 @@
+'''
+Mono12 vs packed Mono12 benchmark
+    1. Unpacking: megapixels per second of the vectorized unpacker, into a
+       separate array and in place in a frame slot, against a plain numpy
+       unpack with temporaries; every result is checked against the frame
+       that was packed.
+    2. End to end: the acquisition scripts' frame loops against the
+       simulated camera (see bench_acquisition.py) with PixelFormat Mono12
+       and each packed format, reporting frames/s written and delivered and
+       the CPU use of the process. On a link-limited stream the packed
+       formats move a third more frames.
+
+Usage:
+    python bench_mono12p.py
+    python bench_mono12p.py --scripts totality --num-images 25 --link-mbps 115
+    python bench_mono12p.py --exposures 20000 8000 2500 --output spool
+'''
+import argparse
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import arena_sim
+from acquisition_scripts import SCRIPTS
+from bench_acquisition import run_script
+from mono12_packed import PACKED_FORMATS, pack_mono12, packed_tail, unpack_in_place, unpack_mono12
+
+
+def naive_unpack(packed, shape, pixel_format):
+    b = packed.reshape(-1, 3).astype(np.uint16)
+    out = np.empty((b.shape[0], 2), dtype=np.uint16)
+    if pixel_format == 'Mono12p':
+        out[:, 0] = b[:, 0] | (b[:, 1] & 0xF) << 8
+    else:
+        out[:, 0] = b[:, 0] << 4 | (b[:, 1] & 0xF)
+    out[:, 1] = b[:, 1] >> 4 | b[:, 2] << 4
+    return out.reshape(shape)
+
+
+def time_per_call(function, repeat):
+    function()
+    t_start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - t_start) / repeat
+
+
+def bench_unpack(height, width, repeat):
+    frame = arena_sim.SimDevice(arena_sim.CameraModel(width=width, height=height))._template(80000.)
+    megapixels = frame.size / 1e6
+    print(f'Unpacking {width}x{height} frames')
+    for pixel_format in PACKED_FORMATS:
+        packed = pack_mono12(frame, pixel_format)
+        out = np.empty_like(frame)
+        slot = np.empty_like(frame)
+
+        def in_place():
+            packed_tail(slot)[:] = packed
+            unpack_in_place(slot, pixel_format)
+
+        runs = [('numpy with temporaries', lambda: naive_unpack(packed, frame.shape, pixel_format)),
+                ('vectorized', lambda: unpack_mono12(packed, out, pixel_format)),
+                ('in place (incl. copy in)', in_place)]
+        for name, function in runs:
+            elapsed = time_per_call(function, repeat)
+            print(f'  {pixel_format:<13}{name:<26}{elapsed * 1e3:7.2f} ms {megapixels / elapsed:8.0f} MP/s')
+        assert np.array_equal(out, frame) and np.array_equal(slot, frame)
+
+
+def bench_end_to_end(args):
+    print(f"\n{'script':<34}{'format':<14}{'fps':>7}{'deliv':>7}{'cpu%':>7}{'cpu ms/frame':>14}")
+    for name in args.scripts:
+        for pixel_format in ('Mono12',) + PACKED_FORMATS:
+            out_dir = tempfile.mkdtemp(prefix=f'bench_{name}_')
+            settings = {'PIXEL_FORMAT': pixel_format, 'ACQUISITION_MODE': 'streaming',
+                        'OUTPUT_MODE': args.output}
+            try:
+                res = run_script(name, out_dir, args.num_seq, args.num_images, args.exposures,
+                                 settings)
+            finally:
+                shutil.rmtree(out_dir, ignore_errors=True)
+            cpu_ms = 10. * res['cpu_percent'] / max(res['fps_written'], 1e-9)
+            print(f"{res['script']:<34}{pixel_format:<14}{res['fps_written']:>7.2f}"
+                  f"{res['fps_delivered']:>7.2f}{res['cpu_percent']:>7.1f}{cpu_ms:>14.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scripts', nargs='+', choices=sorted(SCRIPTS), default=['totality'])
+    parser.add_argument('--width', type=int, default=2448)
+    parser.add_argument('--height', type=int, default=2048)
+    parser.add_argument('--num-seq', type=int, default=1)
+    parser.add_argument('--num-images', type=int, default=20)
+    parser.add_argument('--exposures', type=float, nargs=3, default=None,
+                        help='exp1 exp2 exp3 in microseconds (default: script settings)')
+    parser.add_argument('--output', default='frames', help='OUTPUT_MODE of the scripts')
+    parser.add_argument('--link-mbps', type=float, default=115.,
+                        help='simulated link bandwidth in MB/s')
+    parser.add_argument('--repeat', type=int, default=20, help='unpack timing repetitions')
+    args = parser.parse_args()
+
+    bench_unpack(args.height, args.width, args.repeat)
+    arena_sim.install(width=args.width, height=args.height,
+                      link_bytes_per_s=args.link_mbps * 1e6)
+    bench_end_to_end(args)
+
+
+if __name__ == '__main__':
+    main()
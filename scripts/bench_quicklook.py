@@ -0,0 +1,158 @@
+'''
+Quick-look publishing benchmark
+    1. Publish cost: time per QuickLookPublisher.write() of a full frame at
+       several decimations (every frame published), with no viewer, with a
+       viewer copying the newest slot as fast as it can, and with a viewer
+       that attached and then stalled. The writer never waits for a viewer,
+       so the three columns should only differ by memory bandwidth.
+    2. End to end: the acquisition scripts' frame loops against the
+       simulated camera (see bench_acquisition.py) without quick-look, and
+       publishing every QUICKLOOK_EVERY-th frame to a stalled viewer,
+       reporting frames/s, CPU use and the host time per frame.
+
+Usage:
+    python bench_quicklook.py
+    python bench_quicklook.py --width 2448 --height 2048 --repeat 200
+    python bench_quicklook.py --scripts totality --num-images 25 --every 5
+'''
+import argparse
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+import arena_sim
+from acquisition_scripts import SCRIPTS
+from bench_acquisition import run_script
+from quicklook import QuickLookPublisher, QuickLookReader, ring_name
+
+BENCH_NAME = 'eclipse_quicklook_bench'
+DECIMATIONS = (1, 2, 4, 8)
+
+
+def viewer(name, mode):
+    '''
+    Viewer process: 'busy' copies the newest slot in a loop, 'stalled'
+        attaches and never reads
+    '''
+    reader = QuickLookReader(name)
+    while reader.attach() is None:
+        time.sleep(0.01)
+    print('attached', flush=True)
+    while not reader.closed:
+        if mode == 'busy':
+            reader.newest()
+        else:
+            time.sleep(0.1)
+    reader.detach()
+
+
+def start_viewer(name, mode):
+    # a separate interpreter like a real viewer, not a multiprocessing child
+    # sharing this process's resource tracker
+    return subprocess.Popen([sys.executable, __file__, '--viewer', mode, '--name', name],
+                            stdout=subprocess.PIPE, text=True)
+
+
+def stop_viewer(process):
+    # a viewer that never saw the ring (the run ended first) still waits for it
+    try:
+        process.wait(5.)
+    except subprocess.TimeoutExpired:
+        process.terminate()
+        process.wait()
+
+
+def publish_times(frame, decimate, repeat, mode):
+    publisher = QuickLookPublisher(every=1, decimate=decimate, name=BENCH_NAME)
+    meta = {'seq': 0, 'exp_index': 0, 'frame_index': 0, 'exposure_us': 1000.,
+            'timestamp': datetime.now(), 'stats': None}
+    publisher.write(frame, meta)
+    process = None
+    if mode != 'none':
+        process = start_viewer(BENCH_NAME, mode)
+        process.stdout.readline()
+    times = np.empty(repeat)
+    try:
+        for n in range(repeat):
+            t = time.perf_counter()
+            publisher.write(frame, meta)
+            times[n] = time.perf_counter() - t
+    finally:
+        publisher.close()
+        if process is not None:
+            stop_viewer(process)
+    return times
+
+
+def bench_publish(height, width, repeat):
+    frame = (arena_sim.scene_pattern('corona', height, width) * 3000. + 100.).astype(np.uint16)
+    print(f'Publishing {width}x{height} frames, time per write() in microseconds (mean / p99)')
+    modes = ('none', 'busy', 'stalled')
+    print(f"  {'decimate':<10}{'preview':>12}" + ''.join(f'{mode + " viewer":>20}' for mode in modes))
+    for decimate in DECIMATIONS:
+        preview = frame[::decimate, ::decimate].shape
+        cells = []
+        for mode in modes:
+            times = publish_times(frame, decimate, repeat, mode) * 1e6
+            cells.append(f'{times.mean():8.0f} / {np.percentile(times, 99):7.0f}')
+        print(f"  {decimate:<10}{f'{preview[1]}x{preview[0]}':>12}" + ''.join(f'{c:>20}' for c in cells))
+
+
+def bench_end_to_end(args):
+    print(f"\n{'script':<34}{'quick-look':<14}{'fps':>7}{'deliv':>7}{'cpu%':>7}"
+          f"{'host p50':>10}{'p99':>8}")
+    for name in args.scripts:
+        for every in (None, args.every):
+            out_dir = tempfile.mkdtemp(prefix=f'bench_{name}_')
+            settings = {'QUICKLOOK_EVERY': every, 'QUICKLOOK_DECIMATE': args.decimate}
+            process = None
+            if every:
+                # stalled viewer: attaches as soon as the ring exists, never reads
+                process = start_viewer(ring_name(arena_sim.system.models[0].serial), 'stalled')
+            try:
+                res = run_script(name, out_dir, args.num_seq, args.num_images, args.exposures,
+                                 settings)
+            finally:
+                shutil.rmtree(out_dir, ignore_errors=True)
+                if process is not None:
+                    stop_viewer(process)
+            label = f'every {every}' if every else 'off'
+            print(f"{res['script']:<34}{label:<14}{res['fps_written']:>7.2f}"
+                  f"{res['fps_delivered']:>7.2f}{res['cpu_percent']:>7.1f}"
+                  f"{res['host_ms']['p50']:>10.2f}{res['host_ms']['p99']:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scripts', nargs='+', choices=sorted(SCRIPTS), default=list(SCRIPTS))
+    parser.add_argument('--width', type=int, default=2448)
+    parser.add_argument('--height', type=int, default=2048)
+    parser.add_argument('--repeat', type=int, default=100)
+    parser.add_argument('--num-seq', type=int, default=1)
+    parser.add_argument('--num-images', type=int, default=10)
+    parser.add_argument('--exposures', type=float, nargs=3, default=None,
+                        help='exp1 exp2 exp3 in microseconds (default: script settings)')
+    parser.add_argument('--every', type=int, default=1, help='QUICKLOOK_EVERY of the end-to-end runs')
+    parser.add_argument('--decimate', type=int, default=4)
+    parser.add_argument('--skip-end-to-end', action='store_true')
+    parser.add_argument('--viewer', choices=('busy', 'stalled'), help=argparse.SUPPRESS)
+    parser.add_argument('--name', default=BENCH_NAME, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.viewer:
+        viewer(args.name, args.viewer)
+        return
+
+    bench_publish(args.height, args.width, args.repeat)
+    if not args.skip_end_to_end:
+        arena_sim.install(width=args.width, height=args.height)
+        bench_end_to_end(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+'''
+Spool vs FITS write benchmark
+    Writes the same synthetic Mono12 frames to one directory (so all paths hit
+    the same disk) through:
+    - writeto   fits.PrimaryHDU(frame).writeto(), the original per-frame path
+    - encoder   frame_pipeline.FitsFrameEncoder, same bytes without per-frame
+                allocations
+    - spool     frame_spool.SpoolWriter, raw frames into a preallocated
+                memory-mapped file
+    and reports frames/s, MB/s and per-frame time percentiles. With --sync the
+    time to flush everything to the disk (fsync) is included.
+
+Usage:
+    python bench_spool.py --dir D:/eclipse/benchmark --frames 100
+'''
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+from astropy.io import fits
+
+from frame_pipeline import FitsFrameEncoder, frame_filename, frame_header_cards
+from frame_spool import SpoolWriter
+
+
+def synthetic_frames(count, height, width):
+    '''
+    A few distinct noisy Mono12 frames, reused cyclically
+    '''
+    rng = np.random.default_rng(0)
+    base = rng.normal(800., 200., (height, width))
+    return [np.clip(base + rng.normal(0., 20., (height, width)), 0, 4095).astype(np.uint16)
+            for _ in range(min(count, 4))]
+
+
+def frame_meta(n):
+    return {'seq': 0, 'exp_index': 0, 'frame_index': n, 'burst_size': 0,
+            'exposure_us': 25000., 'timestamp': datetime.now()}
+
+
+def fsync_dir_files(paths):
+    for path in paths:
+        with open(path, 'rb+') as f:
+            os.fsync(f.fileno())
+
+
+def run_writeto(out_dir, frames, count, sync):
+    times = []
+    paths = []
+    for n in range(count):
+        t0 = time.perf_counter()
+        meta = frame_meta(n)
+        path = os.path.join(out_dir, frame_filename('writeto', meta))
+        img_fits = fits.PrimaryHDU(frames[n % len(frames)])
+        for key, value in frame_header_cards(meta):
+            img_fits.header[key] = value
+        img_fits.writeto(path, overwrite=True)
+        times.append(time.perf_counter() - t0)
+        paths.append(path)
+    return times, (lambda: fsync_dir_files(paths)) if sync else None
+
+
+def run_encoder(out_dir, frames, count, sync):
+    encoder = FitsFrameEncoder(*frames[0].shape)
+    times = []
+    paths = []
+    for n in range(count):
+        t0 = time.perf_counter()
+        meta = frame_meta(n)
+        path = os.path.join(out_dir, frame_filename('encoder', meta))
+        encoder.write(path, frames[n % len(frames)], frame_header_cards(meta))
+        times.append(time.perf_counter() - t0)
+        paths.append(path)
+    return times, (lambda: fsync_dir_files(paths)) if sync else None
+
+
+def run_spool(out_dir, frames, count, sync):
+    height, width = frames[0].shape
+    base_path = os.path.join(out_dir, 'spool_000')
+    # preallocation happens before the run starts, so it is not timed
+    writer = SpoolWriter(base_path, count, height, width, 'spool')
+    times = []
+    for n in range(count):
+        t0 = time.perf_counter()
+        meta = frame_meta(n)
+        writer.write(writer.reserve(), frames[n % len(frames)], meta)
+        times.append(time.perf_counter() - t0)
+
+    def finish():
+        writer.close()
+        if sync:
+            fsync_dir_files([base_path + '.spool', base_path + '.idx'])
+    return times, finish
+
+
+BACKENDS = {'writeto': run_writeto, 'encoder': run_encoder, 'spool': run_spool}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default=None, help='directory on the disk to test (default: temp)')
+    parser.add_argument('--frames', type=int, default=50)
+    parser.add_argument('--width', type=int, default=2448)
+    parser.add_argument('--height', type=int, default=2048)
+    parser.add_argument('--backends', nargs='+', choices=list(BACKENDS), default=list(BACKENDS))
+    parser.add_argument('--sync', action='store_true', help='include fsync of the written data')
+    args = parser.parse_args()
+
+    frames = synthetic_frames(args.frames, args.height, args.width)
+    frame_mb = frames[0].nbytes / 1e6
+    print(f"{'backend':<10}{'frames/s':>10}{'MB/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for name in args.backends:
+        out_dir = tempfile.mkdtemp(prefix=f'bench_{name}_', dir=args.dir)
+        try:
+            t_start = time.perf_counter()
+            times, finish = BACKENDS[name](out_dir, frames, args.frames, args.sync)
+            if finish is not None:
+                finish()
+            elapsed = time.perf_counter() - t_start
+            ms = np.asarray(times) * 1000.
+            print(f"{name:<10}{args.frames / elapsed:>10.1f}{args.frames * frame_mb / elapsed:>9.1f}"
+                  f"{np.percentile(ms, 50):>9.2f}{np.percentile(ms, 99):>9.2f}{ms.max():>9.2f}")
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
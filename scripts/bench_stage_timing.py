@@ -0,0 +1,95 @@
+'''
+Stage timing overhead benchmark
+    1. Per call: the cost of recording one stage (StageTimer.mark and
+       add_seconds) against NULL_TIMER (timing off) and a bare
+       perf_counter_ns() call, and the added cost per frame for the stages
+       recorded on the trigger loop (arm_wait, trigger, get_buffer, convert,
+       requeue) and on the writer threads (stats, header, writeto).
+    2. End to end: the acquisition scripts' frame loops against the
+       simulated camera (see bench_acquisition.py) with STAGE_TIMING off and
+       on, reporting frames/s, the host time per frame (get_buffer ->
+       requeue) and CPU per frame, and the stage latencies of the timed run.
+
+Usage:
+    python bench_stage_timing.py
+    python bench_stage_timing.py --scripts totality lucid_sequence --num-images 25
+    python bench_stage_timing.py --calls 1000000 --output spool
+'''
+import argparse
+import shutil
+import tempfile
+import time
+
+import arena_sim
+from acquisition_scripts import SCRIPTS
+from bench_acquisition import run_script
+from stage_timing import NULL_TIMER, StageTimer
+
+TRIGGER_LOOP_STAGES = 5
+WRITER_STAGES = 3
+
+
+def ns_per_call(function, calls):
+    function()
+    t_start = time.perf_counter_ns()
+    for _ in range(calls):
+        function()
+    return (time.perf_counter_ns() - t_start) / calls
+
+
+def bench_calls(calls):
+    timer = StageTimer()
+    t = timer.now()
+    loop = ns_per_call(lambda: None, calls)
+    runs = [('perf_counter_ns()', time.perf_counter_ns),
+            ('NULL_TIMER.mark()', lambda: NULL_TIMER.mark('get_buffer', t)),
+            ('StageTimer.mark()', lambda: timer.mark('get_buffer', t)),
+            ('StageTimer.add_seconds()', lambda: timer.add_seconds('arm_wait', 1.5e-4))]
+    print(f'Recording one stage ({calls} calls, call overhead of the loop removed)')
+    costs = {}
+    for name, function in runs:
+        costs[name] = ns_per_call(function, calls) - loop
+        print(f'  {name:<26}{costs[name]:8.0f} ns')
+    per_stage = costs['StageTimer.mark()'] + costs['perf_counter_ns()']
+    off = costs['NULL_TIMER.mark()'] * 2
+    print(f'  per frame, trigger loop ({TRIGGER_LOOP_STAGES} stages): '
+          f'{TRIGGER_LOOP_STAGES * per_stage / 1e3:.2f} us on, {TRIGGER_LOOP_STAGES * off / 1e3:.2f} us off')
+    print(f'  per frame, writer thread ({WRITER_STAGES} stages): '
+          f'{WRITER_STAGES * per_stage / 1e3:.2f} us on, {WRITER_STAGES * off / 1e3:.2f} us off')
+
+
+def bench_end_to_end(args):
+    print(f"\n{'script':<34}{'timing':<8}{'fps':>7}{'host p50':>10}{'p99':>8}{'cpu ms/frame':>14}")
+    for name in args.scripts:
+        for enabled in (False, True):
+            out_dir = tempfile.mkdtemp(prefix=f'bench_{name}_')
+            settings = {'STAGE_TIMING': enabled, 'OUTPUT_MODE': args.output}
+            try:
+                res = run_script(name, out_dir, args.num_seq, args.num_images, None, settings)
+            finally:
+                shutil.rmtree(out_dir, ignore_errors=True)
+            cpu_ms = 10. * res['cpu_percent'] / max(res['fps_written'], 1e-9)
+            print(f"{res['script']:<34}{'on' if enabled else 'off':<8}{res['fps_written']:>7.2f}"
+                  f"{res['host_ms']['p50']:>10.2f}{res['host_ms']['p99']:>8.2f}{cpu_ms:>14.1f}")
+    print('host = get_buffer -> requeue in ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=200000)
+    parser.add_argument('--scripts', nargs='+', choices=sorted(SCRIPTS), default=['totality'])
+    parser.add_argument('--width', type=int, default=2448)
+    parser.add_argument('--height', type=int, default=2048)
+    parser.add_argument('--num-seq', type=int, default=1)
+    parser.add_argument('--num-images', type=int, default=10)
+    parser.add_argument('--output', default='frames', help='OUTPUT_MODE of the scripts')
+    args = parser.parse_args()
+
+    bench_calls(args.calls)
+    arena_sim.install(width=args.width, height=args.height)
+    bench_end_to_end(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+'''
+Online burst co-adding
+    Stacks the num_images frames of every (sequence, exposure) burst as they
+    arrive instead of rereading the FITS files afterwards. Only running
+    per-pixel sums are kept, a few frames' worth of memory per burst being
+    taken however long the burst is. When the burst is complete one stacked
+    frame and a noise map are written as <prefix>_<date>_seq<n>_exp<j>_stack.fits.
+
+    Methods:
+        mean     float64 sum and sum of squares (exact for 12-bit pixels);
+                 noise map = std / sqrt(n)
+        clipped  streaming sigma clipping: after the first ``warmup`` frames
+                 every sample further than clip_sigma standard deviations
+                 from the mean of the samples kept so far is left out;
+                 per-pixel frame counts go into extension NFRAMES
+        median   streaming (stochastic approximation) median estimate, moved
+                 towards every new sample by 1.2533 sigma / (n + 1), sigma
+                 from the clipped sums; noise map = 1.2533 std / sqrt(n)
+
+    Frames are folded in row bands, each with its own lock, so writer threads
+    can add frames of the same burst concurrently. With OUTPUT_MODE = 'none'
+    only the stacks are written.
+'''
+import os
+import threading
+
+import numpy as np
+from astropy.io import fits
+
+from frame_pipeline import DATE_OBS_FORMAT, FILENAME_DATE_FORMAT, count_dropped
+
+STACK_METHODS = ('mean', 'clipped', 'median')
+BAND_ROWS = 16          # float64 band temporaries stay in cache
+
+
+def stack_filename(prefix, meta):
+    '''
+    File name of a burst stack, e.g. eclipse.spectrum_<date>_seq0_exp1_stack.fits
+    '''
+    filename_date = meta['timestamp'].strftime(FILENAME_DATE_FORMAT)
+    return f"{prefix}_{filename_date}_seq{meta['seq']}_exp{meta['exp_index']+1}_stack.fits"
+
+
+class BurstStack:
+    '''
+    Running stack of one burst
+    '''
+
+    def __init__(self, height, width, method='mean', clip_sigma=3., warmup=5, min_sigma=1.,
+                 band_rows=BAND_ROWS):
+        if method not in STACK_METHODS:
+            raise ValueError(f'Unknown stack method {method!r}, expected one of {STACK_METHODS}')
+        self.method = method
+        self.clip_sigma = clip_sigma
+        self.warmup = max(warmup, 2)
+        self.min_sigma = min_sigma
+        self.band_rows = band_rows
+        self.width = width
+        self.sum = np.zeros((height, width), dtype=np.float64)
+        self.sum_sq = np.zeros((height, width), dtype=np.float64)
+        self.count = np.zeros((height, width), dtype=np.uint16) if method != 'mean' else None
+        self.median = np.zeros((height, width), dtype=np.float32) if method == 'median' else None
+        bands = range(0, height, band_rows)
+        self._locks = [threading.Lock() for _ in bands]
+        self._band_frames = [0 for _ in bands]
+        self._local = threading.local()
+        self.frames = 0
+        self._lock = threading.Lock()
+
+    def _scratch(self, rows):
+        scratch = getattr(self._local, 'scratch', None)
+        if scratch is None:
+            scratch = self._local.scratch = np.empty((5, self.band_rows, self.width))
+        return [plane[:rows] for plane in scratch]
+
+    def add(self, frame):
+        '''
+        Fold one frame into the stack. Thread safe.
+        '''
+        for band, lock in enumerate(self._locks):
+            rows = slice(band * self.band_rows, (band + 1) * self.band_rows)
+            raw = frame[rows]
+            x, *scratch = self._scratch(raw.shape[0])
+            np.copyto(x, raw)
+            with lock:
+                n = self._band_frames[band]
+                keep = self._clip(rows, x, n, *scratch) if self.count is not None else None
+                self.sum[rows] += x
+                work = scratch[-1]
+                np.multiply(x, x, out=work)
+                self.sum_sq[rows] += work
+                if self.count is not None:
+                    self.count[rows] += 1 if keep is None else keep
+                self._band_frames[band] = n + 1
+        with self._lock:
+            self.frames += 1
+
+    def _clip(self, rows, x, n, mean, variance, diff, work):
+        '''
+        Median step and clipping of one band against the clipped sums of the
+            previous n frames; zeroes rejected samples of x and returns the
+            keep mask (None while warming up)
+        '''
+        median = self.median[rows] if self.median is not None else None
+        if n == 0:
+            if median is not None:
+                np.copyto(median, x)
+            return None
+        total, count = self.sum[rows], self.count[rows]
+        np.divide(total, count, out=mean)
+        np.multiply(total, mean, out=variance)
+        np.subtract(self.sum_sq[rows], variance, out=variance)
+        variance /= np.maximum(count, 2) - 1
+        np.maximum(variance, self.min_sigma ** 2, out=variance)
+        if median is not None:
+            # Robbins-Monro step for the 50% quantile: sqrt(pi/2) sigma / (n + 1)
+            np.sqrt(variance, out=work)
+            work *= 1.2533 / (n + 1)
+            np.subtract(x, median, out=diff)
+            median += np.copysign(work, diff, out=work)
+        if n < self.warmup:
+            return None
+        np.subtract(x, mean, out=diff)
+        diff *= diff
+        variance *= self.clip_sigma ** 2
+        keep = diff <= variance
+        x *= keep
+        return keep
+
+    def result(self):
+        '''
+        (stacked frame, noise map, per-pixel frame count) as float32, float32, uint16
+        '''
+        count = self.count if self.count is not None else np.full(self.sum.shape, self.frames,
+                                                                  dtype=np.uint16)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            n = count.astype(np.float64)
+            mean = self.sum / n
+            variance = np.maximum(self.sum_sq / n - mean * mean, 0.) * n / np.maximum(n - 1, 1)
+            noise = np.sqrt(variance / n)
+        if self.method == 'median':
+            return self.median, (1.2533 * noise).astype(np.float32), count
+        return mean.astype(np.float32), noise.astype(np.float32), count
+
+
+def write_stack(path, stack, cards=()):
+    '''
+    Stacked frame as the primary HDU, noise map as extension NOISE (and per-pixel
+        frame counts as NFRAMES for clipped stacks)
+    '''
+    stacked, noise, count = stack.result()
+    primary = fits.PrimaryHDU(stacked)
+    for card in cards:
+        primary.header.append(card)
+    primary.header['NFRAMES'] = (stack.frames, 'frames stacked')
+    primary.header['STACK'] = (stack.method, 'stacking method')
+    if stack.method == 'clipped':
+        primary.header['CLIPSIG'] = (stack.clip_sigma, 'clipping threshold [sigma]')
+    hdus = [primary, fits.ImageHDU(noise, name='NOISE')]
+    if stack.method == 'clipped':
+        hdus.append(fits.ImageHDU(count, name='NFRAMES'))
+    fits.HDUList(hdus).writeto(path, overwrite=True)
+
+
+class BurstStackSink:
+    '''
+    Frame pipeline sink stacking every (sequence, exposure) burst. A stack is
+        written once burst_size frames have been added; close() writes
+        incomplete ones.
+    '''
+    stage = 'stack'
+
+    def __init__(self, out_dir, prefix, method='mean', **stack_kwargs):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.method = method
+        self.stack_kwargs = stack_kwargs
+        self._stacks = {}
+        self._dropped = {}
+        self._lock = threading.Lock()
+
+    def _stack(self, frame, meta):
+        key = (meta['seq'], meta['exp_index'])
+        with self._lock:
+            entry = self._stacks.get(key)
+            if entry is None:
+                stack = BurstStack(frame.shape[0], frame.shape[1], self.method, **self.stack_kwargs)
+                entry = self._stacks[key] = [stack, meta, self._dropped.pop(key, 0)]
+            return key, entry
+
+    def write(self, frame, meta):
+        key, entry = self._stack(frame, meta)
+        entry[0].add(frame)
+        with self._lock:
+            # DATE-OBS and file name of the first frame, whichever arrived first
+            if meta['frame_index'] < entry[1]['frame_index']:
+                entry[1] = meta
+            entry[2] += 1
+            done = entry[2] == meta['burst_size']
+            if done:
+                del self._stacks[key]
+        if done:
+            self._write(entry[0], entry[1])
+
+    def dropped(self, meta):
+        with self._lock:
+            entry = count_dropped(self._stacks, self._dropped, (meta['seq'], meta['exp_index']),
+                                  meta['burst_size'])
+        if entry is not None:
+            self._write(entry[0], entry[1])
+
+    def _write(self, stack, meta):
+        cards = [('DATE-OBS', meta['timestamp'].strftime(DATE_OBS_FORMAT), 'first frame of the burst'),
+                 ('EXPTIME', f"{meta['exposure_us']/1000./1000.}"),
+                 ('SEQ', meta['seq'], 'sequence number'),
+                 ('EXPNUM', meta['exp_index'] + 1, 'exposure of the ladder')]
+        write_stack(os.path.join(self.out_dir, stack_filename(self.prefix, meta)), stack, cards)
+
+    def close(self):
+        with self._lock:
+            entries = list(self._stacks.values())
+            self._stacks.clear()
+        for stack, meta, _ in entries:
+            self._write(stack, meta)
@@ -0,0 +1,500 @@
+'''
+Dark and flat reduction
+    Batch reduction of the frames written by the acquisition scripts:
+
+    - master bias, darks and flats are median combined per key (EXPTIME,
+      pixel format, ROI) in bands of rows, so memory stays within memory_mb
+      however many frames go in: every worker process reads its bands of all
+      the input frames through memory maps (only those rows are read) and
+      writes the median straight into the master, a float32 .npy mapped by
+      every worker
+    - flats have their dark subtracted and are scaled by their own median
+      (estimated from every 16th pixel) before the combination; the master
+      flat is normalised to a median of 1
+    - every science frame is reduced as (raw - dark) / flat in a process pool,
+      each task a run of frames: the raw frame is read through a memory map,
+      the masters are memory-mapped once per worker, and the result is
+      written as a float32 FITS file through a memory map of its data unit.
+      Pixels with a flat below MIN_FLAT are NaN.
+
+    A science frame takes the dark of its own key; without one, the bias plus
+    the thermal part (dark - bias) of the dark of the nearest EXPTIME scaled
+    to its EXPTIME, or the bias alone. It takes the flat of its own key, else
+    the flat of the same pixel format and ROI nearest in EXPTIME, else none.
+
+    The masters are cached in cache_dir (default: calibration_cache in the
+    output directory), named after their key, with masters.json listing the
+    files (path, size, mtime) each was built from; a master whose inputs are
+    unchanged is not built again.
+
+    The pixel format is the PIXFMT card where a header has one, else the
+    stored data type; the ROI is (OFFSETX, OFFSETY, NAXIS1, NAXIS2), the
+    offsets 0 where the header has none. Plain per-frame files are mapped,
+    compressed ones (.fits.fz) are decompressed in full.
+
+    Burst cubes (OUTPUT_MODE = 'cube', fits_cube.py) hold the same Mono12
+    values as the per-frame files, without the BZERO offset, and share
+    their key. A science cube is reduced plane by plane into a float32 cube
+    (NAXIS3 = frames) with the FRAMES table copied over; planes the burst
+    never filled are NaN. In masters every filled plane counts as a frame.
+
+Usage:
+    python calibration.py --science "D:/eclipse/totality/*.fits" --darks "D:/eclipse/darks/*.fits" \\
+        --flats "D:/eclipse/flats/*.fits" --out D:/eclipse/reduced --workers 8
+    python calibration.py --science "run/*.fits" --darks "darks/*.fits" --bias "bias/*.fits" \\
+        --out reduced --memory-mb 1024
+'''
+import argparse
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+from fits_compressed import image_hdu
+from frame_pipeline import FITS_BLOCK
+
+MEMORY_MB = 256             # per worker, for the bands of a median combination
+FRAMES_PER_TASK = 8
+MIN_FLAT = 0.05
+NORM_STRIDE = 16
+CACHE_DIR = 'calibration_cache'
+CACHE_INDEX = 'masters.json'
+CALIBRATED_SUFFIX = '_cal'
+
+
+def frame_key(header):
+    '''
+    (EXPTIME in microseconds, pixel format, ROI) of a frame header
+    '''
+    if 'ZBITPIX' in header:
+        bitpix, zero = header['ZBITPIX'], header.get('BZERO', 0)
+    else:
+        bitpix, zero = header['BITPIX'], header.get('BZERO', 0)
+    # burst cubes store Mono12 unsigned values as plain 16 bit
+    unsigned = zero == 32768 or (header.get('NAXIS') == 3 and zero == 0)
+    pixel_format = header.get('PIXFMT') or ('uint16' if bitpix == 16 and unsigned
+                                             else f'bitpix{bitpix}')
+    width = header.get('ZNAXIS1', header['NAXIS1'])
+    height = header.get('ZNAXIS2', header['NAXIS2'])
+    roi = (int(header.get('OFFSETX', 0)), int(header.get('OFFSETY', 0)), int(width), int(height))
+    return int(round(float(header['EXPTIME']) * 1e6)), pixel_format, roi
+
+
+def key_name(kind, key):
+    exposure_us, pixel_format, (x, y, width, height) = key
+    return f'{kind}_{exposure_us}us_{pixel_format}_{x}_{y}_{width}x{height}'
+
+
+def read_keys(paths):
+    '''
+    [(path, key)] from the headers alone. Module level so it runs in the
+        worker processes.
+    '''
+    keys = []
+    for path in paths:
+        header = fits.getheader(path, 1 if path.endswith('.fz') else 0)
+        naxis = header.get('ZNAXIS', header['NAXIS'])
+        if naxis not in (2, 3) or (naxis == 3 and path.endswith('.fz')):
+            raise ValueError(f'{path}: NAXIS = {naxis}, expected a frame or a burst cube')
+        keys.append((path, frame_key(header)))
+    return keys
+
+
+def group_frames(paths, executor, per_task=64):
+    '''
+    {key: [path, ...]} of frame files, headers read in parallel
+    '''
+    groups = {}
+    futures = [executor.submit(read_keys, paths[n:n + per_task])
+               for n in range(0, len(paths), per_task)]
+    for future in futures:
+        for path, key in future.result():
+            groups.setdefault(key, []).append(path)
+    return groups
+
+
+def open_frame(path):
+    '''
+    (data, zero) of a frame or burst cube: the raw stored values,
+        memory-mapped for plain files, and the BZERO to add to them
+    '''
+    if path.endswith('.fz'):
+        with fits.open(path) as hdul:
+            return image_hdu(hdul).data.astype(np.float32), 0.
+    hdul = fits.open(path, memmap=True, do_not_scale_image_data=True)
+    hdu = hdul[0]
+    return hdu.data, float(hdu.header.get('BZERO', 0.))
+
+
+def cube_filled(path, planes):
+    '''
+    Which planes of a burst cube hold a frame (its FRAMES table), all of
+        them without the table
+    '''
+    with fits.open(path) as hdul:
+        if 'FRAMES' not in hdul:
+            return np.ones(planes, dtype=bool)
+        return np.asarray(hdul['FRAMES'].data['FILLED'], dtype=bool)
+
+
+def frame_sources(path):
+    '''
+    [(data, zero)] of the frames in a file: the frame itself, or every
+        filled plane of a burst cube
+    '''
+    data, zero = open_frame(path)
+    if data.ndim == 2:
+        return [(data, zero)]
+    filled = cube_filled(path, len(data))
+    return [(data[n], zero) for n in range(len(data)) if filled[n]]
+
+
+def read_rows(source, start, stop, out):
+    data, zero = source
+    np.copyto(out, data[start:stop], casting='unsafe')
+    if zero:
+        out += zero
+    return out
+
+
+def load_master(path, cache={}):
+    # masters are mapped once per worker process
+    master = cache.get(path)
+    if master is None:
+        master = cache[path] = np.load(path, mmap_mode='r')
+    return master
+
+
+def scaled_dark(dark_path, scaling, cache={}):
+    # bias + (dark - bias) x factor, once per worker process
+    if scaling is None:
+        return load_master(dark_path)
+    key = (dark_path,) + tuple(scaling)
+    dark = cache.get(key)
+    if dark is None:
+        bias_path, factor = scaling
+        bias = load_master(bias_path)
+        dark = cache[key] = bias + (load_master(dark_path) - bias) * np.float32(factor)
+    return dark
+
+
+def flat_mask(flat_path, cache={}):
+    # pixels of a master flat too dark to divide by, once per worker process
+    mask = cache.get(flat_path)
+    if mask is None:
+        mask = cache[flat_path] = load_master(flat_path) < MIN_FLAT
+    return mask
+
+
+def frame_norms(path, dark=None):
+    '''
+    Median of every NORM_STRIDE-th pixel of every frame of a flat file
+        (see frame_sources()), less its dark
+    '''
+    norms = []
+    for data, zero in frame_sources(path):
+        sample = np.asarray(data[::NORM_STRIDE, ::NORM_STRIDE], dtype=np.float32) + zero
+        if dark is not None:
+            sample -= scaled_dark(*dark)[::NORM_STRIDE, ::NORM_STRIDE]
+        norms.append(float(np.median(sample)))
+    return norms
+
+
+def combine_rows(paths, master_path, start, stop, memory_mb, dark=None, norms=None):
+    '''
+    Median of rows start:stop of the frames of paths (see frame_sources())
+        into the master, in bands that fit memory_mb. With dark (see
+        Calibration.dark_for()) the dark is subtracted first, with norms
+        every frame is divided by its norm. Module level so it runs in the
+        worker processes.
+    '''
+    sources = [source for path in paths for source in frame_sources(path)]
+    master = np.load(master_path, mmap_mode='r+')
+    width = master.shape[1]
+    band = max(1, int(memory_mb * 1024 * 1024 // (len(sources) * width * 4 * 2)))
+    stack = np.empty((len(sources), min(band, stop - start), width), dtype=np.float32)
+    if dark is not None:
+        dark = scaled_dark(*dark)
+    for row in range(start, stop, band):
+        rows = min(band, stop - row)
+        planes = stack[:, :rows]
+        for n, source in enumerate(sources):
+            read_rows(source, row, row + rows, planes[n])
+        if dark is not None:
+            planes -= dark[row:row + rows]
+        if norms is not None:
+            planes /= np.asarray(norms, dtype=np.float32)[:, None, None]
+        master[row:row + rows] = np.median(planes, axis=0)
+    master.flush()
+    return stop - start
+
+
+class MasterCache:
+    '''
+    Masters on disk, one float32 .npy per kind and key, reused while their
+        input files are unchanged
+    '''
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.index_path = os.path.join(directory, CACHE_INDEX)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        self.built = 0
+        self.reused = 0
+        self.build_s = 0.
+
+    @staticmethod
+    def inputs(paths):
+        return [[os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)]
+                for path in sorted(paths)]
+
+    def master(self, kind, key, paths, executor, workers, memory_mb=MEMORY_MB, dark=None):
+        '''
+        Path of the master of paths, built (in parallel over bands of rows)
+            unless the cache has it. dark is subtracted from flats.
+        '''
+        name = key_name(kind, key)
+        path = os.path.join(self.directory, name + '.npy')
+        inputs = self.inputs(paths)
+        entry = self.index.get(name)
+        dark_entry = json.loads(json.dumps(dark))
+        if entry is not None and entry['inputs'] == inputs and entry.get('dark') == dark_entry \
+                and os.path.exists(path):
+            self.reused += 1
+            return path
+        t = time.perf_counter()
+        _, _, (_, _, width, height) = key
+        np.lib.format.open_memmap(path, 'w+', np.float32, (height, width)).flush()
+        norms = None
+        if kind == 'flat':
+            norms = [norm for file_norms in executor.map(frame_norms, paths, [dark] * len(paths))
+                     for norm in file_norms]
+        tasks = max(workers, 1) * 2
+        bounds = np.linspace(0, height, min(tasks, height) + 1).astype(int)
+        futures = [executor.submit(combine_rows, paths, path, start, stop, memory_mb, dark, norms)
+                   for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+        for future in futures:
+            future.result()
+        if kind == 'flat':
+            master = np.load(path, mmap_mode='r+')
+            master /= np.median(master[::NORM_STRIDE, ::NORM_STRIDE])
+            master.flush()
+            del master
+        self.index[name] = {'kind': kind, 'inputs': inputs, 'dark': dark_entry}
+        with open(self.index_path, 'w') as f:
+            json.dump(self.index, f, indent=1)
+        self.built += 1
+        self.build_s += time.perf_counter() - t
+        return path
+
+
+class Calibration:
+    '''
+    Master bias, darks and flats by key, and the choice of masters for a
+        science frame (see module docstring)
+    '''
+
+    def __init__(self, bias=None, darks=None, flats=None):
+        self.bias = bias or {}
+        self.darks = darks or {}
+        self.flats = flats or {}
+
+    @classmethod
+    def build(cls, cache, executor, workers, bias=(), darks=(), flats=(), memory_mb=MEMORY_MB):
+        '''
+        Masters of the bias, dark and flat frames (lists of paths), grouped
+            by key; flats have the dark for their key subtracted
+        '''
+        calibration = cls()
+        for kind, paths, masters in (('bias', bias, calibration.bias),
+                                     ('dark', darks, calibration.darks)):
+            for key, group in sorted(group_frames(list(paths), executor).items()):
+                masters[key] = cache.master(kind, key, group, executor, workers, memory_mb)
+        for key, group in sorted(group_frames(list(flats), executor).items()):
+            calibration.flats[key] = cache.master('flat', key, group, executor, workers,
+                                                  memory_mb, calibration.dark_for(key))
+        return calibration
+
+    @staticmethod
+    def _nearest(masters, key):
+        exposure_us, pixel_format, roi = key
+        candidates = [k for k in masters if k[1:] == (pixel_format, roi)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda k: abs(k[0] - exposure_us))
+
+    def dark_for(self, key):
+        '''
+        (dark path, None) for a master of the key; (dark path, (bias path,
+            factor)) for a scaled dark; (bias path, None) for the bias
+            alone; None without any
+        '''
+        if key in self.darks:
+            return self.darks[key], None
+        bias = self._nearest(self.bias, key)
+        if bias is None:
+            return None
+        nearest = self._nearest(self.darks, key)
+        if nearest is None or nearest[0] == 0:
+            return self.bias[bias], None
+        return self.darks[nearest], (self.bias[bias], key[0] / nearest[0])
+
+    def flat_for(self, key):
+        if key in self.flats:
+            return self.flats[key]
+        nearest = self._nearest(self.flats, key)
+        return self.flats[nearest] if nearest is not None else None
+
+
+def calibrated_header(header, dark, flat):
+    naxis = header.get('ZNAXIS', header['NAXIS'])
+    cards = fits.Header([('SIMPLE', True), ('BITPIX', -32), ('NAXIS', naxis),
+                         ('NAXIS1', header.get('ZNAXIS1', header['NAXIS1'])),
+                         ('NAXIS2', header.get('ZNAXIS2', header['NAXIS2']))])
+    if naxis == 3:
+        cards['NAXIS3'] = (header['NAXIS3'], 'frames in the burst')
+        cards['EXTEND'] = True
+    for key in ('DATE-OBS', 'EXPTIME', 'SEQ', 'EXPNUM', 'FRAMEID', 'CAMTIME', 'DATE-RCV', 'PHASE',
+                'DECIMATE', 'AESCALE', 'AESTEP', 'PIXFMT', 'OFFSETX', 'OFFSETY'):
+        if key in header:
+            cards[key] = header[key]
+    cards['BUNIT'] = 'DN'
+    if dark is not None:
+        cards['CALDARK'] = (os.path.basename(dark[0]), 'master dark' if dark[1] is None else
+                            f'scaled x{dark[1][1]:.4f} over the bias')
+    if flat is not None:
+        cards['CALFLAT'] = os.path.basename(flat)
+    return cards
+
+
+def float_frame(path, header, shape):
+    '''
+    Create a float32 FITS frame or cube of shape and return a memory map of
+        its data unit
+    '''
+    header_bytes = header.tostring().encode('ascii')
+    data_bytes = int(np.prod(shape)) * 4
+    with open(path, 'wb') as f:
+        f.write(header_bytes)
+        f.truncate(len(header_bytes) + data_bytes + (-data_bytes % FITS_BLOCK))
+    return np.memmap(path, dtype='>f4', mode='r+', offset=len(header_bytes), shape=shape)
+
+
+def calibrate_frames(tasks):
+    '''
+    Reduce a run of science frames and burst cubes: tasks are (path,
+        out_path, dark, flat) with dark as returned by Calibration.dark_for().
+        Cubes are reduced plane by plane. Module level so it runs in the
+        worker processes; returns the number of frames.
+    '''
+    frame = None
+    frames = 0
+    for path, out_path, dark, flat in tasks:
+        header = fits.getheader(path, 1 if path.endswith('.fz') else 0)
+        data, zero = open_frame(path)
+        cube = data.ndim == 3
+        planes = data if cube else data[np.newaxis]
+        filled = cube_filled(path, len(data)) if cube else [True]
+        out = float_frame(out_path, calibrated_header(header, dark, flat), data.shape)
+        out_planes = out if cube else out[np.newaxis]
+        for plane, out_plane, plane_filled in zip(planes, out_planes, filled):
+            if not plane_filled:
+                out_plane[:] = np.nan
+                continue
+            if frame is None or frame.shape != plane.shape:
+                frame = np.empty(plane.shape, dtype=np.float32)
+            read_rows((plane, zero), 0, frame.shape[0], frame)
+            if dark is not None:
+                frame -= scaled_dark(*dark)
+            if flat is not None:
+                mask = flat_mask(flat)
+                np.divide(frame, load_master(flat), out=frame, where=~mask)
+                frame[mask] = np.nan
+            out_plane[:] = frame
+            frames += 1
+        out.flush()
+        del out, out_planes
+        if cube:
+            with fits.open(path) as hdul:
+                if 'FRAMES' in hdul:
+                    fits.append(out_path, hdul['FRAMES'].data, hdul['FRAMES'].header)
+    return frames
+
+
+def calibrated_filename(path):
+    name = os.path.basename(path)
+    for extension in ('.fits.fz', '.fits'):
+        if name.endswith(extension):
+            return name[:-len(extension)] + CALIBRATED_SUFFIX + '.fits'
+    return name + CALIBRATED_SUFFIX + '.fits'
+
+
+def reduce_frames(paths, calibration, out_dir, executor, frames_per_task=FRAMES_PER_TASK):
+    '''
+    Reduce science frames into out_dir in parallel; returns the number of
+        frames and how many had no dark or no flat
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    tasks = []
+    missing = {'dark': 0, 'flat': 0}
+    for key, group in sorted(group_frames(list(paths), executor).items()):
+        dark, flat = calibration.dark_for(key), calibration.flat_for(key)
+        missing['dark'] += len(group) if dark is None else 0
+        missing['flat'] += len(group) if flat is None else 0
+        tasks += [(path, os.path.join(out_dir, calibrated_filename(path)), dark, flat)
+                  for path in group]
+    futures = [executor.submit(calibrate_frames, tasks[n:n + frames_per_task])
+               for n in range(0, len(tasks), frames_per_task)]
+    return sum(future.result() for future in futures), missing
+
+
+def expand(patterns):
+    return sorted(path for pattern in patterns or () for path in glob.glob(pattern))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--science', nargs='+', required=True, help='frames to reduce (globs ok)')
+    parser.add_argument('--darks', nargs='+', help='dark frames (globs ok)')
+    parser.add_argument('--flats', nargs='+', help='flat frames (globs ok)')
+    parser.add_argument('--bias', nargs='+', help='bias frames (globs ok)')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--cache', help=f'master cache directory (default: <out>/{CACHE_DIR})')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--memory-mb', type=float, default=MEMORY_MB,
+                        help='memory per worker for the median combination')
+    args = parser.parse_args()
+
+    workers = args.workers or os.cpu_count()
+    cache = MasterCache(args.cache or os.path.join(args.out, CACHE_DIR))
+    science = expand(args.science)
+    with ProcessPoolExecutor(workers) as executor:
+        t_start = time.time()
+        calibration = Calibration.build(cache, executor, workers, expand(args.bias),
+                                        expand(args.darks), expand(args.flats), args.memory_mb)
+        masters_s = time.time() - t_start
+        print(f'Masters: {len(calibration.bias)} bias, {len(calibration.darks)} darks, '
+              f'{len(calibration.flats)} flats ({cache.built} built in {masters_s:.1f} s, '
+              f'{cache.reused} from the cache)')
+        t_start = time.time()
+        frames, missing = reduce_frames(science, calibration, args.out, executor)
+        elapsed = time.time() - t_start
+    print(f'Reduced {frames} frames in {elapsed:.1f} s ({frames / max(elapsed, 1e-9):.1f} '
+          f'frames/s, {workers} workers)')
+    for kind, count in missing.items():
+        if count:
+            print(f'{count} frames had no {kind} to match')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+'''
+Exposure ladder on the camera sequencer
+    Writing ExposureTime between bursts costs a node round trip, and the new
+    value only applies one frame later, so every step of the ladder also
+    costs a discarded frame. The sequencer feature set lets the camera switch
+    exposures itself: each sequencer set is saved with one ExposureTime of
+    the ladder and points to the next set, and with SequencerMode On the
+    camera steps to the next set at the end of every frame. Exposures then
+    follow exp1, exp2, exp3, exp1, ... frame by frame with no dummy frames
+    and no node writes during the run.
+
+    Programming happens once, before start_stream, together with the chunk
+    data that says which set every frame was taken with: frames are tagged
+    from their ChunkSequencerSetActive, or where the camera lacks that chunk,
+    from the ladder exposure nearest their ChunkExposureTime, so dropped
+    frames, wrapping GigE block IDs and restarted streams do not shift the
+    ladder. Without either chunk the frame ID is the last resort: frame IDs
+    count from 1 after start_stream and the stream starts on set 0, so frame
+    k was taken with set (k - 1) % len(ladder) as long as the IDs neither wrap
+    nor restart. The initial ChunkModeActive is part of the node snapshot the
+    scripts restore at the end (node_cache.RESTORE_NODES).
+'''
+import numpy as np
+
+SEQUENCER_NODES = ['SequencerMode', 'SequencerConfigurationMode', 'SequencerSetSelector',
+                   'SequencerSetSave', 'SequencerPathSelector', 'SequencerSetNext',
+                   'SequencerTriggerSource', 'SequencerSetStart']
+# chunks a frame's sequencer set is read from, in order of preference
+SEQUENCER_CHUNKS = ('SequencerSetActive', 'ExposureTime')
+
+
+def sequencer_nodes(nodemap):
+    nodes = nodemap.get_node(SEQUENCER_NODES)
+    missing = [name for name, node in nodes.items() if node is None]
+    if missing:
+        raise Exception(f"Camera has no sequencer nodes {missing}")
+    return nodes
+
+
+def enable_sequencer_chunks(nodemap):
+    '''
+    Turn chunk data on with the SEQUENCER_CHUNKS the camera has; returns
+        their chunk node names, empty without chunk data
+    '''
+    nodes = nodemap.get_node(['ChunkModeActive', 'ChunkSelector', 'ChunkEnable'])
+    if any(node is None for node in nodes.values()):
+        return []
+    entries = nodes['ChunkSelector'].enumentry_names or ()
+    enabled = []
+    for name in SEQUENCER_CHUNKS:
+        if name in entries:
+            nodes['ChunkSelector'].value = name
+            nodes['ChunkEnable'].value = True
+            enabled.append(f'Chunk{name}')
+    if enabled:
+        nodes['ChunkModeActive'].value = True
+    return enabled
+
+
+def program_exposure_ladder(nodemap, exposures):
+    '''
+    Save one sequencer set per exposure (in microseconds), each advancing to
+        the next at the end of a frame, and start the sequence on set 0.
+        Returns the SequencerLadder used to tag frames.
+    '''
+    nodes = sequencer_nodes(nodemap)
+    if len(exposures) > nodes['SequencerSetSelector'].max + 1:
+        raise Exception(f"{len(exposures)} exposures do not fit the "
+                        f"{nodes['SequencerSetSelector'].max + 1} sequencer sets")
+    exposure_time = nodemap.get_node('ExposureTime')
+    nodes['SequencerMode'].value = 'Off'
+    nodes['SequencerConfigurationMode'].value = 'On'
+    for n, exposure_us in enumerate(exposures):
+        nodes['SequencerSetSelector'].value = n
+        exposure_time.value = exposure_us
+        nodes['SequencerPathSelector'].value = 0
+        nodes['SequencerSetNext'].value = (n + 1) % len(exposures)
+        nodes['SequencerTriggerSource'].value = 'FrameEnd'
+        nodes['SequencerSetSave'].execute()
+    nodes['SequencerConfigurationMode'].value = 'Off'
+    nodes['SequencerSetStart'].value = 0
+    return SequencerLadder(exposures, enable_sequencer_chunks(nodemap))
+
+
+def start_sequencer(nodemap):
+    nodemap.get_node('SequencerMode').value = 'On'
+
+
+def stop_sequencer(nodemap):
+    nodemap.get_node('SequencerMode').value = 'Off'
+
+
+class SequencerLadder:
+    '''
+    Exposure of each frame of a sequencer-driven stream, and per-exposure
+        frame counts of the burst being taken
+    '''
+
+    def __init__(self, exposures, chunks=(), first_frame_id=1):
+        self.exposures = list(exposures)
+        self.chunks = list(chunks)
+        self.first_frame_id = first_frame_id
+        self.counts = [0] * len(self.exposures)
+        self.last_index = None
+
+    def exp_index(self, image):
+        '''
+        Ladder index of the exposure a buffer was taken with (see module
+            docstring)
+        '''
+        values = {}
+        if self.chunks and image.has_chunkdata:
+            values = {name: node.value for name, node in image.get_chunk(self.chunks).items()
+                      if node is not None}
+        if 'ChunkSequencerSetActive' in values:
+            return int(values['ChunkSequencerSetActive']) % len(self.exposures)
+        if 'ChunkExposureTime' in values:
+            distance = np.abs(np.subtract(self.exposures, float(values['ChunkExposureTime'])))
+            return int(np.argmin(distance))
+        return (image.frame_id - self.first_frame_id) % len(self.exposures)
+
+    def next_exposure(self):
+        '''
+        Exposure of the frame following the last tagged one
+        '''
+        if self.last_index is None:
+            return self.exposures[0]
+        return self.exposures[(self.last_index + 1) % len(self.exposures)]
+
+    def start_burst(self):
+        self.counts = [0] * len(self.exposures)
+
+    def complete(self, burst_size):
+        return min(self.counts) >= burst_size
+
+    def tag(self, image, meta):
+        '''
+        Fill in exp_index, exposure_us and frame_index of a buffer's frame.
+            Returns False when that exposure already has burst_size frames.
+        '''
+        j = self.exp_index(image)
+        self.last_index = j
+        if self.counts[j] >= meta['burst_size']:
+            return False
+        meta['exp_index'] = j
+        meta['exposure_us'] = self.exposures[j]
+        meta['frame_index'] = self.counts[j]
+        self.counts[j] += 1
+        return True
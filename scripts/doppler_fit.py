@@ -0,0 +1,390 @@
+'''
+K-corona Doppler fitting
+    The K-corona is photospheric light Thomson scattered by the coronal
+    electrons, so its Fraunhofer lines are smeared by the electron motions:
+    the Ca II H and K lines blend into one broad dip near LINE whose width
+    gives the electron temperature and whose shift gives their bulk velocity.
+    Every spectrum (every spatial bin of every frame) is fitted with
+
+        model(w) = sum_k c_k x(w)^k * (1 - depth * exp(-(w - LINE - shift)^2 / (2 width^2)))
+
+    a continuum polynomial of CONTINUUM_ORDER in x, the wavelength scaled to
+    [-1, 1] over the spectrum, times a Gaussian dip: the dip is part of the
+    scattered spectrum, so it scales with the continuum and a sloping
+    continuum does not pull its centre. For scattering at 90 degrees (the
+    plane of the sky) the scattering vector is SCATTER times the wavenumber,
+    so
+
+        temperature = m_e (c width / LINE)^2 / (2 k)
+        velocity    = c shift / (SCATTER LINE)     (along the scattering vector)
+
+    The fit is batched Levenberg-Marquardt: BATCH spectra at a time, with
+    their Jacobians stacked into one (spectra, parameters, columns) array, so
+    an iteration is a few array operations and one batched solve of the
+    normal equations whatever the number of spectra, and every spectrum keeps
+    its own damping and stops on its own. The start is the linear least
+    squares fit of a continuum plus a dip at rest TEMPERATURE0 wide, one
+    lstsq for the whole batch. Uncertainties are the square roots of the
+    diagonal of the covariance inv(J^T J) scaled by the reduced chi-square,
+    so they need no gain or noise model.
+
+    Wavelengths are linear in the sensor column: wavelength0 + dispersion *
+    column; the defaults are placeholders, pass the spectrograph's
+    calibration. The columns of a spectra table start at the x0 of its
+    SLITROI card.
+
+    Input: spectra tables (*_spectra.fits, see spectrum_extract.py) or frames
+    (per-frame FITS files, burst cubes, spool segments) extracted with the
+    given slit geometry. Output per burst, <prefix>_<date>_seq<n>_exp<j>_doppler.fits
+    with (frames, bins) images VELOCITY and VELOCITY_ERR (km/s), TEMPERATURE
+    and TEMPERATURE_ERR (K), DEPTH (dip depth relative to the continuum),
+    CHI2 (reduced, DN^2) and CONVERGED; the values of fits that did not
+    converge are NaN. --stack fits the mean spectrum of each burst instead
+    (one row). Bursts are fitted in parallel, one worker process per spectra
+    table or sequence.
+
+Usage:
+    python doppler_fit.py "D:/eclipse/spectra/*_spectra.fits" --out D:/eclipse/doppler \\
+        --wavelength0 3620 --dispersion 0.31
+    python doppler_fit.py "D:/eclipse/totality/*.fits" --out doppler --roi 900 1150 0 2448 --bins 25 --stack
+'''
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+from frame_pipeline import DATE_OBS_FORMAT, FILENAME_DATE_FORMAT
+
+C_KMS = 299792.458
+K_B = 1.380649e-23
+M_E = 9.1093837015e-31
+LINE = 3951.            # Angstrom, Ca II H (3968.5) and K (3933.7) blended by the electrons
+SCATTER = np.sqrt(2.)   # |k_out - k_in| / k for scattering at 90 degrees
+TEMPERATURE0 = 1.0e6    # K, starting width of the dip
+CONTINUUM_ORDER = 2
+WAVELENGTH0 = 3600.     # Angstrom at sensor column 0
+DISPERSION = 0.3        # Angstrom per column
+BATCH = 32              # spectra per batched solve, small enough to stay in cache
+MAX_ITER = 50
+TOLERANCE = 1e-6        # relative parameter step to stop at
+MAPS = ('VELOCITY', 'VELOCITY_ERR', 'TEMPERATURE', 'TEMPERATURE_ERR', 'DEPTH', 'CHI2')
+
+
+def width_of(temperature, line=LINE):
+    '''
+    Gaussian width (Angstrom) of the dip for an electron temperature (K)
+    '''
+    return line * np.sqrt(2. * K_B * temperature / M_E) / (C_KMS * 1e3)
+
+
+def temperature_of(width, line=LINE):
+    return M_E * (C_KMS * 1e3 * width / line) ** 2 / (2. * K_B)
+
+
+def column_wavelengths(columns, x0=0, wavelength0=WAVELENGTH0, dispersion=DISPERSION):
+    return wavelength0 + dispersion * (x0 + np.arange(columns, dtype=np.float64))
+
+
+class DopplerModel:
+    '''
+    Continuum times Gaussian dip on a fixed wavelength grid (see module
+        docstring); parameters are (c_0 .. c_order, depth, shift, width)
+    '''
+
+    def __init__(self, wavelength, line=LINE, order=CONTINUUM_ORDER):
+        self.wavelength = np.asarray(wavelength, dtype=np.float64)
+        self.line = float(line)
+        self.order = int(order)
+        if self.wavelength.size <= self.order + 4:
+            raise ValueError(f'{self.wavelength.size} columns are too few to fit {self.order + 4} parameters')
+        mid = 0.5 * (self.wavelength[0] + self.wavelength[-1])
+        half = 0.5 * (self.wavelength[-1] - self.wavelength[0])
+        x = (self.wavelength - mid) / half
+        self.basis = np.stack([x ** k for k in range(self.order + 1)], axis=1)
+        self.line_basis = ((self.line - mid) / half) ** np.arange(self.order + 1)
+        self.offset = self.wavelength - self.line
+        self.parameters = self.order + 4
+
+    def terms(self, params):
+        '''
+        (distance from the dip centre in widths, dip, continuum), each
+            (spectra, columns)
+        '''
+        distance = (self.offset - params[:, -2:-1]) / params[:, -1:]
+        return (distance, np.exp(-0.5 * distance * distance),
+                params[:, :self.order + 1] @ self.basis.T)
+
+    def evaluate(self, params, terms=None):
+        _, dip, continuum = self.terms(params) if terms is None else terms
+        return continuum * (1. - params[:, -3:-2] * dip)
+
+    def jacobian(self, params, terms=None):
+        '''
+        Derivatives of the model, (spectra, parameters, columns): parameters
+            first so every derivative is written as one contiguous row
+        '''
+        k = self.order + 1
+        distance, dip, continuum = self.terms(params) if terms is None else terms
+        jacobian = np.empty((len(params), self.parameters, self.wavelength.size))
+        jacobian[:, :k] = self.basis.T * (1. - params[:, -3:-2] * dip)[:, np.newaxis]
+        jacobian[:, k] = -continuum * dip
+        dip_slope = -continuum * params[:, -3:-2] * dip * distance / params[:, -1:]
+        jacobian[:, k + 1] = dip_slope
+        jacobian[:, k + 2] = dip_slope * distance
+        return jacobian
+
+    def initial(self, spectra):
+        '''
+        Linear fit of a continuum plus a dip at rest and TEMPERATURE0 wide,
+            all spectra in one lstsq; the depth is the dip over the continuum
+            at the line
+        '''
+        width = width_of(TEMPERATURE0, self.line)
+        design = np.column_stack([self.basis, np.exp(-0.5 * (self.offset / width) ** 2)])
+        coefficients = np.linalg.lstsq(design, spectra.T, rcond=None)[0].T
+        params = np.empty((len(spectra), self.parameters))
+        params[:, :-3] = coefficients[:, :-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            params[:, -3] = -coefficients[:, -1] / (coefficients[:, :-1] @ self.line_basis)
+        params[:, -2] = 0.
+        params[:, -1] = width
+        return params
+
+    def _fit_batch(self, spectra, max_iter):
+        params = self.initial(spectra)
+        # the terms of the accepted parameters are kept for the next Jacobian
+        distance, dip, continuum = self.terms(params)
+        residual = spectra - self.evaluate(params, (distance, dip, continuum))
+        cost = np.einsum('nl,nl->n', residual, residual)
+        damping = np.full(len(spectra), 1e-3)
+        # spectra without a continuum at the line (blank ones) are not fitted
+        active = np.isfinite(params).all(axis=1)
+        params[~active, :-1] = 0.
+        converged = np.zeros(len(spectra), dtype=bool)
+        for _ in range(max_iter):
+            rows = np.flatnonzero(active)
+            if rows.size == 0:
+                break
+            jacobian = self.jacobian(params[rows], (distance[rows], dip[rows], continuum[rows]))
+            normal = jacobian @ jacobian.transpose(0, 2, 1)
+            gradient = (jacobian @ residual[rows, :, np.newaxis])[..., 0]
+            diagonal = np.diagonal(normal, axis1=1, axis2=2)
+            # Marquardt scaling, floored so a vanishing dip cannot make the system singular
+            scale = np.maximum(diagonal, 1e-12 * diagonal.max(axis=1, keepdims=True) + 1e-300)
+            damped = normal + np.einsum('np,pq->npq', damping[rows, np.newaxis] * scale,
+                                        np.eye(self.parameters))
+            step = np.linalg.solve(damped, gradient[..., np.newaxis])[..., 0]
+            trial = params[rows] + step
+            trial[:, -1] = np.abs(trial[:, -1])
+            trial_terms = self.terms(trial)
+            trial_residual = spectra[rows] - self.evaluate(trial, trial_terms)
+            trial_cost = np.einsum('nl,nl->n', trial_residual, trial_residual)
+            better = trial_cost < cost[rows]
+            accepted = rows[better]
+            params[accepted] = trial[better]
+            distance[accepted] = trial_terms[0][better]
+            dip[accepted] = trial_terms[1][better]
+            continuum[accepted] = trial_terms[2][better]
+            residual[accepted] = trial_residual[better]
+            cost[accepted] = trial_cost[better]
+            damping[rows] = np.where(better, damping[rows] * 0.1, damping[rows] * 10.)
+            small = np.all(np.abs(step) <= TOLERANCE * (np.abs(params[rows]) + TOLERANCE), axis=1)
+            done = better & small
+            converged[rows[done]] = True
+            # a damping this large means no step reduces the cost any more: a minimum
+            stuck = ~better & (damping[rows] > 1e10)
+            converged[rows[stuck]] = True
+            active[rows[done | stuck]] = False
+        jacobian = self.jacobian(params, (distance, dip, continuum))
+        covariance = np.linalg.pinv(jacobian @ jacobian.transpose(0, 2, 1))
+        chi2 = cost / (self.wavelength.size - self.parameters)
+        errors = np.sqrt(np.abs(np.diagonal(covariance, axis1=1, axis2=2)) * chi2[:, np.newaxis])
+        return params, errors, chi2, converged
+
+    def fit(self, spectra, batch=BATCH, max_iter=MAX_ITER):
+        '''
+        Fit (spectra, columns); returns {name: (spectra,) array} for MAPS and
+            CONVERGED
+        '''
+        spectra = np.asarray(spectra, dtype=np.float64).reshape(-1, self.wavelength.size)
+        finite = np.isfinite(spectra).all(axis=1)
+        spectra = np.where(finite[:, np.newaxis], spectra, 0.)
+        count = len(spectra)
+        params = np.zeros((count, self.parameters))
+        errors = np.zeros((count, self.parameters))
+        chi2 = np.zeros(count)
+        converged = np.zeros(count, dtype=bool)
+        for start in range(0, count, batch):
+            stop = min(start + batch, count)
+            (params[start:stop], errors[start:stop], chi2[start:stop],
+             converged[start:stop]) = self._fit_batch(spectra[start:stop], max_iter)
+        converged &= finite & (params[:, -3] > 0)
+        shift, width = params[:, -2], params[:, -1]
+        temperature = temperature_of(width, self.line)
+        maps = {'VELOCITY': C_KMS * shift / (SCATTER * self.line),
+                'VELOCITY_ERR': C_KMS * errors[:, -2] / (SCATTER * self.line),
+                'TEMPERATURE': temperature,
+                'TEMPERATURE_ERR': 2. * temperature * errors[:, -1] / width,
+                'DEPTH': params[:, -3],
+                'CHI2': chi2}
+        for name in MAPS:
+            maps[name][~converged] = np.nan
+        maps['CONVERGED'] = converged
+        return maps
+
+
+def doppler_filename(prefix, meta):
+    '''
+    File name of a burst's Doppler maps, e.g. eclipse.spectrum_<date>_seq0_exp1_doppler.fits
+    '''
+    filename_date = meta['timestamp'].strftime(FILENAME_DATE_FORMAT)
+    return f"{prefix}_{filename_date}_seq{meta['seq']}_exp{meta['exp_index']+1}_doppler.fits"
+
+
+def fit_burst(spectra, x0, calibration, stack=False):
+    '''
+    Maps of one burst of spectra (frames, bins, columns), each (frames, bins),
+        or (1, bins) stacked
+    '''
+    spectra = np.asarray(spectra, dtype=np.float64)
+    if stack:
+        spectra = spectra.mean(axis=0, keepdims=True)
+    frames, bins, columns = spectra.shape
+    model = DopplerModel(column_wavelengths(columns, x0, calibration['wavelength0'],
+                                            calibration['dispersion']),
+                         calibration['line'], calibration['order'])
+    maps = model.fit(spectra.reshape(-1, columns))
+    return {name: values.reshape(frames, bins) for name, values in maps.items()}
+
+
+def write_maps(path, maps, cards):
+    primary = fits.PrimaryHDU()
+    for card in cards:
+        primary.header.append(card)
+    hdus = [primary]
+    for name in MAPS:
+        hdus.append(fits.ImageHDU(maps[name].astype(np.float32), name=name))
+    hdus.append(fits.ImageHDU(maps['CONVERGED'].astype(np.uint8), name='CONVERGED'))
+    fits.HDUList(hdus).writeto(path, overwrite=True)
+
+
+def fit_cards(calibration, stack):
+    return [('LINE', calibration['line'], 'rest wavelength of the dip, Angstrom'),
+            ('WAVE0', calibration['wavelength0'], 'Angstrom at sensor column 0'),
+            ('DISPERS', calibration['dispersion'], 'Angstrom per column'),
+            ('CONTORD', calibration['order'], 'continuum polynomial order'),
+            ('STACKED', bool(stack), 'burst mean spectrum fitted')]
+
+
+def fit_table(path, out_dir, calibration, stack):
+    '''
+    Fit one spectra table (module level so it runs in the worker processes);
+        returns the number of spectra fitted and the seconds spent fitting
+    '''
+    with fits.open(path) as hdul:
+        header = hdul[0].header
+        spectra = np.array(hdul['SPECTRA'].data['SPECTRUM'], dtype=np.float64)
+    x0 = int(header['SLITROI'].split()[2]) if 'SLITROI' in header else 0
+    t = time.perf_counter()
+    maps = fit_burst(spectra, x0, calibration, stack)
+    fit_s = time.perf_counter() - t
+    cards = [(key, header[key], header.comments[key])
+             for key in ('DATE-OBS', 'EXPTIME', 'SEQ', 'EXPNUM', 'PHASE', 'SPECBINS', 'SLITROI')
+             if key in header]
+    name = os.path.basename(path).replace('_spectra.fits', '_doppler.fits')
+    write_maps(os.path.join(out_dir, name), maps, cards + fit_cards(calibration, stack))
+    return maps['CHI2'].size, fit_s
+
+
+def fit_sequence(prefix, seq, sources, out_dir, calibration, slit, stack):
+    '''
+    Extract and fit the bursts of one sequence of frames (module level so it
+        runs in the worker processes); slit is the SlitGeometry arguments
+    '''
+    from hdr_merge import read_source
+    from spectrum_extract import SlitGeometry
+    geometry = SlitGeometry(*slit)
+    extracted = []
+    for source in sources:
+        frame, exposure_us, timestamp = read_source(*source)
+        x0 = geometry.window(*frame.shape)[2]
+        extracted.append((exposure_us, timestamp, geometry.extract(frame)))
+    fitted = 0
+    fit_s = 0.
+    exposures = sorted({exposure_us for exposure_us, _, _ in extracted}, reverse=True)
+    for exp_index, exposure in enumerate(exposures):
+        burst = sorted((e for e in extracted if e[0] == exposure), key=lambda e: e[1])
+        meta = {'seq': seq, 'exp_index': exp_index, 'timestamp': burst[0][1]}
+        t = time.perf_counter()
+        maps = fit_burst(np.stack([spectra for _, _, spectra in burst]), x0, calibration, stack)
+        fit_s += time.perf_counter() - t
+        cards = [('DATE-OBS', meta['timestamp'].strftime(DATE_OBS_FORMAT), 'first frame of the burst'),
+                 ('EXPTIME', f"{exposure/1000./1000.}"),
+                 ('SEQ', seq, 'sequence number'),
+                 ('EXPNUM', exp_index + 1, 'exposure of the ladder')]
+        write_maps(os.path.join(out_dir, doppler_filename(prefix, meta)), maps,
+                   cards + geometry.cards() + fit_cards(calibration, stack))
+        fitted += maps['CHI2'].size
+    return fitted, fit_s
+
+
+def fit_files(paths, out_dir, calibration, slit=(None, 1, (), ()), stack=False, workers=None):
+    '''
+    Fit every spectra table and every sequence of frames in paths, in
+        parallel; returns the number of spectra fitted and the seconds spent
+        fitting, summed over the workers
+    '''
+    from hdr_merge import frame_sources
+    os.makedirs(out_dir, exist_ok=True)
+    tables = [path for path in paths if path.endswith('_spectra.fits')]
+    frames = [path for path in paths if not path.endswith('_spectra.fits')]
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(fit_table, path, out_dir, calibration, stack) for path in tables]
+        futures += [executor.submit(fit_sequence, prefix, seq, sources, out_dir, calibration,
+                                    slit, stack)
+                    for (prefix, seq), sources in sorted(frame_sources(frames).items())]
+        results = [future.result() for future in futures]
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+',
+                        help='spectra tables, or frame FITS files, cubes or .spool segments (globs ok)')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--wavelength0', type=float, default=WAVELENGTH0,
+                        help='Angstrom at sensor column 0')
+    parser.add_argument('--dispersion', type=float, default=DISPERSION, help='Angstrom per column')
+    parser.add_argument('--line', type=float, default=LINE, help='rest wavelength of the dip')
+    parser.add_argument('--order', type=int, default=CONTINUUM_ORDER,
+                        help='continuum polynomial order')
+    parser.add_argument('--stack', action='store_true', help='fit the mean spectrum of each burst')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--roi', type=int, nargs=4, metavar=('Y0', 'Y1', 'X0', 'X1'), default=None,
+                        help='slit ROI, for frames')
+    parser.add_argument('--bins', type=int, default=1, help='spatial bins along the slit, for frames')
+    parser.add_argument('--trace', type=float, nargs='+', default=(),
+                        help='row offset vs column, for frames')
+    parser.add_argument('--curvature', type=float, nargs='+', default=(),
+                        help='line shift vs slit row, for frames')
+    args = parser.parse_args()
+
+    paths = sorted(path for pattern in args.files for path in glob.glob(pattern))
+    calibration = {'wavelength0': args.wavelength0, 'dispersion': args.dispersion,
+                   'line': args.line, 'order': args.order}
+    slit = (args.roi, args.bins, args.trace, args.curvature)
+    t_start = time.time()
+    fitted, fit_s = fit_files(paths, args.out, calibration, slit, args.stack, args.workers)
+    elapsed = time.time() - t_start
+    print(f'Fitted {fitted} spectra in {elapsed:.1f} s ({fitted / max(elapsed, 1e-9):.1f} fits/s, '
+          f'{fitted / max(fit_s, 1e-9):.1f} fits/s per worker for the fits themselves)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+'''
+Tile-compressed FITS output
+    Writes every frame as its own lossless tile-compressed FITS file
+    (<frame name>.fits.fz: an empty primary HDU and a CompImageHDU, the
+    layout fpack produces). The 12-bit data in 16-bit containers shrinks to
+    well under half with RICE_1, at roughly 0.1 s of CPU per 5 MP frame,
+    so the compression runs in a pool of worker processes: the writer
+    thread only copies the frame and submits it, and up to ``max_pending``
+    frames are compressed at once. The integer pixels are not quantized, so
+    the data read back is bit-identical to the PrimaryHDU output
+    (bench_compression.py checks this).
+
+    A frame that fails to compress or write is counted in failed_frames and
+    reported through on_failure (the frame pipeline sets it to its
+    frame_failed(), which counts it with the other failures and marks it in
+    the manifest); without it the failure is logged.
+'''
+import functools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import numpy as np
+from astropy.io import fits
+
+from frame_pipeline import frame_filename, frame_header_cards
+
+logger = logging.getLogger(__name__)
+
+COMPRESSION_TYPES = ('RICE_1', 'GZIP_1', 'GZIP_2', 'HCOMPRESS_1')
+TILE_ROWS = 32
+
+
+def compressed_filename(prefix, meta):
+    '''
+    File name of a compressed frame, e.g. eclipse.spectrum_<date>_seq0_exp1_i00.fits.fz
+    '''
+    return frame_filename(prefix, meta) + '.fz'
+
+
+def image_hdu(hdul):
+    '''
+    The image HDU of a frame file: the CompImageHDU of a compressed file,
+        the primary HDU otherwise
+    '''
+    if len(hdul) > 1 and isinstance(hdul[1], fits.CompImageHDU):
+        return hdul[1]
+    return hdul[0]
+
+
+def write_compressed_frame(path, frame, cards, compression='RICE_1', tile_rows=TILE_ROWS):
+    '''
+    Compress one frame and write it. Module level so it can run in a worker
+        process; returns the CPU seconds it took.
+    '''
+    cpu_start = time.process_time()
+    hdu = fits.CompImageHDU(frame, compression_type=compression,
+                            tile_shape=(min(tile_rows, frame.shape[0]), frame.shape[1]))
+    for key, value in cards:
+        hdu.header[key] = value
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(path, overwrite=True)
+    return time.process_time() - cpu_start
+
+
+class CompressedFitsSink:
+    '''
+    Frame pipeline sink writing tile-compressed frames from a process pool.
+        Uses process_pool when given (WRITER_PROCESSES), else its own pool
+        with one worker per core. write() blocks once max_pending frames are
+        waiting for a worker.
+    '''
+
+    def __init__(self, out_dir, prefix, process_pool=None, compression='RICE_1',
+                 tile_rows=TILE_ROWS, max_pending=None):
+        if compression not in COMPRESSION_TYPES:
+            raise ValueError(f'Unknown compression {compression!r}, expected one of '
+                             f'{COMPRESSION_TYPES}')
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.compression = compression
+        self.tile_rows = tile_rows
+        self._own_pool = process_pool is None
+        self.process_pool = process_pool if process_pool is not None else ProcessPoolExecutor()
+        workers = getattr(self.process_pool, '_max_workers', os.cpu_count() or 1)
+        self._pending = threading.BoundedSemaphore(max_pending or 2 * workers)
+        self._futures = set()
+        self._lock = threading.Lock()
+        self.on_failure = None
+        self.frames_written = 0
+        self.failed_frames = 0
+        self.worker_cpu_s = 0.
+
+    def write(self, frame, meta):
+        path = os.path.join(self.out_dir, compressed_filename(self.prefix, meta))
+        self._pending.acquire()
+        # the frame is pickled later by the pool's feeder thread, after the
+        # frame pool slot has been reused, so the worker gets a copy
+        future = self.process_pool.submit(write_compressed_frame, path, np.array(frame),
+                                          frame_header_cards(meta), self.compression,
+                                          self.tile_rows)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(functools.partial(self._done, meta))
+
+    def _done(self, meta, future):
+        with self._lock:
+            self._futures.discard(future)
+        try:
+            cpu_s = future.result()
+        except Exception:
+            with self._lock:
+                self.failed_frames += 1
+            if self.on_failure is None:
+                logger.exception('Failed to write compressed frame seq%s exp%s i%s', meta['seq'],
+                                 meta['exp_index'] + 1, meta['frame_index'])
+            else:
+                self.on_failure(meta)
+        else:
+            with self._lock:
+                self.worker_cpu_s += cpu_s
+                self.frames_written += 1
+        finally:
+            self._pending.release()
+
+    def close(self):
+        '''
+        Wait for the frames still being compressed
+        '''
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures)
+        if self._own_pool:
+            self.process_pool.shutdown()
+        if self.failed_frames:
+            logger.error('%d compressed frames failed to write', self.failed_frames)
@@ -0,0 +1,170 @@
+'''
+Burst-as-cube FITS output
+    Writes every exposure burst as a single 3D FITS file (NAXIS3 = frames in
+    the burst) instead of one file per frame. The file is preallocated on disk
+    when the first frame of the burst arrives and each frame is copied in place
+    through a memory map of the data unit, so there is one open/header/close
+    per burst instead of per frame. Writer threads can deliver the frames of
+    a burst out of order, so DATE-OBS and the file name are set from frame 0
+    (the first frame written) when the cube is closed.
+
+    Mono12 values fit in signed 16 bit, so the cube is stored as plain BITPIX 16
+    without BZERO scaling; astropy (or np.memmap) can then map a whole burst
+    without converting it. Per-frame DATE-OBS and EXPTIME go into a binary
+    table extension (FRAMES) appended when the burst is closed.
+'''
+import os
+import threading
+
+import numpy as np
+from astropy.io import fits
+
+from frame_pipeline import (DATE_OBS_FORMAT, FILENAME_DATE_FORMAT, FITS_BLOCK, count_dropped,
+                            exposure_control_cards)
+
+
+def cube_filename(prefix, meta):
+    '''
+    File name of a burst cube, e.g. eclipse.spectrum_<date>_seq0_exp1_cube.fits
+    '''
+    filename_date = meta['timestamp'].strftime(FILENAME_DATE_FORMAT)
+    return f"{prefix}_{filename_date}_seq{meta['seq']}_exp{meta['exp_index']+1}_cube.fits"
+
+
+class FitsCubeWriter:
+    '''
+    One preallocated (num_images, height, width) FITS cube, filled in place
+    '''
+
+    def __init__(self, path, num_images, height, width, cards=()):
+        self.path = path
+        self.num_images = num_images
+        header = fits.Header([('SIMPLE', True, 'conforms to FITS standard'),
+                              ('BITPIX', 16, 'array data type'),
+                              ('NAXIS', 3, 'number of array dimensions'),
+                              ('NAXIS1', width), ('NAXIS2', height),
+                              ('NAXIS3', num_images, 'frames in the burst'),
+                              ('EXTEND', True)])
+        for card in cards:
+            header.append(card)
+        self.header = header
+        header_bytes = header.tostring().encode('ascii')
+        data_bytes = num_images * height * width * 2
+        with open(path, 'wb') as f:
+            f.write(header_bytes)
+            # preallocate the data unit (zero padded to the FITS block size)
+            f.truncate(len(header_bytes) + data_bytes + (-data_bytes % FITS_BLOCK))
+        self.cube = np.memmap(path, dtype='>i2', mode='r+', offset=len(header_bytes),
+                              shape=(num_images, height, width))
+        self.date_obs = [''] * num_images
+        self.exptime = np.zeros(num_images)
+        self.filled = np.zeros(num_images, dtype=bool)
+
+    def write_frame(self, index, frame, date_obs, exptime):
+        '''
+        Copy one frame into plane ``index`` of the cube. exptime is in seconds.
+        '''
+        np.copyto(self.cube[index], frame, casting='unsafe')
+        self.date_obs[index] = date_obs
+        self.exptime[index] = exptime
+        self.filled[index] = True
+
+    def update_card(self, key, value):
+        '''
+        Rewrite one card of the primary header in place (the value has to
+            fit the 80 bytes of the card)
+        '''
+        index = self.header.index(key)
+        self.header[key] = value
+        with open(self.path, 'r+b') as f:
+            f.seek(index * 80)
+            f.write(self.header.cards[index].image.encode('ascii'))
+
+    def close(self, path=None):
+        '''
+        Flush the data unit and append the per-frame table; the file is
+            renamed to path where given
+        '''
+        self.cube.flush()
+        del self.cube
+        table = fits.BinTableHDU.from_columns([
+            fits.Column(name='FRAME', format='J', array=np.arange(self.num_images)),
+            fits.Column(name='DATE-OBS', format='26A', array=self.date_obs),
+            fits.Column(name='EXPTIME', format='D', unit='s', array=self.exptime),
+            fits.Column(name='FILLED', format='L', array=self.filled),
+        ], name='FRAMES')
+        fits.append(self.path, table.data, table.header)
+        if path is not None and path != self.path:
+            os.replace(self.path, path)
+            self.path = path
+
+
+class FitsCubeSink:
+    '''
+    Frame pipeline sink writing one cube per (sequence, exposure) burst. The
+        cube is opened on the first frame of a burst and closed once all
+        burst_size frames have been written; writer threads fill different
+        planes of the same cube concurrently. Dropped frames count toward
+        their burst and leave their plane unfilled.
+    '''
+
+    def __init__(self, out_dir, prefix):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self._cubes = {}
+        self._dropped = {}
+        self._lock = threading.Lock()
+
+    def _cube(self, frame, meta):
+        key = (meta['seq'], meta['exp_index'])
+        with self._lock:
+            entry = self._cubes.get(key)
+            if entry is None:
+                cards = [('DATE-OBS', meta['timestamp'].strftime(DATE_OBS_FORMAT),
+                          'first frame of the burst'),
+                         ('EXPTIME', f"{meta['exposure_us']/1000./1000.}"),
+                         ('SEQ', meta['seq'], 'sequence number'),
+                         ('EXPNUM', meta['exp_index'] + 1, 'exposure of the ladder')]
+                cards += exposure_control_cards(meta)
+                path = os.path.join(self.out_dir, cube_filename(self.prefix, meta))
+                writer = FitsCubeWriter(path, meta['burst_size'], frame.shape[0],
+                                        frame.shape[1], cards)
+                entry = self._cubes[key] = [writer, meta, self._dropped.pop(key, 0)]
+            return key, entry
+
+    def write(self, frame, meta):
+        key, entry = self._cube(frame, meta)
+        entry[0].write_frame(meta['frame_index'], frame,
+                             meta['timestamp'].strftime(DATE_OBS_FORMAT),
+                             meta['exposure_us'] / 1e6)
+        with self._lock:
+            if meta['frame_index'] < entry[1]['frame_index']:
+                entry[1] = meta
+            entry[2] += 1
+            done = entry[2] == entry[0].num_images
+            if done:
+                del self._cubes[key]
+        if done:
+            self._close(entry[0], entry[1])
+
+    def dropped(self, meta):
+        with self._lock:
+            entry = count_dropped(self._cubes, self._dropped, (meta['seq'], meta['exp_index']),
+                                  meta['burst_size'])
+        if entry is not None:
+            self._close(entry[0], entry[1])
+
+    def _close(self, writer, first):
+        # DATE-OBS and file name of the first frame written, not the first arrived
+        writer.update_card('DATE-OBS', first['timestamp'].strftime(DATE_OBS_FORMAT))
+        writer.close(os.path.join(self.out_dir, cube_filename(self.prefix, first)))
+
+    def close(self):
+        '''
+        Close bursts that did not receive all their frames (FILLED tells which)
+        '''
+        with self._lock:
+            entries = list(self._cubes.values())
+            self._cubes.clear()
+        for writer, first, _ in entries:
+            self._close(writer, first)
@@ -0,0 +1,217 @@
+'''
+Camera-clock frame timestamps
+    DATE-OBS used to be datetime.now() taken after get_buffer() returned: the
+    end of the exposure plus readout, transfer and host latency, with all of
+    their jitter. With chunk data on, every buffer carries the camera's own
+    Timestamp (latched at the start of the exposure), its ExposureTime and
+    FrameID. The camera clock is mapped once to host UTC before the stream
+    starts: TimestampLatch is executed between two host clock reads, a few
+    times, and the tightest bracket gives the offset (uncertainty: half the
+    bracket). The mapping is measured again when the run ends to report how
+    far the two clocks drifted apart.
+
+    FrameClock.stamp() adds to the frame metadata:
+        frame_id           FrameID chunk (the buffer's block ID without chunks)
+        camera_ns          camera Timestamp of the exposure start
+        chunk_exposure_us  ExposureTime the frame was actually taken with
+        received           host UTC when the frame reached the pipeline
+    and replaces timestamp with the exposure start in UTC, so DATE-OBS and
+    the file names use it (without a clock mapping timestamp is left as the
+    host time). Every buffer the frame loop sees, used or discarded, is
+    logged; write_log() saves the log as CSV for frame_timing.py.
+'''
+import csv
+import logging
+import time
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+CLOCK_SAMPLES = 8
+# chunk per field, in order of preference where cameras name them differently
+CHUNK_SELECTORS = {'timestamp': ('Timestamp',), 'exposure': ('ExposureTime',),
+                   'frame_id': ('FrameID', 'FrameCounter')}
+LOG_FIELDS = ('frame_id', 'camera_ns', 'exposure_us', 'received_ns', 'seq', 'exp_index',
+              'frame_index', 'requested_exposure_us', 'frame_rate', 'status')
+EPOCH = datetime(1970, 1, 1)
+# time.time_ns() is Python 3.7+, the scripts also run on 3.6
+time_ns = getattr(time, 'time_ns', lambda: int(time.time() * 1e9))
+
+
+def utc_datetime(ns):
+    '''
+    Naive UTC datetime of a time in ns since the epoch
+    '''
+    return EPOCH + timedelta(microseconds=ns // 1000)
+
+
+class ClockMapping:
+    '''
+    Offset from the camera clock to host UTC, both in ns:
+        utc_ns = camera_ns + offset_ns, within +-uncertainty_ns
+    '''
+
+    def __init__(self, offset_ns, uncertainty_ns, host_ns):
+        self.offset_ns = offset_ns
+        self.uncertainty_ns = uncertainty_ns
+        self.host_ns = host_ns
+
+    @classmethod
+    def measure(cls, nodemap, samples=CLOCK_SAMPLES):
+        '''
+        Latch the camera clock between two host clock reads, samples times,
+            and keep the tightest bracket. None when the camera has no
+            TimestampLatch.
+        '''
+        nodes = nodemap.get_node(['TimestampLatch', 'TimestampLatchValue'])
+        if nodes['TimestampLatch'] is None or nodes['TimestampLatchValue'] is None:
+            return None
+        best = None
+        for _ in range(samples):
+            t_before = time_ns()
+            nodes['TimestampLatch'].execute()
+            t_after = time_ns()
+            camera_ns = int(nodes['TimestampLatchValue'].value)
+            if best is None or t_after - t_before < best[1] - best[0]:
+                best = (t_before, t_after, camera_ns)
+        t_before, t_after, camera_ns = best
+        host_ns = (t_before + t_after) // 2
+        return cls(host_ns - camera_ns, (t_after - t_before) // 2, host_ns)
+
+    def utc_ns(self, camera_ns):
+        return camera_ns + self.offset_ns
+
+    def utc(self, camera_ns):
+        return utc_datetime(camera_ns + self.offset_ns)
+
+
+def enable_chunks(nodemap):
+    '''
+    Turn chunk data on with the timestamp, exposure and frame ID chunks the
+        camera has; returns {field: chunk node name}, empty without chunk data
+    '''
+    nodes = nodemap.get_node(['ChunkModeActive', 'ChunkSelector', 'ChunkEnable'])
+    if any(node is None for node in nodes.values()):
+        return {}
+    nodes['ChunkModeActive'].value = True
+    entries = nodes['ChunkSelector'].enumentry_names or ()
+    enabled = {}
+    for field, names in CHUNK_SELECTORS.items():
+        for name in names:
+            if name in entries:
+                nodes['ChunkSelector'].value = name
+                nodes['ChunkEnable'].value = True
+                enabled[field] = f'Chunk{name}'
+                break
+    return enabled
+
+
+class FrameClock:
+    '''
+    Chunk data and camera clock mapping of one device for a run. Create it
+        before the stream starts and close() it after the stream stopped.
+    '''
+
+    def __init__(self, nodemap, samples=CLOCK_SAMPLES):
+        self.nodemap = nodemap
+        self.samples = samples
+        mode = nodemap.get_node('ChunkModeActive')
+        self._chunk_mode_initial = mode.value if mode is not None else None
+        self.chunks = enable_chunks(nodemap)
+        self._chunk_names = list(self.chunks.values())
+        self.mapping = ClockMapping.measure(nodemap, samples)
+        self.end_mapping = None
+        self.log = []
+        if self.mapping is None:
+            logger.warning('No TimestampLatch: DATE-OBS stays the host time')
+
+    def read(self, image):
+        '''
+        (frame_id, camera_ns, exposure_us) of a buffer, from its chunk data
+            where present; camera_ns and exposure_us may be None
+        '''
+        values = {}
+        if self._chunk_names and image.has_chunkdata:
+            for name, node in image.get_chunk(self._chunk_names).items():
+                if node is not None:
+                    values[name] = node.value
+        frame_id = values.get(self.chunks.get('frame_id'), image.frame_id)
+        camera_ns = values.get(self.chunks.get('timestamp'), getattr(image, 'timestamp_ns', None))
+        return frame_id, camera_ns, values.get(self.chunks.get('exposure'))
+
+    def stamp(self, image, meta):
+        '''
+        Add the buffer's camera time, frame ID and exposure to meta and log it
+        '''
+        received_ns = time_ns()
+        frame_id, camera_ns, exposure_us = self.read(image)
+        meta['frame_id'] = int(frame_id)
+        meta['received'] = utc_datetime(received_ns)
+        if exposure_us is not None:
+            meta['chunk_exposure_us'] = float(exposure_us)
+        if camera_ns is not None:
+            meta['camera_ns'] = camera_ns = int(camera_ns)
+            if self.mapping is not None:
+                meta['timestamp'] = self.mapping.utc(camera_ns)
+        self.log.append((meta['frame_id'], camera_ns, exposure_us, received_ns,
+                         meta.get('seq'), meta.get('exp_index'), meta.get('frame_index'),
+                         meta.get('exposure_us'), meta.get('frame_rate'), 'used'))
+
+    def discard(self, image, status='discarded'):
+        '''
+        Log a buffer the frame loop threw away (settling, incomplete, ...)
+        '''
+        received_ns = time_ns()
+        frame_id, camera_ns, exposure_us = self.read(image)
+        self.log.append((frame_id, camera_ns, exposure_us, received_ns,
+                         None, None, None, None, None, status))
+
+    def drift_ppm(self):
+        '''
+        How much faster the camera clock ran than the host clock, in ppm
+        '''
+        if self.mapping is None or self.end_mapping is None:
+            return None
+        elapsed = self.end_mapping.host_ns - self.mapping.host_ns
+        if elapsed <= 0:
+            return None
+        return -1e6 * (self.end_mapping.offset_ns - self.mapping.offset_ns) / elapsed
+
+    def close(self):
+        '''
+        Measure the clock mapping again and turn chunk data back off; call
+            after stop_stream()
+        '''
+        if self.mapping is not None:
+            self.end_mapping = ClockMapping.measure(self.nodemap, self.samples)
+        if self.chunks and self._chunk_mode_initial is not None:
+            self.nodemap.get_node('ChunkModeActive').value = self._chunk_mode_initial
+
+    def write_log(self, path):
+        '''
+        The frame log as CSV, the clock mapping in '#' comment lines on top
+        '''
+        with open(path, 'w', newline='') as f:
+            if self.mapping is not None:
+                f.write(f'# clock_offset_ns={self.mapping.offset_ns}\n')
+                f.write(f'# clock_uncertainty_ns={self.mapping.uncertainty_ns}\n')
+            drift = self.drift_ppm()
+            if drift is not None:
+                f.write(f'# clock_drift_ppm={drift:.4f}\n')
+            f.write(f"# chunks={','.join(self.chunks.values())}\n")
+            writer = csv.writer(f)
+            writer.writerow(LOG_FIELDS)
+            writer.writerows(self.log)
+
+    def report(self):
+        used = sum(1 for record in self.log if record[-1] == 'used')
+        chunks = ', '.join(self.chunks.values()) or 'none'
+        if self.mapping is None:
+            clock = 'camera clock not mapped (no TimestampLatch)'
+        else:
+            clock = f'camera clock mapped to UTC +-{self.mapping.uncertainty_ns / 1e3:.1f} us'
+            drift = self.drift_ppm()
+            if drift is not None:
+                clock += f', drift {drift:+.2f} ppm'
+        return (f'Frame clock: {clock}; chunks {chunks}; {len(self.log)} buffers logged '
+                f'({used} used, {len(self.log) - used} discarded)')
@@ -0,0 +1,645 @@
+'''
+Producer/consumer frame writing
+    Keeps FITS writing off the trigger loop. The acquisition thread only copies
+    each frame out of the camera buffer (so the buffer can be requeued right
+    away) and puts it on a bounded queue; a pool of writer threads takes frames
+    off the queue, computes the frame statistics, builds the header and writes
+    the file. Frames are copied into the preallocated slots of a FramePool
+    sized for the queue plus one frame per writer, so nothing is allocated per
+    frame and memory stays fixed; when every slot is taken the trigger loop
+    waits for the writers.
+
+    With writers=0 every frame is handled on the calling thread straight from
+    the camera buffer, which is the original behaviour of the scripts.
+
+    Frames are described by a metadata dict filled in by the trigger loop:
+        seq          sequence number
+        exp_index    index of the exposure in the ladder (exp1 -> 0)
+        frame_index  index of the frame within its burst
+        burst_size   number of frames in the burst
+        exposure_us  exposure time in microseconds
+        timestamp    datetime taken when get_buffer() returned
+        frame_rate   AcquisitionFrameRate of the burst (None when not limited)
+    With a FrameClock (see frame_clock.py) submit_buffer() adds frame_id,
+    camera_ns, chunk_exposure_us and received, and timestamp becomes the
+    exposure start in UTC from the camera clock. The writers add
+        stats        frame statistics (see frame_statistics.py) before the sinks
+                     run, or None when statistics are off
+
+    With a Backpressure policy (see backpressure.py) the trigger loop no longer
+    has to wait for a slot when the writers fall behind: frames are dropped or
+    bursts decimated instead, and every dropped, decimated or delayed frame is
+    recorded. Decimated bursts carry decimation in their metadata, and the
+    frames they keep their own frame_index. Every dropped or decimated frame
+    (decimated = True in its metadata) is still counted toward its burst:
+    the writer threads pass it to the burst statistics and to the
+    ``dropped(meta)`` method of the sinks that wait for whole bursts or
+    sequences (cubes, stacks, HDR maps, spectra), so those complete on time
+    with the frame missing.
+
+    With a stage timer (see stage_timing.py) the copy out of the camera
+    buffer, the unpacking, the statistics and every sink write are timed.
+    Sinks are timed under their ``stage`` attribute ('writeto' when they have
+    none); FitsFrameSink times its header build and writeto itself.
+
+    A frame that fails in the statistics or in a sink is logged and counted in
+    failed_frames, and the other sinks still get it; the writer thread goes on
+    with the next frame. Sinks that finish frames later (in a process pool)
+    have an ``on_failure`` attribute, which the pipeline sets to its
+    frame_failed(), so their failures are counted the same way. Sinks with a
+    failed(meta) method (the session manifest) are told about every failed
+    frame.
+'''
+import collections
+import functools
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import numpy as np
+from astropy.io import fits
+
+from frame_pool import FramePool, buffer_as_array
+from mono12_packed import buffer_as_bytes, is_packed, packed_bytes, unpack_mono12
+from frame_statistics import BurstStatistics, FrameStatistics
+from stage_timing import NULL_TIMER
+
+logger = logging.getLogger(__name__)
+
+DATE_OBS_FORMAT = "%Y-%m-%dZ%H:%M:%S.%f"
+FILENAME_DATE_FORMAT = "%Y%m%d_%H%M%S"
+FITS_BLOCK = 2880
+
+
+def frame_filename(prefix, meta):
+    '''
+    File name of a single frame, e.g. eclipse.spectrum_<date>_seq0_exp1_i00.fits
+    '''
+    filename_date = meta['timestamp'].strftime(FILENAME_DATE_FORMAT)
+    return (f"{prefix}_{filename_date}_seq{meta['seq']}_exp{meta['exp_index']+1}"
+            f"_i{meta['frame_index']:02d}.fits")
+
+
+def exposure_control_cards(meta):
+    '''
+    Adaptive exposure state of a frame's sequence (see adaptive_exposure.py):
+        ladder scale against the plan, the step taken before the sequence
+        and the reference peak and saturated fraction it was based on
+    '''
+    control = meta.get('exposure_control')
+    if not control:
+        return []
+    cards = [('AESCALE', round(control['scale'], 5)), ('AESTEP', round(control['step'], 5))]
+    if control['peak'] is not None:
+        cards += [('AEPEAK', round(control['peak'], 1)), ('AESATFR', round(control['saturated'], 6))]
+    return cards
+
+
+def frame_header_cards(meta):
+    '''
+    Header keywords written for every frame; the frame ID, camera clock time,
+        host receive time, observing phase and adaptive exposure state when
+        the frame loop recorded them
+    '''
+    cards = [('DATE-OBS', meta['timestamp'].strftime(DATE_OBS_FORMAT)),
+             ('EXPTIME', f"{meta['exposure_us']/1000./1000.}")]
+    if 'frame_id' in meta:
+        cards.append(('FRAMEID', meta['frame_id']))
+    if 'camera_ns' in meta:
+        cards.append(('CAMTIME', meta['camera_ns']))
+    if 'received' in meta:
+        cards.append(('DATE-RCV', meta['received'].strftime(DATE_OBS_FORMAT)))
+    if meta.get('phase'):
+        cards.append(('PHASE', meta['phase']))
+    if meta.get('decimation'):
+        cards.append(('DECIMATE', meta['decimation']))
+    return cards + exposure_control_cards(meta)
+
+
+def write_fits_frame(path, frame, cards):
+    '''
+    Build the PrimaryHDU and write it. Module level so it can run in a
+        worker process.
+    '''
+    img_fits = fits.PrimaryHDU(frame)
+    for key, value in cards:
+        img_fits.header[key] = value
+    img_fits.writeto(path, overwrite=True)
+
+
+class FitsFrameEncoder:
+    '''
+    Writes uint16 frames as the same bytes PrimaryHDU.writeto() produces
+        (BITPIX 16, BZERO 32768) without allocating per frame: the header
+        template is built once and the data is offset and byteswapped into a
+        scratch frame reused for every write. One encoder per writer thread.
+    '''
+
+    def __init__(self, height, width):
+        self.template = fits.PrimaryHDU(np.zeros((1, 1), dtype=np.uint16)).header
+        self.template['NAXIS1'] = width
+        self.template['NAXIS2'] = height
+        self.template['BSCALE'] = 1
+        self.template['BZERO'] = 32768
+        self.scratch = np.empty((height, width), dtype=np.uint16)
+        self.padding = bytes(-self.scratch.nbytes % FITS_BLOCK)
+
+    def header_bytes(self, cards):
+        header = self.template.copy()
+        for key, value in cards:
+            header[key] = value
+        return header.tostring().encode('ascii')
+
+    def write(self, path, frame, cards, header=None):
+        if header is None:
+            header = self.header_bytes(cards)
+        # x - 32768 on uint16 is a flip of the top bit; then to big endian
+        np.bitwise_xor(frame, 0x8000, out=self.scratch)
+        self.scratch.byteswap(inplace=True)
+        with open(path, 'wb') as f:
+            f.write(header)
+            f.write(self.scratch.data)
+            f.write(self.padding)
+
+
+def count_dropped(entries, dropped, key, expected):
+    '''
+    Count a dropped frame toward its burst (or sequence) in a sink: entries
+        maps keys to lists ending with the number of frames counted so far,
+        dropped holds the counts of keys without an entry yet
+        (a new entry starts from dropped.pop(key, 0)). Returns the entry once
+        it is complete, removed from entries, else None. Call with the sink's
+        lock held.
+    '''
+    entry = entries.get(key)
+    if entry is None:
+        count = dropped.get(key, 0) + 1
+        if count >= expected:
+            dropped.pop(key, None)
+        else:
+            dropped[key] = count
+        return None
+    entry[-1] += 1
+    if entry[-1] != expected:
+        return None
+    del entries[key]
+    return entry
+
+
+class FitsFrameSink:
+    '''
+    Writes every frame to its own FITS file, optionally handing the header
+        build and writeto to a process pool. The header build and the write
+        are recorded into timer as the header and writeto stages; with a
+        process pool, writeto is the hand-over to the pool. Up to max_pending
+        frames (default two per worker) are written by the pool at once,
+        write() blocks beyond that.
+    '''
+    stage = None    # timed here, not by the pipeline
+
+    def __init__(self, out_dir, prefix, process_pool=None, timer=NULL_TIMER, max_pending=None):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.process_pool = process_pool
+        self.timer = timer
+        self.on_failure = None
+        self._local = threading.local()
+        if process_pool is not None:
+            workers = getattr(process_pool, '_max_workers', os.cpu_count() or 1)
+            self._pending = threading.BoundedSemaphore(max_pending or 2 * workers)
+            self._futures = set()
+            self._lock = threading.Lock()
+
+    def _encoder(self, frame):
+        encoder = getattr(self._local, 'encoder', None)
+        if encoder is None or encoder.scratch.shape != frame.shape:
+            encoder = self._local.encoder = FitsFrameEncoder(*frame.shape)
+        return encoder
+
+    def write(self, frame, meta):
+        timer = self.timer
+        t = timer.now()
+        path = os.path.join(self.out_dir, frame_filename(self.prefix, meta))
+        cards = frame_header_cards(meta)
+        if self.process_pool is not None:
+            t = timer.mark('header', t)
+            self._pending.acquire()
+            # the frame is pickled later by the pool's feeder thread, after the
+            # frame pool slot has been reused, so the worker gets a copy
+            future = self.process_pool.submit(write_fits_frame, path, np.array(frame), cards)
+            with self._lock:
+                self._futures.add(future)
+            future.add_done_callback(functools.partial(self._done, meta))
+        elif frame.dtype == np.uint16:
+            encoder = self._encoder(frame)
+            header = encoder.header_bytes(cards)
+            t = timer.mark('header', t)
+            encoder.write(path, frame, cards, header)
+        else:
+            t = timer.mark('header', t)
+            write_fits_frame(path, frame, cards)
+        timer.mark('writeto', t)
+
+    def _done(self, meta, future):
+        with self._lock:
+            self._futures.discard(future)
+        try:
+            future.result()
+        except Exception:
+            if self.on_failure is None:
+                logger.exception('Failed to write frame seq%s exp%s i%s', meta['seq'],
+                                 meta['exp_index'] + 1, meta['frame_index'])
+            else:
+                self.on_failure(meta)
+        finally:
+            self._pending.release()
+
+    def close(self):
+        '''
+        Wait for the frames still being written by the process pool
+        '''
+        if self.process_pool is not None:
+            with self._lock:
+                futures = list(self._futures)
+            wait(futures)
+
+
+class FrameWritePipeline:
+    '''
+    Bounded queue between the trigger loop and a pool of writer threads.
+        submit() is called from the trigger loop, close() drains the queue,
+        stops the writers and closes the sinks.
+
+        on_burst_complete(seq, exp_index, summary) is called (from a writer
+        thread) once every frame of a burst has been written, with the
+        BurstStatistics of the burst. statistics is the FrameStatistics
+        engine run on every frame, None to skip frame statistics.
+        pixel_format is the camera's PixelFormat; packed buffers are
+        unpacked on the writer threads. timer records the stage latencies
+        (see stage_timing.py). frame_clock, when given, stamps every buffer
+        with its camera time and logs it (see frame_clock.py). backpressure
+        decides what happens to frames that find every pool slot taken (see
+        backpressure.py); None waits for a slot.
+    '''
+
+    def __init__(self, sinks, writers=2, queue_depth=8, on_burst_complete=None,
+                 process_pool=None, pool=None, statistics=None, pixel_format='Mono12',
+                 timer=NULL_TIMER, frame_clock=None, backpressure=None):
+        if writers and pool is None:
+            raise ValueError('A FramePool is needed to hand frames to writer threads')
+        if backpressure is not None and backpressure.policy != 'block' and not writers:
+            raise ValueError(f'Backpressure policy {backpressure.policy!r} needs writer threads')
+        self.sinks = list(sinks)
+        self.writers = writers
+        self.on_burst_complete = on_burst_complete
+        self.process_pool = process_pool
+        self.pool = pool
+        self.statistics = statistics
+        self.pixel_format = pixel_format
+        self.timer = timer
+        self.frame_clock = frame_clock
+        self.backpressure = backpressure if writers else None
+        self._sink_stages = [getattr(sink, 'stage', 'writeto') for sink in self.sinks]
+        for sink in self.sinks:
+            if hasattr(sink, 'on_failure'):
+                sink.on_failure = self.frame_failed
+        self._unpacked = None
+        self.frames_written = 0
+        self.failed_frames = 0
+        self._bursts = {}
+        self._dropped = collections.deque()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max(queue_depth, 1))
+        self._threads = []
+        for n in range(writers):
+            thread = threading.Thread(target=self._writer, name=f'fits-writer-{n}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit_buffer(self, image, meta):
+        '''
+        Hand a camera buffer to the writers. The frame is copied into a pool
+            slot before returning, so the buffer can be requeued immediately.
+            Returns False when the backpressure policy dropped the frame.
+        '''
+        if self._closed:
+            raise RuntimeError('Frame pipeline is closed')
+        if self.writers == 0:
+            if self.frame_clock is not None:
+                self.frame_clock.stamp(image, meta)
+            t = self.timer.now()
+            frame = self._inline_frame(image)
+            self.timer.mark('convert', t)
+            self._process(frame, meta)
+            return True
+        slot = self._slot(meta)
+        if slot is None:
+            self.discard_buffer(image, 'decimated' if meta.get('decimated') else 'dropped')
+            return False
+        if self.frame_clock is not None:
+            self.frame_clock.stamp(image, meta)
+        t = self.timer.now()
+        self.pool.copy_from_buffer(image, slot=slot)
+        self.timer.mark('convert', t)
+        self._queue.put((slot, meta))
+        return True
+
+    def _slot(self, meta):
+        # pool slot for a frame, None when the backpressure policy drops it
+        backpressure = self.backpressure
+        if backpressure is None:
+            return self.pool.acquire()
+        if not backpressure.admit(meta, self.pool.fill):
+            # counted toward its burst by the writers, like a dropped frame
+            self._dropped.append(meta)
+            return None
+        slot = self.pool.try_acquire()
+        if slot is not None:
+            return slot
+        if backpressure.policy != 'block':
+            backpressure.drop(meta)
+            # counted toward its burst by the writers, off the trigger loop
+            self._dropped.append(meta)
+            return None
+        t = time.perf_counter()
+        slot = self.pool.acquire()
+        backpressure.delay(meta, time.perf_counter() - t)
+        return slot
+
+    def discard_buffer(self, image, status='discarded'):
+        '''
+        Note a camera buffer the frame loop throws away (a frame taken while
+            an exposure change settles, an incomplete buffer, ...)
+        '''
+        if self.frame_clock is not None:
+            self.frame_clock.discard(image, status)
+
+    def _inline_frame(self, image):
+        if not is_packed(self.pixel_format):
+            return buffer_as_array(image)
+        if self._unpacked is None or self._unpacked.shape != (image.height, image.width):
+            self._unpacked = np.empty((image.height, image.width), dtype=np.uint16)
+        packed = buffer_as_bytes(image, packed_bytes(image.height * image.width))
+        return unpack_mono12(packed, self._unpacked, self.pixel_format)
+
+    def submit(self, frame, meta):
+        '''
+        Same as submit_buffer() for a frame that is already a numpy array
+        '''
+        if self._closed:
+            raise RuntimeError('Frame pipeline is closed')
+        if self.writers == 0:
+            self._process(frame, meta)
+            return True
+        slot = self._slot(meta)
+        if slot is None:
+            return False
+        self._queue.put((self.pool.copy_from_array(frame, slot=slot), meta))
+        return True
+
+    def _writer(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            slot, meta = item
+            try:
+                t = self.timer.now()
+                start = time.perf_counter()
+                frame = self.pool.frame(slot)
+                if self.pool.packed:
+                    self.timer.mark('unpack', t)
+                self._process(frame, meta)
+                if self.backpressure is not None:
+                    self.backpressure.written(time.perf_counter() - start)
+            except Exception:
+                # _process handles the failures of the statistics and sinks;
+                # whatever is left must not stop the writer or keep the slot
+                self.frame_failed(meta)
+            finally:
+                self.pool.release(slot)
+            self._count_dropped()
+
+    def _count_dropped(self):
+        while True:
+            try:
+                meta = self._dropped.popleft()
+            except IndexError:
+                return
+            for sink in self.sinks:
+                dropped = getattr(sink, 'dropped', None)
+                if dropped is None:
+                    continue
+                try:
+                    dropped(meta)
+                except Exception:
+                    logger.exception('Failed to count dropped frame seq%s exp%s i%s',
+                                     meta['seq'], meta['exp_index'] + 1, meta['frame_index'])
+            self._count_burst(meta, None, dropped=True)
+
+    def frame_failed(self, meta):
+        '''
+        Log and count a frame that failed to write, from a writer thread or
+            from a sink finishing frames in the background
+        '''
+        logger.exception('Failed to write frame seq%s exp%s i%s', meta['seq'],
+                         meta['exp_index'] + 1, meta['frame_index'])
+        with self._lock:
+            self.failed_frames += 1
+        for sink in self.sinks:
+            if hasattr(sink, 'failed'):
+                try:
+                    sink.failed(meta)
+                except Exception:
+                    logger.exception('Failed to record the failed frame in the %s stage',
+                                     getattr(sink, 'stage', 'writeto'))
+
+    def _process(self, frame, meta):
+        timer = self.timer
+        t = timer.now()
+        meta['stats'] = None
+        failed = False
+        if self.statistics is not None:
+            try:
+                meta['stats'] = self.statistics(frame)
+            except Exception:
+                self.frame_failed(meta)
+                failed = True
+            t = timer.mark('stats', t)
+        for sink, stage in zip(self.sinks, self._sink_stages):
+            try:
+                sink.write(frame, meta)
+            except Exception:
+                # counted once per frame; the other sinks still get it
+                if failed:
+                    logger.exception('Frame seq%s exp%s i%s also failed in the %s stage',
+                                     meta['seq'], meta['exp_index'] + 1, meta['frame_index'],
+                                     stage or 'writeto')
+                else:
+                    self.frame_failed(meta)
+                failed = True
+            t = timer.mark(stage, t) if stage is not None else timer.now()
+        self._count_burst(meta, meta['stats'])
+
+    def _count_burst(self, meta, stats, dropped=False):
+        key = (meta['seq'], meta['exp_index'])
+        with self._lock:
+            summary = self._bursts.get(key)
+            if summary is None:
+                summary = self._bursts[key] = BurstStatistics(meta['burst_size'])
+            if dropped:
+                summary.dropped += 1
+            else:
+                self.frames_written += 1
+            complete = summary.add(stats)
+            if complete:
+                del self._bursts[key]
+        if complete and self.on_burst_complete is not None:
+            try:
+                self.on_burst_complete(meta['seq'], meta['exp_index'], summary)
+            except Exception:
+                logger.exception('Burst summary of seq%s exp%s failed', meta['seq'],
+                                 meta['exp_index'] + 1)
+
+    def close(self):
+        '''
+        Wait for every queued frame to be written, then stop the writers and
+            close the sinks
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._count_dropped()
+        for sink in self.sinks:
+            sink.close()
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+        if self.failed_frames:
+            logger.error('%d frames failed to write', self.failed_frames)
+
+    def report(self):
+        '''
+        One line on the frame memory used by the pipeline, and the frames
+            that failed to write
+        '''
+        report = ('Frames written inline from the camera buffers' if self.pool is None
+                  else self.pool.report())
+        if self.failed_frames:
+            report += f"; {self.failed_frames} frames failed to write (see the log)"
+        return report
+
+
+class EveryNthSink:
+    '''
+    Passes only every nth frame of a burst (frame_index 0, n, 2n, ...) on to
+        sink, e.g. full frames kept next to the spectra of every frame
+    '''
+
+    def __init__(self, sink, every):
+        self.sink = sink
+        self.every = every
+        self.stage = getattr(sink, 'stage', 'writeto')
+
+    @property
+    def on_failure(self):
+        return getattr(self.sink, 'on_failure', None)
+
+    @on_failure.setter
+    def on_failure(self, callback):
+        if hasattr(self.sink, 'on_failure'):
+            self.sink.on_failure = callback
+
+    def write(self, frame, meta):
+        if meta['frame_index'] % self.every == 0:
+            self.sink.write(frame, meta)
+
+    def dropped(self, meta):
+        dropped = getattr(self.sink, 'dropped', None)
+        if dropped is not None and meta['frame_index'] % self.every == 0:
+            dropped(meta)
+
+    def close(self):
+        self.sink.close()
+
+
+OUTPUT_MODES = ('frames', 'cube', 'spool', 'rice', 'none')
+
+
+def make_sink(output, out_dir, prefix, process_pool=None, run_frames=1000, timer=NULL_TIMER):
+    '''
+    Output backend for an OUTPUT_MODE setting:
+        frames  one FITS file per frame (the original output)
+        cube    one FITS cube per burst, filled through a memory map
+        spool   raw frames appended to a preallocated memory-mapped spool
+                sized for run_frames frames (see frame_spool.py)
+        rice    one RICE tile-compressed FITS file per frame (.fits.fz),
+                compressed in process_pool or a pool of its own (see
+                fits_compressed.py)
+        none    no per-frame output (only the extra sinks, e.g. burst stacks)
+    '''
+    if output == 'none':
+        return None
+    if output == 'frames':
+        return FitsFrameSink(out_dir, prefix, process_pool, timer)
+    if output == 'cube':
+        from fits_cube import FitsCubeSink
+        return FitsCubeSink(out_dir, prefix)
+    if output == 'spool':
+        from frame_spool import SpoolSink
+        return SpoolSink(out_dir, prefix, run_frames)
+    if output == 'rice':
+        from fits_compressed import CompressedFitsSink
+        return CompressedFitsSink(out_dir, prefix, process_pool)
+    raise ValueError(f'Unknown output mode {output!r}, expected one of {OUTPUT_MODES}')
+
+
+def start_frame_pipeline(out_dir, prefix, nodes, writers=2, queue_depth=8, processes=0,
+                         on_burst_complete=None, output='frames', run_frames=1000,
+                         stats_stride=1, extra_sinks=(), timer=NULL_TIMER, frame_clock=None,
+                         keep_every=1, backpressure=None):
+    '''
+    Pipeline writing frames into out_dir with the given output mode. The
+        frame pool is sized from the Width/Height nodes: one slot per queued
+        frame plus one per writer, and PixelFormat says whether buffers are
+        packed. processes > 0 runs the header build and
+        writeto of per-frame files in that many worker processes. run_frames
+        is the number of frames the run will take (sizes the spool).
+        stats_stride is the pixel stride of the frame statistics, 0 turns
+        them off. extra_sinks also receive every frame (e.g. the HDR merge
+        or the burst stacks). timer records the stage latencies, frame_clock
+        stamps frames from the camera clock. keep_every > 1 writes only every
+        keep_every-th frame of a burst in the output mode (the extra sinks
+        still get all of them). backpressure is the policy for frames that
+        find the pool full (see backpressure.py).
+    '''
+    if keep_every > 1 and output == 'cube':
+        raise ValueError('Burst cubes hold every frame of a burst, keep_every needs a per-frame '
+                         'output mode')
+    pool = FramePool.from_nodes(nodes, queue_depth + writers) if writers else None
+    process_pool = ProcessPoolExecutor(processes) if processes else None
+    sink = make_sink(output, out_dir, prefix, process_pool, -(-run_frames // keep_every), timer)
+    if sink is not None and keep_every > 1:
+        sink = EveryNthSink(sink, keep_every)
+    sinks = ([sink] if sink is not None else []) + list(extra_sinks)
+    statistics = FrameStatistics(stats_stride) if stats_stride else None
+    return FrameWritePipeline(sinks, writers, queue_depth, on_burst_complete,
+                              process_pool, pool, statistics, str(nodes['PixelFormat'].value),
+                              timer, frame_clock, backpressure)
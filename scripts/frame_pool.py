@@ -0,0 +1,144 @@
+'''
+Preallocated frame slots
+    A fixed number of uint16 frames allocated once, before the stream starts,
+    and sized from the Width/Height nodes that store_initial() fetches. Each
+    camera buffer is copied into a free slot with a single memmove; the slot
+    goes back to the pool when the consumer releases it. Memory use is
+    therefore fixed at slots x frame size for the whole run, and acquire()
+    blocks the trigger loop when every slot is still being written.
+
+    With a packed pixel format (Mono12p, Mono12Packed) the packed bytes are
+    copied into the tail of the slot and unpacked in place by frame(slot) on
+    the consumer's thread (see mono12_packed.py).
+'''
+import ctypes
+import threading
+
+import numpy as np
+
+from mono12_packed import is_packed, packed_bytes, packed_tail, unpack_in_place
+
+
+def buffer_as_array(image):
+    '''
+    uint16 view (no copy) of a Mono12/Mono16 camera buffer
+    '''
+    pdata_as16 = ctypes.cast(image.pdata, ctypes.POINTER(ctypes.c_ushort))
+    return np.ctypeslib.as_array(pdata_as16, (image.height, image.width))
+
+
+class FramePool:
+    '''
+    Fixed set of preallocated (height, width) uint16 frame slots. Slots are
+        handed out by index; frame(slot) is the frame itself.
+    '''
+
+    def __init__(self, height, width, slots, pixel_format='Mono12'):
+        self.height = height
+        self.width = width
+        self.slots = slots
+        self.pixel_format = pixel_format
+        self.frames = np.zeros((slots, height, width), dtype=np.uint16)
+        self.frame_bytes = height * width * self.frames.itemsize
+        self.packed = is_packed(pixel_format)
+        self.buffer_bytes = packed_bytes(height * width) if self.packed else self.frame_bytes
+        self._needs_unpack = [False] * slots
+        self._free = list(range(slots - 1, -1, -1))
+        self._cond = threading.Condition()
+        self.peak_in_use = 0
+        self.waits = 0
+
+    @classmethod
+    def from_nodes(cls, nodes, slots):
+        '''
+        Pool sized from the Width, Height and PixelFormat nodes of store_initial()
+        '''
+        return cls(int(nodes['Height'].value), int(nodes['Width'].value), slots,
+                   str(nodes['PixelFormat'].value))
+
+    @property
+    def nbytes(self):
+        return self.frames.nbytes
+
+    @property
+    def in_use(self):
+        return self.slots - len(self._free)
+
+    @property
+    def fill(self):
+        '''
+        Fraction of the slots in use
+        '''
+        return self.in_use / self.slots
+
+    def acquire(self, timeout=None):
+        '''
+        Index of a free slot, waiting for one to be released if necessary
+        '''
+        with self._cond:
+            if not self._free:
+                self.waits += 1
+                if not self._cond.wait_for(lambda: self._free, timeout):
+                    raise TimeoutError('No free frame slot')
+            return self._take()
+
+    def try_acquire(self):
+        '''
+        Index of a free slot, None when every slot is in use
+        '''
+        with self._cond:
+            return self._take() if self._free else None
+
+    def _take(self):
+        slot = self._free.pop()
+        self.peak_in_use = max(self.peak_in_use, self.slots - len(self._free))
+        return slot
+
+    def release(self, slot):
+        with self._cond:
+            self._free.append(slot)
+            self._cond.notify()
+
+    def copy_from_buffer(self, image, timeout=None, slot=None):
+        '''
+        Copy a camera buffer into a free slot (one memmove) and return the
+            slot; slot is one the caller acquired already
+        '''
+        if image.width != self.width or image.height != self.height:
+            if slot is not None:
+                self.release(slot)
+            raise ValueError(f'Buffer is {image.width}x{image.height}, frame pool '
+                             f'slots are {self.width}x{self.height}')
+        if slot is None:
+            slot = self.acquire(timeout)
+        if self.packed:
+            ctypes.memmove(packed_tail(self.frames[slot]).ctypes.data, image.pdata,
+                           self.buffer_bytes)
+            self._needs_unpack[slot] = True
+        else:
+            ctypes.memmove(self.frames[slot].ctypes.data, image.pdata, self.frame_bytes)
+        return slot
+
+    def copy_from_array(self, frame, timeout=None, slot=None):
+        if slot is None:
+            slot = self.acquire(timeout)
+        np.copyto(self.frames[slot], frame)
+        self._needs_unpack[slot] = False
+        return slot
+
+    def frame(self, slot):
+        '''
+        The uint16 frame in a slot, unpacked in place first if it holds
+            packed bytes
+        '''
+        if self._needs_unpack[slot]:
+            unpack_in_place(self.frames[slot], self.pixel_format)
+            self._needs_unpack[slot] = False
+        return self.frames[slot]
+
+    def report(self):
+        mb = 1024. * 1024.
+        return (f'Frame pool: {self.slots} slots x {self.frame_bytes / mb:.1f} MB = '
+                f'{self.nbytes / mb:.1f} MB, peak {self.peak_in_use} slots in use '
+                f'({self.peak_in_use * self.frame_bytes / mb:.1f} MB), '
+                f'trigger loop waited for a slot {self.waits} times')
@@ -0,0 +1,195 @@
+'''
+Raw memory-mapped frame spool
+    The cheapest write path for the totality window: frames are appended as raw
+    Mono12-in-uint16 pixels to a large file preallocated at the start of the
+    run and mapped into memory, so writing a frame is a single copy into the
+    page cache with no header, open or close. A fixed-record index written
+    next to it describes every frame (sequence, exposure index, frame index,
+    timestamp, exposure time, frame statistics, and the frame ID, camera clock
+    time, host receive time, decimation, observing phase and adaptive
+    exposure state that go into the FITS header).
+
+    Files of one spool segment:
+        <name>.spool   frames, shape (capacity, height, width), native uint16
+        <name>.idx     SPOOL_INDEX_DTYPE records, one per frame slot
+        <name>.json    shape, capacity, file prefix and index dtype
+
+    When a segment is full the sink continues in a new one. spool_to_fits.py
+    turns spools back into per-frame FITS files or burst cubes after the
+    eclipse.
+'''
+import json
+import os
+import threading
+
+import numpy as np
+
+from frame_pipeline import FILENAME_DATE_FORMAT
+
+SPOOL_INDEX_DTYPE = np.dtype([
+    ('seq', '<i4'),
+    ('exp_index', '<i2'),
+    ('valid', 'u1'),
+    ('pad', 'u1'),
+    ('frame_index', '<i4'),
+    ('burst_size', '<i4'),
+    ('exposure_us', '<f8'),
+    ('timestamp', '<f8'),       # POSIX seconds, host clock
+    ('mean', '<f4'),
+    ('min', '<u2'),
+    ('max', '<u2'),
+    ('std', '<f4'),
+    ('saturated', '<u4'),
+    ('frame_id', '<i8'),        # -1: not recorded
+    ('camera_ns', '<i8'),       # -1: not recorded
+    ('received', '<f8'),        # POSIX seconds, host clock; NaN: not recorded
+    ('decimation', '<u2'),      # 0: not decimated
+    ('phase', 'S30'),           # observing phase, UTF-8
+    ('ae_scale', '<f8'),        # adaptive exposure state, NaN: none
+    ('ae_step', '<f8'),
+    ('ae_peak', '<f8'),
+    ('ae_saturated', '<f8'),
+])
+# index field: key of meta['exposure_control']
+EXPOSURE_CONTROL_FIELDS = (('ae_scale', 'scale'), ('ae_step', 'step'), ('ae_peak', 'peak'),
+                           ('ae_saturated', 'saturated'))
+
+
+def preallocate(path, nbytes):
+    '''
+    Create a file of nbytes, reserving the disk blocks where the OS allows it
+    '''
+    with open(path, 'wb') as f:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(f.fileno(), 0, nbytes)
+        else:
+            f.truncate(nbytes)
+
+
+class SpoolWriter:
+    '''
+    One preallocated spool segment. append() may be called from several
+        writer threads at once; each call gets its own record.
+    '''
+
+    def __init__(self, base_path, capacity, height, width, prefix):
+        self.base_path = base_path
+        self.capacity = capacity
+        self.count = 0
+        self._lock = threading.Lock()
+        frame_shape = (capacity, height, width)
+        preallocate(base_path + '.spool', capacity * height * width * 2)
+        preallocate(base_path + '.idx', capacity * SPOOL_INDEX_DTYPE.itemsize)
+        self.frames = np.memmap(base_path + '.spool', dtype=np.uint16, mode='r+',
+                                shape=frame_shape)
+        self.index = np.memmap(base_path + '.idx', dtype=SPOOL_INDEX_DTYPE, mode='r+',
+                               shape=(capacity,))
+        with open(base_path + '.json', 'w') as f:
+            json.dump({'capacity': capacity, 'height': height, 'width': width,
+                       'dtype': '<u2', 'prefix': prefix,
+                       'index_dtype': SPOOL_INDEX_DTYPE.descr}, f, indent=1)
+
+    def reserve(self):
+        '''
+        Record number for the next frame, or None when the segment is full
+        '''
+        with self._lock:
+            if self.count == self.capacity:
+                return None
+            self.count += 1
+            return self.count - 1
+
+    def write(self, record, frame, meta):
+        np.copyto(self.frames[record], frame)
+        entry = self.index[record]
+        stats = meta.get('stats') or {}
+        entry['seq'] = meta['seq']
+        entry['exp_index'] = meta['exp_index']
+        entry['frame_index'] = meta['frame_index']
+        entry['burst_size'] = meta['burst_size']
+        entry['exposure_us'] = meta['exposure_us']
+        entry['timestamp'] = meta['timestamp'].timestamp()
+        entry['mean'] = stats.get('mean', np.nan)
+        entry['min'] = stats.get('min', 0)
+        entry['max'] = stats.get('max', 0)
+        entry['std'] = stats.get('std', np.nan)
+        entry['saturated'] = stats.get('saturated', 0)
+        entry['frame_id'] = meta.get('frame_id', -1)
+        entry['camera_ns'] = meta.get('camera_ns', -1)
+        entry['received'] = meta['received'].timestamp() if 'received' in meta else np.nan
+        entry['decimation'] = meta.get('decimation') or 0
+        entry['phase'] = (meta.get('phase') or '').encode()
+        control = meta.get('exposure_control') or {}
+        for field, key in EXPOSURE_CONTROL_FIELDS:
+            entry[field] = np.nan if control.get(key) is None else control[key]
+        # marked valid last, so a crash never leaves a half-written record valid
+        entry['valid'] = 1
+
+    def close(self):
+        self.frames.flush()
+        self.index.flush()
+        del self.frames
+        del self.index
+
+
+class SpoolSink:
+    '''
+    Frame pipeline sink appending frames to spool segments in out_dir. Each
+        segment holds capacity frames; a new one is started when it is full.
+    '''
+
+    def __init__(self, out_dir, prefix, capacity):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.capacity = max(int(capacity), 1)
+        self.segments = []
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def _reserve(self, frame, meta):
+        with self._lock:
+            record = None if self._writer is None else self._writer.reserve()
+            if record is None:
+                filename_date = meta['timestamp'].strftime(FILENAME_DATE_FORMAT)
+                base_path = os.path.join(self.out_dir, f'{self.prefix}_{filename_date}'
+                                                       f'_{len(self.segments):03d}')
+                self._writer = SpoolWriter(base_path, self.capacity, frame.shape[0],
+                                           frame.shape[1], self.prefix)
+                self.segments.append(self._writer)
+                record = self._writer.reserve()
+            return self._writer, record
+
+    def write(self, frame, meta):
+        writer, record = self._reserve(frame, meta)
+        writer.write(record, frame, meta)
+
+    def close(self):
+        with self._lock:
+            for writer in self.segments:
+                writer.close()
+            self._writer = None
+
+
+class SpoolReader:
+    '''
+    Read-only view of a spool segment, path given with or without extension
+    '''
+
+    def __init__(self, path):
+        self.base_path = os.path.splitext(path)[0] if path.endswith(('.spool', '.idx', '.json')) else path
+        with open(self.base_path + '.json') as f:
+            self.info = json.load(f)
+        shape = (self.info['capacity'], self.info['height'], self.info['width'])
+        self.prefix = self.info['prefix']
+        self.frames = np.memmap(self.base_path + '.spool', dtype=self.info['dtype'],
+                                mode='r', shape=shape)
+        # the index layout is read back from the .json, so older spools still load
+        index_dtype = np.dtype([tuple(field) for field in self.info['index_dtype']])
+        self.index = np.memmap(self.base_path + '.idx', dtype=index_dtype,
+                               mode='r', shape=(shape[0],))
+
+    def records(self):
+        '''
+        Record numbers of the frames actually written
+        '''
+        return np.flatnonzero(self.index['valid'])
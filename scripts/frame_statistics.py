@@ -0,0 +1,150 @@
+'''
+Single-pass frame statistics
+    Every frame gets its mean, min, max, standard deviation, number of
+    saturated pixels and a coarse histogram. Instead of one numpy reduction
+    per number (each a full pass over 5 MP) the integer pixels are counted
+    into a full-resolution histogram in one pass, done in cache-sized chunks
+    with np.bincount, and every statistic is derived exactly from those
+    counts. stride > 1 histograms every stride-th pixel of every stride-th
+    row instead, for a stride**2 cheaper estimate.
+
+    The statistics run on the frame pipeline's writer threads, never on the
+    trigger loop. BurstStatistics merges the frames of a burst into real
+    burst-level numbers: global min and max, and the pixel mean and variance
+    kept as a running (parallel/Chan) merge of the per-frame moments.
+'''
+import math
+import threading
+
+import numpy as np
+
+MONO12_MAX = 4095
+HISTOGRAM_BINS = 64
+CHUNK_PIXELS = 1 << 16
+
+
+class FrameStatistics:
+    '''
+    Statistics engine, configured once and shared by the writer threads
+        (scratch buffers are per thread). saturation is the pixel value
+        counted as saturated (4095 for Mono12); the coarse histogram has
+        ``bins`` equal bins over [0, saturation].
+    '''
+
+    def __init__(self, stride=1, saturation=MONO12_MAX, bins=HISTOGRAM_BINS,
+                 chunk_pixels=CHUNK_PIXELS):
+        self.stride = max(int(stride), 1)
+        self.saturation = saturation
+        self.bins = bins
+        self.bin_width = -(-(saturation + 1) // bins)
+        self.chunk_pixels = chunk_pixels
+        self._local = threading.local()
+
+    def _scratch(self):
+        local = self._local
+        if not hasattr(local, 'chunk'):
+            local.chunk = np.empty(self.chunk_pixels, dtype=np.intp)
+            local.counts = np.zeros(max(65536, self.bins * self.bin_width), dtype=np.int64)
+        return local.chunk, local.counts
+
+    def pixels(self, frame):
+        if self.stride > 1:
+            frame = frame[::self.stride, ::self.stride]
+        return frame.ravel()
+
+    def histogram(self, frame):
+        '''
+        Full-resolution counts of the (subsampled) integer frame, from one
+            chunked pass. The array is per-thread scratch: use it before the
+            next call on the same thread.
+        '''
+        flat = self.pixels(frame)
+        chunk, counts = self._scratch()
+        counts[:] = 0
+        for start in range(0, flat.size, chunk.size):
+            part = flat[start:start + chunk.size]
+            values = chunk[:part.size]
+            values[...] = part
+            found = np.bincount(values)
+            counts[:found.size] += found
+        return counts
+
+    def __call__(self, frame):
+        '''
+        Dict with mean, min, max, std, saturated, pixels and histogram
+        '''
+        if frame.dtype.kind not in 'ui':
+            return self._float_stats(frame)
+        counts = self.histogram(frame)
+        present = np.flatnonzero(counts)
+        low, high = int(present[0]), int(present[-1])
+        used = counts[low:high + 1]
+        values = np.arange(low, high + 1, dtype=np.float64)
+        pixels = int(used.sum())
+        mean = float(used @ values) / pixels
+        # second moment about the mean, so the variance does not cancel
+        centered = values - mean
+        variance = float(used @ (centered * centered)) / pixels
+        coarse = counts[:self.bins * self.bin_width].reshape(self.bins, -1).sum(axis=1)
+        coarse[-1] += counts[self.bins * self.bin_width:].sum()
+        return {'mean': mean, 'min': low, 'max': high, 'std': math.sqrt(variance),
+                'saturated': int(counts[self.saturation:].sum()), 'pixels': pixels,
+                'histogram': coarse}
+
+    def _float_stats(self, frame):
+        flat = self.pixels(frame)
+        coarse, _ = np.histogram(np.clip(flat, 0, self.saturation), self.bins,
+                                 (0, self.bins * self.bin_width))
+        return {'mean': float(flat.mean()), 'min': float(flat.min()), 'max': float(flat.max()),
+                'std': float(flat.std()), 'saturated': int(np.count_nonzero(flat >= self.saturation)),
+                'pixels': int(flat.size), 'histogram': coarse}
+
+
+class BurstStatistics:
+    '''
+    Burst-level aggregate of frame statistics: global min and max, pixel mean
+        and standard deviation over the whole burst, saturated pixel total
+        and summed coarse histogram
+    '''
+
+    def __init__(self, burst_size):
+        self.burst_size = burst_size
+        self.frames = 0
+        self.dropped = 0        # frames of the burst the backpressure policy dropped or decimated
+        self.pixels = 0
+        self.mean = float('nan')
+        self.min = None
+        self.max = None
+        self.saturated = 0
+        self.histogram = None
+        self._m2 = 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self._m2 / self.pixels) if self.pixels else float('nan')
+
+    def add(self, stats):
+        '''
+        Merge one frame's statistics (None when statistics are off), returns
+            True once the burst is complete
+        '''
+        self.frames += 1
+        if stats:
+            n = stats['pixels']
+            total = self.pixels + n
+            if self.pixels:
+                delta = stats['mean'] - self.mean
+                self.mean += delta * n / total
+                self._m2 += stats['std'] ** 2 * n + delta * delta * self.pixels * n / total
+            else:
+                self.mean = stats['mean']
+                self._m2 = stats['std'] ** 2 * n
+            self.pixels = total
+            self.min = stats['min'] if self.min is None else min(self.min, stats['min'])
+            self.max = stats['max'] if self.max is None else max(self.max, stats['max'])
+            self.saturated += stats['saturated']
+            if self.histogram is None:
+                self.histogram = stats['histogram'].copy()
+            else:
+                self.histogram += stats['histogram']
+        return self.frames == self.burst_size
@@ -0,0 +1,196 @@
+'''
+Free-running (hardware-timed) acquisition
+    With software triggering every frame costs a Python round trip (wait for
+    TriggerArmed, execute, get_buffer), so the frame rate is set by the host
+    rather than by AcquisitionFrameRate. In streaming mode the trigger is off
+    and the camera exposes back to back at a frame rate pinned from the
+    exposure time; a drain thread takes every buffer off the stream, hands the
+    frames of the requested burst to the frame pipeline and requeues at once.
+
+    Exposure changes are made while streaming. A new ExposureTime applies one
+    frame late and frames already exposed are still in flight, so the first
+    ``settle`` frames after a change are thrown away. Frames missing from the
+    stream (gaps in the buffer frame IDs: the camera or driver ran out of
+    buffers) and incomplete buffers are counted.
+'''
+import logging
+import threading
+import time
+from datetime import datetime
+
+from stage_timing import NULL_TIMER
+
+logger = logging.getLogger(__name__)
+
+STREAM_BUFFER_HANDLING_MODES = ('OldestFirst', 'OldestFirstOverwrite', 'NewestOnly')
+
+
+def pin_frame_rate(nodes, exposure_us):
+    '''
+    Set ExposureTime and the fastest AcquisitionFrameRate it allows, returns
+        the frame rate. ExposureTime.max follows the frame rate, so the rate
+        is lowered first when the new exposure does not fit the current one.
+    '''
+    rate = nodes['AcquisitionFrameRate']
+    exposure = nodes['ExposureTime']
+    if exposure_us > exposure.max:
+        rate.value = max(rate.min, 0.95e6 / exposure_us)
+    exposure.value = min(exposure_us, exposure.max)
+    rate.value = min(rate.max, 1e6 / exposure_us)
+    return rate.value
+
+
+def configure_stream(device, handling_mode='OldestFirst'):
+    '''
+    Stream settings for free-running acquisition
+    '''
+    if handling_mode not in STREAM_BUFFER_HANDLING_MODES:
+        raise ValueError(f'Unknown stream buffer handling mode {handling_mode!r}, '
+                         f'expected one of {STREAM_BUFFER_HANDLING_MODES}')
+    tl_stream_nodemap = device.tl_stream_nodemap
+    tl_stream_nodemap['StreamAutoNegotiatePacketSize'].value = True
+    tl_stream_nodemap['StreamPacketResendEnable'].value = True
+    tl_stream_nodemap['StreamBufferHandlingMode'].value = handling_mode
+
+
+def is_timeout(exc):
+    return isinstance(exc, TimeoutError) or 'timeout' in type(exc).__name__.lower()
+
+
+class StreamDrain:
+    '''
+    Thread pulling buffers off a started stream. Between bursts frames are
+        requeued unused; capture() asks for the next burst and blocks until
+        all of its frames are in the pipeline. get_buffer (including the
+        wait for the next frame) and requeue are recorded into timer.
+    '''
+
+    def __init__(self, device, pipeline, timeout_ms=200, timer=NULL_TIMER):
+        self.device = device
+        self.pipeline = pipeline
+        self.timeout_ms = timeout_ms
+        self.timer = timer
+        self.frames_received = 0
+        self.frames_captured = 0
+        self.frames_discarded = 0
+        self.incomplete_buffers = 0
+        self.dropped_frames = 0
+        self.timeouts = 0
+        self.error = None
+        self._last_frame_id = None
+        self._burst = None
+        self._lock = threading.Lock()
+        self._burst_done = threading.Condition(self._lock)
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name='stream-drain', daemon=True)
+        self._t_start = None
+
+    def start(self):
+        self._t_start = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stop draining; call before device.stop_stream()
+        '''
+        self._stop = True
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def capture(self, meta, num_images, settle=0, tag=None):
+        '''
+        Hand the next num_images frames to the pipeline, after discarding
+            settle frames. meta holds the burst keys (seq, exp_index,
+            burst_size, exposure_us); frame_index, timestamp and frame_id are
+            added per frame. tag(image, meta), when given, fills in
+            per-frame keys and returns False for frames not wanted.
+        '''
+        with self._lock:
+            if self.error is not None:
+                raise self.error
+            self._burst = {'meta': meta, 'remaining': num_images, 'settle': settle,
+                           'frame_index': 0, 'tag': tag}
+            while self._burst is not None and self.error is None:
+                self._burst_done.wait(0.5)
+            if self.error is not None:
+                raise self.error
+
+    def _run(self):
+        timer = self.timer
+        while not self._stop:
+            t = timer.now()
+            try:
+                image = self.device.get_buffer(timeout=self.timeout_ms)
+                timer.mark('get_buffer', t)
+            except Exception as exc:
+                if is_timeout(exc):
+                    self.timeouts += 1
+                    continue
+                if self._stop:
+                    return
+                logger.exception('Stream drain stopped')
+                with self._lock:
+                    self.error = exc
+                    self._burst_done.notify_all()
+                return
+            try:
+                self._handle(image)
+            except Exception as exc:
+                logger.exception('Stream drain stopped')
+                with self._lock:
+                    self.error = exc
+                    self._burst_done.notify_all()
+                return
+            finally:
+                t = timer.now()
+                self.device.requeue_buffer(image)
+                timer.mark('requeue', t)
+
+    def _handle(self, image):
+        self.frames_received += 1
+        frame_id = image.frame_id
+        if self._last_frame_id is not None and frame_id > self._last_frame_id + 1:
+            self.dropped_frames += frame_id - self._last_frame_id - 1
+        self._last_frame_id = frame_id
+        if image.is_incomplete:
+            self.incomplete_buffers += 1
+            self.pipeline.discard_buffer(image, 'incomplete')
+            return
+        burst = self._burst
+        if burst is None or burst['settle'] > 0:
+            if burst is not None:
+                burst['settle'] -= 1
+            self.frames_discarded += 1
+            self.pipeline.discard_buffer(image)
+            return
+        meta = dict(burst['meta'], frame_index=burst['frame_index'],
+                    timestamp=datetime.now(), frame_id=frame_id)
+        if burst['tag'] is not None and not burst['tag'](image, meta):
+            self.frames_discarded += 1
+            self.pipeline.discard_buffer(image)
+            return
+        self.pipeline.submit_buffer(image, meta)
+        self.frames_captured += 1
+        burst['frame_index'] += 1
+        burst['remaining'] -= 1
+        if burst['remaining'] == 0:
+            with self._lock:
+                self._burst = None
+                self._burst_done.notify_all()
+
+    def summary(self):
+        elapsed = time.perf_counter() - self._t_start if self._t_start else 0.
+        return {'frames_received': self.frames_received,
+                'frames_captured': self.frames_captured,
+                'frames_discarded': self.frames_discarded,
+                'dropped_frames': self.dropped_frames,
+                'incomplete_buffers': self.incomplete_buffers,
+                'timeouts': self.timeouts,
+                'received_fps': self.frames_received / elapsed if elapsed else 0.}
+
+    def report(self):
+        s = self.summary()
+        return (f"Stream: {s['frames_received']} frames received ({s['received_fps']:.1f} fps), "
+                f"{s['frames_captured']} captured, {s['frames_discarded']} discarded, "
+                f"{s['dropped_frames']} dropped, {s['incomplete_buffers']} incomplete")
@@ -0,0 +1,215 @@
+'''
+Frame timing analysis
+    Reads the frame logs written with CHUNK_TIMESTAMPS (<run>_frames.csv, see
+    frame_clock.py: one line per buffer the frame loop saw, with its FrameID,
+    camera exposure-start timestamp and exposure) and reports whether the
+    frames really came evenly spaced:
+    - inter-frame intervals of consecutive frame IDs from the camera clock,
+      per exposure: mean, jitter (standard deviation), percentiles, extremes
+    - per burst: achieved cadence (frames/s over the burst) against the
+      requested one (AcquisitionFrameRate, or the exposure time when the
+      frame rate is not limited), and frame IDs inside the burst that never
+      reached the host
+    - frame IDs the camera produced that never reached the host
+    - host latency: host receive time minus the exposure end, which is what
+      DATE-OBS used to include
+
+Usage:
+    python frame_timing.py D:/eclipse/totality/eclipse.spectrum_20240408_181800_frames.csv
+    python frame_timing.py D:/eclipse/totality            # every *_frames.csv in it
+    python frame_timing.py run_frames.csv --json timing.json
+'''
+import argparse
+import csv
+import glob
+import json
+import os
+from collections import defaultdict
+
+import numpy as np
+
+PERCENTILES = (1, 50, 99)
+
+
+def read_frame_log(path):
+    '''
+    (info, records): the '#' key=value lines of the log and its rows as dicts
+        with numbers converted (empty fields are None)
+    '''
+    info = {}
+    with open(path, newline='') as f:
+        lines = []
+        for line in f:
+            if line.startswith('#'):
+                key, _, value = line[1:].strip().partition('=')
+                info[key] = value
+            else:
+                lines.append(line)
+    records = []
+    for row in csv.DictReader(lines):
+        record = {}
+        for key, value in row.items():
+            if key == 'status':
+                record[key] = value
+            elif value == '':
+                record[key] = None
+            else:
+                number = float(value)
+                record[key] = int(number) if number.is_integer() and key != 'frame_rate' else number
+        records.append(record)
+    return info, records
+
+
+def id_ranges(ids):
+    '''
+    Sorted frame IDs as compact ranges, e.g. '12-14, 20'
+    '''
+    out = []
+    for frame_id in ids:
+        if out and frame_id == out[-1][1] + 1:
+            out[-1][1] = frame_id
+        else:
+            out.append([frame_id, frame_id])
+    return ', '.join(f'{a}-{b}' if b > a else f'{a}' for a, b in out)
+
+
+def interval_stats(values_ms):
+    values = np.asarray(values_ms, dtype=float)
+    s = {'count': int(values.size), 'mean_ms': float(values.mean()),
+         'jitter_ms': float(values.std()), 'min_ms': float(values.min()),
+         'max_ms': float(values.max())}
+    for q in PERCENTILES:
+        s[f'p{q}_ms'] = float(np.percentile(values, q))
+    return s
+
+
+def requested_period_ms(record):
+    '''
+    Frame period the loop asked for: 1 / AcquisitionFrameRate, but never
+        shorter than the exposure
+    '''
+    exposure = record['requested_exposure_us'] or record['exposure_us'] or 0.
+    period = exposure / 1000.
+    if record['frame_rate']:
+        period = max(period, 1000. / record['frame_rate'])
+    return period or None
+
+
+def analyse(records, info=None):
+    info = info or {}
+    offset = int(info['clock_offset_ns']) if 'clock_offset_ns' in info else None
+    timed = sorted((r for r in records if r['camera_ns'] is not None), key=lambda r: r['frame_id'])
+    seen = {r['frame_id'] for r in records}
+    ids = sorted(seen)
+    result = {'buffers': len(records),
+              'used': sum(1 for r in records if r['status'] == 'used'),
+              'incomplete': sum(1 for r in records if r['status'] == 'incomplete'),
+              'clock': info}
+
+    # frame IDs the camera gave out that the host never saw
+    missing = sorted(set(range(ids[0], ids[-1] + 1)) - seen) if ids else []
+    result['missing_ids'] = len(missing)
+    result['missing_id_ranges'] = id_ranges(missing)
+
+    # intervals between consecutive frame IDs, by exposure of the earlier frame
+    by_exposure = defaultdict(list)
+    for before, after in zip(timed, timed[1:]):
+        if after['frame_id'] == before['frame_id'] + 1:
+            exposure = before['exposure_us'] or before['requested_exposure_us']
+            by_exposure[exposure].append((after['camera_ns'] - before['camera_ns']) / 1e6)
+    result['intervals'] = {f'{exposure:g}' if exposure is not None else 'unknown':
+                           interval_stats(values) for exposure, values in sorted(
+                               by_exposure.items(), key=lambda item: -(item[0] or 0))}
+
+    # cadence per burst
+    bursts = defaultdict(list)
+    for record in timed:
+        if record['status'] == 'used' and record['seq'] is not None:
+            bursts[(record['seq'], record['exp_index'])].append(record)
+    result['bursts'] = []
+    for (seq, exp_index), frames in sorted(bursts.items(), key=lambda item: (
+            item[0][0], -1 if item[0][1] is None else item[0][1])):
+        span_s = (frames[-1]['camera_ns'] - frames[0]['camera_ns']) / 1e9
+        requested = requested_period_ms(frames[0])
+        burst = {'seq': seq, 'exp_index': exp_index, 'frames': len(frames),
+                 'skipped_ids': sum(1 for frame_id in range(frames[0]['frame_id'], frames[-1]['frame_id'])
+                                    if frame_id not in seen),
+                 'achieved_fps': (len(frames) - 1) / span_s if span_s > 0 else None,
+                 'requested_fps': 1000. / requested if requested else None}
+        if burst['achieved_fps'] and burst['requested_fps']:
+            burst['cadence_ratio'] = burst['achieved_fps'] / burst['requested_fps']
+        result['bursts'].append(burst)
+
+    # host latency after the end of the exposure
+    if offset is not None:
+        latency = [(r['received_ns'] - (r['camera_ns'] + offset)) / 1e6
+                   - (r['exposure_us'] or r['requested_exposure_us'] or 0.) / 1000.
+                   for r in timed if r['received_ns'] is not None]
+        if latency:
+            result['host_latency'] = interval_stats(latency)
+    return result
+
+
+def print_report(name, result):
+    print(f"{name}: {result['buffers']} buffers, {result['used']} used, "
+          f"{result['incomplete']} incomplete")
+    clock = result['clock']
+    if 'clock_uncertainty_ns' in clock:
+        drift = f", drift {float(clock['clock_drift_ppm']):+.2f} ppm" if 'clock_drift_ppm' in clock else ''
+        print(f"  camera clock -> UTC +-{int(clock['clock_uncertainty_ns']) / 1e3:.1f} us{drift}")
+    else:
+        print('  camera clock not mapped to UTC')
+    print(f"  missing frame IDs: {result['missing_ids']}"
+          + (f" ({result['missing_id_ranges']})" if result['missing_ids'] else ''))
+    print('  intervals between consecutive frame IDs in ms, by exposure of the first frame')
+    print(f"  {'exposure us':<14}{'n':>6}{'mean':>9}{'jitter':>9}{'p1':>9}{'p50':>9}{'p99':>9}"
+          f"{'min':>9}{'max':>9}")
+    for exposure, s in result['intervals'].items():
+        print(f"  {exposure:<14}{s['count']:>6}{s['mean_ms']:>9.3f}{s['jitter_ms']:>9.3f}"
+              f"{s['p1_ms']:>9.3f}{s['p50_ms']:>9.3f}{s['p99_ms']:>9.3f}{s['min_ms']:>9.3f}"
+              f"{s['max_ms']:>9.3f}")
+    print(f"  {'burst':<14}{'frames':>7}{'skipped':>8}{'fps':>9}{'requested':>10}{'ratio':>7}")
+    for b in result['bursts']:
+        name = f"seq{b['seq']}" + (f" exp{b['exp_index'] + 1}" if b['exp_index'] is not None else '')
+        fps = f"{b['achieved_fps']:.3f}" if b['achieved_fps'] else '-'
+        requested = f"{b['requested_fps']:.3f}" if b['requested_fps'] else '-'
+        ratio = f"{b['cadence_ratio']:.3f}" if 'cadence_ratio' in b else '-'
+        print(f"  {name:<14}{b['frames']:>7}{b['skipped_ids']:>8}{fps:>9}{requested:>10}{ratio:>7}")
+    if 'host_latency' in result:
+        s = result['host_latency']
+        print(f"  host latency after exposure end: p50 {s['p50_ms']:.2f} ms, p99 {s['p99_ms']:.2f} ms, "
+              f"max {s['max_ms']:.2f} ms, jitter {s['jitter_ms']:.2f} ms")
+
+
+def log_paths(paths):
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(sorted(glob.glob(os.path.join(path, '*_frames.csv'))))
+        else:
+            found.append(path)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='frame logs or directories holding them')
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = {}
+    for path in log_paths(args.paths):
+        info, records = read_frame_log(path)
+        if not records:
+            print(f'{path}: empty frame log')
+            continue
+        results[path] = analyse(records, info)
+        print_report(os.path.basename(path), results[path])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
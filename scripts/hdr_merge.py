@@ -0,0 +1,317 @@
+'''
+HDR merge of the exposure-bracketed bursts
+    Every frame of a sequence (each exposure of the ladder, each frame of its
+    burst) is folded into running per-pixel sums as it arrives, so a sequence
+    costs four float32 frames of memory however many frames it has. The
+    radiance of a pixel is the exposure-weighted mean of its samples,
+
+        radiance = sum(w * (I - dark) / t) / sum(w),   w = t
+
+    which is the total signal over the total exposure time of the usable
+    samples (in DN per second). Samples at or above ``saturation`` are masked
+    out, and so are samples less than ``noise_floor`` above the dark level;
+    pixels that only have noisy samples use the same mean over those, pixels
+    saturated in every exposure get the lower bound saturation / shortest
+    exposure.
+
+    Frames are folded in row bands so the temporaries stay small, and each
+    band has its own lock so several writer threads can fold frames of the
+    same sequence at once.
+
+    Online: HdrMergeSink is a frame pipeline sink (HDR_MERGE in the totality
+    script) writing <prefix>_<date>_seq<n>_hdr.fits when a sequence is
+    complete. Offline: this file merges per-frame FITS files, burst cubes or
+    spool segments, one worker process per sequence.
+
+Usage:
+    python hdr_merge.py D:/eclipse/totality/*.fits --out D:/eclipse/hdr
+    python hdr_merge.py run_000.spool --out hdr --dark 100 --workers 4
+'''
+import argparse
+import glob
+import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from astropy.io import fits
+
+from frame_pipeline import DATE_OBS_FORMAT, FILENAME_DATE_FORMAT, count_dropped
+
+SATURATION = 4000       # Mono12 values above this are treated as saturated
+NOISE_FLOOR = 20.       # DN above the dark level for a sample to count as signal
+BAND_ROWS = 32          # small enough for the band temporaries to stay in cache
+
+
+def hdr_filename(prefix, meta):
+    '''
+    File name of a sequence's radiance map, e.g. eclipse.spectrum_<date>_seq0_hdr.fits
+    '''
+    filename_date = meta['timestamp'].strftime(FILENAME_DATE_FORMAT)
+    return f"{prefix}_{filename_date}_seq{meta['seq']}_hdr.fits"
+
+
+class HdrAccumulator:
+    '''
+    Running sums of one sequence. dark is a level or a dark frame.
+    '''
+
+    def __init__(self, height, width, saturation=SATURATION, dark=0., noise_floor=NOISE_FLOOR,
+                 band_rows=BAND_ROWS):
+        self.saturation = saturation
+        self.dark = dark
+        self.noise_floor = noise_floor
+        self.band_rows = band_rows
+        self.signal = np.zeros((height, width), dtype=np.float32)
+        self.time = np.zeros((height, width), dtype=np.float32)
+        self.noisy_signal = np.zeros((height, width), dtype=np.float32)
+        self.noisy_time = np.zeros((height, width), dtype=np.float32)
+        self.exposures = set()
+        self.frames = 0
+        self._locks = [threading.Lock() for _ in range(0, height, band_rows)]
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _scratch(self, shape):
+        scratch = getattr(self._local, 'scratch', None)
+        if scratch is None:
+            width = self.signal.shape[1]
+            scratch = self._local.scratch = np.empty((4, self.band_rows, width), dtype=np.float32)
+        return [plane[:shape[0]] for plane in scratch]
+
+    def add(self, frame, exposure_us):
+        '''
+        Fold one frame taken with exposure_us into the sums. Thread safe.
+        '''
+        t = np.float32(exposure_us * 1e-6)
+        for band, lock in enumerate(self._locks):
+            rows = slice(band * self.band_rows, (band + 1) * self.band_rows)
+            raw = frame[rows]
+            dark = self.dark[rows] if np.ndim(self.dark) else self.dark
+            # masks as 0/1 float32 planes: multiply-adds are much cheaper
+            # than np.add(..., where=mask)
+            signal, good, noisy, product = self._scratch(raw.shape)
+            np.subtract(raw, dark, out=signal, casting='unsafe')
+            np.less(raw, self.saturation, out=noisy, casting='unsafe')
+            np.greater_equal(signal, self.noise_floor, out=good, casting='unsafe')
+            good *= noisy
+            noisy -= good
+            with lock:
+                self.signal[rows] += np.multiply(signal, good, out=product)
+                self.time[rows] += np.multiply(good, t, out=product)
+                self.noisy_signal[rows] += np.multiply(signal, noisy, out=product)
+                self.noisy_time[rows] += np.multiply(noisy, t, out=product)
+        with self._lock:
+            self.exposures.add(exposure_us)
+            self.frames += 1
+
+    def radiance(self):
+        '''
+        Radiance map in DN/s and the usable exposure time per pixel in s
+        '''
+        dark = float(np.mean(self.dark))
+        floor = (self.saturation - dark) / (min(self.exposures) * 1e-6) if self.exposures else 0.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            radiance = np.where(self.time > 0, self.signal / self.time,
+                                np.where(self.noisy_time > 0,
+                                         self.noisy_signal / self.noisy_time, floor))
+        return radiance.astype(np.float32), self.time
+
+
+def write_hdr(path, accumulator, cards=()):
+    '''
+    Radiance map as the primary HDU, usable exposure time as extension EXPTIME
+    '''
+    radiance, exposure = accumulator.radiance()
+    primary = fits.PrimaryHDU(radiance)
+    header = primary.header
+    header['BUNIT'] = 'DN/s'
+    for card in cards:
+        header.append(card)
+    header['NFRAMES'] = (accumulator.frames, 'frames merged')
+    header['EXPTIMES'] = (','.join(f'{e/1e6:g}' for e in sorted(accumulator.exposures)),
+                          'exposures merged [s]')
+    header['SATLEVEL'] = (accumulator.saturation, 'samples at or above are masked')
+    header['NOISEFLR'] = (accumulator.noise_floor, 'DN above dark for a usable sample')
+    if not np.ndim(accumulator.dark):
+        header['DARKLVL'] = (accumulator.dark, 'dark level subtracted')
+    extension = fits.ImageHDU(exposure, name='EXPTIME')
+    extension.header['BUNIT'] = 's'
+    fits.HDUList([primary, extension]).writeto(path, overwrite=True)
+
+
+class HdrMergeSink:
+    '''
+    Frame pipeline sink merging every sequence into a radiance map. A sequence
+        is written once frames_per_seq frames have been folded in (close()
+        writes incomplete ones); frames_per_seq may be a function of the frame
+        metadata where sequences differ in length. Frames dropped or
+        decimated by the backpressure policy count toward their sequence.
+    '''
+    stage = 'hdr_merge'
+
+    def __init__(self, out_dir, prefix, frames_per_seq, **merge_kwargs):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.frames_per_seq = frames_per_seq
+        self.merge_kwargs = merge_kwargs
+        self._sequences = {}
+        self._dropped = {}
+        self._lock = threading.Lock()
+
+    def _sequence(self, frame, meta):
+        with self._lock:
+            entry = self._sequences.get(meta['seq'])
+            if entry is None:
+                accumulator = HdrAccumulator(frame.shape[0], frame.shape[1], **self.merge_kwargs)
+                entry = self._sequences[meta['seq']] = [accumulator, meta,
+                                                        self._dropped.pop(meta['seq'], 0)]
+            return entry
+
+    def write(self, frame, meta):
+        entry = self._sequence(frame, meta)
+        entry[0].add(frame, meta['exposure_us'])
+        with self._lock:
+            # DATE-OBS and file name of the earliest frame, whichever arrived first
+            if meta['timestamp'] < entry[1]['timestamp']:
+                entry[1] = meta
+            entry[2] += 1
+            done = entry[2] == self._frames(meta)
+            if done:
+                del self._sequences[meta['seq']]
+        if done:
+            self._write(entry[0], entry[1])
+
+    def _frames(self, meta):
+        frames = self.frames_per_seq
+        return frames(meta) if callable(frames) else frames
+
+    def dropped(self, meta):
+        with self._lock:
+            entry = count_dropped(self._sequences, self._dropped, meta['seq'], self._frames(meta))
+        if entry is not None:
+            self._write(entry[0], entry[1])
+
+    def _write(self, accumulator, meta):
+        cards = [('DATE-OBS', meta['timestamp'].strftime(DATE_OBS_FORMAT), 'first frame merged'),
+                 ('SEQ', meta['seq'], 'sequence number')]
+        write_hdr(os.path.join(self.out_dir, hdr_filename(self.prefix, meta)), accumulator, cards)
+
+    def close(self):
+        with self._lock:
+            entries = list(self._sequences.values())
+            self._sequences.clear()
+        for accumulator, meta, _ in entries:
+            self._write(accumulator, meta)
+
+
+FRAME_NAME = re.compile(r'(?P<prefix>.+)_(?P<date>\d{8}_\d{6})_seq(?P<seq>\d+)_exp\d+_(i\d+|cube)\.fits(\.fz)?$')
+
+
+def frame_sources(paths):
+    '''
+    {(prefix, seq): [source, ...]} for per-frame FITS files (plain or
+        compressed), burst cubes and spool segments. A source is (kind, path, plane).
+    '''
+    from frame_spool import SpoolReader
+    sequences = {}
+    for path in paths:
+        if path.endswith('.spool'):
+            spool = SpoolReader(path)
+            for record in spool.records():
+                key = (spool.prefix, int(spool.index['seq'][record]))
+                sequences.setdefault(key, []).append(('spool', path, int(record)))
+            continue
+        match = FRAME_NAME.match(os.path.basename(path))
+        if match is None:
+            continue
+        key = (match['prefix'], int(match['seq']))
+        if match.group(4) == 'cube':
+            filled = fits.getdata(path, 'FRAMES')['FILLED']
+            sequences.setdefault(key, []).extend(('cube', path, int(plane))
+                                                 for plane in np.flatnonzero(filled))
+        else:
+            sequences.setdefault(key, []).append(('fits', path, 0))
+    return sequences
+
+
+def read_source(kind, path, plane):
+    '''
+    (frame, exposure_us, timestamp) of one source
+    '''
+    if kind == 'spool':
+        from frame_spool import SpoolReader
+        spool = SpoolReader(path)
+        entry = spool.index[plane]
+        return (spool.frames[plane], float(entry['exposure_us']),
+                datetime.fromtimestamp(float(entry['timestamp'])))
+    if kind == 'cube':
+        with fits.open(path, memmap=True) as hdul:
+            table = hdul['FRAMES'].data
+            return (np.array(hdul[0].data[plane]), float(table['EXPTIME'][plane]) * 1e6,
+                    datetime.strptime(table['DATE-OBS'][plane], DATE_OBS_FORMAT))
+    from fits_compressed import image_hdu
+    with fits.open(path) as hdul:
+        hdu = image_hdu(hdul)
+        header = hdu.header
+        return (hdu.data, float(header['EXPTIME']) * 1e6,
+                datetime.strptime(header['DATE-OBS'], DATE_OBS_FORMAT))
+
+
+def merge_sequence(prefix, seq, sources, out_dir, merge_kwargs):
+    '''
+    Merge one sequence from its sources, returns the number of frames merged
+    '''
+    accumulator = None
+    first = None
+    for source in sources:
+        frame, exposure_us, timestamp = read_source(*source)
+        if accumulator is None:
+            accumulator = HdrAccumulator(frame.shape[0], frame.shape[1], **merge_kwargs)
+        if first is None or timestamp < first:
+            first = timestamp
+        accumulator.add(frame, exposure_us)
+    meta = {'seq': seq, 'timestamp': first}
+    cards = [('DATE-OBS', first.strftime(DATE_OBS_FORMAT), 'first frame merged'),
+             ('SEQ', seq, 'sequence number')]
+    write_hdr(os.path.join(out_dir, hdr_filename(prefix, meta)), accumulator, cards)
+    return accumulator.frames
+
+
+def merge_files(paths, out_dir, workers=None, **merge_kwargs):
+    '''
+    Merge every sequence found in paths, in parallel; returns frames merged
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    sequences = frame_sources(paths)
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(merge_sequence, prefix, seq, sources, out_dir, merge_kwargs)
+                   for (prefix, seq), sources in sorted(sequences.items())]
+        return sum(future.result() for future in futures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', help='frame FITS files, cubes or .spool segments (globs ok)')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--dark', type=float, default=0., help='dark level in DN')
+    parser.add_argument('--saturation', type=float, default=SATURATION)
+    parser.add_argument('--noise-floor', type=float, default=NOISE_FLOOR)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    args = parser.parse_args()
+
+    paths = sorted(path for pattern in args.files for path in glob.glob(pattern))
+    t_start = time.time()
+    frames = merge_files(paths, args.out, args.workers, dark=args.dark,
+                         saturation=args.saturation, noise_floor=args.noise_floor)
+    elapsed = time.time() - t_start
+    print(f'Merged {frames} frames in {elapsed:.1f} s ({frames / max(elapsed, 1e-9):.1f} frames/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,20 @@
 import time
 from arena_api.system import system
-from arena_api.buffer import BufferFactory
-from astropy.io import fits
-import numpy as np
-import ctypes
 from datetime import datetime
 import os
 import logging
 
+import frame_pipeline
+import trigger_arming
+import frame_stream
+import burst_stack
+import multi_camera
+import stage_timing
+import frame_clock
+import node_cache
+import backpressure
+import session_manifest
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Constants
@@ -22,6 +29,94 @@ BASE_DIR = r'E:\LucidTests\\'
 SUB_DIR = ''
 FILENAME_BASE = 'lucid.5MP.polcal'
 
+# FITS writing runs on writer threads fed through a bounded queue, so a slow
+# disk does not stall the trigger loop. WRITER_THREADS = 0 writes each frame on
+# the trigger thread instead (no copy of the camera buffer).
+WRITER_THREADS = 2
+WRITER_QUEUE_DEPTH = 8  # frames held between the trigger loop and the writers
+WRITER_PROCESSES = 0  # >0 builds headers and writes files in worker processes
+# What happens when the writers fall behind and every frame slot is taken:
+# 'block' waits for a slot (no frame lost, the cadence slips), 'drop' drops the
+# frame, 'decimate' keeps only every 2nd, 4th, ... frame of the next bursts (up
+# to BACKPRESSURE_MAX_DECIMATE) until the writers catch up. Dropped, decimated
+# and delayed frames are logged to <FILENAME_BASE>_<date>_backpressure.csv
+# (see backpressure.py).
+BACKPRESSURE = 'block'
+BACKPRESSURE_MAX_DECIMATE = 8
+# Time a DISK_PREFLIGHT_MB test write in the output directory before the run
+# and print how many sequences fit in the free space (64 is enough to see the
+# sustained rate); None skips it
+DISK_PREFLIGHT_MB = None
+# Record every frame (file, sequence, exposure, times, statistics) and the
+# camera settings of the run in an SQLite manifest written while acquiring,
+# <FILENAME_BASE>_<date>_manifest.sqlite, queried with session_manifest.py
+MANIFEST = False
+# 'frames': one FITS file per frame, 'cube': one FITS cube per exposure burst
+# (NAXIS3 = NUM_IMAGES) with per-frame DATE-OBS/EXPTIME in a table extension,
+# 'spool': raw frames into a preallocated memory-mapped spool (cheapest, convert
+# with spool_to_fits.py afterwards), 'rice': one lossless RICE tile-compressed
+# file per frame (.fits.fz, compressed in the WRITER_PROCESSES workers, or one
+# per core when 0, see fits_compressed.py), 'none': no per-frame output
+OUTPUT_MODE = 'frames'
+# Also stack every exposure burst while acquiring: 'mean', 'clipped' (streaming
+# sigma-clipped mean) or 'median' (streaming median estimate), written with a
+# noise map as <FILENAME_BASE>_<date>_seq<n>_exp<j>_stack.fits (see
+# burst_stack.py); None turns it off. With OUTPUT_MODE = 'none' only the stacks
+# are written.
+STACK_METHOD = None
+STACK_CLIP_SIGMA = 3.
+# Publish every QUICKLOOK_EVERY-th frame, decimated by QUICKLOOK_DECIMATE, to a
+# shared-memory ring for a live viewer (python quicklook.py in another
+# terminal, --camera <serial> to pick a camera); None turns it off. The writers
+# never wait for the viewer. Needs Python 3.8 (multiprocessing.shared_memory).
+QUICKLOOK_EVERY = None
+QUICKLOOK_DECIMATE = 4
+# Frame statistics (mean, min, max, std, saturated pixels, histogram) are
+# computed on the writer threads from every STATS_STRIDE-th pixel in x and y;
+# 0 turns them off
+STATS_STRIDE = 1
+# How to wait for TriggerArmed: 'spin' (tight polling, pins a core), 'backoff'
+# (spin, yield, then short growing sleeps) or 'predictive' (sleep until the
+# expected arm time from exposure and frame rate, then back off; less CPU next
+# to the writer threads, see trigger_arming.py)
+ARMING_STRATEGY = 'spin'
+# 'triggered': one software trigger per frame, 'streaming': trigger off, the
+# camera free-runs at the fastest frame rate the exposure allows and a drain
+# thread takes the frames off the stream (see frame_stream.py)
+ACQUISITION_MODE = 'triggered'
+STREAM_BUFFERS = 32  # buffers announced to the stream in streaming mode
+STREAM_BUFFER_HANDLING = 'OldestFirst'  # or 'OldestFirstOverwrite', 'NewestOnly'
+STREAM_SETTLE_FRAMES = 3  # frames discarded after an exposure change
+# 'Mono12': 12-bit pixels in 16-bit containers, 'Mono12p' or 'Mono12Packed': two
+# pixels in three bytes, a third more frames through the link, unpacked on the
+# writer threads (see mono12_packed.py)
+PIXEL_FORMAT = 'Mono12'
+# Drive every connected camera at once, one process per camera, each writing
+# into BASE_DIR/SUB_DIR/<serial number> (see multi_camera.py); False uses the
+# first camera found
+MULTI_CAMERA = False
+# Time every stage of the frame loop (arm wait, trigger, get_buffer, copy,
+# statistics, header, writeto, requeue) into latency histograms, printed at the
+# end of the run and dumped as <FILENAME_BASE>_<date>_timing.json/.csv (see
+# stage_timing.py)
+STAGE_TIMING = False
+# Profile one burst, e.g. (0, 1) for the frames named seq0_exp1: 'cprofile'
+# profiles the trigger loop, 'sample' samples the stacks of every thread; written
+# as <FILENAME_BASE>_<date>_profile.txt. None turns it off
+PROFILE_BURST = None
+PROFILE_MODE = 'cprofile'
+# Stamp every frame from the camera's chunk data (exposure-start Timestamp,
+# FrameID, ExposureTime) with the camera clock mapped once to UTC: DATE-OBS is
+# then the exposure start, and every buffer is logged to
+# <FILENAME_BASE>_<date>_frames.csv for frame_timing.py (see frame_clock.py).
+# DATE-OBS and the dates in the frame file names are then UTC instead of the
+# host's local time
+CHUNK_TIMESTAMPS = False
+# Resolve node handles once and cache node values, ranges and writability, so
+# rewriting an unchanged ExposureTime or reading .min/.max again costs no camera
+# round trip (see node_cache.py); False sends every node access to the camera
+NODE_CACHE = True
+
 
 def create_devices_with_tries():
     """
@@ -55,38 +150,49 @@ def toc(t_start):
 
 def store_initial(nodemap):
     """
-    Store initial node values, return their values at the end
+    Resolve the nodes once (cached, see node_cache.py) and store the initial
+    values of the settings the script changes, to return them at the end
     """
-    nodes = nodemap.get_node(['TriggerMode', 'TriggerSource', 'TriggerSelector', 'TriggerSoftware',
-                              'TriggerArmed', 'ExposureAuto', 'ExposureTime', 'PixelFormat', 'Width', 'Height',
-                              'AcquisitionFrameRateEnable', 'AcquisitionFrameRate'])
-
-    trigger_mode_initial = nodes['TriggerMode'].value
-    trigger_source_initial = nodes['TriggerSource'].value
-    trigger_selector_initial = nodes['TriggerSelector'].value
-    exposure_auto_initial = nodes['ExposureAuto'].value
-    exposure_time_initial = nodes['ExposureTime'].value
+    nodes = node_cache.NodeCache(nodemap, ['TriggerMode', 'TriggerSource', 'TriggerSelector', 'TriggerSoftware',
+                                           'TriggerArmed', 'ExposureAuto', 'ExposureTime', 'PixelFormat',
+                                           'Width', 'Height', 'AcquisitionFrameRateEnable',
+                                           'AcquisitionFrameRate'], enabled=NODE_CACHE)
 
-    return nodes, [exposure_time_initial, exposure_auto_initial, trigger_selector_initial,
-                   trigger_source_initial, trigger_mode_initial]
+    # every setting the script changes, restored in dependency order by
+    # nodes.apply(initial_vals) at the end
+    return nodes, nodes.snapshot()
 
 
-def trigger_software_once_armed(nodes):
+def trigger_software_once_armed(nodes, arming=None):
     """
-    Continually check until trigger is armed. Once the trigger is armed,
-    it is ready to be executed.
+    Wait until the trigger is armed, then execute it. How the wait is done
+    is up to ``arming`` (see trigger_arming.py); without one TriggerArmed
+    is polled in a tight loop.
     """
-    while not bool(nodes['TriggerArmed'].value):
-        pass
+    if arming is None:
+        arming = trigger_arming.SpinArming()
+    # wait for TriggerArmed, then execute the software trigger node
+    arming.trigger(nodes)
 
-    # retrieve and execute software trigger node
-    nodes['TriggerSoftware'].execute()
 
+def log_burst_summary(seq, exp_index, burst):
+    """
+    Called by the frame pipeline once every frame of a burst is written
+    """
+    logging.info(f'{TAB1}{TAB2}{TAB1}Image Burst seq{seq} [mean, std, min, max, saturated]: '
+                 f'{burst.mean:.2f}, {burst.std:.2f}, {burst.min}, {burst.max}, {burst.saturated}')
 
-def acquire_singlexp_images(device, nodes, initial_vals, exp1, exp2, exp3):
+
+def acquire_singlexp_images(device, nodes, initial_vals, exp1, exp2, exp3, on_start=None):
+    '''
+    on_start is called once the camera, the pipeline and the output are set
+    up, right before the stream starts (multi_camera.py waits there for the
+    common start). Returns the number of frames written.
+    '''
     logging.info(f"{TAB1}Prepare trigger mode")
     nodes['TriggerSelector'].value = "FrameStart"
-    nodes['TriggerMode'].value = "On"
+    # free-running in streaming mode, software triggered otherwise
+    nodes['TriggerMode'].value = "Off" if ACQUISITION_MODE == 'streaming' else "On"
     nodes['TriggerSource'].value = "Software"
     nodes['AcquisitionFrameRateEnable'].value = True
     min_frame_rate = nodes['AcquisitionFrameRate'].min
@@ -104,7 +210,7 @@ def acquire_singlexp_images(device, nodes, initial_vals, exp1, exp2, exp3):
 
     logging.info(f"{TAB1}Disable auto exposure")
     nodes['ExposureAuto'].value = 'Off'
-    pixel_format_name = 'Mono12'
+    pixel_format_name = PIXEL_FORMAT
     logging.info(f'Setting Pixel Format to {pixel_format_name}')
     nodes['PixelFormat'].value = pixel_format_name
 
@@ -121,65 +227,141 @@ def acquire_singlexp_images(device, nodes, initial_vals, exp1, exp2, exp3):
         exposures = [exp1, exp2, exp3]
         logging.info(f"Exposure times have been adjusted: {exposures}")
 
-        tl_stream_nodemap = device.tl_stream_nodemap
-        tl_stream_nodemap['StreamAutoNegotiatePacketSize'].value = True
-        tl_stream_nodemap['StreamPacketResendEnable'].value = True
-
-        logging.info(f"{TAB1}Acquire {NUM_IMAGES} HDR images")
+    tl_stream_nodemap = device.tl_stream_nodemap
+    tl_stream_nodemap['StreamAutoNegotiatePacketSize'].value = True
+    tl_stream_nodemap['StreamPacketResendEnable'].value = True
+
+    logging.info(f"{TAB1}Acquire {NUM_IMAGES} HDR images")
+    timer = stage_timing.make_stage_timer(STAGE_TIMING)
+    run_name = os.path.join(BASE_DIR, SUB_DIR,
+                            f"{FILENAME_BASE}_{datetime.now().strftime(frame_pipeline.FILENAME_DATE_FORMAT)}")
+    profiler = stage_timing.BurstProfiler(PROFILE_BURST, run_name + '_profile', PROFILE_MODE)
+    arming = trigger_arming.make_arming(ARMING_STRATEGY, timer)
+    # chunk data has to be configured before the stream starts
+    clock = frame_clock.FrameClock(nodes) if CHUNK_TIMESTAMPS else None
+    extra_sinks = []
+    if STACK_METHOD:
+        extra_sinks.append(burst_stack.BurstStackSink(os.path.join(BASE_DIR, SUB_DIR), FILENAME_BASE,
+                                                      STACK_METHOD, clip_sigma=STACK_CLIP_SIGMA))
+    preview = None
+    if QUICKLOOK_EVERY:
+        import quicklook
+        serial = device.nodemap['DeviceSerialNumber'].value
+        preview = quicklook.QuickLookPublisher(QUICKLOOK_EVERY, QUICKLOOK_DECIMATE,
+                                               name=quicklook.ring_name(serial),
+                                               queue_depth=lambda: pipeline.queue_depth)
+        extra_sinks.append(preview)
+        logging.info(f"{TAB1}Quick-look viewer: python quicklook.py --camera {serial}")
+    manifest = None
+    if MANIFEST:
+        settings = session_manifest.node_settings(nodes)
+        settings.update(OUTPUT_MODE=OUTPUT_MODE, ACQUISITION_MODE=ACQUISITION_MODE,
+                        BACKPRESSURE=BACKPRESSURE, exposures_us=exposures)
+        manifest = session_manifest.ManifestSink(run_name + '_manifest.sqlite',
+                                                 os.path.join(BASE_DIR, SUB_DIR), FILENAME_BASE,
+                                                 OUTPUT_MODE, settings=settings)
+        extra_sinks.append(manifest)
+    if DISK_PREFLIGHT_MB:
+        preflight = backpressure.preflight_run(os.path.join(BASE_DIR, SUB_DIR), nodes, OUTPUT_MODE,
+                                               [(exposures, NUM_IMAGES, 0.)], NUM_SEQ * NUM_IMAGES,
+                                               megabytes=DISK_PREFLIGHT_MB)
+        logging.info(f"{TAB1}{preflight.report()}")
+    pressure = backpressure.Backpressure(BACKPRESSURE, max_decimate=BACKPRESSURE_MAX_DECIMATE,
+                                         writers=WRITER_THREADS, log=logging.info)
+    pipeline = frame_pipeline.start_frame_pipeline(
+        os.path.join(BASE_DIR, SUB_DIR), FILENAME_BASE, nodes, WRITER_THREADS,
+        WRITER_QUEUE_DEPTH, WRITER_PROCESSES, on_burst_complete=log_burst_summary,
+        output=OUTPUT_MODE, run_frames=NUM_SEQ * NUM_IMAGES, stats_stride=STATS_STRIDE,
+        extra_sinks=extra_sinks, timer=timer, frame_clock=clock, backpressure=pressure)
+    if on_start is not None:
+        on_start()
+    drain = None
+    if ACQUISITION_MODE == 'streaming':
+        frame_stream.configure_stream(device, STREAM_BUFFER_HANDLING)
+        device.start_stream(STREAM_BUFFERS)
+        drain = frame_stream.StreamDrain(device, pipeline, timer=timer).start()
+    else:
         device.start_stream()
 
+    try:
         for seq in range(NUM_SEQ):
             logging.info(f"Starting Sequence {seq}")
             seq_start = tic()
 
             t_start = tic()
+            tx_start, polls_start = nodes.transactions, nodes.polls
 
             exposure = exp1
             j = 0
             logging.info(f"{TAB1}{TAB2}Image Exposure #{j+1}: {exposure/1000:.1f} ms")
+            profiler.begin(seq, j + 1)
+
+            if drain is not None:
+                # the camera runs at the fastest rate this exposure allows; the drain
+                # thread hands the burst to the pipeline
+                frame_rate = frame_stream.pin_frame_rate(nodes, exposure)
+                drain.capture({'seq': seq, 'exp_index': j, 'burst_size': NUM_IMAGES,
+                               'exposure_us': exposure, 'frame_rate': frame_rate},
+                              NUM_IMAGES, STREAM_SETTLE_FRAMES)
+            else:
+                nodes['ExposureTime'].value = exposure
+                arming.expect(exposure, frame_rate)
+                trigger_software_once_armed(nodes, arming)
+                image_pre = device.get_buffer()
+                pipeline.discard_buffer(image_pre)
+                device.requeue_buffer(image_pre)
+
+                for i in range(NUM_IMAGES):
+                    trigger_software_once_armed(nodes, arming)
+                    t = timer.now()
+                    image = device.get_buffer()
+                    timer.mark('get_buffer', t)
+
+                    # the pipeline copies the frame into a preallocated slot, so the
+                    # buffer can be requeued right away
+                    pipeline.submit_buffer(image, {'seq': seq, 'exp_index': j, 'frame_index': i,
+                                                   'burst_size': NUM_IMAGES, 'exposure_us': exposure,
+                                                   'frame_rate': frame_rate, 'timestamp': datetime.now()})
+                    t = timer.now()
+                    device.requeue_buffer(image)
+                    timer.mark('requeue', t)
+            profiler.end()
 
-            nodes['ExposureTime'].value = exposure
-            trigger_software_once_armed(nodes)
-            image_pre = device.get_buffer()
-            device.requeue_buffer(image_pre)
-
-            sequence_mean = 0.0
-            sequence_min = 0.0
-            sequence_max = 0.0
-
-            for i in range(NUM_IMAGES):
-                trigger_software_once_armed(nodes)
-                image = device.get_buffer()
-
-                pdata_as16 = ctypes.cast(image.pdata, ctypes.POINTER(ctypes.c_ushort))
-                nparray_reshaped = np.ctypeslib.as_array(pdata_as16, (image.height, image.width))
-
-                img_fits = fits.PrimaryHDU(nparray_reshaped)
-                sequence_mean += np.mean(nparray_reshaped)
-                sequence_min += np.min(nparray_reshaped)
-                sequence_max += np.max(nparray_reshaped)
-
-                img_fits.header['DATE-OBS'] = datetime.now().strftime("%Y-%m-%dZ%H:%M:%S.%f")
-                img_fits.header['EXPTIME'] = f"{exposure/1000./1000.}"
-                filename_date = datetime.now().strftime("%Y%m%d_%H%M%S")
-                file_path = os.path.join(BASE_DIR, SUB_DIR, f'{FILENAME_BASE}_{filename_date}_seq{seq}_exp{j+1}_i{i:02d}.fits')
-                img_fits.writeto(file_path, overwrite=True)
-
-                device.requeue_buffer(image)
-
-            logging.info(f'{TAB1}{TAB2}{TAB1}Image Burst [mean, min, max]: {sequence_mean:.2f}, {sequence_min}, {sequence_max}')
             t_elapsed = toc(t_start)
-            logging.info(f"{TAB1}{TAB2}{TAB1}Burst elapsed time: {t_elapsed:.3f} seconds")
+            logging.info(f"{TAB1}{TAB2}{TAB1}Burst elapsed time: {t_elapsed:.3f} seconds, "
+                         f"{nodes.transactions - tx_start} node transactions "
+                         f"({nodes.polls - polls_start} status polls)")
             seq_elapsed = toc(seq_start)
             logging.info(f"{TAB1}{TAB2}Sequence elapsed time: {seq_elapsed:.3f} seconds")
-
+    finally:
+        profiler.end()
+        if drain is not None:
+            drain.stop()
         device.stop_stream()
-
-    nodes['ExposureTime'].value = initial_vals[0]
-    nodes['ExposureAuto'].value = initial_vals[1]
-    nodes['TriggerSelector'].value = initial_vals[2]
-    nodes['TriggerSource'].value = initial_vals[3]
-    nodes['TriggerMode'].value = initial_vals[4]
+        # drain the writer queue before the nodes are restored
+        pipeline.close()
+        logging.info(f"{TAB1}{pipeline.report()}")
+        if preview is not None:
+            logging.info(f"{TAB1}{preview.report()}")
+        logging.info(f"{TAB1}{pressure.report()}")
+        if manifest is not None:
+            logging.info(f"{TAB1}{manifest.report()}")
+        if pressure.events:
+            pressure.write_log(run_name + '_backpressure.csv')
+        logging.info(f"{TAB1}{nodes.report()}")
+        logging.info(f"{TAB1}{drain.report() if drain is not None else arming.report()}")
+        if timer.enabled:
+            logging.info(f"{TAB1}Stage latencies:\n{timer.report()}")
+            timer.dump(run_name + '_timing')
+        if PROFILE_BURST is not None:
+            logging.info(f"{TAB1}{profiler.report()}")
+        if clock is not None:
+            clock.close()
+            clock.write_log(run_name + '_frames.csv')
+            logging.info(f"{TAB1}{clock.report()}")
+
+    nodes.apply(initial_vals)
+    return pipeline.frames_written - pipeline.failed_frames
 
 
 def entry_point():
@@ -201,4 +383,7 @@ def entry_point():
 
 
 if __name__ == "__main__":
-    entry_point()
\ No newline at end of file
+    if MULTI_CAMERA:
+        multi_camera.acquire_all(__file__)
+    else:
+        entry_point()
\ No newline at end of file
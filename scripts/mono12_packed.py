@@ -0,0 +1,140 @@
+'''
+Packed 12-bit pixel formats
+    Mono12 sends every 12-bit pixel in a 16-bit container, so a quarter of
+    the link carries padding; the packed formats put two pixels in three
+    bytes and raise the link-limited frame rate by a third:
+
+        Mono12p       (PFNC)        p0 = b0 | (b1 & 0xF) << 8,   p1 = b1 >> 4 | b2 << 4
+        Mono12Packed  (GigE Vision) p0 = b0 << 4 | (b1 & 0xF),   p1 = b1 >> 4 | b2 << 4
+
+    The unpacker reads each byte triple as one little-endian 32-bit word w
+    (through an overlapping strided view, no copy), so that p1 = (w >> 12) &
+    0xFFF in both formats, and writes both pixels of a pair as one 32-bit
+    word. Work is done in cache-sized chunks of pairs with per-thread
+    scratch.
+
+    It can run in place: the frame pool copies the packed bytes into the
+    last 3/4 of a uint16 frame slot, and unpacking front to back never
+    overwrites bytes that are still to be read (pair i is written to bytes
+    4i..4i+3, it was read from byte n/2 + 3i onwards, n = pixels), so the
+    copy out of the camera buffer stays one memmove and the unpacking runs
+    on the writer threads.
+'''
+import ctypes
+import threading
+
+import numpy as np
+
+PACKED_FORMATS = ('Mono12p', 'Mono12Packed')
+CHUNK_PAIRS = 1 << 14
+
+_local = threading.local()
+
+
+def is_packed(pixel_format):
+    return pixel_format in PACKED_FORMATS
+
+
+def packed_bytes(pixels):
+    '''
+    Size in bytes of a packed frame of ``pixels`` pixels
+    '''
+    if pixels % 2:
+        raise ValueError('Packed Mono12 frames need an even number of pixels')
+    return pixels * 3 // 2
+
+
+def buffer_as_bytes(image, nbytes):
+    '''
+    uint8 view (no copy) of the first nbytes of a camera buffer
+    '''
+    pdata = ctypes.cast(image.pdata, ctypes.POINTER(ctypes.c_ubyte))
+    return np.ctypeslib.as_array(pdata, (nbytes,))
+
+
+def _scratch(pairs):
+    scratch = getattr(_local, 'scratch', None)
+    if scratch is None or scratch.shape[1] < pairs:
+        scratch = _local.scratch = np.empty((3, max(pairs, CHUNK_PAIRS)), dtype=np.uint32)
+    return [plane[:pairs] for plane in scratch]
+
+
+def _unpack_words(w, t, u, pixel_format):
+    '''
+    Byte triples (as the low 24 bits of w) to pixel pairs (p0 | p1 << 16), in w
+    '''
+    np.left_shift(w, 4, out=t)
+    t &= 0x0FFF0000
+    if pixel_format == 'Mono12p':
+        w &= 0xFFF
+    else:
+        np.bitwise_and(w, 0xFF, out=u)
+        u <<= 4
+        w >>= 8
+        w &= 0xF
+        w |= u
+    w |= t
+
+
+def unpack_mono12(packed, out, pixel_format='Mono12p', chunk_pairs=CHUNK_PAIRS):
+    '''
+    Unpack the bytes of a packed frame into the C-contiguous uint16 array
+        out. packed may be the tail of out's own memory (see unpack_in_place).
+    '''
+    if pixel_format not in PACKED_FORMATS:
+        raise ValueError(f'Unknown packed format {pixel_format!r}, expected one of {PACKED_FORMATS}')
+    pairs = out.size // 2
+    if packed.size < packed_bytes(out.size):
+        raise ValueError(f'{packed.size} packed bytes for {out.size} pixels')
+    out_pairs = out.reshape(-1).view(np.uint32)
+    # word i starts at byte 3i and also holds the first byte of the next
+    # triple, so the last pair is done on its own to stay inside the buffer
+    words = np.ndarray((pairs - 1,), dtype='<u4', buffer=packed, strides=(3,))
+    for start in range(0, pairs - 1, chunk_pairs):
+        stop = min(start + chunk_pairs, pairs - 1)
+        w, t, u = _scratch(stop - start)
+        np.copyto(w, words[start:stop])
+        _unpack_words(w, t, u, pixel_format)
+        out_pairs[start:stop] = w
+    last = packed[3 * (pairs - 1):3 * pairs].astype(np.uint32)
+    w, t, u = _scratch(1)
+    w[0] = last[0] | last[1] << 8 | last[2] << 16
+    _unpack_words(w, t, u, pixel_format)
+    out_pairs[pairs - 1] = w[0]
+    return out
+
+
+def packed_tail(frame):
+    '''
+    uint8 view of the last 3/4 of a uint16 frame, where packed bytes are put
+        for unpack_in_place()
+    '''
+    raw = frame.reshape(-1).view(np.uint8)
+    return raw[raw.size - packed_bytes(frame.size):]
+
+
+def unpack_in_place(frame, pixel_format='Mono12p'):
+    '''
+    Unpack the packed bytes held in packed_tail(frame) into frame itself
+    '''
+    return unpack_mono12(packed_tail(frame), frame, pixel_format)
+
+
+def pack_mono12(frame, pixel_format='Mono12p'):
+    '''
+    Packed bytes of a uint16 frame of 12-bit values (for the simulated
+        camera and the benchmark)
+    '''
+    pixels = frame.reshape(-1, 2).astype(np.uint32)
+    p0, p1 = pixels[:, 0], pixels[:, 1]
+    packed = np.empty((p0.size, 3), dtype=np.uint8)
+    if pixel_format == 'Mono12p':
+        packed[:, 0] = p0 & 0xFF
+        packed[:, 1] = (p0 >> 8) | (p1 & 0xF) << 4
+    elif pixel_format == 'Mono12Packed':
+        packed[:, 0] = p0 >> 4
+        packed[:, 1] = (p0 & 0xF) | (p1 & 0xF) << 4
+    else:
+        raise ValueError(f'Unknown packed format {pixel_format!r}, expected one of {PACKED_FORMATS}')
+    packed[:, 2] = p1 >> 4
+    return packed.reshape(-1)
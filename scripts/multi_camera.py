@@ -0,0 +1,282 @@
+'''
+Multi-camera acquisition
+    Drives every connected camera at once with one of the acquisition
+    scripts, one process per camera so the frame loops, drains and writer
+    threads of different cameras never share a GIL. Each camera writes into
+    its own directory (<out>/<serial>) and logs the script output to
+    <out>/<serial>/acquisition.log.
+
+    Start times are coordinated: every worker opens its camera and runs the
+    script up to the start of the stream (node configuration, disk pre-flight,
+    frame clock mapping, writer pipeline), reports ready, and waits; once all
+    are ready the controller sets a common wall-clock start time a little in
+    the future and every worker starts its stream then (the skew is
+    reported). With --pin every worker is limited to its own share of the
+    cores (disjoint sets, so its writer threads keep several cores), where the
+    OS allows it and there are at least as many cores as cameras.
+
+    At the end the per-camera frames written in the run, frame rate (from the
+    first trigger to the last frame written), lost and incomplete frames
+    (StreamLostFrameCount / StreamIncompleteFrameCount of the stream nodemap)
+    and CPU use are reported with the totals. --solo first runs each camera on
+    its own to show that no camera's frame rate drops when they all run
+    together; with fewer cores than cameras they have to share and the
+    comparison says so.
+
+Usage:
+    python multi_camera.py --script totality --out D:/eclipse/multi
+    python multi_camera.py --script lucid_sequence --set num_images=10 --solo
+    python multi_camera.py --script lucid_sequence --simulate 2 --width 1224 --height 1024 --solo
+    or MULTI_CAMERA = True in the acquisition scripts
+'''
+import argparse
+import contextlib
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+
+from acquisition_scripts import (SCRIPTS, get_setting, load_script, parse_setting,
+                                 script_for_path, set_setting)
+
+STREAM_COUNTERS = ('StreamLostFrameCount', 'StreamIncompleteFrameCount')
+START_LEAD_S = 2.       # time between the last camera being ready and the common start
+READY_TIMEOUT_S = 120.
+
+
+def stream_counters(device):
+    '''
+    Lost and incomplete frame counters of the stream, where the transport
+        layer has them
+    '''
+    nodes = device.tl_stream_nodemap.get_node(list(STREAM_COUNTERS))
+    return {name: int(node.value) for name, node in nodes.items() if node is not None}
+
+
+def wait_until(t_start):
+    '''
+    Sleep until the wall-clock time t_start, spinning for the last 2 ms
+    '''
+    while True:
+        remaining = t_start - time.time()
+        if remaining <= 0:
+            return
+        time.sleep(remaining - 0.002 if remaining > 0.004 else 0)
+
+
+def core_shares(count):
+    '''
+    Disjoint core sets for count camera processes, or None where the OS
+        cannot pin or there are fewer cores than cameras
+    '''
+    if not hasattr(os, 'sched_setaffinity'):
+        return None
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < count:
+        return None
+    return [set(cores[index::count]) for index in range(count)]
+
+
+def log_to(stream):
+    '''
+    Send the root logger to stream only, as logging.basicConfig(stream=...,
+        force=True) does from Python 3.8
+    '''
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+
+
+def camera_worker(name, info, out_dir, settings, simulate, cores, ready, go, start_at,
+                  results):
+    '''
+    Acquisition process of one camera; cores is the set it is pinned to (the
+        trigger loop and the writer threads), None to leave it to the OS
+    '''
+    result = {'serial': info['serial'], 'out_dir': out_dir, 'error': None}
+    device = None
+    module = None
+    is_ready = False
+    try:
+        if simulate is not None:
+            import arena_sim
+            arena_sim.install(**simulate)
+        os.makedirs(out_dir, exist_ok=True)
+        module = load_script(name, prefix=f"camera_{info['serial']}")
+        set_setting(module, 'BASE_DIR', out_dir)
+        set_setting(module, 'SUB_DIR', '')
+        for key, value in settings.items():
+            set_setting(module, key, value)
+        exposures = [get_setting(module, f'exp{n}') for n in (1, 2, 3)]
+        acquire = getattr(module, SCRIPTS[name][1])
+        if cores is not None:
+            os.sched_setaffinity(0, cores)
+        result['cores'] = sorted(cores) if cores is not None else None
+
+        device = module.system.create_device(device_infos=[info])[0]
+        nodes, initial_vals = module.store_initial(device.nodemap)
+        started = {}
+
+        def start():
+            # set up up to the stream: report ready, wait for the common start
+            nonlocal is_ready
+            ready.put(info['serial'])
+            is_ready = True
+            go.wait()
+            wait_until(start_at.value)
+            result['start_error_ms'] = (time.time() - start_at.value) * 1000.
+            started.update(wall=time.perf_counter(), cpu=time.process_time())
+
+        with open(os.path.join(out_dir, 'acquisition.log'), 'w') as log, \
+                contextlib.redirect_stdout(log):
+            log_to(log)
+            frames = acquire(device, nodes, initial_vals, *exposures, on_start=start)
+            wall = time.perf_counter() - started['wall']
+            cpu = time.process_time() - started['cpu']
+        result.update(stream_counters(device))
+        result.update({'frames_written': frames, 'wall_s': wall, 'fps': frames / wall,
+                       'cpu_percent': 100. * cpu / wall})
+    except Exception:
+        result['error'] = traceback.format_exc()
+        if not is_ready:
+            ready.put(info['serial'])
+    finally:
+        if device is not None:
+            module.system.destroy_device(device)
+        results.put(result)
+
+
+def run_cameras(name, out_root, device_infos, settings=None, simulate=None, pin=False,
+                lead_s=START_LEAD_S):
+    '''
+    Run the acquisition script ``name`` on every camera in device_infos at
+        once, one process each; returns the per-camera results
+    '''
+    context = multiprocessing.get_context('spawn')
+    ready, results = context.Queue(), context.Queue()
+    go = context.Event()
+    start_at = context.Value('d', 0.)
+    shares = core_shares(len(device_infos)) if pin else None
+    workers = [context.Process(target=camera_worker, name=f"camera-{info['serial']}",
+                               args=(name, info, os.path.join(out_root, info['serial']),
+                                     settings or {}, simulate,
+                                     shares[index] if shares is not None else None, ready, go,
+                                     start_at, results))
+               for index, info in enumerate(device_infos)]
+    for worker in workers:
+        worker.start()
+    try:
+        for _ in workers:
+            ready.get(timeout=READY_TIMEOUT_S)
+        start_at.value = time.time() + lead_s
+        go.set()
+        collected = [results.get() for _ in workers]
+    finally:
+        go.set()
+        for worker in workers:
+            worker.join()
+    order = {info['serial']: index for index, info in enumerate(device_infos)}
+    return sorted(collected, key=lambda result: order[result['serial']])
+
+
+def totals(results):
+    ok = [r for r in results if r['error'] is None]
+    return {'cameras': len(results), 'failed': len(results) - len(ok),
+            'frames_written': sum(r['frames_written'] for r in ok),
+            'fps': sum(r['fps'] for r in ok),
+            'lost_frames': sum(r.get('StreamLostFrameCount', 0) for r in ok),
+            'incomplete_frames': sum(r.get('StreamIncompleteFrameCount', 0) for r in ok),
+            'max_start_error_ms': max((abs(r['start_error_ms']) for r in ok), default=0.)}
+
+
+def print_report(results, solo=None):
+    print(f"{'camera':<14}{'frames':>8}{'fps':>8}{'solo':>8}{'lost':>6}{'incpl':>7}"
+          f"{'cpu%':>7}{'start ms':>10}  dir")
+    for r in results:
+        if r['error'] is not None:
+            print(f"{r['serial']:<14}  failed:\n{r['error']}")
+            continue
+        solo_fps = f"{solo[r['serial']]:.2f}" if solo and r['serial'] in solo else '-'
+        print(f"{r['serial']:<14}{r['frames_written']:>8}{r['fps']:>8.2f}{solo_fps:>8}"
+              f"{r.get('StreamLostFrameCount', '-'):>6}{r.get('StreamIncompleteFrameCount', '-'):>7}"
+              f"{r['cpu_percent']:>7.1f}{r['start_error_ms']:>10.2f}  {r['out_dir']}")
+    t = totals(results)
+    print(f"{'total':<14}{t['frames_written']:>8}{t['fps']:>8.2f}{'':>8}{t['lost_frames']:>6}"
+          f"{t['incomplete_frames']:>7}")
+    if solo:
+        slower = [r['serial'] for r in results if r['error'] is None and r['serial'] in solo
+                  and r['fps'] < 0.95 * solo[r['serial']]]
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        if slower:
+            print(f"Frame rate fell by more than 5% against the solo run: {', '.join(slower)}")
+        else:
+            print('No camera is slower than when running alone')
+        if slower and cores is not None and cores < len(results):
+            print(f"({cores} cores for {len(results)} cameras: the cameras share cores, a lower "
+                  f"frame rate than alone is expected)")
+
+
+def acquire_all(script_path, out_root=None, settings=None, simulate=None, solo=False, pin=False):
+    '''
+    Entry point used by the acquisition scripts (MULTI_CAMERA = True) and the
+        command line: every connected camera at once, report printed
+    '''
+    name = script_for_path(script_path)
+    if simulate is not None:
+        import arena_sim
+        arena_sim.install(**simulate)
+    module = load_script(name, prefix='controller')
+    if out_root is None:
+        out_root = os.path.join(module.BASE_DIR, module.SUB_DIR)
+    device_infos = list(module.system.device_infos)
+    if not device_infos:
+        raise Exception('No device found! Please connect a device and run the example again.')
+    print(f"Acquiring with {len(device_infos)} cameras: "
+          f"{', '.join(info['serial'] for info in device_infos)}")
+    solo_fps = None
+    if solo:
+        solo_fps = {}
+        for info in device_infos:
+            result, = run_cameras(name, os.path.join(out_root, 'solo'), [info], settings,
+                                  simulate, pin)
+            if result['error'] is None:
+                solo_fps[info['serial']] = result['fps']
+    results = run_cameras(name, out_root, device_infos, settings, simulate, pin)
+    print_report(results, solo_fps)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--script', choices=sorted(SCRIPTS), default='totality')
+    parser.add_argument('--out', help='output root, one directory per camera '
+                                      '(default: the script BASE_DIR/SUB_DIR)')
+    parser.add_argument('--set', dest='settings', action='append', default=[],
+                        type=parse_setting, metavar='NAME=VALUE',
+                        help='override a SETTINGS constant of the script (repeatable)')
+    parser.add_argument('--solo', action='store_true',
+                        help='run every camera alone first and compare frame rates')
+    parser.add_argument('--pin', action='store_true',
+                        help='pin every camera process to its own share of the cores')
+    parser.add_argument('--simulate', type=int, metavar='N',
+                        help='use N simulated cameras (arena_sim.py)')
+    parser.add_argument('--width', type=int, default=2448, help='simulated sensor width')
+    parser.add_argument('--height', type=int, default=2048, help='simulated sensor height')
+    args = parser.parse_args()
+
+    simulate = None
+    if args.simulate:
+        simulate = {'num_devices': args.simulate, 'width': args.width, 'height': args.height}
+    acquire_all(SCRIPTS[args.script][0], args.out, dict(args.settings), simulate, args.solo,
+                args.pin)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+'''
+Cached GenICam node access
+    Every node read or write is a round trip to the camera (a GenCP register
+    access over the link), and the frame loops make many that tell them
+    nothing new: ExposureTime rewritten with the value it already has, .min
+    and .max read again for every check, the same node looked up by name
+    every frame. NodeCache resolves each node handle once and keeps the last
+    value, range and writability of every node it has seen:
+
+    - reads are served from the cache after the first one, except for status
+      nodes (TriggerArmed, TimestampLatchValue, ...: counted as polls) and
+      nodes the camera drives itself (ExposureTime while ExposureAuto is on,
+      AcquisitionFrameRate while AcquisitionFrameRateEnable is off)
+    - writes go through to the camera and update the cache; a write of the
+      value the node already has is skipped
+    - a write invalidates what it can change on the camera: the nodes a
+      selector selects (TriggerSelector -> TriggerMode, ChunkSelector ->
+      ChunkEnable, SequencerSetSelector -> ExposureTime) and the ranges that
+      depend on it (ExposureTime.max follows AcquisitionFrameRate, which
+      follows ExposureTime, PixelFormat, Width and Height)
+    - ExposureTime and AcquisitionFrameRate are rounded by the camera, so
+      after a write their value is read back once; writing the same request
+      again is still skipped
+    - apply() writes a batch of settings in an order the camera accepts
+      (selectors first, a gated node while its gate is open, the exposure and
+      the frame rate in the order the new exposure needs), so restoring the
+      snapshot() taken before the run is a single call
+
+    Command nodes (execute()) always go through. With enabled=False the cache
+    only counts: every access goes to the camera, like the plain node dict.
+    reads/writes count the camera transactions (polls: the status reads among
+    them), hits and skipped the ones saved.
+'''
+# nodes store_initial() snapshots and restores at the end of a run
+RESTORE_NODES = ('TriggerSelector', 'TriggerMode', 'TriggerSource', 'ChunkModeActive',
+                 'ExposureAuto', 'ExposureTime', 'PixelFormat', 'AcquisitionFrameRateEnable',
+                 'AcquisitionFrameRate')
+# writing the key can change the value, range or writability of these
+INVALIDATES = {
+    'TriggerSelector': ('TriggerMode', 'TriggerSource', 'TriggerActivation'),
+    'ExposureAuto': ('ExposureTime',),
+    'ExposureTime': ('AcquisitionFrameRate',),
+    'AcquisitionFrameRateEnable': ('AcquisitionFrameRate', 'ExposureTime'),
+    'AcquisitionFrameRate': ('ExposureTime',),
+    'PixelFormat': ('AcquisitionFrameRate', 'ExposureTime'),
+    'Width': ('AcquisitionFrameRate', 'ExposureTime'),
+    'Height': ('AcquisitionFrameRate', 'ExposureTime'),
+    'SequencerMode': ('ExposureTime', 'SequencerConfigurationMode', 'SequencerSetStart'),
+    'SequencerConfigurationMode': ('ExposureTime', 'SequencerMode', 'SequencerSetSelector',
+                                   'SequencerSetNext', 'SequencerPathSelector',
+                                   'SequencerTriggerSource', 'SequencerSetStart'),
+    'SequencerSetSelector': ('ExposureTime', 'SequencerSetNext', 'SequencerPathSelector',
+                             'SequencerTriggerSource'),
+    'ChunkModeActive': ('ChunkSelector', 'ChunkEnable'),
+    'ChunkSelector': ('ChunkEnable',),
+}
+# status nodes, never cached
+STATUS_NODES = ('TriggerArmed', 'TimestampLatchValue', 'SequencerSetActive', 'AcquisitionStatus',
+                'DeviceTemperature')
+# float nodes the camera rounds to its own increment
+ROUNDED = ('ExposureTime', 'AcquisitionFrameRate')
+# batch write order: selectors and modes before what they select or gate
+WRITE_ORDER = ('TriggerSelector', 'TriggerMode', 'TriggerSource', 'SequencerMode',
+               'ChunkModeActive', 'PixelFormat', 'Width', 'Height', 'ExposureAuto',
+               'AcquisitionFrameRateEnable', 'ExposureTime', 'AcquisitionFrameRate')
+# node: (gate, value) -- the node is only writable, and its value only set by
+# the host, while the gate has that value
+GATES = {'ExposureTime': ('ExposureAuto', 'Off'),
+         'AcquisitionFrameRate': ('AcquisitionFrameRateEnable', True)}
+
+_UNKNOWN = object()
+
+
+class CachedNode:
+    '''
+    Node handle with its last known value, range and writability
+    '''
+
+    def __init__(self, cache, name, node):
+        self._cache = cache
+        self._node = node
+        self.name = name
+        self._rounded = name in ROUNDED
+        self._status = name in STATUS_NODES
+        self._gate = GATES.get(name)
+        self.invalidate()
+
+    def invalidate(self):
+        self._value = _UNKNOWN
+        self._requested = _UNKNOWN
+        self._min = _UNKNOWN
+        self._max = _UNKNOWN
+        self._writable = _UNKNOWN
+
+    @property
+    def node(self):
+        '''
+        The camera's node, for anything the cache does not wrap
+        '''
+        return self._node
+
+    @property
+    def value(self):
+        cache = self._cache
+        if self._value is not _UNKNOWN:
+            cache.hits += 1
+            return self._value
+        value = self._node.value
+        cache.reads += 1
+        if self._status:
+            cache.polls += 1
+        elif cache.enabled and (self._gate is None or cache.gate_open(self._gate)):
+            self._value = value
+        return value
+
+    @value.setter
+    def value(self, value):
+        cache = self._cache
+        if cache.enabled and (value == self._value or value == self._requested):
+            cache.skipped += 1
+            return
+        self._node.value = value
+        cache.writes += 1
+        cache.invalidate(INVALIDATES.get(self.name, ()))
+        if cache.enabled:
+            if self._rounded:
+                self._requested = value
+            else:
+                self._value = value
+
+    def _cached(self, attribute):
+        cache = self._cache
+        value = getattr(self, attribute)
+        if value is not _UNKNOWN:
+            cache.hits += 1
+            return value
+        value = getattr(self._node, attribute[1:])
+        cache.reads += 1
+        if cache.enabled:
+            setattr(self, attribute, value)
+        return value
+
+    @property
+    def min(self):
+        return self._cached('_min')
+
+    @property
+    def max(self):
+        return self._cached('_max')
+
+    @property
+    def is_writable(self):
+        return self._cached('_writable')
+
+    def execute(self):
+        self._node.execute()
+        self._cache.writes += 1
+        self._cache.invalidate(INVALIDATES.get(self.name, ()))
+
+    def __getattr__(self, name):
+        # enumentry_names, is_readable, ...
+        return getattr(self._node, name)
+
+
+class NodeCache(dict):
+    '''
+    {name: CachedNode} of a nodemap, resolved on first use; names the camera
+        does not have map to None like nodemap.get_node(). Also accepted
+        wherever a nodemap is (get_node).
+    '''
+
+    def __init__(self, nodemap, names=(), enabled=True):
+        super().__init__()
+        self.nodemap = nodemap
+        self.enabled = enabled
+        self.reads = 0
+        self.writes = 0
+        self.hits = 0
+        self.skipped = 0
+        self.polls = 0
+        for name in names:
+            self[name]
+
+    def __missing__(self, name):
+        node = self.nodemap.get_node(name)
+        if node is not None:
+            node = CachedNode(self, name, node)
+        self[name] = node
+        return node
+
+    def get_node(self, names):
+        if isinstance(names, str):
+            return self[names]
+        return {name: self[name] for name in names}
+
+    @property
+    def transactions(self):
+        '''
+        Node reads and writes that went to the camera
+        '''
+        return self.reads + self.writes
+
+    def gate_open(self, gate):
+        name, open_value = gate
+        node = self[name]
+        return node is not None and node.value == open_value
+
+    def invalidate(self, names=None):
+        '''
+        Forget the cached state of names (default: every node), e.g. after
+            something wrote them through the nodemap directly
+        '''
+        for name in (self if names is None else names):
+            node = self.get(name)
+            if node is not None:
+                node.invalidate()
+
+    def snapshot(self, names=RESTORE_NODES):
+        '''
+        {name: value} of the nodes the camera has, for apply() later
+        '''
+        return {name: self[name].value for name in names if self[name] is not None}
+
+    def write_order(self, values):
+        '''
+        Names of values in an order the camera accepts the writes in
+        '''
+        rank = {name: n for n, name in enumerate(WRITE_ORDER)}
+        order = sorted(values, key=lambda name: rank.get(name, len(rank)))
+        for name, (gate, open_value) in GATES.items():
+            # a gate being closed goes after the node it gates
+            if name in values and gate in values and values[gate] != open_value:
+                order.remove(gate)
+                order.insert(order.index(name) + 1, gate)
+        exposure, rate = 'ExposureTime', 'AcquisitionFrameRate'
+        if exposure in values and rate in values and self[exposure] is not None:
+            # a longer exposure needs the lower frame rate first
+            if values[exposure] > self[exposure].max and order.index(rate) > order.index(exposure):
+                order.remove(rate)
+                order.insert(order.index(exposure), rate)
+        return order
+
+    def apply(self, values):
+        '''
+        Write {name: value} in dependency order, skipping unchanged values.
+            A gated node whose gate is closed at its turn (ExposureTime with
+            ExposureAuto on, AcquisitionFrameRate with
+            AcquisitionFrameRateEnable off) is left alone: the camera does
+            not use the value then and refuses the write.
+        '''
+        for name in self.write_order(values):
+            node = self[name]
+            if node is None:
+                continue
+            gate = GATES.get(name)
+            if gate is not None and not self.gate_open(gate):
+                continue
+            node.value = values[name]
+
+    def summary(self):
+        return {'transactions': self.transactions, 'reads': self.reads, 'writes': self.writes,
+                'status_polls': self.polls, 'cache_hits': self.hits,
+                'skipped_writes': self.skipped}
+
+    def report(self):
+        counts = (f'{self.transactions} transactions ({self.reads} reads of which '
+                  f'{self.polls} status polls, {self.writes} writes)')
+        if not self.enabled:
+            return f'Node access [uncached]: {counts}'
+        return (f'Node access: {counts}, {self.hits} reads from the cache, '
+                f'{self.skipped} unchanged writes skipped')
@@ -0,0 +1,401 @@
+'''
+Contact-time observing schedule
+    Totality is a few minutes long and the first frames have to start at C2,
+    not whenever the run is started by hand. A timeline gives the second and
+    third contact times (UTC) and the observing phases around them, each with
+    its own exposure ladder, burst size and cadence. The acquisition script
+    opens and configures the camera and starts the stream right away, then
+    Scheduler.sequences() hands out the sequences of every phase on a precise
+    timer: it sleeps until shortly before each slot, spins the last few
+    milliseconds on the performance counter and yields the sequence.
+
+    Before each phase (and before the first sequence) a warm-up callback runs
+    WARMUP_LEAD_S ahead of the start: the script sets the first exposure of
+    the phase and runs a few frames through the stream and the pipeline, so
+    the first frame after the start is a real frame at the right exposure.
+
+    A phase starts one sequence (a burst of burst_size frames at every
+    exposure of its ladder) per cadence_s from its start until its end. A
+    sequence that ends after its successor's slot makes that one start late,
+    at once; slots missed entirely are skipped. cadence_s = 0 runs sequences
+    back to back. The start error of every sequence is logged: the host start
+    error (timer wake-up minus slot) and, with a FrameClock, the first frame
+    error (exposure start of the sequence's first frame from the camera clock
+    minus slot). report() summarises them per phase and write_log() saves
+    them as CSV.
+
+Timeline (JSON):
+    {"c2": "2024-04-08T18:59:13.0Z", "c3": "2024-04-08T19:03:11.0Z",
+     "phases": [
+        {"name": "c2", "start": "C2-10", "end": "C2+15",
+         "exposures": [5000, 1000, 200], "burst_size": 5, "cadence_s": 1.5},
+        {"name": "totality", "start": "C2+15", "end": "C3-15",
+         "exposures": [250000, 80000, 25000], "burst_size": 10, "cadence_s": 10},
+        {"name": "c3", "start": "C3-15", "end": "C3+10",
+         "exposures": [5000, 1000, 200], "burst_size": 5, "cadence_s": 1.5}]}
+    Phase times are a contact plus or minus seconds ("C2", "C3+5.5") or UTC.
+    Exposures are in microseconds.
+
+Usage:
+    python observing_schedule.py timeline.json                  # check and print the plan
+    python observing_schedule.py timeline.json --rehearse 120   # as if C2 were 2 minutes away
+    SCHEDULE = 'timeline.json' in py_eclipse_spectrum.totality.py
+'''
+import argparse
+import csv
+import json
+import logging
+import math
+import re
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+import frame_stream
+
+logger = logging.getLogger(__name__)
+
+WARMUP_LEAD_S = 3.      # warm-up this long before a phase starts
+WARMUP_FRAMES = 3
+SPIN_S = 0.02           # spin instead of sleeping this close to a slot
+COUNTDOWN_S = 60.       # log the remaining wait this often
+CONTACT_TIME = re.compile(r'^(?P<contact>C[1-4])\s*(?P<offset>[+-]\s*[\d.]+)?$', re.IGNORECASE)
+UTC_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S.%f',
+               '%Y-%m-%d %H:%M:%S')
+LOG_FIELDS = ('seq', 'phase', 'slot_utc', 'host_error_ms', 'first_frame_error_ms',
+              'skipped_slots', 'duration_s')
+
+
+def parse_utc(text):
+    '''
+    POSIX time of a UTC time string (a trailing Z is optional)
+    '''
+    text = text.strip().rstrip('Zz')
+    for fmt in UTC_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).replace(tzinfo=timezone.utc).timestamp()
+        except ValueError:
+            pass
+    raise ValueError(f'Not a UTC time: {text!r}')
+
+
+def utc_text(t):
+    return datetime.fromtimestamp(t, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def resolve_time(text, contacts):
+    '''
+    POSIX time of "C2", "C3-15", ... or of an absolute UTC time
+    '''
+    match = CONTACT_TIME.match(str(text).strip())
+    if match is None:
+        return parse_utc(str(text))
+    contact = match.group('contact').lower()
+    if contact not in contacts:
+        raise ValueError(f'{text!r}: the timeline has no {contact.upper()} time')
+    offset = match.group('offset')
+    return contacts[contact] + (float(offset.replace(' ', '')) if offset else 0.)
+
+
+class Phase:
+    '''
+    One observing phase: sequences of burst_size frames at each of exposures
+        (microseconds) every cadence_s between start and end (POSIX times)
+    '''
+
+    def __init__(self, name, start, end, exposures, burst_size, cadence_s=0.):
+        if end <= start:
+            raise ValueError(f'Phase {name!r} ends before it starts')
+        if not exposures or burst_size < 1 or cadence_s < 0:
+            raise ValueError(f'Phase {name!r} needs exposures, burst_size >= 1 and cadence_s >= 0')
+        self.name = name
+        self.start = start
+        self.end = end
+        self.exposures = [float(exposure) for exposure in exposures]
+        self.burst_size = int(burst_size)
+        self.cadence_s = float(cadence_s)
+
+    @property
+    def sequence_frames(self):
+        return self.burst_size * len(self.exposures)
+
+    def max_sequences(self):
+        '''
+        Upper bound of the sequences that fit the phase: one per slot, or with
+            no cadence as many as the bare exposure times allow
+        '''
+        if self.cadence_s > 0:
+            return math.ceil((self.end - self.start) / self.cadence_s)
+        return math.ceil((self.end - self.start) / (1e-6 * sum(self.exposures) * self.burst_size))
+
+    def slot(self, index):
+        return self.start + index * self.cadence_s
+
+
+class Timeline:
+    '''
+    Contact times and phases, in start order
+    '''
+
+    def __init__(self, contacts, phases):
+        self.contacts = contacts
+        self.phases = sorted(phases, key=lambda phase: phase.start)
+        for before, after in zip(self.phases, self.phases[1:]):
+            if after.start < before.end:
+                raise ValueError(f'Phases {before.name!r} and {after.name!r} overlap')
+
+    @classmethod
+    def load(cls, path, rehearse_s=None):
+        '''
+        Timeline from a JSON file; rehearse_s shifts every time so that C2 (or
+            the first phase without one) is that many seconds from now
+        '''
+        with open(path) as f:
+            spec = json.load(f)
+        contacts = {key: parse_utc(spec[key]) for key in ('c1', 'c2', 'c3', 'c4') if key in spec}
+        phases = [Phase(p.get('name', f'phase{n}'), resolve_time(p['start'], contacts),
+                        resolve_time(p['end'], contacts), p['exposures'], p['burst_size'],
+                        p.get('cadence_s', 0.))
+                  for n, p in enumerate(spec['phases'])]
+        timeline = cls(contacts, phases)
+        if rehearse_s is not None:
+            timeline.shift(time.time() + rehearse_s - contacts.get('c2', timeline.phases[0].start))
+        return timeline
+
+    def shift(self, seconds):
+        self.contacts = {key: t + seconds for key, t in self.contacts.items()}
+        for phase in self.phases:
+            phase.start += seconds
+            phase.end += seconds
+
+    def exposures(self):
+        '''
+        Every exposure of every phase, longest first
+        '''
+        return sorted({exposure for phase in self.phases for exposure in phase.exposures},
+                      reverse=True)
+
+    def clamp_exposures(self, low, high):
+        '''
+        Limit every exposure to the camera's ExposureTime range; returns the
+            (phase, requested, used) of those changed
+        '''
+        changed = []
+        for phase in self.phases:
+            for n, exposure in enumerate(phase.exposures):
+                used = min(max(exposure, low), high)
+                if used != exposure:
+                    phase.exposures[n] = used
+                    changed.append((phase.name, exposure, used))
+        return changed
+
+    def max_frames(self):
+        return sum(phase.max_sequences() * phase.sequence_frames for phase in self.phases)
+
+    def describe(self):
+        lines = [f'{key.upper()} {utc_text(t)}' for key, t in sorted(self.contacts.items())]
+        for phase in self.phases:
+            cadence = f'every {phase.cadence_s:g} s' if phase.cadence_s > 0 else 'back to back'
+            ladder = ', '.join(f'{exposure / 1000.:g}' for exposure in phase.exposures)
+            lines.append(f'{phase.name}: {utc_text(phase.start)} - {utc_text(phase.end)} '
+                         f'({phase.end - phase.start:.1f} s), {phase.burst_size} x [{ladder}] ms '
+                         f'{cadence}, up to {phase.max_sequences()} sequences')
+        return '\n'.join(lines)
+
+
+def load_timeline(path, rehearse_s=None):
+    return Timeline.load(path, rehearse_s)
+
+
+def warm_stream(device, nodes, pipeline, exposure_us=None, frame_rate=None, arming=None,
+                streaming=False, frames=WARMUP_FRAMES):
+    '''
+    Set the exposure a phase starts with (None leaves it, e.g. to the camera
+        sequencer) and, with software triggering, take frames frames through
+        get_buffer and the pipeline's discard path (logged as 'warm-up' by a
+        frame clock). A streaming camera keeps running between bursts anyway,
+        so only its exposure and frame rate are pinned. Returns the frame rate.
+    '''
+    if streaming:
+        return frame_stream.pin_frame_rate(nodes, exposure_us) if exposure_us is not None else frame_rate
+    if exposure_us is not None:
+        nodes['ExposureTime'].value = exposure_us
+        arming.expect(exposure_us, frame_rate)
+    for _ in range(frames):
+        arming.trigger(nodes)
+        image = device.get_buffer()
+        pipeline.discard_buffer(image, 'warm-up')
+        device.requeue_buffer(image)
+    return frame_rate
+
+
+def sleep_until(t, spin_s=SPIN_S):
+    '''
+    Wait until the POSIX time t: sleep until spin_s before it, then spin.
+        The deadline is moved onto the performance counter, which is finer
+        and steadier than the wall clock, and re-anchored after long sleeps.
+    '''
+    while True:
+        remaining = t - time.time()
+        if remaining <= 1.:
+            break
+        time.sleep(min(remaining - 0.5, COUNTDOWN_S))
+    deadline = time.perf_counter() + (t - time.time())
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return
+        if remaining > spin_s:
+            time.sleep(remaining - spin_s)
+
+
+class Scheduler:
+    '''
+    Hands out the sequences of a timeline at their start times. warm_up(phase)
+        is called WARMUP_LEAD_S before each phase; frame_clock (a FrameClock)
+        gives the first frame error of each sequence. Progress goes to log
+        (default: this module's logger).
+    '''
+
+    def __init__(self, timeline, warm_up=None, frame_clock=None, warmup_lead_s=WARMUP_LEAD_S,
+                 log=None):
+        self.timeline = timeline
+        self.warm_up = warm_up
+        self.frame_clock = frame_clock
+        self.warmup_lead_s = warmup_lead_s
+        self.log = log or logger.info
+        self.records = []
+        self._frames = {}
+
+    def sequence_frames(self, meta):
+        '''
+        Frames of the sequence a frame belongs to (for per-sequence sinks)
+        '''
+        return self._frames[meta['seq']]
+
+    def _wait(self, t, label):
+        remaining = t - time.time()
+        if remaining > 1.:
+            self.log(f'Waiting {remaining:.1f} s for {label} at {utc_text(t)}')
+        while t - time.time() > COUNTDOWN_S + 1.:
+            sleep_until(time.time() + COUNTDOWN_S)
+            self.log(f'{label} in {t - time.time():.0f} s')
+        sleep_until(t)
+
+    def sequences(self):
+        '''
+        Yields (seq, phase) at each sequence's start time; the sequence is
+            over when the next one is asked for
+        '''
+        seq = 0
+        for phase in self.timeline.phases:
+            if time.time() >= phase.end:
+                self.log(f'Phase {phase.name} already over, skipped')
+                continue
+            warm_at = phase.start - self.warmup_lead_s
+            if self.warm_up is not None:
+                if time.time() < warm_at:
+                    self._wait(warm_at, f'{phase.name} warm-up')
+                self.warm_up(phase)
+            index = 0
+            while True:
+                now = time.time()
+                skipped = 0
+                if phase.cadence_s > 0 and now > phase.slot(index):
+                    # start late at once; slots passed entirely are skipped
+                    skipped = int((now - phase.slot(index)) // phase.cadence_s)
+                    index += skipped
+                slot = phase.slot(index) if phase.cadence_s > 0 or index == 0 else now
+                if slot >= phase.end:
+                    break
+                self._wait(slot, f'{phase.name} seq{seq}')
+                started = time.time()
+                record = {'seq': seq, 'phase': phase.name, 'slot': slot,
+                          'host_error_ms': 1e3 * (started - slot), 'skipped_slots': skipped}
+                self.records.append(record)
+                self._frames[seq] = phase.sequence_frames
+                if skipped:
+                    self.log(f'{phase.name}: {skipped} slots missed before seq{seq}')
+                yield seq, phase
+                record['duration_s'] = time.time() - started
+                record['first_frame_error_ms'] = self._first_frame_error(seq, slot)
+                self.log(f"{phase.name} seq{seq}: started {record['host_error_ms']:+.2f} ms"
+                            + (f", first frame {record['first_frame_error_ms']:+.2f} ms"
+                               if record['first_frame_error_ms'] is not None else '')
+                            + ' from the slot')
+                seq += 1
+                index += 1
+
+    def _first_frame_error(self, seq, slot):
+        '''
+        Exposure start of the sequence's first frame (camera clock) minus slot
+        '''
+        clock = self.frame_clock
+        if clock is None or clock.mapping is None:
+            return None
+        starts = [record[1] for record in clock.log
+                  if record[4] == seq and record[-1] == 'used' and record[1] is not None]
+        if not starts:
+            return None
+        return (clock.mapping.utc_ns(min(starts)) - slot * 1e9) / 1e6
+
+    def summary(self):
+        phases = {}
+        for record in self.records:
+            phases.setdefault(record['phase'], []).append(record)
+        out = {}
+        for name, records in phases.items():
+            host = np.array([r['host_error_ms'] for r in records])
+            first = np.array([r['first_frame_error_ms'] for r in records
+                              if r.get('first_frame_error_ms') is not None])
+            s = {'sequences': len(records),
+                 'skipped_slots': sum(r['skipped_slots'] for r in records),
+                 'host_error_ms_mean': float(host.mean()),
+                 'host_error_ms_max': float(np.abs(host).max())}
+            if first.size:
+                s.update({'first_frame_error_ms_first': float(first[0]),
+                          'first_frame_error_ms_mean': float(first.mean()),
+                          'first_frame_error_ms_max': float(np.abs(first).max())})
+            out[name] = s
+        return out
+
+    def report(self):
+        lines = []
+        for name, s in self.summary().items():
+            line = (f"{name}: {s['sequences']} sequences, {s['skipped_slots']} slots skipped, "
+                    f"start error mean {s['host_error_ms_mean']:+.2f} ms, "
+                    f"max {s['host_error_ms_max']:.2f} ms")
+            if 'first_frame_error_ms_mean' in s:
+                line += (f"; first frame {s['first_frame_error_ms_first']:+.2f} ms at the phase "
+                         f"start, mean {s['first_frame_error_ms_mean']:+.2f} ms, "
+                         f"max {s['first_frame_error_ms_max']:.2f} ms")
+            lines.append(line)
+        return 'Schedule: ' + ('\n'.join(lines) if lines else 'no sequences run')
+
+    def write_log(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(LOG_FIELDS)
+            for r in self.records:
+                writer.writerow([r['seq'], r['phase'], utc_text(r['slot']),
+                                 f"{r['host_error_ms']:.3f}",
+                                 '' if r.get('first_frame_error_ms') is None
+                                 else f"{r['first_frame_error_ms']:.3f}",
+                                 r['skipped_slots'], f"{r.get('duration_s', 0.):.3f}"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('timeline', help='timeline JSON file')
+    parser.add_argument('--rehearse', type=float, default=None, metavar='SECONDS',
+                        help='shift the timeline so that C2 is this many seconds from now')
+    args = parser.parse_args()
+    timeline = load_timeline(args.timeline, args.rehearse)
+    print(timeline.describe())
+    print(f'at most {timeline.max_frames()} frames')
+
+
+if __name__ == '__main__':
+    main()
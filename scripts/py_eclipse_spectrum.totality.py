@@ -1,11 +1,24 @@
 
 from arena_api.system import system
-from arena_api.buffer import BufferFactory
-from astropy.io import fits
 import numpy as np
-import ctypes
+import os
 import time
 from datetime import datetime
+import frame_pipeline
+import trigger_arming
+import frame_stream
+import camera_sequencer
+import hdr_merge
+import burst_stack
+import multi_camera
+import stage_timing
+import frame_clock
+import node_cache
+import observing_schedule
+import adaptive_exposure
+import spectrum_extract
+import backpressure
+import session_manifest
 np.set_printoptions(precision=3)
 
 '''
@@ -32,6 +45,138 @@ exp2 = 80000.0	 #exposures are in microseconds
 exp3 = 25000.0
 BASE_DIR='D:\Annular2023\spectra'
 SUB_DIR='totality'
+FILENAME_BASE='eclipse.spectrum'
+
+# FITS writing runs on writer threads fed through a bounded queue, so a slow
+# disk does not stall the trigger loop. WRITER_THREADS = 0 writes each frame on
+# the trigger thread instead (no copy of the camera buffer).
+WRITER_THREADS = 2
+WRITER_QUEUE_DEPTH = 8		# frames held between the trigger loop and the writers
+WRITER_PROCESSES = 0		# >0 builds headers and writes files in worker processes
+# What happens when the writers fall behind and every frame slot is taken:
+# 'block' waits for a slot (no frame lost, the cadence slips), 'drop' drops the
+# frame, 'decimate' keeps only every 2nd, 4th, ... frame of the next bursts (up
+# to BACKPRESSURE_MAX_DECIMATE) until the writers catch up. Dropped, decimated
+# and delayed frames are logged to <FILENAME_BASE>_<date>_backpressure.csv
+# (see backpressure.py).
+BACKPRESSURE = 'block'
+BACKPRESSURE_MAX_DECIMATE = 8
+# Time a DISK_PREFLIGHT_MB test write in the output directory before the run
+# and print how many sequences fit in the free space (64 is enough to see the
+# sustained rate); None skips it
+DISK_PREFLIGHT_MB = None
+# Record every frame (file, sequence, exposure, times, statistics) and the
+# camera settings of the run in an SQLite manifest written while acquiring,
+# <FILENAME_BASE>_<date>_manifest.sqlite, queried with session_manifest.py
+MANIFEST = False
+# 'frames': one FITS file per frame, 'cube': one FITS cube per exposure burst
+# (NAXIS3 = num_images) with per-frame DATE-OBS/EXPTIME in a table extension,
+# 'spool': raw frames into a preallocated memory-mapped spool (cheapest, convert
+# with spool_to_fits.py afterwards), 'rice': one lossless RICE tile-compressed
+# file per frame (.fits.fz, compressed in the WRITER_PROCESSES workers, or one
+# per core when 0, see fits_compressed.py), 'none': no per-frame output
+OUTPUT_MODE = 'frames'
+# Also stack every exposure burst while acquiring: 'mean', 'clipped' (streaming
+# sigma-clipped mean) or 'median' (streaming median estimate), written with a
+# noise map as <FILENAME_BASE>_<date>_seq<n>_exp<j>_stack.fits (see
+# burst_stack.py); None turns it off. With OUTPUT_MODE = 'none' only the stacks
+# are written.
+STACK_METHOD = None
+STACK_CLIP_SIGMA = 3.
+# Extract the spectra along the slit from every frame while acquiring: the
+# SPECTRUM_ROI = (y0, y1, x0, x1) rows and columns of the slit image (None for
+# the whole frame) are summed into SPECTRUM_BINS spatial bins, following the
+# trace (row offset vs column) and line curvature (column shift vs slit row)
+# polynomials, coefficients constant first. One spectra table per burst,
+# <FILENAME_BASE>_<date>_seq<n>_exp<j>_spectra.fits (see spectrum_extract.py).
+SPECTRUM_EXTRACT = False
+SPECTRUM_ROI = None
+SPECTRUM_BINS = 1
+SPECTRUM_TRACE = ()
+SPECTRUM_CURVATURE = ()
+# Write only every Nth full frame of a burst (frame 0, N, 2N, ...) in the
+# OUTPUT_MODE output; stacks, HDR merge and spectra still use every frame.
+# Not with OUTPUT_MODE = 'cube'.
+FULL_FRAME_EVERY = 1
+# Publish every QUICKLOOK_EVERY-th frame, decimated by QUICKLOOK_DECIMATE, to a
+# shared-memory ring for a live viewer (python quicklook.py in another
+# terminal, --camera <serial> to pick a camera); None turns it off. The writers
+# never wait for the viewer. Needs Python 3.8 (multiprocessing.shared_memory).
+QUICKLOOK_EVERY = None
+QUICKLOOK_DECIMATE = 4
+# Frame statistics (mean, min, max, std, saturated pixels, histogram) are
+# computed on the writer threads from every STATS_STRIDE-th pixel in x and y;
+# 0 turns them off
+STATS_STRIDE = 1
+# How to wait for TriggerArmed: 'spin' (tight polling, pins a core), 'backoff'
+# (spin, yield, then short growing sleeps) or 'predictive' (sleep until the
+# expected arm time from exposure and frame rate, then back off; less CPU next
+# to the writer threads, see trigger_arming.py)
+ARMING_STRATEGY = 'spin'
+# 'triggered': one software trigger per frame, 'streaming': trigger off, the
+# camera free-runs at the fastest frame rate the exposure allows and a drain
+# thread takes the frames off the stream (see frame_stream.py)
+ACQUISITION_MODE = 'triggered'
+STREAM_BUFFERS = 32			# buffers announced to the stream in streaming mode
+STREAM_BUFFER_HANDLING = 'OldestFirst'	# or 'OldestFirstOverwrite', 'NewestOnly'
+STREAM_SETTLE_FRAMES = 3		# frames discarded after an exposure change
+# 'Mono12': 12-bit pixels in 16-bit containers, 'Mono12p' or 'Mono12Packed': two
+# pixels in three bytes, a third more frames through the link, unpacked on the
+# writer threads (see mono12_packed.py)
+PIXEL_FORMAT = 'Mono12'
+# 'node': ExposureTime is written before each exposure burst (one discarded
+# frame per step), 'sequencer': the exposure ladder is programmed into the
+# camera sequencer once and cycled in hardware frame by frame
+# (exp1, exp2, exp3, exp1, ...), see camera_sequencer.py
+HDR_MODE = 'node'
+# Also merge the bursts of every sequence into a radiance map (DN/s) while
+# acquiring, written as <FILENAME_BASE>_<date>_seq<n>_hdr.fits (see hdr_merge.py)
+HDR_MERGE = False
+HDR_DARK_LEVEL = 0.			# DN subtracted from every frame before merging
+# Drive every connected camera at once, one process per camera, each writing
+# into BASE_DIR/SUB_DIR/<serial number> (see multi_camera.py); False uses the
+# first camera found
+MULTI_CAMERA = False
+# Time every stage of the frame loop (arm wait, trigger, get_buffer, copy,
+# statistics, header, writeto, requeue) into latency histograms, printed at the
+# end of the run and dumped as <FILENAME_BASE>_<date>_timing.json/.csv (see
+# stage_timing.py)
+STAGE_TIMING = False
+# Profile one burst, e.g. (0, 1) for the frames named seq0_exp1: 'cprofile'
+# profiles the trigger loop, 'sample' samples the stacks of every thread; written
+# as <FILENAME_BASE>_<date>_profile.txt. None turns it off
+PROFILE_BURST = None
+PROFILE_MODE = 'cprofile'
+# Stamp every frame from the camera's chunk data (exposure-start Timestamp,
+# FrameID, ExposureTime) with the camera clock mapped once to UTC: DATE-OBS is
+# then the exposure start, and every buffer is logged to
+# <FILENAME_BASE>_<date>_frames.csv for frame_timing.py (see frame_clock.py).
+# DATE-OBS and the dates in the frame file names are then UTC instead of the
+# host's local time
+CHUNK_TIMESTAMPS = False
+# Resolve node handles once and cache node values, ranges and writability, so
+# rewriting an unchanged ExposureTime or reading .min/.max again costs no camera
+# round trip (see node_cache.py); False sends every node access to the camera
+NODE_CACHE = True
+# Contact-time schedule: a timeline JSON with the C2/C3 times and the observing
+# phases around them, each with its own exposures, burst size and cadence (see
+# observing_schedule.py). The camera is set up and the stream started right
+# away; every sequence then starts at its slot, after a warm-up before each
+# phase. num_seq, num_images and exp1..exp3 are not used. None runs num_seq
+# sequences at once. SCHEDULE_REHEARSAL_S = 120 shifts the timeline so C2 is
+# two minutes after the start, for a rehearsal.
+SCHEDULE = None
+SCHEDULE_REHEARSAL_S = None
+# Adaptive exposure: scale the exposure ladder between sequences so the peak
+# signal of the shortest exposure (99.9th percentile of every 16th pixel) stays
+# within ADAPTIVE_BAND of the full scale, halving it when more than
+# ADAPTIVE_MAX_SATURATED of the pixels saturate; the frame rate follows the
+# longest exposure. Adjustments are printed, logged to
+# <FILENAME_BASE>_<date>_exposure.csv and recorded in the AE* header cards (see
+# adaptive_exposure.py). Needs HDR_MODE = 'node'.
+ADAPTIVE_EXPOSURE = False
+ADAPTIVE_BAND = (0.5, 0.85)
+ADAPTIVE_MAX_SATURATED = 1e-3
 
 
 def create_devices_with_tries():
@@ -68,39 +213,40 @@ def toc(t_start):
 
 def store_initial(nodemap):
 	'''
-	Store initial node values, return their values at the end
+	Resolve the nodes once (cached, see node_cache.py) and store the initial
+		values of the settings the script changes, to return them at the end
 	'''
-	nodes = nodemap.get_node(['TriggerMode', 'TriggerSource',
+	nodes = node_cache.NodeCache(nodemap, ['TriggerMode', 'TriggerSource',
 							'TriggerSelector', 'TriggerSoftware',
 							'TriggerArmed', 'ExposureAuto', 'ExposureTime','PixelFormat','Width','Height',
-							'AcquisitionFrameRateEnable','AcquisitionFrameRate'])
+							'AcquisitionFrameRateEnable','AcquisitionFrameRate'], enabled=NODE_CACHE)
 
-	trigger_mode_initial = nodes['TriggerMode'].value
-	trigger_source_initial = nodes['TriggerSource'].value
-	trigger_selector_initial = nodes['TriggerSelector'].value
-	exposure_auto_initial = nodes['ExposureAuto'].value
-	exposure_time_initial = nodes['ExposureTime'].value
+	# every setting the script changes, restored in dependency order by
+	# nodes.apply(initial_vals) at the end
+	return nodes, nodes.snapshot()
 
-	return nodes, [exposure_time_initial, exposure_auto_initial,
-				trigger_selector_initial, trigger_source_initial,
-				trigger_mode_initial]
 
-
-def trigger_software_once_armed(nodes):
+def trigger_software_once_armed(nodes, arming=None):
 	'''
-	Continually check until trigger is armed. Once the trigger is armed,
-		it is ready to be executed.
+	Wait until the trigger is armed, then execute it. How the wait is done
+		is up to ``arming`` (see trigger_arming.py); without one TriggerArmed
+		is polled in a tight loop.
 	'''
-	trigger_armed = False
+	if arming is None:
+		arming = trigger_arming.SpinArming()
+	# wait for TriggerArmed, then execute the software trigger node
+	arming.trigger(nodes)
 
-	while (trigger_armed is False):
-		trigger_armed = bool(nodes['TriggerArmed'].value)
 
-	# retrieve and execute software trigger node
-	nodes['TriggerSoftware'].execute()
+def print_burst_summary(seq, exp_index, burst):
+	'''
+	Called by the frame pipeline once every frame of a burst is written
+	'''
+	print(f'{TAB1}{TAB2}{TAB1}Image Burst seq{seq} exp{exp_index+1} [mean,std,min,max,saturated]: '
+		f'{burst.mean:.2f}, {burst.std:.2f}, {burst.min}, {burst.max}, {burst.saturated}')
 
 
-def acquire_hdr_images(device, nodes, initial_vals, exp1, exp2, exp3):
+def acquire_hdr_images(device, nodes, initial_vals, exp1, exp2, exp3, on_start=None):
 	'''
 	demonstrates exposure configuration and acquisition for HDR imaging
 	(1) Sets trigger mode
@@ -114,6 +260,9 @@ def acquire_hdr_images(device, nodes, initial_vals, exp1, exp2, exp3):
 	(9) Copies images into object for later processing
 	(10) Does NOT process copied images
 	(11) Cleans up copied images
+	on_start is called once the camera, the pipeline and the output are set
+	up, right before the stream starts (multi_camera.py waits there for the
+	common start). Returns the number of frames written.
 	'''
 	'''
 	Prepare trigger mode
@@ -122,9 +271,21 @@ def acquire_hdr_images(device, nodes, initial_vals, exp1, exp2, exp3):
 		exposure time of each image in a way that a continuous stream might have
 		trouble with.
 	'''
+	timeline = None
+	if SCHEDULE:
+		'''
+		Load the contact-time schedule
+			The frame rate is set for the longest exposure of the timeline,
+			every phase brings its own exposure ladder
+		'''
+		timeline = observing_schedule.load_timeline(SCHEDULE, SCHEDULE_REHEARSAL_S)
+		print(f"{TAB1}Schedule {SCHEDULE}:\n{timeline.describe()}")
+		exp1 = timeline.exposures()[0]
+
 	print(f"{TAB1}Prepare trigger mode")
 	nodes['TriggerSelector'].value = "FrameStart"
-	nodes['TriggerMode'].value = "On"
+	# free-running in streaming mode, software triggered otherwise
+	nodes['TriggerMode'].value = "Off" if ACQUISITION_MODE == 'streaming' else "On"
 	nodes['TriggerSource'].value = "Software"
 	nodes['AcquisitionFrameRateEnable'].value=True
 	min_frame_rate = nodes['AcquisitionFrameRate'].min
@@ -149,7 +310,7 @@ def acquire_hdr_images(device, nodes, initial_vals, exp1, exp2, exp3):
 	'''
 	print(f"{TAB1}Disable auto exposure")
 	nodes['ExposureAuto'].value = 'Off'
-	pixel_format_name = 'Mono12'
+	pixel_format_name = PIXEL_FORMAT
 	print(f'Setting Pixel Format to {pixel_format_name}')
 	nodes['PixelFormat'].value=pixel_format_name
 	'''
@@ -184,26 +345,196 @@ def acquire_hdr_images(device, nodes, initial_vals, exp1, exp2, exp3):
 
 		exposures=[exp1,exp2,exp3]
 		print(f"New exposure times are : {exposures}")
-		'''
-		Setup stream values
-		'''
-		tl_stream_nodemap = device.tl_stream_nodemap
-		tl_stream_nodemap['StreamAutoNegotiatePacketSize'].value = True
-		tl_stream_nodemap['StreamPacketResendEnable'].value = True
 
-		# Store HDR images for processing
-		#hdr_images = []
-		#datacub=[] #np.zeros((num_images*len(exposures),2048,2448))
+	if timeline is not None:
+		for phase_name, requested, used in timeline.clamp_exposures(
+				nodes['ExposureTime'].min, nodes['ExposureTime'].max):
+			print(f"{TAB1}{phase_name}: exposure {requested} limited to {used}")
+		exposures = timeline.phases[0].exposures
+		if HDR_MODE == 'sequencer' and any(phase.exposures != exposures for phase in timeline.phases):
+			raise Exception("HDR_MODE 'sequencer' needs the same exposures in every phase")
 
-		print(f"{TAB1}Acquire {num_images} HDR images")
+	ladder = None
+	if HDR_MODE == 'sequencer':
+		'''
+		Program the exposure ladder into the camera sequencer
+			The camera then steps through the exposures itself, one per frame,
+			so there are no dummy frames and no ExposureTime writes during the
+			run. The frame rate limit is lifted so every frame only takes as
+			long as its own exposure.
+		'''
+		print(f"{TAB1}Program sequencer with exposures {exposures}")
+		nodes['AcquisitionFrameRateEnable'].value = False
+		frame_rate = None
+		ladder = camera_sequencer.program_exposure_ladder(nodes, exposures)
+		camera_sequencer.start_sequencer(nodes)
+	'''
+	Setup stream values
+	'''
+	tl_stream_nodemap = device.tl_stream_nodemap
+	tl_stream_nodemap['StreamAutoNegotiatePacketSize'].value = True
+	tl_stream_nodemap['StreamPacketResendEnable'].value = True
+
+	# Store HDR images for processing
+	#hdr_images = []
+	#datacub=[] #np.zeros((num_images*len(exposures),2048,2448))
+
+	print(f"{TAB1}Acquire {num_images} HDR images")
+	timer = stage_timing.make_stage_timer(STAGE_TIMING)
+	run_name = os.path.join(BASE_DIR, SUB_DIR,
+		f"{FILENAME_BASE}_{datetime.now().strftime(frame_pipeline.FILENAME_DATE_FORMAT)}")
+	profiler = stage_timing.BurstProfiler(PROFILE_BURST, run_name + '_profile', PROFILE_MODE)
+	arming = trigger_arming.make_arming(ARMING_STRATEGY, timer)
+	# chunk data has to be configured before the stream starts
+	clock = frame_clock.FrameClock(nodes) if CHUNK_TIMESTAMPS else None
+	schedule = None
+	last_exposure = None
+	if timeline is not None:
+		def warm_up(phase):
+			# first exposure of the phase set and a few frames through the
+			# stream and the pipeline before the phase starts
+			nonlocal last_exposure
+			print(f"{TAB1}Warm-up for {phase.name}")
+			exposure = None
+			if ladder is None:
+				exposure = phase.exposures[0] if control is None else control.scaled(phase.exposures)[0]
+				exposure = min(exposure, nodes['ExposureTime'].max)
+			observing_schedule.warm_stream(device, nodes, pipeline, exposure, frame_rate, arming,
+				streaming=drain is not None)
+			last_exposure = exposure
+
+		schedule = observing_schedule.Scheduler(timeline, warm_up, clock, log=print)
+	extra_sinks = []
+	control = None
+	if ADAPTIVE_EXPOSURE:
+		if ladder is not None:
+			raise Exception("ADAPTIVE_EXPOSURE needs HDR_MODE 'node': the sequencer ladder "
+				"cannot change while the stream runs")
+		control = adaptive_exposure.ExposureControl(*ADAPTIVE_BAND, ADAPTIVE_MAX_SATURATED,
+			min_us=nodes['ExposureTime'].min, max_us=1e6 / nodes['AcquisitionFrameRate'].min,
+			dark=HDR_DARK_LEVEL, log=print)
+		extra_sinks.append(control)
+	if HDR_MERGE:
+		extra_sinks.append(hdr_merge.HdrMergeSink(os.path.join(BASE_DIR, SUB_DIR), FILENAME_BASE,
+			schedule.sequence_frames if schedule is not None else len(exposures) * num_images,
+			dark=HDR_DARK_LEVEL))
+	if STACK_METHOD:
+		extra_sinks.append(burst_stack.BurstStackSink(os.path.join(BASE_DIR, SUB_DIR), FILENAME_BASE,
+			STACK_METHOD, clip_sigma=STACK_CLIP_SIGMA))
+	spectra = None
+	if SPECTRUM_EXTRACT:
+		spectra = spectrum_extract.SpectrumSink(os.path.join(BASE_DIR, SUB_DIR), FILENAME_BASE,
+			spectrum_extract.SlitGeometry(SPECTRUM_ROI, SPECTRUM_BINS, SPECTRUM_TRACE,
+				SPECTRUM_CURVATURE))
+		extra_sinks.append(spectra)
+	preview = None
+	if QUICKLOOK_EVERY:
+		import quicklook
+		serial = device.nodemap['DeviceSerialNumber'].value
+		preview = quicklook.QuickLookPublisher(QUICKLOOK_EVERY, QUICKLOOK_DECIMATE,
+			name=quicklook.ring_name(serial), queue_depth=lambda: pipeline.queue_depth, log=print)
+		extra_sinks.append(preview)
+		print(f"{TAB1}Quick-look viewer: python quicklook.py --camera {serial}")
+	manifest = None
+	if MANIFEST:
+		settings = session_manifest.node_settings(nodes)
+		settings.update(OUTPUT_MODE=OUTPUT_MODE, ACQUISITION_MODE=ACQUISITION_MODE, HDR_MODE=HDR_MODE,
+			BACKPRESSURE=BACKPRESSURE, FULL_FRAME_EVERY=FULL_FRAME_EVERY, SCHEDULE=SCHEDULE,
+			exposures_us=exposures)
+		manifest = session_manifest.ManifestSink(run_name + '_manifest.sqlite',
+			os.path.join(BASE_DIR, SUB_DIR), FILENAME_BASE, OUTPUT_MODE, FULL_FRAME_EVERY, settings)
+		extra_sinks.append(manifest)
+	run_frames = (timeline.max_frames() if timeline is not None
+		else num_seq * len(exposures) * num_images)
+	if DISK_PREFLIGHT_MB:
+		ladders = ([(phase.exposures, phase.burst_size, phase.cadence_s) for phase in timeline.phases]
+			if timeline is not None else [(exposures, num_images, 0.)])
+		preflight = backpressure.preflight_run(os.path.join(BASE_DIR, SUB_DIR), nodes, OUTPUT_MODE,
+			ladders, run_frames, FULL_FRAME_EVERY, DISK_PREFLIGHT_MB)
+		print(f"{TAB1}{preflight.report()}")
+	pressure = backpressure.Backpressure(BACKPRESSURE, max_decimate=BACKPRESSURE_MAX_DECIMATE,
+		writers=WRITER_THREADS, log=print)
+	pipeline = frame_pipeline.start_frame_pipeline(
+		os.path.join(BASE_DIR, SUB_DIR), FILENAME_BASE, nodes, WRITER_THREADS,
+		WRITER_QUEUE_DEPTH, WRITER_PROCESSES, on_burst_complete=print_burst_summary,
+		output=OUTPUT_MODE, run_frames=run_frames,
+		stats_stride=STATS_STRIDE, extra_sinks=extra_sinks, timer=timer,
+		frame_clock=clock, keep_every=FULL_FRAME_EVERY, backpressure=pressure)
+	if on_start is not None:
+		on_start()
+	drain = None
+	if ACQUISITION_MODE == 'streaming':
+		frame_stream.configure_stream(device, STREAM_BUFFER_HANDLING)
+		device.start_stream(STREAM_BUFFERS)
+		drain = frame_stream.StreamDrain(device, pipeline, timer=timer).start()
+	else:
 		device.start_stream()
 
-		for seq in range(0, num_seq):
-			print(f"Starting Sequence {seq}")
+	try:
+		if schedule is not None:
+			sequences = schedule.sequences()
+		else:
+			sequences = ((seq, None) for seq in range(0, num_seq))
+		coupled_exposure = exposure_max = None
+		for seq, phase in sequences:
+			# a scheduled sequence takes the ladder and burst size of its phase
+			seq_exposures = phase.exposures if phase is not None else exposures
+			seq_images = phase.burst_size if phase is not None else num_images
+			phase_name = phase.name if phase is not None else None
+			control_state = None
+			if control is not None:
+				'''
+				Adaptive exposure: the ladder scaled after the last measured
+				burst of the shortest exposure; with software triggering the
+				frame rate follows its longest exposure
+				'''
+				seq_exposures = control.ladder(seq, seq_exposures)
+				control_state = control.header_state()
+				if drain is None:
+					if max(seq_exposures) != coupled_exposure:
+						coupled_exposure = max(seq_exposures)
+						frame_rate, exposure_max = adaptive_exposure.couple_frame_rate(nodes,
+							coupled_exposure)
+					seq_exposures = [min(exposure, exposure_max) for exposure in seq_exposures]
+			print(f"Starting Sequence {seq}" + (f" ({phase_name})" if phase_name else ''))
 			seq_start=tic()
+			tx_start, polls_start = nodes.transactions, nodes.polls
+
+			if ladder is not None:
+				'''
+				Sequencer HDR: exposures cycle frame by frame in the camera,
+				each frame is tagged with its exposure from its chunk data
+				'''
+				ladder.start_burst()
+				profiler.begin(seq)
+				if drain is not None:
+					drain.capture({'seq': seq, 'burst_size': seq_images, 'phase': phase_name},
+						seq_images * len(seq_exposures), tag=ladder.tag)
+				else:
+					while not ladder.complete(seq_images):
+						arming.expect(ladder.next_exposure(), frame_rate, latched=True)
+						trigger_software_once_armed(nodes, arming)
+						t = timer.now()
+						image=device.get_buffer()
+						timer.mark('get_buffer', t)
+						meta = {'seq': seq, 'burst_size': seq_images, 'phase': phase_name,
+							'timestamp': datetime.now()}
+						if ladder.tag(image, meta):
+							pipeline.submit_buffer(image, meta)
+						else:
+							pipeline.discard_buffer(image)
+						t = timer.now()
+						device.requeue_buffer(image)
+						timer.mark('requeue', t)
+				profiler.end()
+				seq_elapsed=toc(seq_start)
+				print(f"{TAB1}{TAB2}Sequence elapsed time: {seq_elapsed:.3f} seconds, "
+					f"{nodes.transactions - tx_start} node transactions "
+					f"({nodes.polls - polls_start} status polls)")
+				continue
 
 			#for i in range(0, num_images):
-			for j, exposure in enumerate(exposures):
+			for j, exposure in enumerate(seq_exposures):
 				'''
 				Get high, medium, and low exposure images
 				This example grabs three examples of varying exposures for later
@@ -211,78 +542,116 @@ def acquire_hdr_images(device, nodes, initial_vals, exp1, exp2, exp3):
 				be triggered, and then that image must be retrieved. After the
 				exposure time is changed, the setting does not take place on the
 				device until after the next frame. Because of this, two images are
-				retrieved, the first of which is discarded.
+				retrieved, the first of which is discarded (not needed when the
+				exposure is the one of the previous frames).
 				'''
 				t_start=tic()
+				tx_start, polls_start = nodes.transactions, nodes.polls
+				profiler.begin(seq, j + 1)
 
-	        	#set exposure time
+				#set exposure time
 				print(f"{TAB1}{TAB2}Image Exposure{j+1}: {exposure/1000:.1f} ms")
 				#print(j,exposure)
-				nodes['ExposureTime'].value=exposure
-				trigger_software_once_armed(nodes)
-				image_pre=device.get_buffer()
-				device.requeue_buffer(image_pre)
-
-		    	#	print(f'{TAB2}Getting HDR image set {i}')
-				sequence_mean = 0.0
-				sequence_min = 0.0
-				sequence_max = 0.0
-
-				for i in range(0, num_images):
-					trigger_software_once_armed(nodes)
-					image=device.get_buffer()
-
-					pdata_as16 = ctypes.cast(image.pdata,ctypes.POINTER(ctypes.c_ushort))
-					nparray_reshaped = np.ctypeslib.as_array(pdata_as16,(image.height, image.width))
-
-					img_fits = fits.PrimaryHDU(nparray_reshaped)
-					sequence_mean = sequence_mean + np.mean(nparray_reshaped)
-					sequence_min = sequence_min + np.min(nparray_reshaped)
-					sequence_max = sequence_max + np.max(nparray_reshaped)
-					
-					#print(f'Frame mean,min,max: {np.mean(nparray_reshaped):.2f}, {np.min(nparray_reshaped)}, {np.max(nparray_reshaped)}')
-					img_fits.header['DATE-OBS'] = datetime.now().strftime("%Y-%m-%dZ%H:%M:%S.%f")
-					img_fits.header['EXPTIME'] = f"{exposure/1000./1000.}"
-					filename_date=datetime.now().strftime("%Y%m%d_%H%M%S")
-					img_fits.writeto(f'{BASE_DIR}\{SUB_DIR}\eclipse.spectrum_{filename_date}_seq{seq}_exp{j+1}_i{i:02d}.fits', overwrite=True)     #change FITS file naming here
-					'''
-					Copy images for processing later
-					Use the image factory to copy the images for later processing. Images
-					are copied in order to requeue buffers to allow for more images to be
-					retrieved from the device.
-					'''
-					# Requeue buffers
-					device.requeue_buffer(image)
-				print(f'{TAB1}{TAB2}{TAB1}Image Burst [mean,min,max]: {sequence_mean:.2f}, {sequence_min}, {sequence_max}')
+				if drain is not None:
+					# the camera runs at the fastest rate this exposure allows;
+					# the drain thread hands the burst to the pipeline
+					frame_rate = frame_stream.pin_frame_rate(nodes, exposure)
+					drain.capture({'seq': seq, 'exp_index': j, 'burst_size': seq_images,
+						'exposure_us': exposure, 'frame_rate': frame_rate, 'phase': phase_name,
+						'exposure_control': control_state},
+						seq_images, STREAM_SETTLE_FRAMES if exposure != last_exposure else 0)
+				else:
+					nodes['ExposureTime'].value=exposure
+					arming.expect(exposure, frame_rate)
+					if exposure != last_exposure:
+						trigger_software_once_armed(nodes, arming)
+						image_pre=device.get_buffer()
+						pipeline.discard_buffer(image_pre)
+						device.requeue_buffer(image_pre)
+
+					for i in range(0, seq_images):
+						trigger_software_once_armed(nodes, arming)
+						t = timer.now()
+						image=device.get_buffer()
+						timer.mark('get_buffer', t)
+
+						'''
+						Hand the frame to the writers
+						The pipeline copies the frame out of the camera buffer into a
+						preallocated slot (one memmove), so the buffer can be requeued
+						right away; statistics, header and writeto happen on the
+						writer threads.
+						'''
+						pipeline.submit_buffer(image, {'seq': seq, 'exp_index': j,
+							'frame_index': i, 'burst_size': seq_images,
+							'exposure_us': exposure, 'frame_rate': frame_rate,
+							'phase': phase_name, 'exposure_control': control_state,
+							'timestamp': datetime.now()})
+						# Requeue buffers
+						t = timer.now()
+						device.requeue_buffer(image)
+						timer.mark('requeue', t)
+				last_exposure = exposure
+				profiler.end()
 				t_elapsed=toc(t_start)
-				print(f"{TAB1}{TAB2}{TAB1}Burst elapsed time: {t_elapsed:.3f} seconds")
+				print(f"{TAB1}{TAB2}{TAB1}Burst elapsed time: {t_elapsed:.3f} seconds, "
+					f"{nodes.transactions - tx_start} node transactions "
+					f"({nodes.polls - polls_start} status polls)")
 			seq_elapsed=toc(seq_start)
 			print(f"{TAB1}{TAB2}Sequence elapsed time: {seq_elapsed:.3f} seconds")
-		
+	finally:
 		#device.requeue_buffer(image_pre)
+		profiler.end()
+		if drain is not None:
+			drain.stop()
 		device.stop_stream()
+		if ladder is not None:
+			camera_sequencer.stop_sequencer(nodes)
+		# drain the writer queue before the nodes are restored
+		pipeline.close()
+		print(f"{TAB1}{pipeline.report()}")
+		if spectra is not None:
+			print(f"{TAB1}{spectra.report()}")
+		if preview is not None:
+			print(f"{TAB1}{preview.report()}")
+		print(f"{TAB1}{pressure.report()}")
+		if manifest is not None:
+			print(f"{TAB1}{manifest.report()}")
+		if pressure.events:
+			pressure.write_log(run_name + '_backpressure.csv')
+		print(f"{TAB1}{nodes.report()}")
+		print(f"{TAB1}{drain.report() if drain is not None else arming.report()}")
+		if timer.enabled:
+			print(f"{TAB1}Stage latencies:\n{timer.report()}")
+			timer.dump(run_name + '_timing')
+		if PROFILE_BURST is not None:
+			print(f"{TAB1}{profiler.report()}")
+		if clock is not None:
+			clock.close()
+			clock.write_log(run_name + '_frames.csv')
+			print(f"{TAB1}{clock.report()}")
+		if schedule is not None:
+			schedule.write_log(run_name + '_schedule.csv')
+			print(f"{TAB1}{schedule.report()}")
+		if control is not None:
+			control.write_log(run_name + '_exposure.csv')
+			print(f"{TAB1}{control.report()}")
 
 	'''
 	Run HDR processing
 		Once the images have been retrieved and copied, they can be processed
-		into an HDR image. HDR algorithms
+		into an HDR image. With HDR_MERGE the radiance maps are built while
+		acquiring; hdr_merge.py does the same offline from the written frames.
 	'''
 	#print(f"{TAB1}Run HDR processing")
 
-	# Destroy copied images after processing to prevent memory leaks
-	#for i in range(0, hdr_images.__len__()):
-	#	BufferFactory.destroy(hdr_images[i])
-
 	'''
 	Return nodes to initial values
 	'''
-	nodes['ExposureTime'].value = initial_vals[0]
-	nodes['ExposureAuto'].value = initial_vals[1]
-	nodes['TriggerSelector'].value = initial_vals[2]
-	nodes['TriggerSource'].value = initial_vals[3]
-	nodes['TriggerMode'].value = initial_vals[4]
+	nodes.apply(initial_vals)
 
 	#return np.array(datacub)
+	return pipeline.frames_written - pipeline.failed_frames
 
 def example_entry_point():
 
@@ -303,5 +672,8 @@ def example_entry_point():
 
 if __name__ == "__main__":
 	print("Eclipse sequence Started\n")
-	example_entry_point()
+	if MULTI_CAMERA:
+		multi_camera.acquire_all(__file__)
+	else:
+		example_entry_point()
 	print("\nEclipse sequence Completed")
@@ -0,0 +1,432 @@
+'''
+Live quick-look preview
+    The operators need to see frames during the eclipse, but nothing that
+    shows them may slow the acquisition. QuickLookPublisher is a frame
+    pipeline sink that drops a decimated copy (every decimate-th pixel of
+    every decimate-th row) of every every-th frame into a ring of slots in
+    shared memory; the viewer (main(), run in another window) maps the same
+    memory and shows the newest slot.
+
+    The ring is lock-free with a single writer and any number of readers:
+    - the writer overwrites the oldest slot and never looks at the readers,
+      so a slow, stalled or crashed viewer costs the acquisition nothing
+    - every slot has a version counter (a seqlock): odd while the slot is
+      being written, even once it is complete. A reader copies the slot and
+      keeps the copy only if the version was even and unchanged around the
+      copy; otherwise the writer lapped it and it takes the newest slot again
+    - the writer threads of the pipeline share one publisher: a thread that
+      finds another one publishing skips its frame instead of waiting
+
+    Next to the frames the header holds the frames seen, the acquisition
+    frame rate and the pipeline's writer queue depth, for the viewer's
+    status line. The shared memory is created with the first frame and
+    removed by close().
+
+    Every camera publishes to its own ring, eclipse_quicklook_<serial>
+    (ring_name()), so the camera processes of multi_camera.py do not share
+    one. A publisher never removes a ring it did not create: when the name
+    is taken (another acquisition of the same camera, or a run that crashed
+    and left it behind on Linux) it logs that and publishes nothing. The
+    viewer picks the camera with --camera; without it, it shows the only
+    ring it finds (listing needs /dev/shm, so on Windows --camera is needed).
+
+    The acquisition scripts import this module only when QUICKLOOK_EVERY is
+    set: multiprocessing.shared_memory needs Python 3.8.
+
+Usage:
+    python quicklook.py                        # window (matplotlib), newest frame
+    python quicklook.py --camera 223200992     # the ring of one camera (DeviceSerialNumber)
+    python quicklook.py --stretch equalize --interval 0.5
+    python quicklook.py --text                 # one status line per frame, no window
+'''
+import argparse
+import logging
+import os
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from frame_statistics import MONO12_MAX
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NAME = 'eclipse_quicklook'
+SLOTS = 4
+MAGIC = 0x4b4f4f4c4b434951      # 'QICKLOOK'
+HEADER = np.dtype([('magic', '<u8'), ('slots', '<u4'), ('height', '<u4'), ('width', '<u4'),
+                   ('decimate', '<u4'), ('published', '<u8'), ('frames_seen', '<u8'),
+                   ('fps', '<f8'), ('queue_depth', '<i4'), ('closed', '<u4')])
+SLOT = np.dtype([('version', '<u8'), ('seq', '<i4'), ('exp_index', '<i4'), ('frame_index', '<i4'),
+                 ('index', '<u8'), ('number', '<u8'), ('exposure_us', '<f8'), ('timestamp', '<f8'),
+                 ('published', '<f8'), ('mean', '<f8'), ('max', '<f8'), ('saturated', '<i8')])
+FPS_WINDOW_S = 1.
+STRETCHES = ('linear', 'sqrt', 'equalize')
+SHM_DIR = '/dev/shm'
+
+
+def ring_name(camera=None):
+    '''
+    Shared memory name of a camera's ring, camera being its DeviceSerialNumber
+    '''
+    return DEFAULT_NAME if camera is None else f'{DEFAULT_NAME}_{camera}'
+
+
+def find_rings():
+    '''
+    Names of the quick-look rings present, None where shared memory cannot
+        be listed (no /dev/shm, e.g. Windows)
+    '''
+    if not os.path.isdir(SHM_DIR):
+        return None
+    return sorted(name for name in os.listdir(SHM_DIR) if name.startswith(DEFAULT_NAME))
+
+
+def ring_size(slots, height, width):
+    return HEADER.itemsize + slots * SLOT.itemsize + slots * height * width * 2
+
+
+def ring_views(buffer, slots, height, width):
+    '''
+    (header, slot records, frames) numpy views of a ring's shared memory
+    '''
+    header = np.ndarray((), HEADER, buffer, 0)
+    records = np.ndarray((slots,), SLOT, buffer, HEADER.itemsize)
+    frames = np.ndarray((slots, height, width), np.uint16, buffer,
+                        HEADER.itemsize + slots * SLOT.itemsize)
+    return header, records, frames
+
+
+class QuickLookPublisher:
+    '''
+    Frame pipeline sink publishing every every-th frame, decimated, into the
+        shared-memory ring name (see ring_name()). queue_depth, when given,
+        is called for the writer queue depth shown by the viewer. log gets
+        the message when the ring cannot be created (default: this module's
+        logger).
+    '''
+    stage = 'quicklook'
+
+    def __init__(self, every=10, decimate=4, name=DEFAULT_NAME, slots=SLOTS, queue_depth=None,
+                 log=None):
+        self.every = max(int(every), 1)
+        self.decimate = max(int(decimate), 1)
+        self.name = name
+        self.slots = slots
+        self.queue_depth = queue_depth
+        self.log = log or logger.warning
+        self.shm = None
+        self.unavailable = False
+        self.frames_seen = 0
+        self.published = 0
+        self.skipped_busy = 0
+        self.publish_s = 0.
+        self._count_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._rate = None
+
+    def _create(self, height, width):
+        try:
+            self.shm = shared_memory.SharedMemory(self.name, create=True,
+                                                  size=ring_size(self.slots, height, width))
+        except FileExistsError:
+            # not ours to remove: another acquisition may be publishing to it
+            self.unavailable = True
+            self.log(f"Quick-look: shared memory '{self.name}' already exists (another "
+                     f"acquisition of this camera, or left behind by a crashed run: remove "
+                     f"{SHM_DIR}/{self.name}), nothing is published")
+            return False
+        self._header, self._records, self._frames = ring_views(self.shm.buf, self.slots,
+                                                               height, width)
+        self._records[:] = np.zeros((), SLOT)
+        header = self._header
+        header['slots'] = self.slots
+        header['height'] = height
+        header['width'] = width
+        header['decimate'] = self.decimate
+        header['magic'] = MAGIC
+        return True
+
+    def write(self, frame, meta):
+        with self._count_lock:
+            self.frames_seen += 1
+            count = self.frames_seen
+        if (count - 1) % self.every or self.unavailable:
+            return
+        if not self._lock.acquire(blocking=False):
+            self.skipped_busy += 1
+            return
+        try:
+            t = time.perf_counter()
+            self._publish(frame, meta, count, t)
+            self.publish_s += time.perf_counter() - t
+        finally:
+            self._lock.release()
+
+    def _publish(self, frame, meta, count, t):
+        preview = frame[::self.decimate, ::self.decimate]
+        if self.shm is None and not self._create(*preview.shape):
+            return
+        header = self._header
+        if preview.shape != self._frames.shape[1:]:
+            return
+        n = self.published
+        slot = n % self.slots
+        record = self._records[slot]
+        version = int(record['version'])
+        record['version'] = version + 1
+        np.copyto(self._frames[slot], preview, casting='unsafe')
+        stats = meta.get('stats') or {}
+        record['index'] = n
+        record['seq'] = meta['seq']
+        record['exp_index'] = meta.get('exp_index', -1)
+        record['frame_index'] = meta.get('frame_index', -1)
+        record['number'] = count
+        record['exposure_us'] = meta.get('exposure_us') or 0.
+        record['timestamp'] = meta['timestamp'].timestamp()
+        record['published'] = time.time()
+        record['mean'] = stats.get('mean', np.nan)
+        record['max'] = stats.get('max', np.nan)
+        record['saturated'] = stats.get('saturated', -1)
+        record['version'] = version + 2
+        self.published = n + 1
+        header['published'] = n + 1
+        header['frames_seen'] = count
+        if self._rate is None:
+            self._rate = (t, count)
+        since, seen = self._rate
+        if t - since >= FPS_WINDOW_S:
+            header['fps'] = (count - seen) / (t - since)
+            self._rate = (t, count)
+        if self.queue_depth is not None:
+            header['queue_depth'] = self.queue_depth()
+
+    def close(self):
+        with self._lock:
+            if self.shm is None:
+                return
+            self._header['closed'] = 1
+            shm, self.shm = self.shm, None
+            self._header = self._records = self._frames = None
+        shm.close()
+        shm.unlink()
+
+    def summary(self):
+        return {'frames_seen': self.frames_seen, 'published': self.published,
+                'skipped_busy': self.skipped_busy,
+                'publish_us_mean': 1e6 * self.publish_s / max(self.published, 1)}
+
+    def report(self):
+        s = self.summary()
+        if self.unavailable:
+            return f"Quick-look: nothing published, '{self.name}' was taken"
+        return (f"Quick-look: {s['published']} of {s['frames_seen']} frames published to "
+                f"'{self.name}', {s['publish_us_mean']:.0f} us each, {s['skipped_busy']} skipped "
+                f"while another writer published")
+
+
+class QuickLookReader:
+    '''
+    Read side of the ring: attach() maps it (None until a publisher has
+        created it), newest() copies the newest complete slot
+    '''
+
+    def __init__(self, name=DEFAULT_NAME):
+        self.name = name
+        self.shm = None
+        self.torn = 0
+
+    def attach(self):
+        try:
+            shm = shared_memory.SharedMemory(self.name)
+        except FileNotFoundError:
+            return None
+        # the publisher owns the memory: the reader must not unlink it at exit
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        header = np.ndarray((), HEADER, shm.buf, 0)
+        if int(header['magic']) != MAGIC:
+            shm.close()
+            return None
+        self.shm = shm
+        self.header, self.records, self.frames = ring_views(
+            shm.buf, int(header['slots']), int(header['height']), int(header['width']))
+        return self
+
+    def detach(self):
+        if self.shm is not None:
+            self.header = self.records = self.frames = None
+            self.shm.close()
+            self.shm = None
+
+    @property
+    def closed(self):
+        return bool(self.header['closed'])
+
+    def newest(self, tries=3):
+        '''
+        (record, frame) copies of the newest complete slot, None when none
+            is published yet or the writer kept lapping the copy
+        '''
+        for _ in range(tries):
+            published = int(self.header['published'])
+            if published == 0:
+                return None
+            slot = (published - 1) % len(self.records)
+            before = int(self.records[slot]['version'])
+            if before % 2:
+                self.torn += 1
+                continue
+            record = self.records[slot].copy()
+            frame = self.frames[slot].copy()
+            if int(self.records[slot]['version']) == before:
+                return record, frame
+            self.torn += 1
+        return None
+
+    def status(self):
+        header = self.header
+        return {'frames_seen': int(header['frames_seen']), 'published': int(header['published']),
+                'fps': float(header['fps']), 'queue_depth': int(header['queue_depth'])}
+
+
+def stretch(frame, mode='linear', low=0.5, high=99.5, saturation=MONO12_MAX):
+    '''
+    Display image in [0, 1] from the frame's histogram: linear or sqrt
+        between the low and high percentiles, or histogram equalized
+    '''
+    counts = np.bincount(frame.ravel(), minlength=saturation + 1)
+    cumulative = np.cumsum(counts) / frame.size
+    if mode == 'equalize':
+        return cumulative[frame].astype(np.float32)
+    lo = np.searchsorted(cumulative, low / 100.)
+    hi = max(np.searchsorted(cumulative, high / 100.), lo + 1)
+    image = np.clip((frame.astype(np.float32) - lo) / (hi - lo), 0., 1.)
+    return np.sqrt(image) if mode == 'sqrt' else image
+
+
+def describe(record, status, shown, missed):
+    name = f"seq{record['seq']}"
+    if record['exp_index'] >= 0:
+        name += f" exp{record['exp_index'] + 1} i{record['frame_index']:02d}"
+    age = time.time() - record['published']
+    return (f"{name}  {record['exposure_us'] / 1000.:.1f} ms  mean {record['mean']:.0f} "
+            f"max {record['max']:.0f} sat {record['saturated']}  |  {status['fps']:.1f} fps, "
+            f"queue {status['queue_depth']}, frame {record['number']}, age {age * 1000.:.0f} ms, "
+            f"{shown} shown, {missed} overwritten unseen")
+
+
+def choose_ring(poll_s=0.5):
+    '''
+    Name of the only ring present, waiting for one to appear; None when
+        there are several or they cannot be listed
+    '''
+    announced = False
+    while True:
+        names = find_rings()
+        if names is None:
+            print('Shared memory cannot be listed here: pass --camera <DeviceSerialNumber>')
+            return None
+        if len(names) == 1:
+            return names[0]
+        if names:
+            print('Quick-look rings of several cameras, pick one with --camera:')
+            for name in names:
+                print(f'  {name[len(DEFAULT_NAME) + 1:] or name}')
+            return None
+        if not announced:
+            print('Waiting for an acquisition to publish ...')
+            announced = True
+        time.sleep(poll_s)
+
+
+def wait_for_ring(reader, poll_s=0.5):
+    announced = False
+    while reader.attach() is None:
+        if not announced:
+            print(f"Waiting for the acquisition to publish to '{reader.name}' ...")
+            announced = True
+        time.sleep(poll_s)
+
+
+class Viewed:
+    '''
+    Counts of the published previews shown and of those overwritten before
+        the viewer got to them
+    '''
+
+    def __init__(self):
+        self.shown = 0
+        self.missed = 0
+        self.last = None
+
+    def new(self, record):
+        index = int(record['index'])
+        if index == self.last:
+            return False
+        if self.last is not None:
+            self.missed += max(index - self.last - 1, 0)
+        self.last = index
+        self.shown += 1
+        return True
+
+
+def run_text(reader, interval):
+    viewed = Viewed()
+    while not reader.closed:
+        newest = reader.newest()
+        if newest is not None and viewed.new(newest[0]):
+            print(describe(newest[0], reader.status(), viewed.shown, viewed.missed))
+        time.sleep(interval)
+
+
+def run_window(reader, interval, mode):
+    import matplotlib.pyplot as plt
+    figure, axes = plt.subplots()
+    image = None
+    viewed = Viewed()
+    while not reader.closed and plt.fignum_exists(figure.number):
+        newest = reader.newest()
+        if newest is not None and viewed.new(newest[0]):
+            record, frame = newest
+            display = stretch(frame, mode)
+            if image is None:
+                image = axes.imshow(display, cmap='gray', vmin=0., vmax=1., origin='lower')
+            else:
+                image.set_data(display)
+            axes.set_title(describe(record, reader.status(), viewed.shown, viewed.missed),
+                           fontsize=8)
+        plt.pause(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--camera', help='DeviceSerialNumber of the camera to show (default: '
+                                         'the only one publishing)')
+    parser.add_argument('--name', help='shared memory name (instead of --camera)')
+    parser.add_argument('--stretch', choices=STRETCHES, default='linear')
+    parser.add_argument('--interval', type=float, default=0.2, help='refresh interval in seconds')
+    parser.add_argument('--text', action='store_true', help='status lines instead of a window')
+    args = parser.parse_args()
+
+    name = args.name or (ring_name(args.camera) if args.camera else choose_ring())
+    if name is None:
+        return
+    reader = QuickLookReader(name)
+    wait_for_ring(reader)
+    try:
+        if args.text:
+            run_text(reader, args.interval)
+        else:
+            run_window(reader, args.interval, args.stretch)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if reader.shm is not None and reader.closed:
+            print('Acquisition finished')
+        reader.detach()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,436 @@
+'''
+Session manifest
+    A run writes thousands of frame files, and finding "every exp2 frame of
+    seq 3" or "the frames with more than 0.1% saturated pixels" used to mean
+    globbing the directory and opening every header. The manifest is an
+    SQLite database next to the frames with one row per frame:
+
+        frames  run, path (relative to the manifest, empty when the output
+                mode writes no file per frame), seq, exp (1-based, as in the
+                file names), frame_index, burst_size, exposure_us, date_obs,
+                date_rcv, frame_id, camera_ns, phase, frame_rate, decimation,
+                mean, std, min, max, saturated (pixels), saturated_fraction,
+                status ('written'; 'failed' when a pipeline stage or sink
+                failed on the frame; 'dropped' when the backpressure policy
+                dropped it and 'decimated' when it left it out of a
+                decimated burst, both with no path or statistics)
+        runs    run, name, started, settings (JSON: the camera nodes of the
+                run and whatever settings the script passes)
+
+    ManifestSink fills it during acquisition as a frame pipeline sink: rows
+    are collected on the writer threads and inserted in batches (every
+    FLUSH_ROWS rows or FLUSH_S seconds), in WAL mode, so the manifest can be
+    queried while the run is still going and holds everything written up to
+    the last batch if the run dies.
+
+    Manifest is the query side, build_manifest() rebuilds a manifest from
+    existing directories of per-frame files (.fits, .fits.fz) by reading only
+    their headers, in a pool of worker processes. The frame statistics are
+    not in the headers, so indexed frames have none.
+
+Usage:
+    python session_manifest.py query run_manifest.sqlite --seq 3 --exp 2 --paths
+    python session_manifest.py query run_manifest.sqlite --saturated-above 0.001
+    python session_manifest.py query run_manifest.sqlite --sql "select seq, avg(mean) from frames group by seq"
+    python session_manifest.py runs run_manifest.sqlite
+    python session_manifest.py index D:/Annular2023/spectra --workers 8
+'''
+import argparse
+import glob
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from astropy.io import fits
+
+from frame_pipeline import DATE_OBS_FORMAT, frame_filename
+
+MANIFEST_NAME = 'manifest.sqlite'
+FLUSH_ROWS = 64
+FLUSH_S = 1.
+HEADERS_PER_TASK = 64
+# camera nodes recorded with every run, where the camera has them
+RUN_NODES = ('DeviceModelName', 'DeviceSerialNumber', 'DeviceFirmwareVersion', 'Width', 'Height',
+             'OffsetX', 'OffsetY', 'PixelFormat', 'Gain', 'BlackLevel', 'ExposureAuto',
+             'TriggerMode', 'AcquisitionFrameRateEnable', 'AcquisitionFrameRate')
+FRAME_NAME = re.compile(r'(?P<prefix>.+)_(?P<date>\d{8}_\d{6})_seq(?P<seq>\d+)_exp(?P<exp>\d+)'
+                        r'_i(?P<index>\d+)\.fits(\.fz)?$')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run INTEGER PRIMARY KEY, name TEXT, started TEXT, settings TEXT);
+CREATE TABLE IF NOT EXISTS frames (
+    run INTEGER, path TEXT, seq INTEGER, exp INTEGER, frame_index INTEGER, burst_size INTEGER,
+    exposure_us REAL, date_obs TEXT, date_rcv TEXT, frame_id INTEGER, camera_ns INTEGER,
+    phase TEXT, frame_rate REAL, decimation INTEGER, mean REAL, std REAL, min INTEGER,
+    max INTEGER, saturated INTEGER, saturated_fraction REAL, status TEXT);
+CREATE INDEX IF NOT EXISTS frames_burst ON frames (seq, exp, frame_index);
+CREATE INDEX IF NOT EXISTS frames_date ON frames (date_obs);
+'''
+FRAME_COLUMNS = ('run', 'path', 'seq', 'exp', 'frame_index', 'burst_size', 'exposure_us',
+                 'date_obs', 'date_rcv', 'frame_id', 'camera_ns', 'phase', 'frame_rate',
+                 'decimation', 'mean', 'std', 'min', 'max', 'saturated', 'saturated_fraction',
+                 'status')
+INSERT_FRAME = (f"INSERT INTO frames ({', '.join(FRAME_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(FRAME_COLUMNS))})")
+MARK_FAILED = ("UPDATE frames SET status = 'failed' "
+               "WHERE run = ? AND seq = ? AND exp = ? AND frame_index = ?")
+
+
+def connect(path):
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(SCHEMA)
+    columns = [row[1] for row in connection.execute('PRAGMA table_info(frames)')]
+    if 'status' not in columns:
+        # manifest from before the status column, appended to
+        connection.execute('ALTER TABLE frames ADD COLUMN status TEXT')
+    return connection
+
+
+def add_run(connection, name, settings=None):
+    '''
+    New row in runs, returns its run number
+    '''
+    cursor = connection.execute('INSERT INTO runs (name, started, settings) VALUES (?, ?, ?)',
+                                (name, datetime.now().strftime(DATE_OBS_FORMAT),
+                                 json.dumps(settings or {}, default=str)))
+    connection.commit()
+    return cursor.lastrowid
+
+
+def node_settings(nodes, names=RUN_NODES):
+    '''
+    {name: value} of the nodes the camera has, for the runs table
+    '''
+    settings = {}
+    for name in names:
+        node = nodes[name]
+        if node is not None:
+            settings[name] = node.value
+    return settings
+
+
+def frame_key(meta):
+    '''
+    (seq, exp, frame_index) of a frame, as in the frames table
+    '''
+    return meta['seq'], meta['exp_index'] + 1, meta['frame_index']
+
+
+def frame_row(run, path, meta, status='written'):
+    stats = meta.get('stats')
+    received = meta.get('received')
+    row = (run, path, meta['seq'], meta['exp_index'] + 1, meta['frame_index'],
+           meta.get('burst_size'), meta['exposure_us'],
+           meta['timestamp'].strftime(DATE_OBS_FORMAT),
+           received.strftime(DATE_OBS_FORMAT) if received is not None else None,
+           meta.get('frame_id'), meta.get('camera_ns'), meta.get('phase'),
+           meta.get('frame_rate'), meta.get('decimation'))
+    if not stats:
+        return row + (None,) * 6 + (status,)
+    return row + (stats['mean'], stats['std'], stats['min'], stats['max'], stats['saturated'],
+                  stats['saturated'] / stats['pixels'], status)
+
+
+class ManifestSink:
+    '''
+    Frame pipeline sink recording every frame in the manifest at path (see
+        module docstring). output and keep_every are the pipeline's output
+        mode and keep_every, which say which frames get a file of their own
+        under out_dir. settings are stored with the run next to the camera
+        nodes (node_settings()).
+    '''
+    stage = 'manifest'
+
+    def __init__(self, path, out_dir, prefix, output='frames', keep_every=1, settings=None):
+        self.path = path
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.output = output
+        self.keep_every = keep_every
+        self.connection = connect(path)
+        self.run = add_run(self.connection, prefix, settings)
+        self.rows = 0
+        self.flushes = 0
+        self.flush_s = 0.
+        self._pending = []
+        self._failed = set()
+        self._failed_pending = []
+        self._flushed = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def frame_path(self, meta):
+        '''
+        Path of a frame's file relative to the manifest, '' when it has none
+        '''
+        if self.output not in ('frames', 'rice') or meta['frame_index'] % self.keep_every:
+            return ''
+        name = frame_filename(self.prefix, meta) + ('.fz' if self.output == 'rice' else '')
+        return os.path.relpath(os.path.join(self.out_dir, name), os.path.dirname(self.path))
+
+    def write(self, frame, meta):
+        path = self.frame_path(meta)
+        with self._lock:
+            status = 'failed' if frame_key(meta) in self._failed else 'written'
+            self._add(frame_row(self.run, path, meta, status))
+
+    def dropped(self, meta):
+        '''
+        A frame the backpressure policy dropped or decimated: a row without
+            file or statistics
+        '''
+        with self._lock:
+            self._add(frame_row(self.run, '', meta,
+                                'decimated' if meta.get('decimated') else 'dropped'))
+
+    def failed(self, meta):
+        '''
+        A frame the pipeline failed to write (FrameWritePipeline.frame_failed),
+            before or after its row was added
+        '''
+        with self._lock:
+            self._failed.add(frame_key(meta))
+            self._failed_pending.append((self.run,) + frame_key(meta))
+
+    def _add(self, row):
+        self._pending.append(row)
+        if (len(self._pending) >= FLUSH_ROWS
+                or time.perf_counter() - self._flushed >= FLUSH_S):
+            self._flush()
+
+    def _flush(self):
+        t = time.perf_counter()
+        if self._pending or self._failed_pending:
+            self.connection.executemany(INSERT_FRAME, self._pending)
+            self.connection.executemany(MARK_FAILED, self._failed_pending)
+            self.connection.commit()
+            self.rows += len(self._pending)
+            self.flushes += 1
+            self._pending = []
+            self._failed_pending = []
+        self._flushed = time.perf_counter()
+        self.flush_s += self._flushed - t
+
+    def close(self):
+        with self._lock:
+            if self.connection is None:
+                return
+            self._flush()
+            self.connection.close()
+            self.connection = None
+
+    def summary(self):
+        return {'rows': self.rows, 'flushes': self.flushes,
+                'flush_ms_mean': 1000. * self.flush_s / max(self.flushes, 1)}
+
+    def report(self):
+        s = self.summary()
+        return (f"Manifest: {s['rows']} frames in {self.path}, {s['flushes']} batches of "
+                f"{s['flush_ms_mean']:.1f} ms")
+
+
+class Manifest:
+    '''
+    Read side of a manifest. frames() takes the common filters, sql() any
+        query; rows come back as dicts.
+    '''
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        self.path = path
+        # not mode=ro: a read-only connection leaves the -wal and -shm files behind
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA query_only=ON')
+        self.connection.row_factory = sqlite3.Row
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def sql(self, query, params=()):
+        return [dict(row) for row in self.connection.execute(query, params)]
+
+    def runs(self):
+        return self.sql('SELECT run, name, started, settings, '
+                        '(SELECT count(*) FROM frames WHERE frames.run = runs.run) AS frames '
+                        'FROM runs ORDER BY run')
+
+    def frames(self, run=None, seq=None, exp=None, frame_index=None, phase=None,
+               saturated_above=None, max_above=None, since=None, until=None, status=None,
+               limit=None):
+        '''
+        Frames matching every filter given. run, seq, exp and frame_index
+            take a number or a list of them (exp is 1-based, as in the file
+            names); saturated_above is a fraction of the pixels, max_above a
+            pixel value; since and until bound DATE-OBS (same format); status
+            is one or more of 'written', 'failed', 'dropped' and 'decimated'.
+        '''
+        clauses, params = [], []
+        for column, value in (('run', run), ('seq', seq), ('exp', exp),
+                              ('frame_index', frame_index), ('phase', phase),
+                              ('status', status)):
+            if value is None:
+                continue
+            values = list(value) if isinstance(value, (list, tuple, set, range)) else [value]
+            clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+            params += values
+        for clause, value in (('saturated_fraction > ?', saturated_above), ('max > ?', max_above),
+                              ('date_obs >= ?', since), ('date_obs <= ?', until)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        query = 'SELECT * FROM frames'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        query += ' ORDER BY run, seq, exp, frame_index'
+        if limit is not None:
+            query += f' LIMIT {int(limit)}'
+        return self.sql(query, params)
+
+    def paths(self, **filters):
+        '''
+        Absolute paths of the files of the frames matching the filters
+        '''
+        base = os.path.dirname(os.path.abspath(self.path))
+        return [os.path.normpath(os.path.join(base, row['path']))
+                for row in self.frames(**filters) if row['path']]
+
+
+def read_headers(paths, base):
+    '''
+    Frame rows of per-frame files from their headers alone. Module level so
+        it runs in the worker processes.
+    '''
+    rows = []
+    for path in paths:
+        match = FRAME_NAME.match(os.path.basename(path))
+        header = fits.getheader(path, 1 if path.endswith('.fz') else 0)
+        exptime = header.get('EXPTIME')
+        rows.append((None, os.path.relpath(path, base), int(match['seq']), int(match['exp']),
+                     int(match['index']), None,
+                     float(exptime) * 1e6 if exptime is not None else None,
+                     header.get('DATE-OBS'), header.get('DATE-RCV'), header.get('FRAMEID'),
+                     header.get('CAMTIME'), header.get('PHASE'), None, header.get('DECIMATE'))
+                    + (None,) * 6 + ('written',))
+    return rows
+
+
+def frame_files(directory):
+    paths = glob.glob(os.path.join(directory, '*.fits')) + glob.glob(os.path.join(directory, '*.fits.fz'))
+    return sorted(path for path in paths if FRAME_NAME.match(os.path.basename(path)))
+
+
+def build_manifest(directories, path=None, workers=None, append=False):
+    '''
+    Manifest of the per-frame files in directories, one run per directory,
+        from parallel header-only reads. path defaults to manifest.sqlite in
+        the first directory; an existing manifest there is replaced unless
+        append. Returns the number of frames indexed.
+    '''
+    path = path or os.path.join(directories[0], MANIFEST_NAME)
+    if not append:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    connection = connect(path)
+    base = os.path.dirname(os.path.abspath(path))
+    frames = 0
+    try:
+        with ProcessPoolExecutor(workers) as executor:
+            for directory in directories:
+                paths = [os.path.abspath(p) for p in frame_files(directory)]
+                run = add_run(connection, os.path.abspath(directory), {'indexed': True})
+                futures = [executor.submit(read_headers, paths[n:n + HEADERS_PER_TASK], base)
+                           for n in range(0, len(paths), HEADERS_PER_TASK)]
+                for future in futures:
+                    rows = [(run,) + row[1:] for row in future.result()]
+                    connection.executemany(INSERT_FRAME, rows)
+                    frames += len(rows)
+                connection.commit()
+    finally:
+        connection.close()
+    return frames
+
+
+def print_rows(rows, columns=None):
+    if not rows:
+        print('no frames')
+        return
+    columns = columns or list(rows[0])
+    print('\t'.join(columns))
+    for row in rows:
+        print('\t'.join('' if row[column] is None else str(row[column]) for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    query = commands.add_parser('query', help='list the frames matching filters')
+    query.add_argument('manifest')
+    query.add_argument('--run', type=int, nargs='+')
+    query.add_argument('--seq', type=int, nargs='+')
+    query.add_argument('--exp', type=int, nargs='+', help='exposure of the ladder, 1-based')
+    query.add_argument('--frame', type=int, nargs='+', help='frame index within the burst')
+    query.add_argument('--phase', nargs='+')
+    query.add_argument('--saturated-above', type=float, help='fraction of saturated pixels')
+    query.add_argument('--max-above', type=float, help='brightest pixel in DN')
+    query.add_argument('--since', help=f'DATE-OBS lower bound ({DATE_OBS_FORMAT})')
+    query.add_argument('--until', help='DATE-OBS upper bound')
+    query.add_argument('--status', nargs='+', choices=['written', 'failed', 'dropped', 'decimated'])
+    query.add_argument('--limit', type=int)
+    query.add_argument('--paths', action='store_true', help='print only the file paths')
+    query.add_argument('--count', action='store_true', help='print only the number of frames')
+    query.add_argument('--sql', help='run this query instead')
+    runs = commands.add_parser('runs', help='list the runs of a manifest')
+    runs.add_argument('manifest')
+    index = commands.add_parser('index', help='build a manifest from existing frame files')
+    index.add_argument('directories', nargs='+')
+    index.add_argument('--out', help=f'manifest path (default: {MANIFEST_NAME} in the first directory)')
+    index.add_argument('--workers', type=int, default=None,
+                       help='worker processes (default: one per core)')
+    index.add_argument('--append', action='store_true', help='add to an existing manifest')
+    args = parser.parse_args()
+
+    if args.command == 'index':
+        t_start = time.time()
+        frames = build_manifest(args.directories, args.out, args.workers, args.append)
+        elapsed = time.time() - t_start
+        print(f'Indexed {frames} frames in {elapsed:.1f} s ({frames / max(elapsed, 1e-9):.0f} '
+              f'headers/s)')
+        return
+    with Manifest(args.manifest) as manifest:
+        if args.command == 'runs':
+            print_rows(manifest.runs(), ['run', 'name', 'started', 'frames', 'settings'])
+            return
+        if args.sql:
+            print_rows(manifest.sql(args.sql))
+            return
+        filters = {'run': args.run, 'seq': args.seq, 'exp': args.exp, 'frame_index': args.frame,
+                   'phase': args.phase, 'saturated_above': args.saturated_above,
+                   'max_above': args.max_above, 'since': args.since, 'until': args.until,
+                   'status': args.status, 'limit': args.limit}
+        if args.paths:
+            print('\n'.join(manifest.paths(**filters)))
+        elif args.count:
+            print(len(manifest.frames(**filters)))
+        else:
+            print_rows(manifest.frames(**filters),
+                       ['run', 'seq', 'exp', 'frame_index', 'exposure_us', 'date_obs', 'phase',
+                        'mean', 'max', 'saturated_fraction', 'path'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+'''
+Real-time spectrum extraction
+    The science product of the totality spectrograph is the K-corona spectrum
+    along the slit, a few kilobytes of a 10 MB frame. SpectrumSink collapses
+    every frame to 1D spectra while acquiring and writes one compact spectra
+    table per burst, <prefix>_<date>_seq<n>_exp<j>_spectra.fits, so the
+    spectra are there for quick-look during the eclipse and the full frames
+    can be thinned out (FULL_FRAME_EVERY in the acquisition script).
+
+    Geometry (SlitGeometry), with the dispersion along x (columns) and the
+    slit along y (rows):
+        roi        (y0, y1, x0, x1): rows and columns of the slit image
+        bins       number of spatial bins the slit rows are summed into
+        trace      polynomial (coefficients constant first) of the row offset
+                   of the slit image against the column, u = column minus the
+                   ROI's centre column: the spectrum drifting across the sensor
+        curvature  polynomial of the column shift of a spectral line against
+                   the slit row, v = row minus the ROI's centre row: line
+                   curvature (smile) of the spectrograph
+    Each ROI pixel is sampled at (y0 + r + trace(u), x0 + c + curvature(v))
+    by bilinear interpolation, which straightens the lines before the rows
+    are summed. The four gather indices and weights are computed once per
+    frame shape, so a frame costs four takes, a weighted sum and one
+    np.add.reduceat; without trace and curvature the ROI is summed directly.
+
+    Spectra tables: primary header with DATE-OBS, EXPTIME, SEQ, EXPNUM and the
+    geometry (ROI, SPECBINS, TRACEn, CURVn); binary table SPECTRA with one row
+    per frame: FRAME, DATE-OBS, EXPTIME, FRAMEID (-1 without frame clock) and
+    SPECTRUM (bins x columns, DN summed over the rows of each bin).
+
+Usage (offline, from written frames):
+    python spectrum_extract.py "D:/eclipse/totality/*.fits" --out spectra --roi 900 1150 0 2448 --bins 5
+    python spectrum_extract.py "*.fits" --out spectra --curvature 0 0 2.5e-5 --timing
+'''
+import argparse
+import glob
+import os
+import threading
+import time
+
+import numpy as np
+from astropy.io import fits
+from numpy.polynomial import polynomial
+
+from frame_pipeline import DATE_OBS_FORMAT, FILENAME_DATE_FORMAT, count_dropped
+
+
+def spectra_filename(prefix, meta):
+    '''
+    File name of a burst's spectra table, e.g. eclipse.spectrum_<date>_seq0_exp1_spectra.fits
+    '''
+    filename_date = meta['timestamp'].strftime(FILENAME_DATE_FORMAT)
+    return f"{prefix}_{filename_date}_seq{meta['seq']}_exp{meta['exp_index']+1}_spectra.fits"
+
+
+class SlitGeometry:
+    '''
+    Slit ROI, spatial binning and trace/curvature model (see module
+        docstring); roi None is the whole frame
+    '''
+
+    def __init__(self, roi=None, bins=1, trace=(), curvature=()):
+        self.roi = tuple(int(v) for v in roi) if roi is not None else None
+        self.bins = int(bins)
+        self.trace = tuple(float(c) for c in trace)
+        self.curvature = tuple(float(c) for c in curvature)
+        if self.bins < 1:
+            raise ValueError('Spectrum extraction needs at least one spatial bin')
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    @property
+    def straight(self):
+        return not any(self.trace) and not any(self.curvature)
+
+    def window(self, height, width):
+        '''
+        (y0, y1, x0, x1) of the ROI on a height x width frame
+        '''
+        y0, y1, x0, x1 = self.roi if self.roi is not None else (0, height, 0, width)
+        if not (0 <= y0 < y1 <= height and 0 <= x0 < x1 <= width):
+            raise ValueError(f'Slit ROI {self.roi} is outside the {height} x {width} frame')
+        if y1 - y0 < self.bins:
+            raise ValueError(f'{self.bins} spatial bins do not fit {y1 - y0} slit rows')
+        return y0, y1, x0, x1
+
+    def bin_starts(self, rows):
+        return np.linspace(0, rows, self.bins + 1).astype(np.intp)[:-1]
+
+    def _sampling(self, height, width):
+        '''
+        Flat gather indices (4, rows, columns) and bilinear weights of the
+            ROI on a height x width frame, computed once per shape
+        '''
+        key = (height, width)
+        with self._lock:
+            maps = self._maps.get(key)
+        if maps is not None:
+            return maps
+        y0, y1, x0, x1 = self.window(height, width)
+        rows = np.arange(y1 - y0, dtype=np.float64)
+        columns = np.arange(x1 - x0, dtype=np.float64)
+        u = columns - 0.5 * (x1 - x0 - 1)
+        v = rows - 0.5 * (y1 - y0 - 1)
+        trace = polynomial.polyval(u, self.trace) if self.trace else np.zeros_like(u)
+        curvature = polynomial.polyval(v, self.curvature) if self.curvature else np.zeros_like(v)
+        y = np.clip(y0 + rows[:, np.newaxis] + trace[np.newaxis, :], 0, height - 1)
+        x = np.clip(x0 + columns[np.newaxis, :] + curvature[:, np.newaxis], 0, width - 1)
+        iy = np.minimum(np.floor(y).astype(np.intp), height - 2)
+        ix = np.minimum(np.floor(x).astype(np.intp), width - 2)
+        fy = (y - iy).astype(np.float32)
+        fx = (x - ix).astype(np.float32)
+        base = iy * width + ix
+        index = np.stack([base, base + 1, base + width, base + width + 1])
+        weight = np.stack([(1 - fy) * (1 - fx), (1 - fy) * fx, fy * (1 - fx), fy * fx])
+        maps = (index, weight)
+        with self._lock:
+            self._maps[key] = maps
+        return maps
+
+    def extract(self, frame):
+        '''
+        Spectra of one frame, float32 (bins, ROI columns)
+        '''
+        height, width = frame.shape
+        y0, y1, x0, x1 = self.window(height, width)
+        if self.straight:
+            roi = frame[y0:y1, x0:x1].astype(np.float32)
+        else:
+            index, weight = self._sampling(height, width)
+            flat = frame.ravel()
+            roi = np.take(flat, index[0]) * weight[0]
+            for n in range(1, 4):
+                roi += np.take(flat, index[n]) * weight[n]
+        return np.add.reduceat(roi, self.bin_starts(y1 - y0), axis=0)
+
+    def cards(self):
+        cards = [('SPECBINS', self.bins, 'spatial bins along the slit')]
+        if self.roi is not None:
+            cards.append(('SLITROI', ' '.join(str(v) for v in self.roi), 'y0 y1 x0 x1'))
+        cards += [(f'TRACE{n}', c, 'slit row offset vs column') for n, c in enumerate(self.trace)]
+        cards += [(f'CURV{n}', c, 'line shift vs slit row') for n, c in enumerate(self.curvature)]
+        return cards
+
+
+class SpectrumTable:
+    '''
+    Spectra of one burst, one row per frame in frame_index order
+    '''
+
+    def __init__(self, burst_size, bins, columns):
+        self.spectra = np.zeros((burst_size, bins, columns), dtype=np.float32)
+        self.date_obs = [''] * burst_size
+        self.exptime = np.zeros(burst_size)
+        self.frame_id = np.full(burst_size, -1, dtype=np.int64)
+        self.filled = np.zeros(burst_size, dtype=bool)
+
+    def add(self, index, spectra, meta):
+        self.spectra[index] = spectra
+        self.date_obs[index] = meta['timestamp'].strftime(DATE_OBS_FORMAT)
+        self.exptime[index] = meta['exposure_us'] / 1e6
+        self.frame_id[index] = meta.get('frame_id', -1)
+        self.filled[index] = True
+
+
+def write_spectra(path, table, cards):
+    '''
+    Spectra table file: header cards in the primary HDU, the filled rows in
+        the SPECTRA binary table
+    '''
+    rows = np.flatnonzero(table.filled)
+    bins, columns = table.spectra.shape[1:]
+    primary = fits.PrimaryHDU()
+    for card in cards:
+        primary.header.append(card)
+    spectra = fits.BinTableHDU.from_columns([
+        fits.Column('FRAME', 'J', array=rows),
+        fits.Column('DATE-OBS', '26A', array=[table.date_obs[n] for n in rows]),
+        fits.Column('EXPTIME', 'D', unit='s', array=table.exptime[rows]),
+        fits.Column('FRAMEID', 'K', array=table.frame_id[rows]),
+        fits.Column('SPECTRUM', f'{bins * columns}E', dim=f'({columns},{bins})', unit='DN',
+                    array=table.spectra[rows])], name='SPECTRA')
+    fits.HDUList([primary, spectra]).writeto(path, overwrite=True)
+
+
+class SpectrumSink:
+    '''
+    Frame pipeline sink extracting the spectra of every frame into a table
+        per (sequence, exposure) burst, written once burst_size frames are in;
+        close() writes incomplete ones.
+    '''
+    stage = 'spectrum'
+
+    def __init__(self, out_dir, prefix, geometry):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.geometry = geometry
+        self.frames = 0
+        self.extract_s = 0.
+        self._tables = {}
+        self._dropped = {}
+        self._lock = threading.Lock()
+
+    def _table(self, spectra, meta):
+        key = (meta['seq'], meta['exp_index'])
+        with self._lock:
+            entry = self._tables.get(key)
+            if entry is None:
+                table = SpectrumTable(meta['burst_size'], *spectra.shape)
+                entry = self._tables[key] = [table, meta, self._dropped.pop(key, 0)]
+            return key, entry
+
+    def write(self, frame, meta):
+        t = time.perf_counter()
+        spectra = self.geometry.extract(frame)
+        elapsed = time.perf_counter() - t
+        key, entry = self._table(spectra, meta)
+        entry[0].add(meta['frame_index'], spectra, meta)
+        with self._lock:
+            self.frames += 1
+            self.extract_s += elapsed
+            entry[2] += 1
+            done = entry[2] == meta['burst_size']
+            if done:
+                del self._tables[key]
+        if done:
+            self._write(entry[0], entry[1])
+
+    def dropped(self, meta):
+        with self._lock:
+            entry = count_dropped(self._tables, self._dropped, (meta['seq'], meta['exp_index']),
+                                  meta['burst_size'])
+        if entry is not None:
+            self._write(entry[0], entry[1])
+
+    def _write(self, table, meta):
+        cards = [('DATE-OBS', meta['timestamp'].strftime(DATE_OBS_FORMAT), 'first frame of the burst'),
+                 ('EXPTIME', f"{meta['exposure_us']/1000./1000.}"),
+                 ('SEQ', meta['seq'], 'sequence number'),
+                 ('EXPNUM', meta['exp_index'] + 1, 'exposure of the ladder')]
+        if meta.get('phase'):
+            cards.append(('PHASE', meta['phase']))
+        write_spectra(os.path.join(self.out_dir, spectra_filename(self.prefix, meta)), table,
+                      cards + self.geometry.cards())
+
+    def close(self):
+        with self._lock:
+            entries = list(self._tables.values())
+            self._tables.clear()
+        for table, meta, _ in entries:
+            self._write(table, meta)
+
+    def report(self):
+        return (f'Spectrum extraction: {self.frames} frames, '
+                f'{1e3 * self.extract_s / max(self.frames, 1):.2f} ms each')
+
+
+def extract_files(paths, out_dir, geometry):
+    '''
+    Spectra tables for frames already written (FITS files, cubes or spool
+        segments), one per sequence and exposure; returns the number of
+        frames and the seconds spent extracting
+    '''
+    from hdr_merge import frame_sources, read_source
+    os.makedirs(out_dir, exist_ok=True)
+    frames = 0
+    extract_s = 0.
+    for (prefix, seq), sources in sorted(frame_sources(paths).items()):
+        # spectra are extracted as the frames are read, tables built per exposure after
+        extracted = []
+        for source in sources:
+            frame, exposure_us, timestamp = read_source(*source)
+            t = time.perf_counter()
+            extracted.append((exposure_us, timestamp, geometry.extract(frame)))
+            extract_s += time.perf_counter() - t
+        exposures = sorted({exposure_us for exposure_us, _, _ in extracted}, reverse=True)
+        for exp_index, exposure in enumerate(exposures):
+            burst = sorted((e for e in extracted if e[0] == exposure), key=lambda e: e[1])
+            table = SpectrumTable(len(burst), *burst[0][2].shape)
+            meta = {'seq': seq, 'exp_index': exp_index, 'exposure_us': exposure,
+                    'timestamp': burst[0][1]}
+            for frame_index, (exposure_us, timestamp, spectra) in enumerate(burst):
+                table.add(frame_index, spectra, dict(meta, timestamp=timestamp))
+            cards = [('DATE-OBS', meta['timestamp'].strftime(DATE_OBS_FORMAT), 'first frame of the burst'),
+                     ('EXPTIME', f"{exposure/1000./1000.}"),
+                     ('SEQ', seq, 'sequence number'),
+                     ('EXPNUM', exp_index + 1, 'exposure of the ladder')]
+            write_spectra(os.path.join(out_dir, spectra_filename(prefix, meta)), table,
+                          cards + geometry.cards())
+            frames += len(burst)
+    return frames, extract_s
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', help='frame FITS files, cubes or .spool segments (globs ok)')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--roi', type=int, nargs=4, metavar=('Y0', 'Y1', 'X0', 'X1'), default=None)
+    parser.add_argument('--bins', type=int, default=1, help='spatial bins along the slit')
+    parser.add_argument('--trace', type=float, nargs='+', default=(),
+                        help='row offset vs column, polynomial coefficients constant first')
+    parser.add_argument('--curvature', type=float, nargs='+', default=(),
+                        help='line shift vs slit row, polynomial coefficients constant first')
+    parser.add_argument('--timing', action='store_true', help='print the extraction time per frame')
+    args = parser.parse_args()
+
+    paths = sorted(path for pattern in args.files for path in glob.glob(pattern))
+    geometry = SlitGeometry(args.roi, args.bins, args.trace, args.curvature)
+    t_start = time.time()
+    frames, extract_s = extract_files(paths, args.out, geometry)
+    elapsed = time.time() - t_start
+    print(f'Extracted {frames} frames in {elapsed:.1f} s')
+    if args.timing:
+        print(f'{1e3 * extract_s / max(frames, 1):.2f} ms per frame for the extraction itself')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+'''
+Spool to FITS converter
+    Turns the raw spool segments written with OUTPUT_MODE = 'spool' into the
+    usual per-frame FITS files (same names and headers as OUTPUT_MODE =
+    'frames') or into one cube per burst (as OUTPUT_MODE = 'cube'). The work
+    is split over a pool of worker processes, each reading the spool through
+    its own memory map.
+
+Usage:
+    python spool_to_fits.py D:/eclipse/totality/*.spool --out D:/eclipse/fits
+    python spool_to_fits.py run_000.spool --out cubes --mode cube --workers 8
+'''
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from fits_cube import FitsCubeWriter, cube_filename
+from frame_pipeline import (DATE_OBS_FORMAT, FitsFrameEncoder, exposure_control_cards,
+                            frame_filename, frame_header_cards)
+from frame_spool import EXPOSURE_CONTROL_FIELDS, SpoolReader
+
+FRAMES_PER_TASK = 16
+
+
+def record_meta(entry):
+    '''
+    Frame metadata dict (as used by the frame pipeline) of an index record;
+        spools written before the header fields were indexed give the basic
+        keys only
+    '''
+    meta = {'seq': int(entry['seq']), 'exp_index': int(entry['exp_index']),
+            'frame_index': int(entry['frame_index']),
+            'burst_size': int(entry['burst_size']),
+            'exposure_us': float(entry['exposure_us']),
+            'timestamp': datetime.fromtimestamp(float(entry['timestamp']))}
+    if 'frame_id' not in entry.dtype.names:
+        return meta
+    if entry['frame_id'] >= 0:
+        meta['frame_id'] = int(entry['frame_id'])
+    if entry['camera_ns'] >= 0:
+        meta['camera_ns'] = int(entry['camera_ns'])
+    if not np.isnan(entry['received']):
+        meta['received'] = datetime.fromtimestamp(float(entry['received']))
+    if entry['decimation']:
+        meta['decimation'] = int(entry['decimation'])
+    if entry['phase']:
+        meta['phase'] = entry['phase'].decode(errors='ignore')
+    if not np.isnan(entry['ae_scale']):
+        meta['exposure_control'] = {
+            key: None if np.isnan(entry[field]) else float(entry[field])
+            for field, key in EXPOSURE_CONTROL_FIELDS}
+    return meta
+
+
+def convert_frames(spool_path, records, out_dir):
+    '''
+    Write the given spool records as per-frame FITS files
+    '''
+    spool = SpoolReader(spool_path)
+    encoder = FitsFrameEncoder(spool.info['height'], spool.info['width'])
+    for record in records:
+        meta = record_meta(spool.index[record])
+        path = os.path.join(out_dir, frame_filename(spool.prefix, meta))
+        encoder.write(path, spool.frames[record], frame_header_cards(meta))
+    return len(records)
+
+
+def convert_cube(parts, out_dir):
+    '''
+    Write one burst as a FITS cube. parts is a list of (spool path, records)
+        since a burst can straddle two spool segments.
+    '''
+    spools = [(SpoolReader(path), records) for path, records in parts]
+    metas = [(spool, record, record_meta(spool.index[record]))
+             for spool, records in spools for record in records]
+    metas.sort(key=lambda item: item[2]['frame_index'])
+    first_spool, _, first = metas[0]
+    burst_size = max(first['burst_size'], metas[-1][2]['frame_index'] + 1)
+    cards = [('DATE-OBS', first['timestamp'].strftime(DATE_OBS_FORMAT), 'first frame of the burst'),
+             ('EXPTIME', f"{first['exposure_us']/1000./1000.}"),
+             ('SEQ', first['seq'], 'sequence number'),
+             ('EXPNUM', first['exp_index'] + 1, 'exposure of the ladder')]
+    cards += exposure_control_cards(first)
+    cube = FitsCubeWriter(os.path.join(out_dir, cube_filename(first_spool.prefix, first)),
+                          burst_size, first_spool.info['height'], first_spool.info['width'],
+                          cards)
+    for spool, record, meta in metas:
+        cube.write_frame(meta['frame_index'], spool.frames[record],
+                         meta['timestamp'].strftime(DATE_OBS_FORMAT),
+                         meta['exposure_us'] / 1e6)
+    cube.close()
+    return len(metas)
+
+
+def plan_tasks(spool_paths, mode):
+    '''
+    (function, args) work items: chunks of frames, or one item per burst
+    '''
+    tasks = []
+    bursts = {}
+    for path in spool_paths:
+        spool = SpoolReader(path)
+        records = spool.records()
+        if mode == 'frames':
+            tasks.extend((convert_frames, (path, records[n:n + FRAMES_PER_TASK]))
+                         for n in range(0, len(records), FRAMES_PER_TASK))
+            continue
+        index = spool.index[records]
+        for key in set(zip(index['seq'].tolist(), index['exp_index'].tolist())):
+            burst = records[(index['seq'] == key[0]) & (index['exp_index'] == key[1])]
+            bursts.setdefault(key, []).append((path, burst))
+    tasks.extend((convert_cube, (parts,)) for _, parts in sorted(bursts.items()))
+    return tasks
+
+
+def convert_spools(spool_paths, out_dir, mode='frames', workers=None):
+    '''
+    Convert spool segments in parallel, returns the number of frames written
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    tasks = plan_tasks(spool_paths, mode)
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(func, *args, out_dir) for func, args in tasks]
+        return sum(future.result() for future in futures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('spools', nargs='+', help='spool segments (.spool files or globs)')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--mode', choices=['frames', 'cube'], default='frames')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    args = parser.parse_args()
+
+    spools = sorted(path for pattern in args.spools for path in glob.glob(pattern))
+    t_start = time.time()
+    frames = convert_spools(spools, args.out, args.mode, args.workers)
+    elapsed = time.time() - t_start
+    print(f'Converted {frames} frames from {len(spools)} spool segments in {elapsed:.1f} s '
+          f'({frames / max(elapsed, 1e-9):.1f} frames/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,421 @@
+'''
+Per-stage latency instrumentation
+    Times every stage of a frame on its way from the trigger to the disk:
+
+        arm_wait    waiting for TriggerArmed          (trigger loop)
+        trigger     TriggerSoftware.execute()         (trigger loop)
+        get_buffer  device.get_buffer()               (trigger loop / stream drain)
+        convert     buffer -> numpy: the copy into a frame pool slot, or the
+                    view/unpack when writing inline    (trigger loop / stream drain)
+        requeue     device.requeue_buffer()           (trigger loop / stream drain)
+        unpack      in-place unpacking of packed Mono12 (writer threads)
+        stats       frame statistics                   (writer threads)
+        header      FITS header build                  (writer threads)
+        writeto     writing the frame (for the 'frames' output the data
+                    conversion and file write, for the other outputs the
+                    whole sink)                         (writer threads)
+    Extra sinks are timed under their own stage names (hdr_merge, stack).
+
+    Every stage keeps an HDR-style latency histogram (log-linear buckets:
+    exact below 64 ns, then 32 sub-buckets per power of two, so any
+    percentile is within ~3% over nanoseconds to hours) in plain Python
+    lists, one set per thread so recording takes no lock. Recording a stage
+    is one perf_counter_ns() call and a bucket increment, under a
+    microsecond (bench_stage_timing.py measures it), and the trigger loop
+    records five stages per frame. With timing off NULL_TIMER takes the same
+    calls and does nothing. The histograms are
+    merged at the end of the run, printed, and dumped as JSON (summary plus
+    the non-empty buckets) or CSV (summary).
+
+    BurstProfiler profiles a single burst, with cProfile on the trigger
+    loop's thread or by sampling the stacks of every thread (trigger loop,
+    stream drain and writers) at a fixed interval.
+'''
+import cProfile
+import contextlib
+import csv
+import io
+import json
+import pstats
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, defaultdict
+
+STAGES = ('arm_wait', 'trigger', 'get_buffer', 'convert', 'requeue', 'unpack', 'stats',
+          'header', 'writeto')
+PERCENTILES = (50, 90, 99, 99.9)
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+PROFILE_MODES = ('cprofile', 'sample')
+# time.perf_counter_ns() is Python 3.7+, the scripts also run on 3.6
+perf_counter_ns = getattr(time, 'perf_counter_ns', lambda: int(time.perf_counter() * 1e9))
+
+
+def bucket_index(ns):
+    '''
+    Histogram bucket of a duration in nanoseconds
+    '''
+    if ns < 2 * SUB_BUCKETS:
+        return ns if ns > 0 else 0
+    shift = ns.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift + 1) << SUB_BUCKET_BITS | (ns >> shift) & (SUB_BUCKETS - 1)
+
+
+def bucket_bounds(index):
+    '''
+    [low, high) in nanoseconds of a histogram bucket
+    '''
+    if index < 2 * SUB_BUCKETS:
+        return index, index + 1
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    low = (SUB_BUCKETS + (index & (SUB_BUCKETS - 1))) << shift
+    return low, low + (1 << shift)
+
+
+class LatencyHistogram:
+    '''
+    Log-linear histogram of durations in nanoseconds, with the total, min
+        and max kept exactly
+    '''
+    __slots__ = ('counts', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (64 * SUB_BUCKETS)
+        self.total = 0
+        self.min = 1 << 63
+        self.max = 0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def record(self, ns):
+        # bucket_index() inlined (SUB_BUCKET_BITS = 5): this runs for every
+        # stage of every frame
+        if ns < 64:
+            index = ns if ns > 0 else 0
+        else:
+            shift = ns.bit_length() - 6
+            index = (shift + 1) << 5 | (ns >> shift) & 31
+        self.counts[index] += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+        if ns < self.min:
+            self.min = ns
+
+    def merge(self, other):
+        for index, n in enumerate(other.counts):
+            if n:
+                self.counts[index] += n
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.min = min(self.min, other.min)
+        return self
+
+    def percentile(self, q):
+        '''
+        Duration (ns, bucket midpoint, clipped to the exact min/max) below
+            which q percent of the samples fall
+        '''
+        count = self.count
+        if not count:
+            return float('nan')
+        rank = q / 100. * count
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                low, high = bucket_bounds(index)
+                return min(max((low + high - 1) / 2., self.min), self.max)
+        return float(self.max)
+
+    def buckets(self):
+        '''
+        Non-empty buckets as [low_ns, high_ns, count]
+        '''
+        return [[*bucket_bounds(index), n] for index, n in enumerate(self.counts) if n]
+
+    def summary(self):
+        count = self.count
+        if not count:
+            return {'count': 0}
+        s = {'count': count, 'total_s': self.total / 1e9,
+             'mean_us': self.total / count / 1e3,
+             'min_us': self.min / 1e3, 'max_us': self.max / 1e3}
+        for q in PERCENTILES:
+            s[f'p{q:g}_us'] = self.percentile(q) / 1e3
+        return s
+
+
+class StageTimer:
+    '''
+    Per-stage latency histograms, recorded from any thread. Use as
+
+        t = timer.now()
+        image = device.get_buffer()
+        t = timer.mark('get_buffer', t)
+        ...
+        timer.mark('requeue', t)
+
+        mark() records the time since t under the stage and returns the
+        current time, so consecutive stages chain without extra clock reads.
+    '''
+    enabled = True
+
+    def __init__(self):
+        self._local = threading.local()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    now = staticmethod(perf_counter_ns)
+
+    def _histograms(self):
+        try:
+            return self._local.histograms
+        except AttributeError:
+            histograms = self._local.histograms = defaultdict(LatencyHistogram)
+            with self._lock:
+                self._threads.append(histograms)
+            return histograms
+
+    def add(self, stage, ns):
+        self._histograms()[stage].record(ns)
+
+    def add_seconds(self, stage, seconds):
+        self._histograms()[stage].record(int(seconds * 1e9))
+
+    def mark(self, stage, t_start):
+        t = perf_counter_ns()
+        try:
+            histogram = self._local.histograms[stage]
+        except AttributeError:
+            histogram = self._histograms()[stage]
+        # LatencyHistogram.record() inlined, one call less per stage
+        ns = t - t_start
+        if ns < 64:
+            index = ns if ns > 0 else 0
+        else:
+            shift = ns.bit_length() - 6
+            index = (shift + 1) << 5 | (ns >> shift) & 31
+        histogram.counts[index] += 1
+        histogram.total += ns
+        if ns > histogram.max:
+            histogram.max = ns
+        if ns < histogram.min:
+            histogram.min = ns
+        return t
+
+    def histograms(self):
+        '''
+        The histograms of all threads merged, stages in frame order
+        '''
+        merged = {}
+        with self._lock:
+            threads = list(self._threads)
+        for histograms in threads:
+            for stage, histogram in list(histograms.items()):
+                merged.setdefault(stage, LatencyHistogram()).merge(histogram)
+        order = {stage: n for n, stage in enumerate(STAGES)}
+        return dict(sorted(merged.items(), key=lambda item: (order.get(item[0], len(order)),
+                                                             item[0])))
+
+    def summary(self):
+        return {stage: histogram.summary() for stage, histogram in self.histograms().items()}
+
+    def report(self):
+        summary = self.summary()
+        if not summary:
+            return 'Stage timing: no frames'
+        lines = [f"{'stage':<12}{'count':>7}{'mean':>10}"
+                 + ''.join(f'{f"p{q:g}":>10}' for q in PERCENTILES) + f"{'max':>10}{'total s':>9}"]
+        for stage, s in summary.items():
+            lines.append(f"{stage:<12}{s['count']:>7}{s['mean_us']:>10.1f}"
+                         + ''.join(f"{s[f'p{q:g}_us']:>10.1f}" for q in PERCENTILES)
+                         + f"{s['max_us']:>10.1f}{s['total_s']:>9.2f}")
+        lines.append('durations in microseconds')
+        return '\n'.join(lines)
+
+    def dump_json(self, path):
+        with open(path, 'w') as f:
+            json.dump({'stages': self.summary(),
+                       'histograms': {stage: histogram.buckets()
+                                      for stage, histogram in self.histograms().items()}},
+                      f, indent=1)
+
+    def dump_csv(self, path):
+        fields = (['stage', 'count', 'mean_us', 'min_us'] + [f'p{q:g}_us' for q in PERCENTILES]
+                  + ['max_us', 'total_s'])
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fields)
+            writer.writeheader()
+            for stage, s in self.summary().items():
+                writer.writerow(dict(s, stage=stage))
+
+    def dump(self, path_base):
+        '''
+        Write <path_base>.json and <path_base>.csv
+        '''
+        self.dump_json(path_base + '.json')
+        self.dump_csv(path_base + '.csv')
+
+
+class NullStageTimer:
+    '''
+    Stand-in when timing is off: same calls, nothing recorded
+    '''
+    enabled = False
+
+    def now(self):
+        return 0
+
+    def add(self, stage, ns):
+        pass
+
+    def add_seconds(self, stage, seconds):
+        pass
+
+    def mark(self, stage, t_start):
+        return 0
+
+    def report(self):
+        return 'Stage timing off'
+
+    def dump(self, path_base):
+        pass
+
+
+NULL_TIMER = NullStageTimer()
+
+
+def make_stage_timer(enabled):
+    '''
+    Timer for a STAGE_TIMING setting
+    '''
+    return StageTimer() if enabled else NULL_TIMER
+
+
+class StackSampler:
+    '''
+    Samples the Python stack of every thread every interval seconds and
+        counts, per thread, the functions on top of the stack (self time)
+        and on the stack at all (inclusive time)
+    '''
+
+    def __init__(self, interval=1e-3):
+        self.interval = interval
+        self.samples = 0
+        self.leaf = defaultdict(Counter)
+        self.inclusive = defaultdict(Counter)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                name = names.get(ident, str(ident))
+                stack = traceback.extract_stack(frame)
+                functions = [f'{entry.name} ({entry.filename.rsplit("/", 1)[-1]}:{entry.lineno})'
+                             for entry in stack]
+                if not functions:
+                    continue
+                self.leaf[name][functions[-1]] += 1
+                self.inclusive[name].update(set(functions))
+            self.samples += 1
+
+    def report(self, top=15):
+        out = [f'{self.samples} samples every {self.interval * 1e3:g} ms']
+        for name in sorted(self.leaf):
+            total = sum(self.leaf[name].values())
+            out.append(f'\nthread {name}: {total} samples')
+            out.append('  self%   incl%  function')
+            for function, n in self.leaf[name].most_common(top):
+                out.append(f'{100. * n / total:7.1f} {100. * self.inclusive[name][function] / total:7.1f}'
+                           f'  {function}')
+        return '\n'.join(out)
+
+
+class BurstProfiler:
+    '''
+    Profiles the one burst (seq, exposure number) given, e.g. (0, 1) for the
+        frames named seq0_exp1. The loop calls begin(seq, j + 1) before every
+        burst and end() after it (end() is safe to call again, e.g. from a
+        finally); exposure None (a sequencer burst, all exposures at once)
+        matches any exposure number. mode 'cprofile' profiles the calling
+        thread and writes <path_base>.prof (pstats) and <path_base>.txt;
+        'sample' samples all threads and writes <path_base>.txt.
+    '''
+
+    def __init__(self, target, path_base, mode='cprofile', interval=1e-3, top=30):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f'Unknown profile mode {mode!r}, expected one of {PROFILE_MODES}')
+        self.target = tuple(target) if target is not None else None
+        self.path_base = path_base
+        self.mode = mode
+        self.interval = interval
+        self.top = top
+        self.written = None
+        self._active = None
+
+    def matches(self, seq, exposure):
+        if self.target is None or self.written is not None or self._active is not None:
+            return False
+        return seq == self.target[0] and (exposure is None or exposure == self.target[1])
+
+    def begin(self, seq, exposure=None):
+        if not self.matches(seq, exposure):
+            return
+        if self.mode == 'cprofile':
+            self._active = cProfile.Profile()
+            self._active.enable()
+        else:
+            self._active = StackSampler(self.interval).start()
+
+    def end(self):
+        active, self._active = self._active, None
+        if active is None:
+            return
+        if self.mode == 'cprofile':
+            active.disable()
+            active.dump_stats(self.path_base + '.prof')
+            text = io.StringIO()
+            pstats.Stats(active, stream=text).sort_stats('cumulative').print_stats(self.top)
+            self._write(text.getvalue())
+        else:
+            active.stop()
+            self._write(active.report())
+
+    @contextlib.contextmanager
+    def burst(self, seq, exposure=None):
+        self.begin(seq, exposure)
+        try:
+            yield
+        finally:
+            self.end()
+
+    def _write(self, text):
+        self.written = self.path_base + '.txt'
+        with open(self.written, 'w') as f:
+            f.write(f'Profile of seq{self.target[0]} exp{self.target[1]} ({self.mode})\n')
+            f.write(text)
+
+    def report(self):
+        if self.target is None:
+            return 'Profiling off'
+        if self.written is None:
+            return f'Profiled burst seq{self.target[0]} exp{self.target[1]} was not reached'
+        return f'Profile of seq{self.target[0]} exp{self.target[1]} written to {self.written}'
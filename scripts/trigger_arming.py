@@ -0,0 +1,206 @@
+'''
+Software trigger arming strategies
+    Before each software trigger the scripts wait for TriggerArmed. Polling it
+    in a tight loop pins a core and, through the GIL, slows the writer threads
+    running next to the trigger loop. The strategies here trade a little
+    trigger latency for much less CPU:
+
+    spin        poll TriggerArmed back to back (the original loop)
+    backoff     spin briefly, then yield, then sleep with a growing interval
+                capped relative to the typical wait, so short waits stay tight
+    predictive  sleep until shortly before the moment the trigger should arm
+                (last trigger + max(exposure, 1 / frame rate)), then poll
+                with backoff. The wake-up margin adapts to how late sleeps
+                return (coarse timers on Windows).
+
+    Every strategy records per-frame wait time and number of TriggerArmed
+    polls; report() summarises them. With a stage timer (see stage_timing.py)
+    the wait and the TriggerSoftware.execute() call are also recorded as the
+    arm_wait and trigger stages.
+'''
+import time
+
+import numpy as np
+
+from stage_timing import NULL_TIMER
+
+
+class ArmingStrategy:
+    '''
+    Base class: tight polling plus the wait/poll instrumentation
+    '''
+    name = 'spin'
+    timer = NULL_TIMER
+
+    def __init__(self):
+        self.wait_times = []
+        self.poll_counts = []
+
+    def expect(self, exposure_us, frame_rate, latched=False):
+        '''
+        Tell the strategy the exposure and frame rate of the next frames.
+            latched: the exposure applies to the very next frame (camera
+            sequencer) instead of one frame late.
+        '''
+
+    def wait(self, nodes):
+        '''
+        Block until TriggerArmed, return the number of polls
+        '''
+        polls = 1
+        while not bool(nodes['TriggerArmed'].value):
+            polls += 1
+        return polls
+
+    def trigger(self, nodes):
+        '''
+        Wait for the trigger to arm, then execute it
+        '''
+        t_start = time.perf_counter()
+        polls = self.wait(nodes)
+        t_armed = time.perf_counter()
+        nodes['TriggerSoftware'].execute()
+        self.timer.add_seconds('arm_wait', t_armed - t_start)
+        self.timer.add_seconds('trigger', time.perf_counter() - t_armed)
+        self.wait_times.append(t_armed - t_start)
+        self.poll_counts.append(polls)
+        self.triggered(t_armed)
+
+    def triggered(self, t_trigger):
+        pass
+
+    def summary(self):
+        if not self.wait_times:
+            return {'strategy': self.name, 'frames': 0}
+        wait_ms = np.asarray(self.wait_times) * 1000.
+        polls = np.asarray(self.poll_counts)
+        return {'strategy': self.name, 'frames': len(wait_ms),
+                'wait_ms_mean': float(wait_ms.mean()),
+                'wait_ms_p50': float(np.percentile(wait_ms, 50)),
+                'wait_ms_p99': float(np.percentile(wait_ms, 99)),
+                'wait_ms_max': float(wait_ms.max()),
+                'polls_mean': float(polls.mean()), 'polls_max': int(polls.max())}
+
+    def report(self):
+        s = self.summary()
+        if not s['frames']:
+            return f"Arm wait [{self.name}]: no frames"
+        return (f"Arm wait [{self.name}]: {s['frames']} frames, mean {s['wait_ms_mean']:.2f} ms, "
+                f"p50 {s['wait_ms_p50']:.2f} ms, p99 {s['wait_ms_p99']:.2f} ms, "
+                f"polls mean {s['polls_mean']:.1f} max {s['polls_max']}")
+
+
+SpinArming = ArmingStrategy
+
+
+class BackoffArming(ArmingStrategy):
+    '''
+    Spin for spin_polls, yield for yield_polls, then sleep with an interval
+        that doubles from min_sleep up to a cap of a fraction of the typical
+        (moving average) wait, and never more than max_sleep
+    '''
+    name = 'backoff'
+
+    def __init__(self, spin_polls=20, yield_polls=20, min_sleep=50e-6, max_sleep=2e-3,
+                 cap_fraction=0.1):
+        super().__init__()
+        self.spin_polls = spin_polls
+        self.yield_polls = yield_polls
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.cap_fraction = cap_fraction
+        self.typical_wait = max_sleep
+
+    def wait(self, nodes):
+        t_start = time.perf_counter()
+        polls = 0
+        sleep = self.min_sleep
+        cap = min(self.max_sleep, max(self.min_sleep, self.cap_fraction * self.typical_wait))
+        while True:
+            polls += 1
+            if bool(nodes['TriggerArmed'].value):
+                break
+            if polls <= self.spin_polls:
+                continue
+            if polls <= self.spin_polls + self.yield_polls:
+                time.sleep(0)
+                continue
+            time.sleep(sleep)
+            sleep = min(2 * sleep, cap)
+        self.typical_wait = 0.8 * self.typical_wait + 0.2 * (time.perf_counter() - t_start)
+        return polls
+
+
+class PredictiveArming(BackoffArming):
+    '''
+    Sleep until margin before the predicted arm time, then back off as above.
+        The arm time is predicted from the last trigger, the frame rate and the
+        exposure. A new ExposureTime only applies one frame later, so the
+        longest exposure of the last two triggers and the expected one is used,
+        unless exposures are latched per frame by the camera sequencer.
+    '''
+    name = 'predictive'
+
+    def __init__(self, margin=1e-3, overhead_us=50., **kwargs):
+        super().__init__(**kwargs)
+        self.margin = margin
+        self.min_margin = margin
+        self.overhead_us = overhead_us
+        self.exposure_us = None
+        self.frame_rate = None
+        self.last_trigger = None
+        self.recent_exposures = []
+        self.latched = False
+
+    def expect(self, exposure_us, frame_rate, latched=False):
+        self.exposure_us = exposure_us
+        self.frame_rate = frame_rate
+        self.latched = latched
+
+    def predicted_arm_time(self):
+        if self.last_trigger is None or self.exposure_us is None:
+            return None
+        if self.latched:
+            # the last triggered frame was taken with the exposure expected for it
+            exposure_us = self.recent_exposures[-1]
+        else:
+            exposure_us = max([self.exposure_us] + self.recent_exposures)
+        period = (exposure_us + self.overhead_us) * 1e-6
+        if self.frame_rate:
+            period = max(period, 1. / self.frame_rate)
+        return self.last_trigger + period
+
+    def wait(self, nodes):
+        armed_at = self.predicted_arm_time()
+        if armed_at is not None:
+            wake = armed_at - self.margin
+            delay = wake - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+                # widen the margin when sleeps return late (timer granularity)
+                late = time.perf_counter() - wake
+                self.margin = max(self.min_margin, 0.9 * self.margin + 0.1 * 2 * late)
+        return super().wait(nodes)
+
+    def triggered(self, t_trigger):
+        self.last_trigger = t_trigger
+        self.recent_exposures = self.recent_exposures[-1:] + [self.exposure_us or 0.]
+
+
+ARMING_STRATEGIES = {'spin': SpinArming, 'backoff': BackoffArming,
+                     'predictive': PredictiveArming}
+
+
+def make_arming(name, timer=None):
+    '''
+    Strategy for an ARMING_STRATEGY setting, recording its stages into timer
+        when given
+    '''
+    try:
+        arming = ARMING_STRATEGIES[name]()
+    except KeyError:
+        raise ValueError(f'Unknown arming strategy {name!r}, expected one of '
+                         f'{sorted(ARMING_STRATEGIES)}') from None
+    if timer is not None:
+        arming.timer = timer
+    return arming
@@ -0,0 +1,21 @@
+'''
+The scripts are plain files, not a package: put scripts/ on the import path,
+and give the tests the simulated camera (arena_sim.py) in place of arena_api
+'''
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'scripts'))
+
+import arena_sim  # noqa: E402
+
+
+@pytest.fixture
+def camera():
+    '''
+    A simulated camera with frames small enough for quick end-to-end runs
+    '''
+    return arena_sim.install(width=256, height=192)
@@ -0,0 +1,102 @@
+import glob
+import os
+import time
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+import bench_acquisition
+import frame_pipeline
+
+NUM_SEQ = 3
+NUM_IMAGES = 10
+EXPOSURES = [5000., 2000., 1000.]
+
+
+class SlowSink:
+    '''
+    A sink slower than the camera, so the writer pool fills up
+    '''
+    stage = 'slow'
+
+    def write(self, frame, meta):
+        time.sleep(0.2)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def slow_run(camera, tmp_path, monkeypatch):
+    '''
+    Runs the totality script with a slow sink and returns the output files
+        as they were when the pipeline started closing its sinks, and the
+        bursts the pipeline reported complete
+    '''
+    closing, completed = [], []
+    start = frame_pipeline.start_frame_pipeline
+
+    def start_slow(*args, **kwargs):
+        kwargs['extra_sinks'] = list(kwargs.get('extra_sinks', ())) + [SlowSink()]
+        report = kwargs['on_burst_complete']
+
+        def on_burst_complete(seq, exp_index, summary):
+            completed.append((seq, exp_index))
+            report(seq, exp_index, summary)
+
+        kwargs['on_burst_complete'] = on_burst_complete
+        pipeline = start(*args, **kwargs)
+        for sink in pipeline.sinks:
+            sink.close = closing_first(sink.close)
+        return pipeline
+
+    def closing_first(close):
+        def wrapped():
+            if not closing:
+                closing.append(sorted(os.listdir(tmp_path)))
+            close()
+        return wrapped
+
+    monkeypatch.setattr(frame_pipeline, 'start_frame_pipeline', start_slow)
+
+    def run(policy, output_mode='cube'):
+        bench_acquisition.run_script('totality', str(tmp_path), NUM_SEQ, NUM_IMAGES, EXPOSURES,
+                                     settings={'BACKPRESSURE': policy, 'OUTPUT_MODE': output_mode,
+                                               'STACK_METHOD': 'mean', 'HDR_MERGE': True})
+        return closing[0], completed, tmp_path
+    return run
+
+
+@pytest.mark.parametrize('policy', ['block', 'drop', 'decimate'])
+def test_bursts_complete_under_backpressure(slow_run, policy):
+    files, completed, out_dir = slow_run(policy)
+    bursts = NUM_SEQ * len(EXPOSURES)
+    # every burst and sequence was finished by its frames, not by close()
+    assert sorted(completed) == [(seq, exp) for seq in range(NUM_SEQ)
+                                 for exp in range(len(EXPOSURES))]
+    assert len([f for f in files if f.endswith('_cube.fits')]) == bursts
+    assert len([f for f in files if f.endswith('_stack.fits')]) == bursts
+    assert len([f for f in files if f.endswith('_hdr.fits')]) == NUM_SEQ
+    planes = filled = 0
+    for path in glob.glob(str(out_dir / '*_cube.fits')):
+        with fits.open(path) as hdul:
+            planes += hdul['FRAMES'].data['FRAME'].size
+            filled += np.count_nonzero(hdul['FRAMES'].data['FILLED'])
+    if policy == 'block':
+        assert planes == filled == bursts * NUM_IMAGES
+    else:
+        # dropped and decimated frames leave their plane unfilled
+        assert planes == bursts * NUM_IMAGES and 0 < filled < planes
+
+
+def test_decimated_frames_keep_their_index(slow_run):
+    files, completed, out_dir = slow_run('decimate', 'frames')
+    decimated = 0
+    for path in glob.glob(str(out_dir / '*_i[0-9][0-9].fits')):
+        index = int(path[-len('00.fits'):-len('.fits')])
+        assert index < NUM_IMAGES
+        level = fits.getheader(path).get('DECIMATE', 1)
+        assert index % level == 0
+        decimated += level > 1
+    assert decimated
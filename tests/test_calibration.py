@@ -0,0 +1,116 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from calibration import Calibration, MasterCache, read_keys, reduce_frames
+from fits_cube import FitsCubeWriter
+from frame_pipeline import FitsFrameEncoder, frame_filename, frame_header_cards
+
+HEIGHT, WIDTH = 24, 40
+EXPOSURE_US = 1000.
+DARK = 100
+
+
+def write_frames(directory, prefix, frames):
+    os.makedirs(directory, exist_ok=True)
+    encoder = FitsFrameEncoder(HEIGHT, WIDTH)
+    paths = []
+    for n, frame in enumerate(frames):
+        meta = {'seq': 0, 'exp_index': 0, 'frame_index': n, 'burst_size': len(frames),
+                'exposure_us': EXPOSURE_US, 'timestamp': datetime(2024, 4, 8, 18, 33, 51, n)}
+        paths.append(os.path.join(directory, frame_filename(prefix, meta)))
+        encoder.write(paths[-1], frame, frame_header_cards(meta))
+    return paths
+
+
+def write_cube(path, frames, filled):
+    '''
+    A burst cube as fits_cube.py writes it; planes not filled stay zero
+    '''
+    cards = [('DATE-OBS', '2024-04-08Z18:33:51.000000'), ('EXPTIME', f'{EXPOSURE_US / 1e6}'),
+             ('SEQ', 0), ('EXPNUM', 1)]
+    cube = FitsCubeWriter(path, len(frames), HEIGHT, WIDTH, cards)
+    for n, frame in enumerate(frames):
+        if filled[n]:
+            cube.write_frame(n, frame, '2024-04-08Z18:33:51.000000', EXPOSURE_US / 1e6)
+    cube.close()
+    return path
+
+
+@pytest.fixture
+def night(tmp_path):
+    '''
+    Noise-free darks, flats and science signal, so the masters and the
+        reduced frames can be checked exactly
+    '''
+    y, x = np.mgrid[0:HEIGHT, 0:WIDTH]
+    flat = 1. - 0.3 * ((y / HEIGHT - 0.5) ** 2 + (x / WIDTH - 0.5) ** 2)
+    flat_frame = np.rint(DARK + 2000. * flat).astype(np.uint16)
+    signals = [np.rint(500. + 10. * n + 3. * x).astype(np.uint16) for n in range(3)]
+    return {'dir': tmp_path,
+            'darks': write_frames(str(tmp_path / 'darks'), 'dark',
+                                  [np.full((HEIGHT, WIDTH), DARK, np.uint16)] * 3),
+            'flats': write_frames(str(tmp_path / 'flats'), 'flat', [flat_frame] * 3),
+            'raw': [signal + DARK for signal in signals]}
+
+
+def reduce(night, science, workers=2):
+    with ProcessPoolExecutor(workers) as executor:
+        calibration = Calibration.build(MasterCache(str(night['dir'] / 'cache')), executor,
+                                        workers, darks=night['darks'], flats=night['flats'])
+        return reduce_frames(science, calibration, str(night['dir'] / 'reduced'), executor)
+
+
+def test_frames_and_cubes_reduced_alike(night):
+    frames = write_frames(str(night['dir'] / 'science'), 'frame', night['raw'])
+    cube = write_cube(str(night['dir'] / 'science' / 'burst_cube.fits'), night['raw'],
+                      [True, False, True])
+    reduced, missing = reduce(night, frames + [cube])
+    assert reduced == 3 + 2 and missing == {'dark': 0, 'flat': 0}
+
+    out = night['dir'] / 'reduced'
+    planes = []
+    for path in frames:
+        with fits.open(out / (os.path.basename(path)[:-len('.fits')] + '_cal.fits')) as hdul:
+            assert hdul[0].header['NAXIS'] == 2
+            planes.append(hdul[0].data)
+    # (raw - dark) / flat, the flat normalised to a median of 1
+    flat = fits.getdata(night['flats'][0]).astype(np.float32) - DARK
+    flat /= np.median(flat[::16, ::16])
+    for plane, raw in zip(planes, night['raw']):
+        np.testing.assert_allclose(plane, (raw.astype(np.float32) - DARK) / flat, rtol=1e-5)
+
+    with fits.open(out / 'burst_cube_cal.fits') as hdul:
+        header = hdul[0].header
+        assert (header['NAXIS'], header['NAXIS3']) == (3, 3)
+        assert header['SEQ'] == 0 and header['EXPNUM'] == 1
+        data = hdul[0].data
+        assert data.shape == (3, HEIGHT, WIDTH)
+        np.testing.assert_array_equal(data[0], planes[0])
+        assert np.isnan(data[1]).all()
+        np.testing.assert_array_equal(data[2], planes[2])
+        assert list(hdul['FRAMES'].data['FILLED']) == [True, False, True]
+
+
+def test_cube_planes_count_in_masters(night):
+    # the unfilled (zero) plane must not pull the median down
+    darks = [np.full((HEIGHT, WIDTH), level, np.uint16) for level in (90, 100, 110, 0)]
+    night['darks'] = [write_cube(str(night['dir'] / 'dark_cube.fits'), darks,
+                                 [True, True, True, False])]
+    science = write_frames(str(night['dir'] / 'science'), 'frame', night['raw'][:1])
+    assert reduce(night, science)[0] == 1
+    cache = MasterCache(str(night['dir'] / 'cache'))
+    masters = {entry['kind']: name for name, entry in cache.index.items()}
+    master = np.load(os.path.join(cache.directory, masters['dark'] + '.npy'))
+    np.testing.assert_array_equal(master, DARK)
+
+
+def test_other_dimensions_refused(tmp_path):
+    path = str(tmp_path / 'row.fits')
+    fits.PrimaryHDU(np.zeros(WIDTH, np.int16)).writeto(path)
+    with pytest.raises(ValueError, match='NAXIS = 1'):
+        read_keys([path])
@@ -0,0 +1,60 @@
+import glob
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from bench_doppler import synthetic_spectra, write_tables
+from doppler_fit import (CONTINUUM_ORDER, DISPERSION, LINE, WAVELENGTH0, DopplerModel,
+                         column_wavelengths, fit_files)
+
+COLUMNS = 2448
+LEVEL = 20000.
+
+
+@pytest.fixture(scope='module')
+def fitted():
+    spectra, velocity, temperature = synthetic_spectra(128, COLUMNS, LEVEL,
+                                                       np.random.default_rng(0))
+    model = DopplerModel(column_wavelengths(COLUMNS))
+    return spectra, velocity, temperature, model, model.fit(spectra)
+
+
+@pytest.mark.parametrize('name', ['VELOCITY', 'TEMPERATURE'])
+def test_parameters_recovered(fitted, name):
+    _, velocity, temperature, _, maps = fitted
+    truth = {'VELOCITY': velocity, 'TEMPERATURE': temperature}[name]
+    assert maps['CONVERGED'].all()
+    residual = maps[name] - truth
+    error = maps[name + '_ERR']
+    # no bias beyond the scatter of the mean, and errors that match the scatter
+    assert abs(residual.mean()) < 4 * residual.std() / np.sqrt(residual.size)
+    assert 0.75 < np.std(residual / error) < 1.3
+
+
+def test_batch_size_does_not_change_the_fit(fitted):
+    spectra, _, _, model, maps = fitted
+    single = model.fit(spectra[:16], batch=1)
+    for name in ('VELOCITY', 'TEMPERATURE'):
+        np.testing.assert_allclose(single[name], maps[name][:16],
+                                   atol=1e-3 * np.abs(maps[name + '_ERR'][:16]).max())
+
+
+def test_fit_files_writes_maps_for_every_table(tmp_path):
+    tables, out_dir = tmp_path / 'spectra', tmp_path / 'doppler'
+    tables.mkdir()
+    write_tables(str(tables), 2, 3, 2, COLUMNS, LEVEL, np.random.default_rng(1))
+    calibration = {'wavelength0': WAVELENGTH0, 'dispersion': DISPERSION, 'line': LINE,
+                   'order': CONTINUUM_ORDER}
+    fitted, _ = fit_files(sorted(glob.glob(str(tables / '*_spectra.fits'))), str(out_dir),
+                          calibration, workers=1)
+    assert fitted == 2 * 3 * 2
+    paths = sorted(glob.glob(str(out_dir / '*_doppler.fits')))
+    assert len(paths) == 2
+    for seq, path in enumerate(paths):
+        with fits.open(path) as hdul:
+            assert hdul[0].header['SEQ'] == seq
+            assert hdul['VELOCITY'].data.shape == (3, 2)
+            assert hdul['CONVERGED'].data.all()
+            # the synthetic velocities are within +-300 km/s
+            assert np.all(np.abs(hdul['VELOCITY'].data) <= 350.)
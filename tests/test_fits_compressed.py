@@ -0,0 +1,84 @@
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+import bench_acquisition
+from fits_compressed import (CompressedFitsSink, compressed_filename, image_hdu,
+                             write_compressed_frame)
+from frame_pipeline import FitsFrameEncoder, frame_filename, frame_header_cards
+
+LOSSLESS = ('RICE_1', 'GZIP_1', 'GZIP_2')
+
+
+def frame_meta(frame_index=0):
+    return {'seq': 1, 'exp_index': 2, 'frame_index': frame_index, 'burst_size': 3,
+            'exposure_us': 2500., 'timestamp': datetime(2024, 4, 8, 18, 33, 51, 5 + frame_index),
+            'frame_id': 77 + frame_index, 'camera_ns': 123456789012, 'phase': 'totality',
+            'received': datetime(2024, 4, 8, 18, 33, 51, 9000), 'decimation': 2,
+            'exposure_control': {'scale': 2., 'step': 1.5, 'peak': 2800., 'saturated': 0.}}
+
+
+def random_frame(seed=0):
+    frame = np.random.default_rng(seed).integers(0, 4096, (70, 96), dtype=np.uint16)
+    frame[0, :2] = (0, 65535)
+    return frame
+
+
+def assert_same_frame(plain_path, packed_path, cards):
+    with fits.open(plain_path) as plain, fits.open(packed_path) as packed:
+        hdu = image_hdu(packed)
+        assert hdu is not packed[0]
+        assert hdu.data.dtype == plain[0].data.dtype
+        np.testing.assert_array_equal(hdu.data, plain[0].data)
+        for key, *_ in cards:
+            assert hdu.header[key] == plain[0].header[key], key
+
+
+@pytest.mark.parametrize('compression', LOSSLESS)
+def test_compressed_frame_matches_the_encoder(tmp_path, compression):
+    frame, cards = random_frame(), frame_header_cards(frame_meta())
+    FitsFrameEncoder(*frame.shape).write(tmp_path / 'plain.fits', frame, cards)
+    write_compressed_frame(str(tmp_path / 'packed.fits.fz'), frame, cards, compression,
+                           tile_rows=16)
+    assert_same_frame(tmp_path / 'plain.fits', tmp_path / 'packed.fits.fz', cards)
+
+
+def test_sink_writes_from_the_process_pool(tmp_path):
+    encoder = FitsFrameEncoder(70, 96)
+    with ProcessPoolExecutor(1) as pool:
+        sink = CompressedFitsSink(str(tmp_path), 'eclipse', pool)
+        for n in range(3):
+            frame, meta = random_frame(n), frame_meta(n)
+            encoder.write(tmp_path / frame_filename('eclipse', meta), frame,
+                          frame_header_cards(meta))
+            sink.write(frame, meta)
+            # the sink works on its own copy of the frame pool slot
+            frame[:] = 0
+        sink.close()
+    assert (sink.frames_written, sink.failed_frames) == (3, 0)
+    for n in range(3):
+        meta = frame_meta(n)
+        assert_same_frame(tmp_path / frame_filename('eclipse', meta),
+                          tmp_path / compressed_filename('eclipse', meta),
+                          frame_header_cards(meta))
+
+
+def test_rice_run_writes_the_frames_of_a_plain_run(camera, tmp_path):
+    frames = {}
+    for mode, pattern in (('frames', '*.fits'), ('rice', '*.fits.fz')):
+        out_dir = str(tmp_path / mode)
+        os.makedirs(out_dir)
+        result = bench_acquisition.run_script('totality', out_dir, 1, 2,
+                                              settings={'OUTPUT_MODE': mode})
+        assert result['frames_written'] == 6
+        frames[mode] = sorted(glob.glob(os.path.join(out_dir, pattern)))
+    assert len(frames['frames']) == len(frames['rice']) == 6
+    for plain, packed in zip(frames['frames'], frames['rice']):
+        with fits.open(plain) as a, fits.open(packed) as b:
+            np.testing.assert_array_equal(image_hdu(b).data, a[0].data)
+            assert image_hdu(b).header['EXPTIME'] == a[0].header['EXPTIME']
@@ -0,0 +1,50 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from frame_pipeline import FitsFrameEncoder, frame_header_cards, write_fits_frame
+
+
+def frame_meta(**meta):
+    base = {'seq': 2, 'exp_index': 1, 'frame_index': 3, 'burst_size': 10, 'exposure_us': 8000.,
+            'timestamp': datetime(2024, 4, 8, 18, 33, 51, 123456)}
+    base.update(meta)
+    return base
+
+
+FULL_META = frame_meta(frame_id=1234, camera_ns=98765432101234,
+                       received=datetime(2024, 4, 8, 18, 33, 51, 140001), phase='totality',
+                       decimation=2,
+                       exposure_control={'scale': 0.5, 'step': 0.25, 'peak': 3012.5,
+                                         'saturated': 2e-4})
+
+
+@pytest.mark.parametrize('meta', [frame_meta(), FULL_META], ids=['basic', 'all cards'])
+def test_encoder_writes_the_bytes_of_primary_hdu_writeto(tmp_path, meta):
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 4096, (48, 70), dtype=np.uint16)
+    # the extremes of uint16 go through the BZERO offset too
+    frame[0, :2] = (0, 65535)
+    cards = frame_header_cards(meta)
+    FitsFrameEncoder(*frame.shape).write(tmp_path / 'encoder.fits', frame, cards)
+    write_fits_frame(tmp_path / 'hdu.fits', frame, cards)
+    assert (tmp_path / 'encoder.fits').read_bytes() == (tmp_path / 'hdu.fits').read_bytes()
+
+
+def test_encoder_reused_for_every_frame(tmp_path):
+    encoder = FitsFrameEncoder(16, 24)
+    rng = np.random.default_rng(1)
+    frames = [rng.integers(0, 4096, (16, 24), dtype=np.uint16) for _ in range(3)]
+    originals = [frame.copy() for frame in frames]
+    header = encoder.header_bytes(frame_header_cards(frame_meta()))
+    for n, frame in enumerate(frames):
+        encoder.write(tmp_path / f'{n}.fits', frame, None, header)
+    for n, frame in enumerate(originals):
+        with fits.open(tmp_path / f'{n}.fits') as hdul:
+            np.testing.assert_array_equal(hdul[0].data, frame)
+            assert hdul[0].header['DATE-OBS'] == '2024-04-08Z18:33:51.123456'
+    # the frames are encoded through the scratch frame, not in place
+    for frame, original in zip(frames, originals):
+        np.testing.assert_array_equal(frame, original)
@@ -0,0 +1,76 @@
+import glob
+import os
+from datetime import datetime
+
+import numpy as np
+from astropy.io import fits
+
+import bench_acquisition
+from frame_pipeline import frame_header_cards
+from frame_spool import SpoolReader, SpoolSink
+from spool_to_fits import convert_spools, record_meta
+
+
+def burst_metas():
+    '''
+    A three-frame burst with every header field, then a frame with the basic
+        keys only
+    '''
+    metas = [{'seq': 0, 'exp_index': 1, 'frame_index': n, 'burst_size': 3, 'exposure_us': 1234.5,
+              'timestamp': datetime(2024, 4, 8, 18, 33, 51, 123457 + n), 'frame_id': 100 + n,
+              'camera_ns': 2**40 + n, 'received': datetime(2024, 4, 8, 18, 33, 51, 999999),
+              'phase': 'totality', 'decimation': 2,
+              'exposure_control': {'scale': 0.5, 'step': 0.25, 'peak': 3000.1 if n == 0 else None,
+                                   'saturated': 1e-4}}
+             for n in range(3)]
+    metas.append({'seq': 1, 'exp_index': 0, 'frame_index': 0, 'burst_size': 1,
+                  'exposure_us': 10., 'timestamp': datetime(2024, 4, 8, 18, 33, 52)})
+    return metas
+
+
+def test_spool_round_trip_keeps_the_header(tmp_path):
+    metas = burst_metas()
+    # capacity 2: the burst straddles two segments
+    sink = SpoolSink(str(tmp_path), 'eclipse', 2)
+    for n, meta in enumerate(metas):
+        sink.write(np.full((4, 5), n, np.uint16), meta)
+    sink.close()
+    spools = [SpoolReader(path) for path in sorted(glob.glob(str(tmp_path / '*.spool')))]
+    assert len(spools) == 2
+    records = [(spool, record) for spool in spools for record in spool.records()]
+    assert len(records) == len(metas)
+    for n, ((spool, record), meta) in enumerate(zip(records, metas)):
+        assert frame_header_cards(record_meta(spool.index[record])) == frame_header_cards(meta)
+        np.testing.assert_array_equal(spool.frames[record], n)
+
+
+def run_pair(camera, tmp_path):
+    '''
+    The same run written as FITS frames and as a spool converted afterwards
+    '''
+    direct, spooled = str(tmp_path / 'frames'), str(tmp_path / 'spool')
+    for out_dir, mode in ((direct, 'frames'), (spooled, 'spool')):
+        os.makedirs(out_dir)
+        result = bench_acquisition.run_script('totality', out_dir, 2, 3,
+                                              settings={'OUTPUT_MODE': mode})
+        assert result['frames_written'] == 18
+    converted = os.path.join(spooled, 'fits')
+    assert convert_spools(sorted(glob.glob(os.path.join(spooled, '*.spool'))), converted,
+                          'frames', 1) == 18
+    return (sorted(glob.glob(os.path.join(direct, '*.fits'))),
+            sorted(glob.glob(os.path.join(converted, '*.fits'))))
+
+
+def test_spool_converts_to_the_frames_of_a_direct_run(camera, tmp_path):
+    direct, converted = run_pair(camera, tmp_path)
+    assert len(direct) == len(converted) == 18
+    for a, b in zip(direct, converted):
+        # the names differ only in the date of the run
+        assert os.path.basename(a).split('_')[-3:] == os.path.basename(b).split('_')[-3:]
+        with fits.open(a) as hdul_a, fits.open(b) as hdul_b:
+            header_a, header_b = hdul_a[0].header, hdul_b[0].header
+            assert list(header_a.keys()) == list(header_b.keys())
+            for key in header_a:
+                if key != 'DATE-OBS':
+                    assert header_a[key] == header_b[key], key
+            np.testing.assert_array_equal(hdul_a[0].data, hdul_b[0].data)
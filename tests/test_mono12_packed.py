@@ -0,0 +1,71 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+import bench_acquisition
+from mono12_packed import (PACKED_FORMATS, pack_mono12, packed_bytes, packed_tail,
+                           unpack_in_place, unpack_mono12)
+
+# p0 = 0xABC, p1 = 0x123 as the camera sends them
+KNOWN_BYTES = {'Mono12p': [0xBC, 0x3A, 0x12], 'Mono12Packed': [0xAB, 0x3C, 0x12]}
+
+
+def random_frame(shape, seed=0):
+    frame = np.random.default_rng(seed).integers(0, 4096, shape, dtype=np.uint16)
+    frame.reshape(-1)[:4] = (0, 4095, 4095, 0)
+    return frame
+
+
+@pytest.mark.parametrize('pixel_format', PACKED_FORMATS)
+def test_known_bytes(pixel_format):
+    packed = np.array(KNOWN_BYTES[pixel_format], dtype=np.uint8)
+    np.testing.assert_array_equal(pack_mono12(np.array([0xABC, 0x123], np.uint16), pixel_format),
+                                  packed)
+    out = unpack_mono12(packed, np.zeros(2, np.uint16), pixel_format)
+    np.testing.assert_array_equal(out, [0xABC, 0x123])
+
+
+@pytest.mark.parametrize('pixel_format', PACKED_FORMATS)
+@pytest.mark.parametrize('chunk_pairs', [1, 7, 1 << 14])
+def test_round_trip(pixel_format, chunk_pairs):
+    frame = random_frame((37, 50))
+    packed = pack_mono12(frame, pixel_format)
+    assert packed.size == packed_bytes(frame.size)
+    out = unpack_mono12(packed, np.empty_like(frame), pixel_format, chunk_pairs)
+    np.testing.assert_array_equal(out, frame)
+
+
+@pytest.mark.parametrize('pixel_format', PACKED_FORMATS)
+def test_unpack_in_place(pixel_format):
+    frame = random_frame((64, 96), seed=1)
+    slot = np.zeros_like(frame)
+    packed_tail(slot)[:] = pack_mono12(frame, pixel_format)
+    assert unpack_in_place(slot, pixel_format) is slot
+    np.testing.assert_array_equal(slot, frame)
+
+
+def test_unknown_format_and_odd_sizes_are_refused():
+    with pytest.raises(ValueError):
+        unpack_mono12(np.zeros(3, np.uint8), np.zeros(2, np.uint16), 'Mono10p')
+    with pytest.raises(ValueError):
+        packed_bytes(3)
+
+
+def run_frames(out_dir, pixel_format):
+    os.makedirs(out_dir)
+    result = bench_acquisition.run_script('totality', out_dir, 1, 2,
+                                          settings={'PIXEL_FORMAT': pixel_format})
+    assert result['frames_written'] == 6
+    return [fits.getdata(path) for path in sorted(glob.glob(os.path.join(out_dir, '*.fits')))]
+
+
+@pytest.mark.parametrize('pixel_format', PACKED_FORMATS)
+def test_packed_run_writes_the_mono12_frames(camera, tmp_path, pixel_format):
+    unpacked = run_frames(str(tmp_path / 'mono12'), 'Mono12')
+    packed = run_frames(str(tmp_path / pixel_format), pixel_format)
+    assert len(packed) == len(unpacked) == 6
+    for a, b in zip(unpacked, packed):
+        np.testing.assert_array_equal(a, b)
@@ -0,0 +1,50 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+import quicklook
+from quicklook import QuickLookPublisher, QuickLookReader, ring_name
+
+META = {'seq': 0, 'exp_index': 0, 'frame_index': 0, 'exposure_us': 1000.,
+        'timestamp': datetime(2024, 4, 8, 18, 33, 51)}
+
+
+@pytest.fixture(autouse=True)
+def same_process_reader(monkeypatch):
+    # reader and publisher share this process's resource tracker, which must
+    # keep the publisher's registration for its unlink()
+    monkeypatch.setattr(quicklook.resource_tracker, 'unregister', lambda name, rtype: None)
+
+
+def test_cameras_publish_to_their_own_rings():
+    publishers = [QuickLookPublisher(every=1, decimate=2, name=ring_name(f'TEST{n}'))
+                  for n in range(2)]
+    try:
+        for n, publisher in enumerate(publishers):
+            publisher.write(np.full((8, 12), n + 1, np.uint16), META)
+        for n in range(2):
+            reader = QuickLookReader(ring_name(f'TEST{n}')).attach()
+            record, frame = reader.newest()
+            assert frame.shape == (4, 6) and np.all(frame == n + 1)
+            reader.detach()
+    finally:
+        for publisher in publishers:
+            publisher.close()
+
+
+def test_a_ring_in_use_is_left_alone():
+    messages = []
+    first = QuickLookPublisher(every=1, name=ring_name('TESTX'))
+    second = QuickLookPublisher(every=1, name=ring_name('TESTX'), log=messages.append)
+    try:
+        first.write(np.full((8, 8), 7, np.uint16), META)
+        second.write(np.zeros((8, 8), np.uint16), META)
+        assert second.unavailable and second.published == 0 and len(messages) == 1
+        second.close()
+        # the first publisher's ring survived the second one
+        reader = QuickLookReader(ring_name('TESTX')).attach()
+        assert np.all(reader.newest()[1] == 7)
+        reader.detach()
+    finally:
+        first.close()